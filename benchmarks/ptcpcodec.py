@@ -0,0 +1,69 @@
+# Copyright 2005 Divmod, Inc.  See LICENSE file for details
+
+"""
+Measure how many PTCP packets per second can be created, encoded, decoded
+and verified.
+
+Usage: python benchmarks/ptcpcodec.py [seconds per measurement]
+"""
+
+from __future__ import print_function
+
+import sys
+import time
+
+from vertex import ptcp
+
+PEER = ('10.0.0.2', 4321)
+SIZES = [0, 64, ptcp.PTCPConnection.mtu]
+
+
+
+def measure(name, operation, duration):
+    """
+    Run C{operation} repeatedly for about C{duration} seconds, and report how
+    many times per second it ran.
+    """
+    count = 0
+    batch = 1000
+    start = time.time()
+    while True:
+        for i in xrange(batch):
+            operation()
+        count += batch
+        elapsed = time.time() - start
+        if elapsed >= duration:
+            break
+    print('%-32s %12.0f packets/s' % (name, count / elapsed))
+
+
+
+def create(data):
+    return ptcp.PTCPPacket.create(1, 2, 1000, 2000, data, ack=True,
+                                  destination=PEER)
+
+
+
+def main(duration=1.0):
+    for size in SIZES:
+        data = 'x' * size
+        packet = create(data)
+        encoded = packet.encode()
+        def send():
+            create(data).encode()
+        def receive():
+            ptcp.PTCPPacket.decode(encoded, PEER).verifyChecksum()
+        measure('send, %d octets' % (size,), send, duration)
+        measure('receive, %d octets' % (size,), receive, duration)
+    sacked = ptcp.PTCPPacket.create(1, 2, 1000, 2000, '', ack=True,
+                                    destination=PEER,
+                                    sackBlocks=[(3000, 4000), (5000, 6000)])
+    encoded = sacked.encode()
+    measure('receive, 2 SACK blocks',
+            lambda: ptcp.PTCPPacket.decode(encoded, PEER).verifyChecksum(),
+            duration)
+
+
+
+if __name__ == '__main__':
+    main(*[float(arg) for arg in sys.argv[1:]])
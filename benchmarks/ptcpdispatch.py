@@ -0,0 +1,96 @@
+# Copyright 2005 Divmod, Inc.  See LICENSE file for details
+
+"""
+Measure how many in-order data segments per second an established PTCP
+connection can take in, with and without the state machine's fast path.
+
+Usage: python benchmarks/ptcpdispatch.py [seconds per measurement]
+"""
+
+from __future__ import print_function
+
+import sys
+import time
+
+from twisted.internet import protocol, task
+
+from vertex import ptcp, tcpdfa
+
+PEER = ('10.0.0.2', 4321)
+SIZES = [1, 64, 1024]
+
+
+
+class NullTransport(object):
+    """
+    A UDP transport which discards everything written to it.
+    """
+    def write(self, datagram, addr):
+        pass
+
+
+    def stopListening(self):
+        pass
+
+
+
+def establish(proto, clock):
+    """
+    Have a peer connect to C{proto}, and complete the handshake.
+    """
+    proto.datagramReceived(
+        ptcp.PTCPPacket.create(2, 1, 0, 0, '', syn=True).encode(), PEER)
+    proto.datagramReceived(
+        ptcp.PTCPPacket.create(2, 1, 1, 1, '', ack=True).encode(), PEER)
+    clock.advance(1)
+    return proto._connections[(2, 1, PEER)]
+
+
+
+def measure(name, data, duration):
+    """
+    Deliver segments of C{data} to a new connection for about C{duration}
+    seconds, and report how many it took in per second.
+    """
+    clock = task.Clock()
+    ptcp.reactor = clock
+    factory = protocol.ServerFactory()
+    factory.protocol = protocol.Protocol
+    proto = ptcp.PTCP(factory)
+    proto.makeConnection(NullTransport())
+    conn = establish(proto, clock)
+
+    seq = 1
+    count = 0
+    batch = 1000
+    elapsed = 0.0
+    while elapsed < duration:
+        packets = []
+        for i in xrange(batch):
+            packets.append(ptcp.PTCPPacket.decode(
+                ptcp.PTCPPacket.create(2, 1, seq, 1, data,
+                                       ack=True).encode(), PEER))
+            seq += len(data)
+        start = time.time()
+        for packet in packets:
+            conn.packetReceived(packet)
+        elapsed += time.time() - start
+        count += batch
+        clock.advance(1)
+    print('%-32s %12.0f segments/s' % (name, count / elapsed))
+
+
+
+def main(duration=1.0):
+    for size in SIZES:
+        data = 'x' * size
+        for fastPath in [False, True]:
+            tcpdfa.TCP.fastPath = fastPath
+            measure('%d octets, %s' % (size, fastPath and 'fast path'
+                                       or 'state machine'),
+                    data, duration)
+
+
+
+if __name__ == '__main__':
+    main(*[float(arg) for arg in sys.argv[1:]])
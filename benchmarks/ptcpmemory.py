@@ -0,0 +1,119 @@
+# Copyright 2005 Divmod, Inc.  See LICENSE file for details
+
+"""
+Measure how much memory an idle PTCP connection, and a segment queued for
+retransmission, take up.
+
+Usage: python benchmarks/ptcpmemory.py [connections]
+"""
+
+from __future__ import print_function
+
+import gc
+import sys
+import types
+
+from twisted.internet import protocol, task
+
+from vertex import ptcp
+
+PEER = ('10.0.0.2', 4321)
+
+# Objects of these types are shared between connections, not owned by any.
+_shared = (type, types.ModuleType, types.FunctionType, types.ClassType,
+           types.BuiltinFunctionType, types.MethodType)
+
+
+
+class NullTransport(object):
+    """
+    A UDP transport which discards everything written to it.
+    """
+    def write(self, datagram, addr):
+        pass
+
+
+    def stopListening(self):
+        pass
+
+
+
+def reachable(roots):
+    """
+    Find the ids of all the objects reachable from C{roots}.
+    """
+    seen = set()
+    pending = list(roots)
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen or isinstance(obj, _shared):
+            continue
+        seen.add(id(obj))
+        pending.extend(gc.get_referents(obj))
+    return seen
+
+
+
+def footprint(roots, exclude):
+    """
+    Add up the sizes of all the objects reachable from C{roots} whose ids are
+    not in C{exclude}.
+    """
+    seen = set(exclude)
+    total = 0
+    pending = list(roots)
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen or isinstance(obj, _shared):
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        pending.extend(gc.get_referents(obj))
+    return total
+
+
+
+def establish(proto, sourcePort):
+    """
+    Have a peer connect to C{proto}, and complete the handshake.
+    """
+    proto.datagramReceived(
+        ptcp.PTCPPacket.create(sourcePort, 1, 0, 0, '', syn=True).encode(),
+        PEER)
+    conn = proto._connections[(sourcePort, 1, PEER)]
+    proto.datagramReceived(
+        ptcp.PTCPPacket.create(sourcePort, 1, 1, 1, '', ack=True).encode(),
+        PEER)
+    return conn
+
+
+
+def main(count=1000):
+    clock = task.Clock()
+    ptcp.reactor = clock
+    factory = protocol.ServerFactory()
+    factory.protocol = protocol.Protocol
+    proto = ptcp.PTCP(factory)
+    proto.makeConnection(NullTransport())
+    clock.advance(0)
+    baseline = reachable([proto, factory, clock])
+
+    connections = [establish(proto, port) for port in range(2, count + 2)]
+    clock.advance(1)
+    perConnection = footprint(connections, baseline) / float(count)
+    print('%-40s %8.0f bytes' % ('idle connection', perConnection))
+
+    conn = connections[0]
+    conn.sendWindow = conn.congestion.congestionWindow = 1 << 30
+    baseline = reachable([proto, factory, clock])
+    conn.write('x' * (count * conn.mtu))
+    clock.advance(1)
+    segments = list(conn.retransmissionQueue)
+    perSegment = footprint(segments, baseline) / float(len(segments))
+    print('%-40s %8.0f bytes' % ('queued segment, less its data',
+                                 perSegment - conn.mtu))
+
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,140 @@
+# Copyright 2005 Divmod, Inc.  See LICENSE file for details
+
+"""
+Measure how PTCP bulk transfers fare over simulated networks with various
+conditions: how fast the data gets through (goodput) and how long it takes,
+in simulated time; how much of what was sent had been sent before; and how
+much CPU time it took per octet transferred.
+
+Every run of a scenario with the same seed simulates exactly the same thing,
+so only the CPU time varies from one run to the next.
+
+Usage: python benchmarks/ptcpsim.py [octets per transfer [seed]]
+"""
+
+from __future__ import print_function
+
+import sys
+import time
+
+from twisted.internet import protocol
+
+from vertex import ptcp
+from vertex.netsim import Network
+
+CLIENT = '10.0.0.1'
+SERVER = '10.0.0.2'
+PORT = 5000
+
+SCENARIOS = [
+    ('clean LAN', dict(delay=0.0002, bandwidth=12500000)),
+    ('broadband', dict(delay=0.015, jitter=0.002, bandwidth=2500000,
+                       queueLimit=64)),
+    ('lossy Wi-Fi', dict(delay=0.005, jitter=0.003, bandwidth=2500000,
+                         loss=0.02, reordering=0.01, duplication=0.005)),
+    ('cellular', dict(delay=0.04, jitter=0.02, bandwidth=625000, loss=0.05,
+                      reordering=0.02, queueLimit=32)),
+    ('long fat pipe', dict(delay=0.1, bandwidth=12500000, queueLimit=256)),
+    ('small MTU', dict(delay=0.005, bandwidth=2500000, mtu=576)),
+    ]
+
+
+
+class Sink(protocol.Protocol):
+    """
+    Count the octets received, and note when the last of them arrives.
+    """
+    received = 0
+    finished = None
+
+    def __init__(self, clock, expected):
+        self.clock = clock
+        self.expected = expected
+
+
+    def dataReceived(self, data):
+        self.received += len(data)
+        if self.received >= self.expected and self.finished is None:
+            self.finished = self.clock.seconds()
+
+
+
+class Source(protocol.Protocol):
+    """
+    Write all the data to transfer as soon as the connection is made.
+    """
+    def __init__(self, data):
+        self.data = data
+
+
+    def connectionMade(self):
+        self.transport.write(self.data)
+
+
+
+def transfer(conditions, size, seed, **settings):
+    """
+    Send C{size} octets from a client to a server across a simulated network.
+
+    @param settings: L{ptcp.PTCPConnection} attributes to override for the
+        transfer.
+
+    @return: A C{dict} of measurements.
+    """
+    network = Network(seed=seed, **conditions)
+    clock = network.clock
+    saved = {}
+    for name, value in settings.items():
+        saved[name] = getattr(ptcp.PTCPConnection, name)
+        setattr(ptcp.PTCPConnection, name, value)
+
+    sent = [0]
+    def monitor(datagram):
+        sent[0] += len(ptcp.PTCPPacket.decode(datagram, None).data)
+    network.link(CLIENT, SERVER).monitor = monitor
+
+    sink = Sink(clock, size)
+    factory = protocol.ServerFactory()
+    factory.protocol = lambda: sink
+    network.listenUDP(PORT, ptcp.PTCP(factory, reactor=network), SERVER)
+    client = ptcp.PTCP(None, reactor=network)
+    network.listenUDP(0, client, CLIENT)
+    factory = protocol.ClientFactory()
+    factory.protocol = lambda: Source('x' * size)
+
+    cpu = time.clock()
+    try:
+        client.connect(factory, SERVER, PORT)
+        network.runUntil(lambda: sink.finished is not None, 3600)
+    finally:
+        cpu = time.clock() - cpu
+        for name, value in saved.items():
+            setattr(ptcp.PTCPConnection, name, value)
+
+    if sink.finished is None:
+        return None
+    return dict(
+        goodput=size / sink.finished,
+        completion=sink.finished,
+        retransmitted=(sent[0] - size) / float(sent[0]),
+        cpu=cpu / size)
+
+
+
+def main(size=1000000, seed=0):
+    print('%-16s %14s %12s %14s %14s' % (
+            'scenario', 'goodput (B/s)', 'time (s)', 'retransmitted',
+            'CPU (us/B)'))
+    for name, conditions in SCENARIOS:
+        result = transfer(conditions, size, seed)
+        if result is None:
+            print('%-16s %14s' % (name, 'did not finish'))
+            continue
+        print('%-16s %14.0f %12.3f %13.2f%% %14.3f' % (
+                name, result['goodput'], result['completion'],
+                result['retransmitted'] * 100, result['cpu'] * 1e6))
+
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,292 @@
+# -*- test-case-name: vertex.test.test_batchudp -*-
+# Copyright 2005 Divmod, Inc.  See LICENSE file for details
+
+"""
+UDP ports which hand datagrams to and from the kernel in batches.
+
+On Linux, C{sendmmsg(2)} and C{recvmmsg(2)} let one system call send or
+receive many datagrams; at high packet rates that matters a great deal more
+than anything we do with the datagrams ourselves.  L{BatchedUDPPort} uses them
+where it can and falls back to one system call per datagram, exactly like
+L{twisted.internet.udp.Port}, everywhere else.
+"""
+
+import os
+import sys
+import socket
+import struct
+from errno import EINTR, ENOSYS
+
+from twisted.internet import udp, abstract
+from twisted.internet.interfaces import IReactorFDSet
+from twisted.python import log
+
+try:
+    import ctypes
+    import ctypes.util
+except ImportError:
+    ctypes = None
+
+_MSG_DONTWAIT = 0x40
+
+
+
+def _loadSystemCalls():
+    """
+    Find C{sendmmsg} and C{recvmmsg} in the C library.
+
+    @return: A two-tuple of the C{sendmmsg} and C{recvmmsg} functions, either
+        of which is C{None} if it isn't available.
+    """
+    if ctypes is None or not sys.platform.startswith('linux'):
+        return None, None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except OSError:
+        return None, None
+    sendmmsg = getattr(libc, 'sendmmsg', None)
+    if sendmmsg is not None:
+        sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_mmsghdr),
+                             ctypes.c_uint, ctypes.c_int]
+        sendmmsg.restype = ctypes.c_int
+    recvmmsg = getattr(libc, 'recvmmsg', None)
+    if recvmmsg is not None:
+        recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_mmsghdr),
+                             ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+        recvmmsg.restype = ctypes.c_int
+    return sendmmsg, recvmmsg
+
+
+
+if ctypes is not None:
+    class _iovec(ctypes.Structure):
+        _fields_ = [('iov_base', ctypes.c_void_p),
+                    ('iov_len', ctypes.c_size_t)]
+
+
+    class _msghdr(ctypes.Structure):
+        _fields_ = [('msg_name', ctypes.c_void_p),
+                    ('msg_namelen', ctypes.c_uint32),
+                    ('msg_iov', ctypes.POINTER(_iovec)),
+                    ('msg_iovlen', ctypes.c_size_t),
+                    ('msg_control', ctypes.c_void_p),
+                    ('msg_controllen', ctypes.c_size_t),
+                    ('msg_flags', ctypes.c_int)]
+
+
+    class _mmsghdr(ctypes.Structure):
+        _fields_ = [('msg_hdr', _msghdr),
+                    ('msg_len', ctypes.c_uint)]
+
+
+    class _sockaddr_in(ctypes.Structure):
+        # sin_port and sin_addr are in network byte order.
+        _fields_ = [('sin_family', ctypes.c_ushort),
+                    ('sin_port', ctypes.c_uint16),
+                    ('sin_addr', ctypes.c_uint32),
+                    ('sin_zero', ctypes.c_char * 8)]
+
+
+_sendmmsg, _recvmmsg = _loadSystemCalls()
+batchingSupported = _sendmmsg is not None or _recvmmsg is not None
+
+
+
+class BatchedUDPPort(udp.Port):
+    """
+    A UDP port which sends and receives many IPv4 datagrams per system call.
+
+    @ivar batchSize: The largest number of datagrams handed to or taken from
+        the kernel at once.
+
+    @ivar _batchSend: The C{sendmmsg} function, or C{None} if datagrams have
+        to be sent one at a time.
+
+    @ivar _batchReceive: The C{recvmmsg} function, or C{None} if datagrams
+        have to be received one at a time.
+
+    @ivar _receiving: C{None}, or, once the first batch has been read, the
+        structures C{recvmmsg} reads datagrams into, as returned by
+        L{_allocateReceiveBuffers}.
+    """
+    batchSize = 64
+
+    _batchSend = _sendmmsg
+    _batchReceive = _recvmmsg
+    _receiving = None
+
+    def writeBatch(self, datagrams):
+        """
+        Write several datagrams, each to its own address.
+
+        Any datagram the kernel won't take as part of a batch is written with
+        L{write}, which deals with errors just as it would have had it been
+        written on its own.
+
+        @param datagrams: A sequence of two-tuples of a datagram and the
+            C{(host, port)} to send it to.
+        """
+        datagrams = list(datagrams)
+        while datagrams:
+            sent = 0
+            if (self._batchSend is not None and self._connectedAddr is None
+                and self.addressFamily == socket.AF_INET):
+                sent = self._sendBatch(datagrams[:self.batchSize])
+            if not sent:
+                datagram, addr = datagrams[0]
+                self.write(datagram, addr)
+                sent = 1
+            del datagrams[:sent]
+
+
+    def _sendBatch(self, datagrams):
+        """
+        Send as many of C{datagrams} as the kernel will take with a single
+        C{sendmmsg} call.
+
+        @return: The number of datagrams sent, from the front of
+            C{datagrams}; C{0} if the first could not be sent this way.
+        """
+        count = 0
+        for datagram, (host, port) in datagrams:
+            if not abstract.isIPAddress(host):
+                break
+            count += 1
+        if not count:
+            return 0
+        messages = (_mmsghdr * count)()
+        addresses = (_sockaddr_in * count)()
+        vectors = (_iovec * count)()
+        buffers = []
+        for i, (datagram, (host, port)) in enumerate(datagrams[:count]):
+            address = addresses[i]
+            address.sin_family = socket.AF_INET
+            address.sin_port = socket.htons(port)
+            address.sin_addr = struct.unpack('=I', socket.inet_aton(host))[0]
+            # The kernel only reads from this, so the string itself will do.
+            buf = ctypes.c_char_p(datagram)
+            buffers.append(buf)
+            vectors[i].iov_base = ctypes.cast(buf, ctypes.c_void_p)
+            vectors[i].iov_len = len(datagram)
+            header = messages[i].msg_hdr
+            header.msg_name = ctypes.addressof(address)
+            header.msg_namelen = ctypes.sizeof(_sockaddr_in)
+            header.msg_iov = ctypes.pointer(vectors[i])
+            header.msg_iovlen = 1
+        while True:
+            sent = self._batchSend(self.socket.fileno(), messages, count, 0)
+            if sent >= 0:
+                return sent
+            no = ctypes.get_errno()
+            if no != EINTR:
+                break
+        if no == ENOSYS:
+            self._batchSend = None
+        return 0
+
+
+    def doRead(self):
+        """
+        Called when my socket is ready for reading; read datagrams from it in
+        batches until it is drained or C{maxThroughput} octets have been read.
+        """
+        if (self._batchReceive is None
+            or self.addressFamily != socket.AF_INET):
+            return udp.Port.doRead(self)
+        read = 0
+        while read < self.maxThroughput:
+            try:
+                datagrams = self._receiveBatch()
+            except socket.error as se:
+                no = se.args[0]
+                if no == ENOSYS:
+                    self._batchReceive = None
+                    return udp.Port.doRead(self)
+                if no in udp._sockErrReadIgnore:
+                    return
+                if no in udp._sockErrReadRefuse:
+                    if self._connectedAddr:
+                        self.protocol.connectionRefused()
+                    return
+                raise
+            for data, addr in datagrams:
+                read += len(data)
+                try:
+                    self.protocol.datagramReceived(data, addr)
+                except:
+                    log.err()
+            if len(datagrams) < self.batchSize:
+                # Had there been more, the kernel would have handed them over.
+                return
+
+
+    def _receiveBatch(self):
+        """
+        Read up to C{batchSize} datagrams with a single C{recvmmsg} call.
+
+        @raise socket.error: If the call fails.
+
+        @return: A C{list} of two-tuples of a datagram and the C{(host, port)}
+            it came from.
+        """
+        if self._receiving is None:
+            self._receiving = self._allocateReceiveBuffers()
+        messages, addresses, vectors, buffers = self._receiving
+        for message in messages:
+            message.msg_hdr.msg_namelen = ctypes.sizeof(_sockaddr_in)
+        while True:
+            count = self._batchReceive(self.socket.fileno(), messages,
+                                       self.batchSize, _MSG_DONTWAIT, None)
+            if count >= 0:
+                break
+            no = ctypes.get_errno()
+            if no != EINTR:
+                raise socket.error(no, os.strerror(no))
+        datagrams = []
+        for i in range(count):
+            data = ctypes.string_at(buffers[i], messages[i].msg_len)
+            address = addresses[i]
+            host = socket.inet_ntoa(struct.pack('=I', address.sin_addr))
+            datagrams.append((data, (host, socket.ntohs(address.sin_port))))
+        return datagrams
+
+
+    def _allocateReceiveBuffers(self):
+        """
+        Set up the structures C{recvmmsg} reads datagrams into.
+
+        @return: A four-tuple of the C{mmsghdr} array, the source address
+            array, the C{iovec} array the headers point to, and a C{list} of
+            buffers, C{maxPacketSize} octets each.
+        """
+        count = self.batchSize
+        messages = (_mmsghdr * count)()
+        addresses = (_sockaddr_in * count)()
+        vectors = (_iovec * count)()
+        buffers = [ctypes.create_string_buffer(self.maxPacketSize)
+                   for i in range(count)]
+        for i in range(count):
+            vectors[i].iov_base = ctypes.addressof(buffers[i])
+            vectors[i].iov_len = self.maxPacketSize
+            header = messages[i].msg_hdr
+            header.msg_name = ctypes.addressof(addresses[i])
+            header.msg_iov = ctypes.pointer(vectors[i])
+            header.msg_iovlen = 1
+        return messages, addresses, vectors, buffers
+
+
+
+def listenUDP(port, protocol, interface='', maxPacketSize=8192, reactor=None):
+    """
+    Like L{IReactorUDP.listenUDP}, but with a L{BatchedUDPPort} wherever
+    batched I/O is supported and C{reactor} deals in file descriptors.
+
+    @return: An L{IListeningPort} provider; a L{BatchedUDPPort} if possible.
+    """
+    if reactor is None:
+        from twisted.internet import reactor
+    if not (batchingSupported and IReactorFDSet.providedBy(reactor)):
+        return reactor.listenUDP(port, protocol, interface, maxPacketSize)
+    p = BatchedUDPPort(port, protocol, interface, maxPacketSize, reactor)
+    p.startListening()
+    return p
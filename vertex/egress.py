@@ -0,0 +1,193 @@
+# -*- test-case-name: vertex.test.test_egress -*-
+# Copyright 2005 Divmod, Inc.  See LICENSE file for details
+
+"""
+Scheduling of the datagrams many flows send out of one UDP port.
+
+Left to themselves, flows sharing a port take turns at it in whatever order
+they happen to send, so one which sends a great deal at once holds up all the
+others behind it.  L{EgressScheduler} queues each flow's datagrams separately
+and takes them from the flows in turn (deficit round robin, after Shreedhar
+and Varghese), spacing them out so that the port as a whole keeps within its
+bandwidth limit, if it has one.
+"""
+
+from collections import deque
+
+
+
+class _Flow(object):
+    """
+    The datagrams waiting to be sent for one flow.
+
+    @ivar key: The flow's key in L{EgressScheduler._flows}.
+
+    @ivar queue: A C{deque} of two-tuples of a datagram and its address.
+
+    @ivar deficit: The number of octets the flow may still send in this turn
+        of the round robin.
+    """
+    __slots__ = ('key', 'queue', 'deficit')
+
+    def __init__(self, key):
+        self.key = key
+        self.queue = deque()
+        self.deficit = 0
+
+
+
+class EgressScheduler(object):
+    """
+    Queue datagrams by flow, and write them to a transport in a fair order,
+    no faster than the port's bandwidth limit allows.
+
+    Datagrams which may go right away are written the next time the reactor
+    gets round to it, all in one batch, as L{vertex.ptcp.PTCP} has always
+    written them; the rest are written as the bandwidth limit allows.
+
+    @ivar quantum: The number of octets each flow is allowed to send on each
+        of its turns; a datagram is only held back for another turn if it
+        would take the flow over its allowance.
+
+    @ivar horizon: The number of seconds' worth of C{bandwidthLimit} the port
+        may send in a burst, to catch up on time lost to the reactor running
+        late.
+
+    @ivar flowLimit: The most datagrams a flow may have waiting; any more are
+        dropped, as a router's would be, so that the flow's congestion control
+        finds out it is sending faster than the port can.
+
+    @ivar bandwidthLimit: The most octets per second the port may send, or
+        C{None}, for no limit.
+
+    @ivar dropped: The number of datagrams dropped for want of room in their
+        flow's queue.
+
+    @ivar _write: The callable which writes a C{list} of two-tuples of a
+        datagram and its address to the transport.
+
+    @ivar _flows: A C{dict} mapping flow keys to the L{_Flow}s which have
+        datagrams queued.
+
+    @ivar _active: A C{deque} of the same L{_Flow}s, in the order they will
+        get their turns.
+
+    @ivar _nextSend: The time before which the port may not send anything
+        more, if it has a bandwidth limit.
+
+    @ivar _timer: C{None}, or the L{IDelayedCall} which will send whatever
+        may be sent next.
+    """
+    quantum = 1500
+    horizon = 0.002
+    flowLimit = 100
+
+    def __init__(self, reactor, write, bandwidthLimit=None):
+        """
+        @param reactor: The L{IReactorTime} provider to space datagrams out
+            with.
+
+        @param write: The callable to write batches of datagrams with.
+
+        @param bandwidthLimit: The initial value of C{bandwidthLimit}.
+        """
+        self._reactor = reactor
+        self._write = write
+        self.bandwidthLimit = bandwidthLimit
+        self.dropped = 0
+        self._flows = {}
+        self._active = deque()
+        self._nextSend = reactor.seconds()
+        self._timer = None
+
+
+    def enqueue(self, key, datagram, address):
+        """
+        Queue a datagram to be sent as part of a flow.
+
+        @param key: A hashable object identifying the flow.
+        """
+        flow = self._flows.get(key)
+        if flow is None:
+            flow = self._flows[key] = _Flow(key)
+            self._active.append(flow)
+        elif len(flow.queue) >= self.flowLimit:
+            self.dropped += 1
+            return
+        flow.queue.append((datagram, address))
+        if self._timer is None:
+            self._timer = self._reactor.callLater(0, self._send)
+
+
+    def pending(self):
+        """
+        @return: The number of datagrams waiting to be sent.
+        """
+        return sum(len(flow.queue) for flow in self._active)
+
+
+    def flush(self):
+        """
+        Write every waiting datagram right away, however fast that is.
+        """
+        self._cancel()
+        datagrams = []
+        for flow in self._active:
+            datagrams.extend(flow.queue)
+        self._active.clear()
+        self._flows.clear()
+        if datagrams:
+            self._write(datagrams)
+
+
+    def discard(self):
+        """
+        Throw away every waiting datagram.
+        """
+        self._cancel()
+        self._active.clear()
+        self._flows.clear()
+
+
+    def _cancel(self):
+        if self._timer is not None:
+            if self._timer.active():
+                self._timer.cancel()
+            self._timer = None
+
+
+    def _send(self):
+        """
+        Write, in one batch, every datagram which may be sent now, taking them
+        from each flow in turn; then arrange to be called again when the next
+        of those held back may be sent.
+        """
+        self._timer = None
+        now = self._reactor.seconds()
+        limit = self.bandwidthLimit
+        active = self._active
+        datagrams = []
+        while active and (limit is None or self._nextSend <= now):
+            flow = active[0]
+            flow.deficit += self.quantum
+            queue = flow.queue
+            while queue and len(queue[0][0]) <= flow.deficit:
+                datagram = queue.popleft()
+                size = len(datagram[0])
+                datagrams.append(datagram)
+                flow.deficit -= size
+                if limit is not None:
+                    self._nextSend = (max(self._nextSend, now - self.horizon)
+                                      + size / float(limit))
+                    if self._nextSend > now:
+                        break
+            if queue:
+                active.rotate(-1)
+            else:
+                active.popleft()
+                del self._flows[flow.key]
+        if datagrams:
+            self._write(datagrams)
+        if active:
+            self._timer = self._reactor.callLater(
+                max(0, self._nextSend - now), self._send)
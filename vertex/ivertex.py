@@ -1,6 +1,6 @@
 # Copyright 2005 Divmod, Inc.  See LICENSE file for details
 
-from zope.interface import Interface
+from zope.interface import Interface, Attribute
 
 class IQ2QTransport(Interface):
     """
@@ -69,6 +69,50 @@ class IQ2QUserStore(Interface):
         """
 
 
+
+class ICongestionControl(Interface):
+    """
+    A congestion control algorithm, deciding how much data a single PTCP
+    connection may have unacknowledged in the network at once.
+    """
+
+    maximumSegmentSize = Attribute(
+        "The largest number of octets the connection will put in a single "
+        "segment.  The connection updates this as it learns about its path.")
+
+    congestionWindow = Attribute(
+        "The number of octets of sequence space which may currently be "
+        "unacknowledged.")
+
+    def acknowledged(octets):
+        """
+        Some data which was in flight has been acknowledged by the peer.
+
+        @param octets: The amount of sequence space newly acknowledged.
+        @type octets: L{int}
+        """
+
+    def timedOut(inFlight):
+        """
+        The retransmission timer expired, so everything in flight is presumed
+        to have been lost.
+
+        @param inFlight: The amount of sequence space which was
+            unacknowledged when the timer expired.
+        @type inFlight: L{int}
+        """
+
+    def lost(inFlight):
+        """
+        Duplicate acknowledgements from the peer indicate that a single segment
+        was lost, and it is being retransmitted; the segments after it are
+        still arriving.
+
+        @param inFlight: The amount of sequence space which is unacknowledged.
+        @type inFlight: L{int}
+        """
+
+
 class IFileTransfer(Interface):
 
     def getUploadSink(self, path):
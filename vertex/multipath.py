@@ -0,0 +1,619 @@
+# -*- test-case-name: vertex.test.test_multipath -*-
+# Copyright 2005 Divmod, Inc.  See LICENSE file for details
+
+"""
+One stream striped across several connections between the same two peers.
+
+A L{MultipathTransport} gives its protocol a single ordered stream, and
+carries it over as many L{Subflow}s as happen to be connected: in
+L{vertex.q2q}, every path to the peer on which a connection attempt succeeds.
+Each subflow is a connection in its own right, with its own congestion
+control; the stream is cut into chunks, and each chunk goes to whichever
+subflow has the most room in its congestion window for it, so faster paths
+carry more of the stream and a path which degrades carries less.
+
+Chunks are framed with their offset in the stream, and the receiving end puts
+them back in order before delivering them.  It acknowledges each chunk it
+receives, and the sender keeps every chunk until it is acknowledged, so that
+if a subflow is lost, what was in flight on it is sent again on the others.
+A chunk which goes unacknowledged for several of its subflow's round trips is
+sent again on another subflow too, and the subflow it was late on is given
+nothing more until it acknowledges something again.
+Acknowledgements also say how much of the stream has been delivered to the
+protocol, which limits how far ahead of that the sender may get.
+
+Each end says where its stream ends once all of it has been acknowledged,
+and the subflows are only closed once both ends have, so that losing the
+connection at one end doesn't cut off what the other is still sending.
+"""
+
+import heapq
+import struct
+
+from zope.interface import implementer
+
+from twisted.internet import error, interfaces, protocol
+from twisted.internet.main import CONNECTION_DONE
+from twisted.python import log
+from twisted.python.failure import Failure
+
+from vertex.ptcp import _SendBuffer
+
+# Every frame starts with its kind, a stream offset, and the length of what
+# follows.  DATA frames carry a chunk of the stream starting at their offset.
+# ACK frames carry how much of the stream has been delivered, and the offsets
+# of the DATA frames being acknowledged.  A FIN frame's offset is the length
+# of the whole stream.
+_DATA, _ACK, _FIN = range(3)
+_header = struct.Struct('!BQI')
+_ackedOffset = struct.Struct('!Q')
+
+
+
+class _Chunk(object):
+    """
+    A chunk of the stream which has been sent but not acknowledged.
+
+    @ivar data: The chunk's octets.
+
+    @ivar subflow: The L{Subflow} the chunk was last sent on, or C{None} if
+        that was lost, or the chunk was overdue on it, and the chunk is
+        waiting to be sent again.
+
+    @ivar timer: The L{IDelayedCall} by which the chunk is overdue on
+        C{subflow}, or C{None}.
+    """
+    __slots__ = ('data', 'subflow', 'timer')
+
+    def __init__(self, data, subflow):
+        self.data = data
+        self.subflow = subflow
+        self.timer = None
+
+
+    def stopTimer(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+
+
+class Subflow(protocol.Protocol):
+    """
+    One of the connections a L{MultipathTransport}'s stream is carried over.
+
+    @ivar multipath: The L{MultipathTransport} this is a subflow of.
+
+    @ivar inflight: The number of octets of the stream sent on this subflow
+        which have not been acknowledged.
+
+    @ivar closing: Whether the subflow has been told to close; nothing more
+        is sent on it once it has.
+
+    @ivar overdue: Whether a chunk sent on this subflow went unacknowledged
+        for too long; nothing more is sent on it until it acknowledges
+        something again.
+
+    @ivar _buffer: Received octets which do not yet make up a whole frame.
+    """
+
+    def __init__(self, multipath):
+        self.multipath = multipath
+        self.inflight = 0
+        self.closing = False
+        self.overdue = False
+        self._buffer = ''
+
+
+    def connectionMade(self):
+        self.multipath._subflowConnected(self)
+
+
+    def dataReceived(self, data):
+        buf = self._buffer + data
+        start = 0
+        acked = []
+        while len(buf) - start >= _header.size:
+            kind, offset, length = _header.unpack_from(buf, start)
+            end = start + _header.size + length
+            if len(buf) < end:
+                break
+            payload = buf[start + _header.size:end]
+            start = end
+            if kind == _DATA:
+                acked.append(offset)
+                self.multipath._dataReceived(offset, payload)
+            elif kind == _ACK:
+                self.multipath._ackReceived(self, offset, [
+                        _ackedOffset.unpack_from(payload, i)[0]
+                        for i in range(0, len(payload), _ackedOffset.size)])
+            elif kind == _FIN:
+                self.multipath._finReceived(offset)
+            else:
+                log.msg("Unknown multipath frame kind %d; dropping %r"
+                        % (kind, self.transport))
+                self.close()
+                return
+        self._buffer = buf[start:]
+        if acked:
+            self.acknowledge(acked)
+
+
+    def connectionLost(self, reason):
+        self.multipath._subflowLost(self, reason)
+
+
+    def window(self):
+        """
+        Find out how many octets this subflow may have in flight.
+
+        @return: The lesser of the congestion window and the peer's receive
+            window of the connection underneath, if its transport counts
+            them, or the multipath transport's C{defaultWindow} if not.
+        """
+        getStatistics = getattr(self.transport, 'getStatistics', None)
+        if getStatistics is None:
+            return self.multipath.defaultWindow
+        stats = getStatistics()
+        default = self.multipath.defaultWindow
+        return min(stats.get('congestionWindow', default),
+                   stats.get('sendWindow', default))
+
+
+    def chunkTimeout(self):
+        """
+        Find out how long a chunk sent on this subflow may go unacknowledged.
+
+        @return: C{rttMultiple} times the round trip time of the connection
+            underneath plus four times its variance, if its transport
+            measures them, but no less than C{minimumChunkTimeout}; or the
+            multipath transport's C{defaultChunkTimeout} if not.
+        """
+        getStatistics = getattr(self.transport, 'getStatistics', None)
+        if getStatistics is None:
+            return self.multipath.defaultChunkTimeout
+        stats = getStatistics()
+        rtt = stats.get('smoothedRTT')
+        if rtt is None:
+            return self.multipath.defaultChunkTimeout
+        return max(self.multipath.minimumChunkTimeout,
+                   self.multipath.rttMultiple
+                   * (rtt + 4 * (stats.get('rttVariance') or 0)))
+
+
+    def room(self):
+        """
+        Find out how many more octets of the stream this subflow should be
+        given now.
+        """
+        room = self.window() - self.inflight
+        if not self.inflight:
+            # An idle subflow may always send something, so that one whose
+            # window looks shut finds out when it opens again.
+            room = max(room, self.multipath.chunkSize)
+        return room
+
+
+    def sendFrame(self, kind, offset, payload=''):
+        if not self.closing:
+            self.transport.writeSequence(
+                [_header.pack(kind, offset, len(payload)), payload])
+
+
+    def close(self):
+        if not self.closing:
+            self.closing = True
+            self.transport.loseConnection()
+
+
+    def acknowledge(self, offsets=()):
+        """
+        Acknowledge chunks of the stream, and tell the sender how much of it
+        has been delivered.
+
+        @param offsets: The offsets of the chunks being acknowledged.
+        """
+        self.sendFrame(_ACK, self.multipath._delivered, ''.join(
+                [_ackedOffset.pack(offset) for offset in offsets]))
+
+
+
+class SubflowFactory(protocol.ClientFactory):
+    """
+    Build L{Subflow}s for a L{MultipathTransport}.
+    """
+
+    def __init__(self, multipath):
+        self.multipath = multipath
+
+
+    def buildProtocol(self, addr):
+        return Subflow(self.multipath)
+
+
+
+@implementer(interfaces.ITransport, interfaces.IConsumer,
+             interfaces.IPushProducer)
+class MultipathTransport(object):
+    """
+    A transport for a stream striped across the L{Subflow}s connected to it.
+
+    The protocol is built, and connected to the stream, when the first
+    subflow connects; it is disconnected when the last subflow is lost.
+
+    @ivar chunkSize: The largest chunk of the stream given to one subflow at
+        once.
+
+    @ivar defaultWindow: How many octets a subflow whose transport doesn't
+        count them may have in flight.
+
+    @ivar streamWindow: How many octets beyond what has been delivered to the
+        protocol at the other end may be sent.
+
+    @ivar bufferSize: How many octets waiting to be sent pause a streaming
+        producer.
+
+    @ivar rttMultiple: How many of its subflow's round trips a chunk may go
+        unacknowledged before it is overdue.
+
+    @ivar minimumChunkTimeout: The least time a chunk may go unacknowledged
+        before it is overdue.
+
+    @ivar defaultChunkTimeout: How long a chunk may go unacknowledged on a
+        subflow whose transport doesn't measure its round trip time.
+
+    @ivar factory: The factory the protocol is built with.
+
+    @ivar addr: The address the protocol is built for.
+
+    @ivar _reactor: The L{IReactorTime} provider chunks are timed by.
+
+    @ivar protocol: The protocol, once the first subflow has connected.
+
+    @ivar subflows: The L{Subflow}s which are connected, earliest first.
+
+    @ivar _primary: The transport of the first subflow connected, whose
+        addresses are the stream's.
+
+    @ivar _pending: A L{_SendBuffer} of what has been written but not sent.
+
+    @ivar _nextOffset: The stream offset of the first octet in C{_pending}.
+
+    @ivar _unacked: A C{dict} mapping the offsets of chunks sent but not
+        acknowledged to their L{_Chunk}s.
+
+    @ivar _resend: A heap of the offsets of chunks in C{_unacked} which were
+        sent on a subflow since lost, or were overdue, and have to be sent
+        again.
+
+    @ivar _peerDelivered: How much of the stream has been delivered to the
+        protocol at the other end, as far as we know.
+
+    @ivar _delivered: How much of the peer's stream has been delivered to our
+        protocol.
+
+    @ivar _reassembly: A C{dict} mapping the offsets of chunks received ahead
+        of C{_delivered}, or while paused, to their octets.
+
+    @ivar _finalOffset: The length of the peer's stream, once it has said it
+        is done, or C{None}.
+
+    @ivar _finSent: Whether we have said we are done.
+
+    @ivar _paused: Whether delivery to the protocol is paused.
+    """
+    chunkSize = 16384
+    defaultWindow = 65536
+    streamWindow = 1 << 20
+    bufferSize = 65536
+    rttMultiple = 4
+    minimumChunkTimeout = 0.2
+    defaultChunkTimeout = 2.0
+
+    protocol = None
+    producer = None
+    streamingProducer = False
+    producerPaused = False
+
+    disconnecting = False
+    disconnected = False
+
+    def __init__(self, factory, addr, reactor=None):
+        """
+        @param reactor: The L{IReactorTime} provider to time chunks by, or
+            C{None} for the global reactor.
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self.factory = factory
+        self.addr = addr
+        self.subflows = []
+        self._primary = None
+        self._pending = _SendBuffer()
+        self._nextOffset = 0
+        self._unacked = {}
+        self._resend = []
+        self._peerDelivered = 0
+        self._delivered = 0
+        self._reassembly = {}
+        self._finalOffset = None
+        self._finSent = False
+        self._paused = False
+
+
+    # ITransport
+
+    def write(self, data):
+        if not data:
+            return
+        self._pending.append(data)
+        self._schedule()
+        if (self.producer is not None and self.streamingProducer
+            and not self.producerPaused
+            and len(self._pending) >= self.bufferSize):
+            self.producerPaused = True
+            self.producer.pauseProducing()
+
+
+    def writeSequence(self, iovec):
+        self.write(''.join(iovec))
+
+
+    def loseConnection(self):
+        if not self.disconnecting:
+            self.disconnecting = True
+            self._maybeFinish()
+
+
+    def getHost(self):
+        return self._primary.getHost()
+
+
+    def getPeer(self):
+        return self._primary.getPeer()
+
+
+    # IQ2QTransport, when the subflows are Q2Q connections
+
+    def getQ2QHost(self):
+        return self._primary.getQ2QHost()
+
+
+    def getQ2QPeer(self):
+        return self._primary.getQ2QPeer()
+
+
+    # IConsumer
+
+    def registerProducer(self, producer, streaming):
+        if self.producer is not None:
+            raise RuntimeError(
+                "Cannot register producer %s, "
+                "because producer %s was never unregistered."
+                % (producer, self.producer))
+        if self.disconnected:
+            producer.stopProducing()
+            return
+        self.producer = producer
+        self.streamingProducer = streaming
+        self.producerPaused = False
+        if not streaming:
+            producer.resumeProducing()
+
+
+    def unregisterProducer(self):
+        self.producer = None
+
+
+    # IPushProducer
+
+    def pauseProducing(self):
+        """
+        Stop delivering the stream to the protocol.  What arrives in the
+        meantime is held, until the peer has sent all C{streamWindow} octets
+        it may.
+        """
+        self._paused = True
+
+
+    def resumeProducing(self):
+        """
+        Deliver whatever arrived while we were paused, and let the peer know
+        it may send more.
+        """
+        self._paused = False
+        self._deliver()
+        if self.subflows:
+            self.subflows[0].acknowledge()
+
+
+    def stopProducing(self):
+        self.loseConnection()
+
+
+    # Sending
+
+    def _schedule(self):
+        """
+        Give each chunk of the stream to be sent, those to be sent again
+        first, to the subflow with the most room for it, until none of them
+        has any.  Overdue subflows are given nothing.
+        """
+        while self._resend or self._pending:
+            best = None
+            bestRoom = 0
+            for subflow in self.subflows:
+                if subflow.overdue:
+                    continue
+                room = subflow.room()
+                if room > bestRoom:
+                    best, bestRoom = subflow, room
+            if best is None:
+                return
+            if self._resend:
+                offset = heapq.heappop(self._resend)
+                chunk = self._unacked.get(offset)
+                if chunk is None or chunk.subflow is not None:
+                    continue
+                chunk.subflow = best
+            else:
+                amount = min(bestRoom, self.chunkSize,
+                             self._peerDelivered + self.streamWindow
+                             - self._nextOffset)
+                if amount <= 0:
+                    return
+                offset = self._nextOffset
+                chunk = _Chunk(self._pending.take(amount), best)
+                self._nextOffset += len(chunk.data)
+                self._unacked[offset] = chunk
+            best.inflight += len(chunk.data)
+            chunk.timer = self._reactor.callLater(
+                best.chunkTimeout(), self._chunkOverdue, offset)
+            best.sendFrame(_DATA, offset, chunk.data)
+
+
+    def _chunkOverdue(self, offset):
+        """
+        A chunk has gone unacknowledged for too long on the subflow it was
+        sent on: give that subflow nothing more until it catches up, and send
+        the chunk again on another, if there is one to send it on.
+        """
+        chunk = self._unacked[offset]
+        chunk.timer = None
+        late = chunk.subflow
+        late.overdue = True
+        for subflow in self.subflows:
+            if not subflow.overdue and not subflow.closing:
+                break
+        else:
+            chunk.timer = self._reactor.callLater(
+                late.chunkTimeout(), self._chunkOverdue, offset)
+            return
+        log.msg("Multipath chunk at %d overdue on %r; sending it again"
+                % (offset, late.transport))
+        late.inflight -= len(chunk.data)
+        chunk.subflow = None
+        heapq.heappush(self._resend, offset)
+        self._schedule()
+
+
+    def _ackReceived(self, subflow, delivered, offsets):
+        if offsets:
+            subflow.overdue = False
+        for offset in offsets:
+            chunk = self._unacked.pop(offset, None)
+            if chunk is not None:
+                chunk.stopTimer()
+                if chunk.subflow is not None:
+                    chunk.subflow.inflight -= len(chunk.data)
+        self._peerDelivered = max(self._peerDelivered, delivered)
+        self._schedule()
+        if self.producer is not None and len(self._pending) < self.bufferSize:
+            if not self.streamingProducer:
+                self.producer.resumeProducing()
+            elif self.producerPaused:
+                self.producerPaused = False
+                self.producer.resumeProducing()
+        self._maybeFinish()
+
+
+    def _maybeFinish(self):
+        """
+        Once everything written before C{loseConnection} has been
+        acknowledged, tell the peer where the stream ends; once the peer's
+        stream has ended too, close the subflows.
+        """
+        if (self.disconnecting and not self._finSent
+            and not self._pending and not self._unacked):
+            self._finSent = True
+            for subflow in self.subflows:
+                subflow.sendFrame(_FIN, self._nextOffset)
+        if self._finSent and self._peerFinished():
+            for subflow in list(self.subflows):
+                subflow.close()
+
+
+    def _peerFinished(self):
+        """
+        Find out whether all of the peer's stream has been delivered.
+        """
+        return (self._finalOffset is not None
+                and self._delivered >= self._finalOffset)
+
+
+    # Receiving
+
+    def _dataReceived(self, offset, data):
+        if offset >= self._delivered and offset not in self._reassembly:
+            self._reassembly[offset] = data
+            self._deliver()
+
+
+    def _finReceived(self, offset):
+        self._finalOffset = offset
+        self._deliver()
+
+
+    def _deliver(self):
+        """
+        Deliver as much of the peer's stream as has arrived in order, unless
+        paused; once all of it has, lose the connection, as the peer has.
+        """
+        while not self._paused and self.protocol is not None:
+            data = self._reassembly.pop(self._delivered, None)
+            if data is None:
+                break
+            self._delivered += len(data)
+            self.protocol.dataReceived(data)
+        if self._peerFinished():
+            self.disconnecting = True
+            self._maybeFinish()
+
+
+    # Subflows coming and going
+
+    def _subflowConnected(self, subflow):
+        if self.disconnected:
+            subflow.close()
+            return
+        self.subflows.append(subflow)
+        if self.protocol is None:
+            self._primary = subflow.transport
+            self.protocol = self.factory.buildProtocol(self.addr)
+            if self.protocol is None:
+                subflow.close()
+                return
+            self.protocol.makeConnection(self)
+        if self._finSent:
+            subflow.sendFrame(_FIN, self._nextOffset)
+            self._maybeFinish()
+        else:
+            self._schedule()
+
+
+    def _subflowLost(self, subflow, reason):
+        if subflow not in self.subflows:
+            return
+        self.subflows.remove(subflow)
+        for offset, chunk in self._unacked.iteritems():
+            if chunk.subflow is subflow:
+                chunk.stopTimer()
+                chunk.subflow = None
+                heapq.heappush(self._resend, offset)
+        subflow.inflight = 0
+        if self.subflows:
+            self._schedule()
+            return
+        self.disconnected = True
+        if self.protocol is None:
+            return
+        if self._finSent and self._peerFinished():
+            reason = Failure(CONNECTION_DONE)
+        else:
+            reason = Failure(error.ConnectionLost(
+                    "Every subflow of the stream was lost"))
+        if self.producer is not None:
+            self.producer.stopProducing()
+            self.producer = None
+        self.protocol.connectionLost(reason)
@@ -0,0 +1,379 @@
+# -*- test-case-name: vertex.test.test_netsim -*-
+# Copyright 2005 Divmod, Inc.  See LICENSE file for details
+
+"""
+A deterministic, in-memory simulation of the UDP paths between hosts, for
+exercising and measuring L{vertex.ptcp} without real sockets.
+
+A L{Network} hands out UDP transports, as C{reactor.listenUDP} would, and
+carries the datagrams written to them over a L{Link} for each direction
+between each pair of hosts.  Links lose, duplicate, reorder, delay and
+truncate datagrams, and limit their rate, as they are told to; every random
+choice is taken from the network's own seeded C{random.Random}, and all time
+is the network's virtual clock, so the same seed and the same traffic always
+give the same results, however fast or slow the machine running them.
+
+A L{Network} is also an L{IReactorTime} provider, telling the time by its
+C{clock}, so it can be given as the reactor of the L{vertex.ptcp.PTCP}s
+listening on it, or of a L{vertex.q2q.PTCPConnectionDispatcher}.
+"""
+
+import random
+
+from collections import deque
+
+from zope.interface import implementer
+
+from twisted.internet import task, defer
+from twisted.internet.address import IPv4Address
+from twisted.internet.interfaces import IReactorTime, IReactorUDP
+
+
+
+class Link(object):
+    """
+    One direction of the path between two simulated hosts.
+
+    Each of the conditions below starts out as the network's default for it,
+    and may be changed at any time; changes affect datagrams sent from then
+    on.
+
+    @ivar loss: The probability that a datagram is lost.
+
+    @ivar duplication: The probability that a datagram is delivered twice.
+
+    @ivar reordering: The probability that a datagram is held back for
+        C{reorderDelay} seconds more than usual, so that those sent after it
+        overtake it.
+
+    @ivar reorderDelay: How long, in seconds, reordered datagrams are held
+        back.
+
+    @ivar delay: The one-way propagation delay, in seconds.
+
+    @ivar jitter: The most, in seconds, by which a datagram's delay may
+        randomly exceed C{delay}.
+
+    @ivar bandwidth: The rate, in octets per second, at which the link sends
+        datagrams, one after another; or C{None}, to send every datagram as
+        soon as it is written.
+
+    @ivar queueLimit: The most datagrams which may be waiting for the link's
+        C{bandwidth} to send them; any more are dropped, as a router's would
+        be.  C{None} means there is no limit.
+
+    @ivar mtu: The largest datagram, in octets, the link carries whole;
+        anything larger has its end cut off.  C{None} means there is no limit.
+
+    @ivar monitor: C{None}, or a callable which is called with every datagram
+        written to the link, before anything happens to it.
+
+    @ivar sent: The number of datagrams written to the link.
+
+    @ivar octets: The number of octets in them.
+
+    @ivar lost: The number of datagrams lost to C{loss}.
+
+    @ivar dropped: The number of datagrams dropped for want of room in the
+        queue.
+
+    @ivar duplicated: The number of datagrams delivered twice.
+
+    @ivar reordered: The number of datagrams held back to be overtaken.
+
+    @ivar truncated: The number of datagrams cut short by C{mtu}.
+
+    @ivar delivered: The number of datagrams which arrived, counting both
+        copies of duplicated ones.
+
+    @ivar _network: The L{Network} this link is part of.
+
+    @ivar _departures: A C{deque} of the times at which the datagrams still
+        waiting for C{bandwidth} will have been sent, soonest first.
+    """
+    conditions = ('loss', 'duplication', 'reordering', 'reorderDelay',
+                  'delay', 'jitter', 'bandwidth', 'queueLimit', 'mtu')
+
+    loss = 0.0
+    duplication = 0.0
+    reordering = 0.0
+    reorderDelay = 0.01
+    delay = 0.0
+    jitter = 0.0
+    bandwidth = None
+    queueLimit = None
+    mtu = None
+
+    monitor = None
+
+    def __init__(self, network, **conditions):
+        self._network = network
+        self._departures = deque()
+        self.configure(**conditions)
+        self.sent = self.octets = 0
+        self.lost = self.dropped = self.duplicated = 0
+        self.reordered = self.truncated = self.delivered = 0
+
+
+    def configure(self, **conditions):
+        """
+        Change some of the link's conditions.
+
+        @raise TypeError: If one of the keyword arguments is not the name of a
+            condition.
+        """
+        for name, value in conditions.items():
+            if name not in self.conditions:
+                raise TypeError("No such link condition: %r" % (name,))
+            setattr(self, name, value)
+
+
+    def transmit(self, datagram, deliver):
+        """
+        Carry a datagram across the link, if it makes it.
+
+        @param deliver: The callable to deliver the datagram with, when it
+            arrives.
+        """
+        if self.monitor is not None:
+            self.monitor(datagram)
+        clock = self._network.clock
+        rand = self._network.random
+        now = clock.seconds()
+        self.sent += 1
+        self.octets += len(datagram)
+
+        departure = now
+        if self.bandwidth is not None:
+            departures = self._departures
+            while departures and departures[0] <= now:
+                departures.popleft()
+            if (self.queueLimit is not None
+                and len(departures) >= self.queueLimit):
+                self.dropped += 1
+                return
+            if departures:
+                departure = departures[-1]
+            departure += len(datagram) / float(self.bandwidth)
+            departures.append(departure)
+
+        if rand.random() < self.loss:
+            self.lost += 1
+            return
+        if self.mtu is not None and len(datagram) > self.mtu:
+            self.truncated += 1
+            datagram = datagram[:self.mtu]
+
+        copies = 1
+        if rand.random() < self.duplication:
+            self.duplicated += 1
+            copies = 2
+        for i in range(copies):
+            arrival = departure + self.delay
+            if self.jitter:
+                arrival += rand.uniform(0, self.jitter)
+            if rand.random() < self.reordering:
+                self.reordered += 1
+                arrival += self.reorderDelay
+            clock.callLater(arrival - now, self._arrive, datagram, deliver)
+
+
+    def _arrive(self, datagram, deliver):
+        self.delivered += 1
+        deliver(datagram)
+
+
+
+class SimulatedPort(object):
+    """
+    A UDP transport on a simulated host, as returned by
+    L{Network.listenUDP}.
+
+    @ivar protocol: The L{twisted.internet.protocol.DatagramProtocol} the
+        port delivers datagrams to.
+
+    @ivar address: The port's C{(host, port)} address.
+
+    @ivar connected: Whether the port is still listening.
+    """
+
+    def __init__(self, network, protocol, address):
+        self._network = network
+        self.protocol = protocol
+        self.address = address
+        self.connected = True
+
+
+    def write(self, datagram, addr):
+        self._network._transmit(self.address, addr, datagram)
+
+
+    def writeBatch(self, datagrams):
+        for datagram, addr in datagrams:
+            self._network._transmit(self.address, addr, datagram)
+
+
+    def getHost(self):
+        return IPv4Address('UDP', *self.address)
+
+
+    def stopListening(self):
+        if self.connected:
+            self.connected = False
+            del self._network._ports[self.address]
+            self.protocol.doStop()
+        return defer.succeed(None)
+
+
+    def _deliver(self, datagram, source):
+        if self.connected:
+            self.protocol.datagramReceived(datagram, source)
+
+
+
+@implementer(IReactorTime, IReactorUDP)
+class Network(object):
+    """
+    A simulated network of hosts exchanging UDP datagrams.
+
+    @ivar clock: The L{task.Clock} all time on the network is measured by.
+
+    @ivar random: The C{random.Random} every link takes its chances from.
+
+    @ivar defaults: A C{dict} of the conditions new links start out with.
+
+    @ivar _links: A C{dict} mapping two-tuples of source and destination
+        hosts to the L{Link}s between them.
+
+    @ivar _ports: A C{dict} mapping C{(host, port)} addresses to the
+        L{SimulatedPort}s listening on them.
+    """
+
+    def __init__(self, seed=0, clock=None, **defaults):
+        """
+        @param seed: The seed for C{random}.
+
+        @param clock: The C{clock} to use, or C{None} for a new one.
+
+        @param defaults: Conditions for every link to start out with; see
+            L{Link}.
+        """
+        if clock is None:
+            clock = task.Clock()
+        self.clock = clock
+        self.random = random.Random(seed)
+        # Find out now, rather than when the first link is made, about any
+        # which aren't conditions.
+        Link(self, **defaults)
+        self.defaults = defaults
+        self._links = {}
+        self._ports = {}
+        self._nextPort = 10000
+
+
+    def link(self, source, destination):
+        """
+        Find the link carrying datagrams from one host to another, to see what
+        it has done or to change its conditions.
+
+        @param source: The IP address of the sending host.
+
+        @param destination: The IP address of the receiving host.
+
+        @rtype: L{Link}
+        """
+        key = (source, destination)
+        link = self._links.get(key)
+        if link is None:
+            link = self._links[key] = Link(self, **self.defaults)
+        return link
+
+
+    def seconds(self):
+        return self.clock.seconds()
+
+
+    def callLater(self, delay, f, *args, **kw):
+        return self.clock.callLater(delay, f, *args, **kw)
+
+
+    def getDelayedCalls(self):
+        return self.clock.getDelayedCalls()
+
+
+    def listenUDP(self, port, protocol, interface='127.0.0.1',
+                  maxPacketSize=8192):
+        """
+        Start a datagram protocol listening on a simulated host, as
+        C{reactor.listenUDP} would.
+
+        @param port: The port number, or 0 for any free one.
+
+        @param interface: The simulated host's IP address.
+
+        @param maxPacketSize: Ignored; datagrams are only ever cut short by
+            the C{mtu} of the link they cross.
+
+        @rtype: L{SimulatedPort}
+        """
+        if port == 0:
+            while (interface, self._nextPort) in self._ports:
+                self._nextPort += 1
+            port = self._nextPort
+        address = (interface, port)
+        if address in self._ports:
+            raise ValueError("Address already in use: %r" % (address,))
+        transport = self._ports[address] = SimulatedPort(
+            self, protocol, address)
+        protocol.makeConnection(transport)
+        return transport
+
+
+    def _transmit(self, source, destination, datagram):
+        """
+        Send a datagram from one simulated port to whichever is listening at
+        its destination when it arrives.
+        """
+        def deliver(datagram):
+            port = self._ports.get(destination)
+            if port is not None:
+                port._deliver(datagram, source)
+        self.link(source[0], destination[0]).transmit(datagram, deliver)
+
+
+    def advance(self, seconds):
+        """
+        Let some time go by on the network, running everything that falls
+        due, in order, each at its own time.
+        """
+        deadline = self.clock.seconds() + seconds
+        self.runUntil(lambda: False, seconds)
+        self.clock.advance(max(0, deadline - self.clock.seconds()))
+
+
+    def runUntil(self, condition, timeout):
+        """
+        Run the network, from one thing happening to the next, until a
+        condition holds, or until there is nothing left to happen before
+        C{timeout} seconds have gone by.
+
+        L{task.Clock.advance} runs everything due within the time it is
+        advanced by at the end of that time, so the clock is only ever
+        advanced to the time of the next thing to happen.
+
+        @param condition: A callable returning whether to stop.
+
+        @return: Whether C{condition} came to hold.
+        """
+        clock = self.clock
+        deadline = clock.seconds() + timeout
+        while not condition():
+            calls = clock.getDelayedCalls()
+            if not calls:
+                return False
+            due = min([call.getTime() for call in calls])
+            if due > deadline:
+                clock.advance(deadline - clock.seconds())
+                return condition()
+            clock.advance(max(0, due - clock.seconds()))
+        return True
@@ -2,20 +2,33 @@
 
 from __future__ import print_function
 
+import os
+import hmac
 import struct
+import bisect
+import hashlib
+
+from collections import deque
 
 from binascii import crc32  # used to use zlib.crc32 - but that gives different
                             # results on 64-bit platforms!!
+from binascii import hexlify, unhexlify
 
 import itertools
 
 from tcpdfa import TCP
 
+from zope.interface import implementer
+
 from twisted.python.failure import Failure
 from twisted.internet.defer import Deferred
 from twisted.internet import protocol, error, reactor, defer
 from twisted.internet.main import CONNECTION_DONE
-from twisted.python import log, util
+from twisted.python import log
+
+from vertex.ivertex import ICongestionControl
+from vertex.timerwheel import TimerWheel
+from vertex.egress import EgressScheduler
 
 genConnID = itertools.count(8).next
 
@@ -32,12 +45,79 @@ _packetFormat = ('!' # WTF did you think
                      # (signed because of binascii.crc32)
                  'H' # dlen
                  )
-_fixedSize = struct.calcsize(_packetFormat)
+_header = struct.Struct(_packetFormat)
+_fixedSize = _header.size
+
+# Packets with the SAK flag set carry selective acknowledgement blocks between
+# the header and the data: a count, followed by that many pairs of
+# (left edge, right edge) sequence numbers.  A SYN+ACK with the SAK flag set
+# and no blocks tells the peer that we will use them.
+_sackCountFormat = '!B'
+_sackCount = struct.Struct(_sackCountFormat)
+_sackCountSize = _sackCount.size
+_sackBlockFormat = ('!'
+                    'L' # leftEdge
+                    'L' # rightEdge
+                    )
+_sackBlock = struct.Struct(_sackBlockFormat)
+_sackBlockSize = _sackBlock.size
+
+# Packets with the MIG flag set carry the connection's ID between the header
+# and any selective acknowledgement blocks, so that the connection can be
+# found again should its peer turn up at a new address.  A SYN+ACK with the
+# MIG flag set tells the peer the ID both ends will use.
+_connectionIDFormat = '!Q'
+_connectionID = struct.Struct(_connectionIDFormat)
+_connectionIDSize = _connectionID.size
+
+# Straight after the connection ID, a SYN+ACK with the MIG flag set carries
+# the key both ends authenticate the connection's other packets with; each of
+# those carries there instead the first few octets of an HMAC-SHA256, under
+# that key, of the rest of the packet.  The connection ID alone may be seen
+# or guessed, but only our peer can send a packet with the right MAC, so only
+# such a packet from a new address may move the connection there.
+_migrationKeySize = 16
+_migrationMACSize = 8
+
+# A packet with both the STB and MIG flags set is a path challenge: its data
+# is a nonce, to be sent straight back, in a packet with the ACK flag set
+# too, by the peer it was sent to.  A connection only moves to a new address
+# once the answer to a challenge sent there comes back from it.
+_pathChallengeSize = 8
+
+# A packet with the FEC flag set, other than a SYN+ACK, is a parity segment:
+# the data of a group of consecutive data segments, each padded with zeros to
+# the length of the longest, XORed together.  Its sequence number is that of
+# the first segment in the group.  It has no acknowledgement to make, so its
+# acknowledgement number holds the number of segments in the group, and no
+# window to advertise, so its window holds the number of octets of data they
+# carry.  It occupies no sequence space, and is never retransmitted.  A
+# SYN+ACK with the FEC flag set tells the peer that we will use parity.
+
+# A SYN, or a SYN+ACK, may carry a fast-open cookie after any other options,
+# before its data.  Having no flag of its own, it is known to be there by the
+# packet being that much longer than its data.  A SYN+ACK only carries one
+# for a peer whose SYN asked for it; a SYN only carries one, issued by the
+# peer it is sent to, along with data for the peer to take before the
+# handshake is complete.
+_fastOpenCookieSize = 8
 
 SEND_DELAY = 0.00001
 ACK_DELAY = 0.00001
 
-_SYN, _ACK, _FIN, _RST, _STB = [1 << n for n in range(5)]
+_SYN, _ACK, _FIN, _RST, _STB, _SAK, _MIG, _FEC = [1 << n for n in range(8)]
+
+# A SYN without an ACK has no use for its acknowledgement number, and peers
+# which predate the SAK flag would refuse a SYN with any other flag set, so
+# that is where a new connection's options go.  Older peers always send 0.
+_SYN_SACK_PERMITTED = 1
+_SYN_MIGRATION_PERMITTED = 2
+_SYN_FEC_PERMITTED = 4
+_SYN_FAST_OPEN = 8
+# Older peers take it for granted that our initial sequence number is 0, so
+# only a SYN which sets this, saying it takes any, may be answered with a SYN
+# cookie.
+_SYN_ANY_ISN = 16
 
 def _flagprop(flag):
     def setter(self, value):
@@ -47,6 +127,23 @@ def _flagprop(flag):
             self.flags &= ~flag
     return property(lambda self: bool(self.flags & flag), setter)
 
+def _xor(strings, size):
+    """
+    XOR some strings together, each padded with zeros to C{size} octets.
+    """
+    result = 0
+    for s in strings:
+        result ^= int(hexlify(s), 16) << (8 * (size - len(s)))
+    return unhexlify('%0*x' % (size * 2, result))
+
+def _defaultReactor():
+    """
+    Find the reactor to keep time with when none is given: this module's
+    C{reactor}, looked up when it is needed, rather than when the module is
+    imported, so that it can be replaced.
+    """
+    return reactor
+
 def relativeSequence(wireSequence, initialSequence, lapNumber):
     """ Compute a relative sequence number from a wire sequence number so that we
     can use natural Python comparisons on it, such as <, >, ==.
@@ -60,7 +157,42 @@ def relativeSequence(wireSequence, initialSequence, lapNumber):
     """
     return (wireSequence + (lapNumber * (2**32))) - initialSequence
 
-class PTCPPacket(util.FancyStrMixin, object):
+class PTCPPacket(object):
+    """
+    A single PTCP segment.
+
+    There can be a great many of these queued up at once, so they have no
+    instance dictionary; every attribute a packet may have is a slot.
+    """
+    __slots__ = (
+        'sourcePseudoPort', 'destPseudoPort', 'seqNum', 'ackNum', 'window',
+        'flags', 'checksum', 'dlen', 'data', 'sackBlocks', 'connectionID',
+        'migrationKey', 'mac', 'fastOpenCookie', 'peerAddressTuple',
+        'seqOffset', 'ackOffset', 'seqLaps', 'ackLaps', 'destination',
+
+        # When this segment was first sent, if it needs to be acknowledged and
+        # has not been retransmitted since; the acknowledgement of such a
+        # segment is a round-trip time measurement.
+        'sentAt',
+
+        # When this segment was most recently sent, if it needs to be
+        # acknowledged; it is due to be retransmitted one retransmission
+        # timeout after this.
+        'transmittedAt',
+
+        # When this segment was first sent, whether or not it has been
+        # retransmitted since; if it is still unacknowledged
+        # maximumRetransmitTime after this, the connection times out.
+        'firstSentAt',
+
+        # Whether our peer has told us, with a selective acknowledgement, that
+        # it is holding this segment.
+        'sacked',
+
+        # The number of times this segment has been retransmitted.
+        'retransmissions',
+        )
+
     showAttributes = (
         ('sourcePseudoPort', 'sourcePseudoPort', '%d'),
         ('destPseudoPort', 'destPseudoPort', '%d'),
@@ -72,6 +204,8 @@ class PTCPPacket(util.FancyStrMixin, object):
         ('checksum', 'checksum', '%x'),
         ('peerAddressTuple', 'peerAddress', '%r'),
         ('retransmitCount', 'retransmitCount', '%d'),
+        ('sackBlocks', 'sack', '%r'),
+        ('connectionID', 'connectionID', '%r'),
         )
 
     syn = _flagprop(_SYN)
@@ -79,10 +213,26 @@ class PTCPPacket(util.FancyStrMixin, object):
     fin = _flagprop(_FIN)
     rst = _flagprop(_RST)
     stb = _flagprop(_STB)
+    sak = _flagprop(_SAK)
+    mig = _flagprop(_MIG)
+    fec = _flagprop(_FEC)
+
+    # The number of retransmit attempts each segment gets.  When it has used
+    # them all up, this segment is dead.
+    maximumRetransmits = 50
 
-    # Number of retransmit attempts left for this segment.  When it reaches
-    # zero, this segment is dead.
-    retransmitCount = 50
+    def retransmitCount():
+        def get(self):
+            return self.maximumRetransmits - self.retransmissions
+        return get,
+    retransmitCount = property(*retransmitCount())
+
+    def __repr__(self):
+        return '<%s%s>' % (self.__class__.__name__, ''.join([
+                (' %s=' + format) % (name, getattr(self, attribute))
+                for (attribute, name, format) in self.showAttributes]))
+
+    __str__ = __repr__
 
     def shortdata():
         def get(self):
@@ -98,7 +248,8 @@ class PTCPPacket(util.FancyStrMixin, object):
             res = []
             for (f, v) in [
                 (self.syn, 'S'), (self.ack, 'A'), (self.fin, 'F'),
-                (self.rst, 'R'), (self.stb, 'T')]:
+                (self.rst, 'R'), (self.stb, 'T'), (self.sak, 'K'),
+                (self.mig, 'M'), (self.fec, 'E')]:
                 res.append(f and v or '.')
             return ''.join(res)
         return get,
@@ -107,18 +258,37 @@ class PTCPPacket(util.FancyStrMixin, object):
     def create(cls,
                sourcePseudoPort, destPseudoPort,
                seqNum, ackNum, data,
-               window=(1 << 15),
+               window=None,
                syn=False, ack=False, fin=False,
-               rst=False, stb=False,
-               destination=None):
+               rst=False, stb=False, sak=False, fec=False,
+               destination=None, sackBlocks=(), connectionID=None,
+               migrationKey=None, fastOpenCookie=None):
+        flags = 0
+        if syn:
+            flags |= _SYN
+        if ack:
+            flags |= _ACK
+        if fin:
+            flags |= _FIN
+        if rst:
+            flags |= _RST
+        if stb:
+            flags |= _STB
+        if sak or sackBlocks:
+            flags |= _SAK
+        if connectionID is not None:
+            flags |= _MIG
+        if fec:
+            flags |= _FEC
+        if window is None:
+            window = PTCPConnection.recvWindow
         i = cls(sourcePseudoPort, destPseudoPort,
                 seqNum, ackNum, window,
-                0, 0, len(data), data)
-        i.syn = syn
-        i.ack = ack
-        i.fin = fin
-        i.rst = rst
-        i.stb = stb
+                flags, 0, len(data), data, sackBlocks=sackBlocks,
+                connectionID=connectionID, migrationKey=migrationKey,
+                fastOpenCookie=fastOpenCookie)
+        # This is the only time the checksum is computed for a packet we
+        # send; it covers nothing which changes when the packet is resent.
         i.checksum = i.computeChecksum()
         i.destination = destination
         return i
@@ -130,7 +300,9 @@ class PTCPPacket(util.FancyStrMixin, object):
                  destPseudoPort,
                  seqNum, ackNum, window, flags,
                  checksum, dlen, data, peerAddressTuple=None,
-                 seqOffset=0, ackOffset=0, seqLaps=0, ackLaps=0):
+                 seqOffset=0, ackOffset=0, seqLaps=0, ackLaps=0,
+                 sackBlocks=(), connectionID=None, migrationKey=None,
+                 mac=None, fastOpenCookie=None):
         self.sourcePseudoPort = sourcePseudoPort
         self.destPseudoPort = destPseudoPort
         self.seqNum = seqNum
@@ -140,6 +312,11 @@ class PTCPPacket(util.FancyStrMixin, object):
         self.checksum = checksum
         self.dlen = dlen
         self.data = data
+        self.sackBlocks = sackBlocks
+        self.connectionID = connectionID
+        self.migrationKey = migrationKey
+        self.mac = mac
+        self.fastOpenCookie = fastOpenCookie
         self.peerAddressTuple = peerAddressTuple # None if local
 
         self.seqOffset = seqOffset
@@ -147,11 +324,18 @@ class PTCPPacket(util.FancyStrMixin, object):
         self.seqLaps = seqLaps
         self.ackLaps = ackLaps
 
+        self.destination = None
+        self.sentAt = None
+        self.transmittedAt = None
+        self.firstSentAt = None
+        self.sacked = False
+        self.retransmissions = 0
+
     def segmentLength(self):
         """RFC page 26: 'The segment length (SEG.LEN) includes both data and sequence
         space occupying controls'
         """
-        return self.dlen + self.syn + self.fin
+        return self.dlen + bool(self.flags & _SYN) + bool(self.flags & _FIN)
 
     def relativeSeq(self):
         return relativeSequence(self.seqNum, self.seqOffset, self.seqLaps)
@@ -159,6 +343,22 @@ class PTCPPacket(util.FancyStrMixin, object):
     def relativeAck(self):
         return relativeSequence(self.ackNum, self.ackOffset, self.ackLaps)
 
+    def relativeTo(self, seqISN, ackISN):
+        """
+        Count this packet's relative sequence and acknowledgement numbers
+        from the given initial sequence numbers, on the assumption that
+        neither has wrapped around 2**32 more than once since.
+        """
+        self.seqOffset = seqISN
+        self.seqLaps = int(self.seqNum < seqISN)
+        self.ackOffset = ackISN
+        self.ackLaps = int(self.ackNum < ackISN)
+
+    def relativeSackBlocks(self):
+        return [(relativeSequence(left, self.ackOffset, self.ackLaps),
+                 relativeSequence(right, self.ackOffset, self.ackLaps))
+                for (left, right) in self.sackBlocks]
+
 
     def verifyChecksum(self):
         if len(self.data) != self.dlen:
@@ -172,14 +372,94 @@ class PTCPPacket(util.FancyStrMixin, object):
             raise ChecksumMismatchError(expected, received)
 
     def computeChecksum(self):
-        return crc32(self.data)
+        if not self.hasOptions():
+            return crc32(self.data)
+        return crc32(self.data, crc32(self.encodeOptions()))
+
+    def hasOptions(self):
+        """
+        Find out whether anything goes between the header and the data.
+        """
+        return bool(self.flags & (_SAK | _MIG)
+                    or self.fastOpenCookie is not None)
+
+    def encodeOptions(self):
+        """
+        Encode everything which goes between the header and the data, except
+        the MAC, which covers it.
+        """
+        options = self.encodeSackBlocks()
+        if self.mig:
+            if self.syn:
+                options = self.migrationKey + options
+            options = _connectionID.pack(self.connectionID) + options
+        if self.fastOpenCookie is not None:
+            options += self.fastOpenCookie
+        return options
+
+    def computeMAC(self, key, header=None, options=None):
+        """
+        Compute the MAC this packet carries, if it is one which carries one.
+
+        @param key: The migration key of the connection the packet is part of.
+        """
+        if header is None:
+            header = self.encodeHeader()
+        if options is None:
+            options = self.encodeOptions()
+        return hmac.new(key, ''.join([header, options, self.data]),
+                        hashlib.sha256).digest()[:_migrationMACSize]
+
+    def verifyMAC(self, key):
+        """
+        Find out whether this packet carries the right MAC for C{key}.
+        """
+        return self.mac is not None and hmac.compare_digest(
+            self.mac, self.computeMAC(key))
+
+    def encodeSackBlocks(self):
+        if not self.sak:
+            return ''
+        return _sackCount.pack(len(self.sackBlocks)) + ''.join([
+                _sackBlock.pack(left, right)
+                for (left, right) in self.sackBlocks])
 
     def decode(cls, bytes, hostPortPair):
-        fields = struct.unpack(_packetFormat, bytes[:_fixedSize])
-        sourcePseudoPort, destPseudoPort, seq, ack, window, flags, checksum, dlen = fields
-        data = bytes[_fixedSize:]
+        (sourcePseudoPort, destPseudoPort, seq, ack, window, flags, checksum,
+         dlen) = _header.unpack_from(bytes)
+        offset = _fixedSize
+        sackBlocks = ()
+        connectionID = migrationKey = mac = None
+        if flags & _MIG and len(bytes) >= offset + _connectionIDSize:
+            [connectionID] = _connectionID.unpack_from(bytes, offset)
+            offset += _connectionIDSize
+            if flags & _SYN:
+                migrationKey = bytes[offset:offset + _migrationKeySize]
+                offset += _migrationKeySize
+            else:
+                mac = bytes[offset:offset + _migrationMACSize]
+                offset += _migrationMACSize
+        if flags & _SAK and len(bytes) >= offset + _sackCountSize:
+            [count] = _sackCount.unpack_from(bytes, offset)
+            offset += _sackCountSize
+            sackBlocks = []
+            for i in range(count):
+                if len(bytes) < offset + _sackBlockSize:
+                    # Truncated; the checksum won't match.
+                    break
+                sackBlocks.append(_sackBlock.unpack_from(bytes, offset))
+                offset += _sackBlockSize
+        fastOpenCookie = None
+        if (flags & _SYN and
+            len(bytes) - offset == dlen + _fastOpenCookieSize):
+            fastOpenCookie = bytes[offset:offset + _fastOpenCookieSize]
+            offset += _fastOpenCookieSize
+        data = bytes[offset:]
         pkt = cls(sourcePseudoPort, destPseudoPort, seq, ack, window, flags,
-                  checksum, dlen, data, hostPortPair)
+                  checksum, dlen, data, hostPortPair,
+                  sackBlocks=sackBlocks, connectionID=connectionID,
+                  migrationKey=migrationKey, mac=mac,
+                  fastOpenCookie=fastOpenCookie)
         return pkt
     decode = classmethod(decode)
 
@@ -191,18 +471,28 @@ class PTCPPacket(util.FancyStrMixin, object):
         Packets which contain a connection-state changing flag (SYN or FIN) or
         a non-zero amount of data can be retransmitted.
         """
-        if self.syn or self.fin or self.dlen:
-            return True
-        return False
+        return bool(self.flags & (_SYN | _FIN) or self.dlen)
 
-    def encode(self):
-        dlen = len(self.data)
-        checksum = self.computeChecksum()
-        return struct.pack(
-            _packetFormat,
+    def encodeHeader(self):
+        return _header.pack(
             self.sourcePseudoPort, self.destPseudoPort,
             self.seqNum, self.ackNum, self.window,
-            self.flags, checksum, dlen) + self.data
+            self.flags, self.checksum, len(self.data))
+
+    def encode(self):
+        header = self.encodeHeader()
+        if self.hasOptions():
+            options = self.encodeOptions()
+            if self.mig and not self.syn:
+                if self.migrationKey is not None:
+                    mac = self.computeMAC(self.migrationKey, header, options)
+                else:
+                    # Decoded, rather than made to send.
+                    mac = self.mac or '\x00' * _migrationMACSize
+                options = ''.join([options[:_connectionIDSize], mac,
+                                   options[_connectionIDSize:]])
+            return ''.join([header, options, self.data])
+        return header + self.data
 
     def fragment(self, mtu):
         if self.dlen < mtu:
@@ -210,21 +500,22 @@ class PTCPPacket(util.FancyStrMixin, object):
         assert not self.syn, "should not be originating syn packets w/ data"
         seqOfft = 0
         L = []
-        # XXX TODO: need to take seqLaps into account, etc.
         for chunk in iterchunks(self.data, mtu):
             last = self.create(self.sourcePseudoPort,
                                self.destPseudoPort,
-                               self.seqNum + seqOfft,
+                               (self.seqNum + seqOfft) % (2**32),
                                self.ackNum,
                                chunk,
                                self.window,
                                destination=self.destination,
-                               ack=self.ack)
+                               ack=self.ack,
+                               connectionID=self.connectionID,
+                               migrationKey=self.migrationKey)
+            last.relativeTo(self.seqOffset, self.ackOffset)
             L.append(last)
             seqOfft += len(chunk)
         if self.fin:
             last.fin = self.fin
-            last.checksum = last.computeChecksum()
         return L
 
 
@@ -295,6 +586,179 @@ class GarbageDataError(Exception):
 
 
 
+@implementer(ICongestionControl)
+class RenoCongestionControl(object):
+    """
+    TCP Reno congestion control, as described by RFC 5681: the congestion
+    window grows exponentially (slow start) until it reaches the slow start
+    threshold, then by about one segment per round trip (congestion
+    avoidance).  When a retransmission timeout indicates loss, the threshold
+    is halved and the window collapses to a single segment; when duplicate
+    acknowledgements do, the window is only halved, since data is evidently
+    still getting through.
+
+    @ivar slowStartThreshold: (TCP RFC: ssthresh) the congestion window size
+    at which slow start gives way to congestion avoidance.
+    """
+    __slots__ = ('maximumSegmentSize', 'congestionWindow',
+                 'slowStartThreshold')
+
+    def __init__(self, maximumSegmentSize):
+        self.maximumSegmentSize = maximumSegmentSize
+        self.congestionWindow = self.initialWindow()
+        self.slowStartThreshold = 2 ** 30
+
+
+    def initialWindow(self):
+        """
+        The initial congestion window; RFC 5681 section 3.1.
+        """
+        mss = self.maximumSegmentSize
+        if mss > 2190:
+            return 2 * mss
+        if mss > 1095:
+            return 3 * mss
+        return 4 * mss
+
+
+    def acknowledged(self, octets):
+        mss = self.maximumSegmentSize
+        if self.congestionWindow < self.slowStartThreshold:
+            self.congestionWindow += min(octets, mss)
+        else:
+            self.congestionWindow += max(1, (mss * mss) // self.congestionWindow)
+
+
+    def timedOut(self, inFlight):
+        mss = self.maximumSegmentSize
+        self.slowStartThreshold = max(inFlight // 2, 2 * mss)
+        self.congestionWindow = mss
+
+
+    def lost(self, inFlight):
+        self.slowStartThreshold = max(inFlight // 2,
+                                      2 * self.maximumSegmentSize)
+        self.congestionWindow = self.slowStartThreshold
+
+
+
+@implementer(ICongestionControl)
+class FixedCongestionWindow(object):
+    """
+    A congestion window of a fixed number of segments, whatever happens.  This
+    is how PTCP used to behave, and is mostly useful for comparison.
+    """
+
+    __slots__ = ('maximumSegmentSize',)
+
+    segments = 2
+
+    def __init__(self, maximumSegmentSize):
+        self.maximumSegmentSize = maximumSegmentSize
+
+
+    def congestionWindow():
+        def get(self):
+            return self.segments * self.maximumSegmentSize
+        return get,
+    congestionWindow = property(*congestionWindow())
+
+
+    def acknowledged(self, octets):
+        pass
+
+
+    def timedOut(self, inFlight):
+        pass
+
+
+    def lost(self, inFlight):
+        pass
+
+
+
+class _SendBuffer(object):
+    """
+    Data written to a connection which has not been sent yet.
+
+    Appending to and slicing the front off a single string copies everything
+    left in it, every time; this keeps the strings as they were written, and
+    only copies out the octets taken from the front.
+
+    @ivar _chunks: a deque of the strings written, oldest first, or C{None}
+        while the buffer is empty; most connections spend most of their time
+        with nothing to send, and an empty deque is not small.
+
+    @ivar _offset: the number of octets of C{_chunks[0]} already taken.
+    """
+    __slots__ = ('_chunks', '_offset', '_size')
+
+    def __init__(self):
+        self._chunks = None
+        self._offset = 0
+        self._size = 0
+
+
+    def __len__(self):
+        return self._size
+
+
+    def append(self, data):
+        if data:
+            if self._chunks is None:
+                self._chunks = deque()
+            self._chunks.append(data)
+            self._size += len(data)
+
+
+    def take(self, amount):
+        """
+        Remove up to C{amount} octets from the front of the buffer.
+
+        @return: the octets removed.
+        @rtype: C{str}
+        """
+        pieces = []
+        chunks = self._chunks
+        if chunks is None:
+            return ''
+        while amount and chunks:
+            chunk = chunks[0]
+            start = self._offset
+            end = min(len(chunk), start + amount)
+            if start == 0 and end == len(chunk):
+                pieces.append(chunk)
+            else:
+                pieces.append(chunk[start:end])
+            amount -= end - start
+            self._size -= end - start
+            if end == len(chunk):
+                chunks.popleft()
+                self._offset = 0
+            else:
+                self._offset = end
+        if not chunks:
+            self._chunks = None
+        if len(pieces) == 1:
+            return pieces[0]
+        return ''.join(pieces)
+
+
+    def prepend(self, data):
+        """
+        Put some octets back at the front of the buffer.
+        """
+        if data:
+            if self._chunks is None:
+                self._chunks = deque()
+            elif self._offset:
+                self._chunks[0] = self._chunks[0][self._offset:]
+                self._offset = 0
+            self._chunks.appendleft(data)
+            self._size += len(data)
+
+
+
 class PTCPConnection(object):
     """
     Implementation of RFC 793 state machine.
@@ -303,13 +767,13 @@ class PTCPConnection(object):
     sequence number referring to an octet which we have sent or may send which
     is unacknowledged.  This begins at 0, which is special because it is not
     for an octet, but rather for the initial SYN packet.  Unless it is 0, this
-    represents the sequence number of self._outgoingBytes[0].
+    represents the sequence number of the first octet in self._outgoingBytes.
 
     @ivar nextSendSeqNum: (TCP RFC: SND.NXT) The next (relative) sequence
     number that we will send to our peer after the current buffered segments
     have all been acknowledged.  This is the sequence number of the
-    not-yet-extant octet in the stream at
-    self._outgoingBytes[len(self._outgoingBytes)].
+    not-yet-extant octet in the stream after the last one in
+    self._outgoingBytes.
 
     @ivar nextRecvSeqNum: (TCP RFC: RCV.NXT) The next (relative) sequence
     number that the peer should send to us if they want to send more data;
@@ -327,34 +791,357 @@ class PTCPConnection(object):
     this.  (see C{relativeSequence})
 
     @ivar retransmissionQueue: a list of packets to be re-sent until their
-    acknowledgements come through.
+    acknowledgements come through.  Each is re-sent on its own, when
+    C{retransmitTimeout} has passed since it was last sent.
 
     @ivar recvWindow: (TCP RFC: RCV.WND) - the size [in octets] of the current
-    window allowed by this host, to be in transit from the other host.
+    window allowed by this host, to be in transit from the other host.  A
+    window limits a transfer to one window per round trip, so this must
+    cover the bandwidth-delay product of the paths we are used over; a
+    megabyte covers 100Mb/s across 80ms.  It is also what
+    L{PTCPPacket.create} and SYN cookies advertise when no connection's own
+    window applies.
 
     @ivar sendWindow: (TCP RFC: SND.WND) - the size [in octets] of the current
-    window allowed by our peer, to be in transit from us.
-
+    window allowed by our peer, to be in transit from us.  This is taken from
+    the window field of our peer's packets, which is 32 bits wide, so windows
+    of any useful size can be advertised without scaling.  When it is zero, we
+    probe every so often, backing off, to find out when it opens again.
+
+    @ivar sendWindowRemaining: the number of octets which we may still send
+    before we must wait for an acknowledgement, according to C{congestion}
+    and C{sendWindow}.
+
+    @ivar congestion: the L{ICongestionControl} provider, created by
+    C{congestionControlFactory} with our MTU, which decides how much data may
+    be in flight.
+
+    @ivar smoothedRTT: (TCP RFC: SRTT) our estimate, in seconds, of the
+    round-trip time to our peer, or C{None} if we have not yet measured it.
+
+    @ivar rttVariance: (TCP RFC: RTTVAR) our estimate, in seconds, of the
+    variation in the round-trip time to our peer, or C{None} if we have not
+    yet measured it.
+
+    @ivar retransmitTimeout: (TCP RFC: RTO) the number of seconds we wait for
+    an acknowledgement before retransmitting.  This starts out as
+    C{_retransmitTimeout}, is derived from C{smoothedRTT} and C{rttVariance}
+    as they are measured, and doubles each time it expires, within the bounds
+    of C{minimumRetransmitTimeout} and C{maximumRetransmitTimeout}.
+
+    @ivar maximumRetransmitTime: (RFC 1122 4.2.3.5: R2) the number of seconds
+    a segment may go unacknowledged, however often it has been retransmitted,
+    before we give up on our peer and the connection times out.  With the
+    timeout backing off to C{maximumRetransmitTimeout}, a segment's
+    C{maximumRetransmits} would otherwise take the best part of an hour to
+    run out.
+
+    @ivar selectiveAcknowledgement: whether we offer to use selective
+    acknowledgements (RFC 2018 SACK) on new connections.
+
+    @ivar sackPermitted: whether both we and our peer agreed, during the
+    handshake, to use selective acknowledgements on this connection.  If so, our
+    acknowledgements report up to C{maximumSackBlocks} ranges of the segments
+    held in C{_reassemblyQueue}, and segments in C{retransmissionQueue} which
+    our peer reports holding are not retransmitted.
+
+    @ivar connectionMigration: whether we offer, on new connections, to carry
+    a connection ID in every packet, so that the connection survives either
+    end turning up at a new address, as it will when a NAT rebinds it.
+
+    @ivar connectionID: the unguessable 64-bit ID, picked by the listening end
+    during the handshake, which every packet of this connection carries; or
+    C{None} if we and our peer did not both agree to use one.  Once the
+    connection is established, a packet from an address we don't know which
+    carries it, with the right MAC, and which is acceptable to our send and
+    receive windows, moves the connection to that address, as soon as our
+    peer answers a challenge sent there.
+
+    @ivar migrationKey: the key, picked by the listening end along with
+    C{connectionID}, under which every packet carrying it is authenticated.
+
+    @ivar pathChallenges: the number of times, one retransmission timeout
+    apart, we challenge a new address our peer seems to be at before giving
+    up on it, unless it answers.
+
+    @ivar forwardErrorCorrection: whether we offer, on new connections, to
+    send and make use of parity segments, from which a receiver can rebuild a
+    segment lost from a group without waiting for it to be retransmitted.
+
+    @ivar fecPermitted: whether both we and our peer agreed, during the
+    handshake, to use parity segments on this connection.
+
+    @ivar lossRate: if C{fecPermitted}, our estimate of the proportion of the
+    segments we send which are lost: a moving average, weighted by
+    C{lossRateGain}, of the losses signalled by retransmission timeouts and
+    by runs of duplicate acknowledgements.  While it is below
+    C{minimumLossRate}, we send no parity; above that, we send a parity
+    segment for every C{parityGroupSize} segments of new data.
+
+    @ivar parityDelay: the fraction of C{smoothedRTT} an incomplete parity
+    group is held open, once we have no room to send more, for the segments
+    which would complete it; if we have nothing more to send, its parity is
+    sent at once.
+
+    @ivar parityGroupSize: the number of segments each of our parity segments
+    covers, or C{None} if we aren't sending any: as many as we expect to lose
+    C{parityGroupLosses} of, between C{minimumParityGroup} and
+    C{maximumParityGroup}.  Parity can only rebuild one segment of a group,
+    so a run of duplicate acknowledgements has to be this much longer before
+    we retransmit without waiting for the retransmission timer.
+
+    @ivar segmentsRecovered: the number of our peer's segments we have
+    rebuilt from parity.
+
+    @ivar fastOpen: whether we use fast open (RFC 7413 TFO) on new
+    connections.  Our SYNs ask for a fast-open cookie, which our peer, if it
+    uses fast open too, sends with its SYN-ACK; the next time we connect to
+    that address, so long as it was within C{PTCP.fastOpenCookieLifetime}
+    seconds, the application is told about the connection straight away, and
+    whatever it writes then goes with our SYN, along with the cookie.  A
+    listening connection which gets such a SYN, with a cookie it issued,
+    takes the data, and is established at once, a round trip sooner than
+    otherwise; if it doesn't take the data, it acknowledges only the SYN, and
+    the data is sent again once the handshake is complete.
+
+    @ivar segmentsSent: the number of segments we have sent, counting
+    retransmissions, parity and keep-alive probes; C{octetsSent} is the
+    number of octets of data in them.
+
+    @ivar segmentsReceived: the number of segments we have received from our
+    peer, whether or not they were any use; C{octetsReceived} is the number
+    of octets of data in them.
+
+    @ivar segmentsRetransmitted: the number of segments we have sent again.
+
+    @ivar duplicateAcksReceived: the number of acknowledgements we have
+    received which acknowledged nothing new while we had segments in flight.
+
+    @ivar _paritySegments: the data segments we have sent since our last
+    parity segment, which our next one will cover.
+
+    @ivar _parityTimer: C{None}, or the L{IDelayedCall} which will send the
+    parity of C{_paritySegments} before their group is complete.
+
+    @ivar _heldSegments: if C{fecPermitted}, a C{dict} mapping the relative
+    sequence numbers of the most recent segments of data we have received to
+    their data, to rebuild a lost neighbour of theirs with; and
+    C{_heldSegmentOrder}, a C{deque} of their sequence numbers, oldest first,
+    for forgetting them again.
+
+    @ivar duplicateAckThreshold: the number of acknowledgements in a row which
+    acknowledge nothing new that it takes for us to retransmit the oldest
+    unacknowledged segment without waiting for its retransmission timer.
+
+    @ivar reorderingTolerance: the most, as a fraction of C{smoothedRTT},
+    that C{_reorderingWindow} may be.
+
+    @ivar _recoveryPoint: C{None}, or, while we are recovering from a loss,
+    the relative sequence number we had sent up to when it was detected.
+    Until our peer acknowledges everything before it, each acknowledgement
+    of only part of it means the segment after that part was lost too, and
+    it is retransmitted straight away instead of when its timer goes off (RFC
+    6582); as are any which selective acknowledgements show to be lost.
+
+    @ivar _recoveredTo: while C{_recoveryPoint} is set, the relative sequence
+    number up to which lost segments have already been retransmitted during
+    the recovery; none is retransmitted twice this way.
+
+    @ivar _deliveredSentAt: C{None}, or when the most recently sent of the
+    segments our peer has acknowledged, without our having retransmitted it,
+    was sent.
+
+    @ivar _reorderingWindow: the longest we have seen a segment which
+    arrived after another, without being retransmitted, have been sent
+    before that other; how far apart two segments must have been sent for
+    the later one's arrival to show that the earlier one was lost rather
+    than overtaken (see L{_lostSegments}).
+
+    @ivar mtu: the largest number of octets of data we put in a segment.  This
+    starts out as whatever an earlier connection to the same host discovered
+    (see L{PTCP.getPathMTU}), or the most an Ethernet path will carry.  It is
+    lowered to C{minimumMTU} if segments of our size repeatedly go missing,
+    or to whatever got through, but no less than C{minimumMTU}, if our peer
+    tells us a segment we have in flight was truncated; in either case it is
+    raised again, no sooner than C{mtuProbeInterval} seconds later, by
+    sending a probe segment larger than C{mtu} and seeing whether it is
+    acknowledged.  Probes search, to within C{mtuProbeGranularity} octets,
+    for the largest size up to C{maximumMTU} which gets through (RFC 4821);
+    only the size of a probe which was acknowledged is remembered for later
+    connections to the same host.
+
+    @ivar blackHoleRetransmits: how many times the oldest unacknowledged
+    segment may be retransmitted before we suspect that segments of our size
+    are being silently dropped, and fall back to C{minimumMTU}.
+
+    @ivar _receiveBuffer: a list of strings of data which arrived in order
+    while the application had paused us, waiting to be delivered when it
+    resumes.  C{_receiveBufferSize} is their total length.
+
+    @ivar _reassemblyQueue: a list of C{(relativeSeq, packet)} tuples, sorted
+    by sequence number, holding segments which arrived inside our receive
+    window but ahead of C{nextRecvSeqNum}.  They are processed, in order, as
+    soon as the gap in front of them has been filled.
+
+    @ivar reassemblyLimit: the maximum number of segments which will be held
+    in C{_reassemblyQueue}; the receive window bounds the sequence space they
+    may occupy, this bounds the number of packets kept around to fill it.
+
+    @ivar _windowProbes: the number of zero-window probes sent since our
+    peer's window last closed; each waits twice as long as the one before,
+    up to C{maximumRetransmitTimeout}.
+
+    @ivar keepAliveInterval: once established, the number of seconds we wait
+    to hear anything from our peer before sending it a keep-alive probe, and
+    then between probes; or C{None}, never to send any.  If our peer answers
+    none of C{keepAliveProbes} probes, it is taken to be gone and the
+    connection times out (RFC 1122 4.2.3.6).
+
+    @ivar idleTimeout: the number of seconds after which the connection times
+    out if no data has been sent or received on it, or C{None}, for it never
+    to.
+
+    @ivar pacingRate: the rate, in octets per second, at which we spread out
+    the segments of new data we send, rather than sending a whole window of
+    them at once; or C{None} if they aren't paced.  This is C{pacingGain}
+    times our congestion window per C{smoothedRTT}, once we have measured
+    it, or C{maximumPacingRate} if that is lower; setting C{pacingGain} to
+    C{None} leaves only C{maximumPacingRate}.
+
+    @ivar pacingHorizon: the number of seconds' worth of C{pacingRate} we may
+    send at once, to catch up on time lost to timers going off late.
+
+    @ivar _lastReceived: when we last received a packet from our peer.
+
+    @ivar _lastData: when data was last sent or received.
+
+    @ivar _keepAliveProbes: the number of keep-alive probes sent since
+    C{_lastReceived}.
+
+    @ivar _pacedUntil: the time before which C{pacingRate} allows us to send
+    no more new data.
+
+    @ivar _reactor: the L{IReactorTime} provider we tell the time by; our
+    timers are armed through C{ptcp}, which is given the same one.
+
+    @ivar _fastOpenRequested: whether our peer's SYN asked us for a
+    fast-open cookie, and we are to send it one.
+
+    @ivar _state: the name of the state C{machine} is in, which it entered at
+    C{_stateEntered}.
+
+    @ivar _stateTimes: a C{dict} mapping the names of the states C{machine}
+    has left to the total number of seconds it spent in each.
     """
 
-    mtu = 512 - _fixedSize
+    mtu = 1500 - 20 - 8 - _fixedSize  # Ethernet, less IPv4 and UDP headers
+    minimumMTU = 512 - _fixedSize
+    maximumMTU = mtu
+    mtuProbeInterval = 600.0
+    mtuProbeGranularity = 32
+    blackHoleRetransmits = 3
 
-    recvWindow = mtu
+    recvWindow = 1 << 20
     sendWindow = mtu
-    sendWindowRemaining = mtu * 2
 
-    protocol = None
+    congestionControlFactory = RenoCongestionControl
+
+    reassemblyLimit = 1024
+
+    selectiveAcknowledgement = True
+    maximumSackBlocks = 8
+
+    connectionMigration = True
+    pathChallenges = 3
+
+    forwardErrorCorrection = False
+    lossRateGain = 1.0 / 32
+    minimumLossRate = 0.005
+    parityGroupLosses = 0.25
+    minimumParityGroup = 2
+    maximumParityGroup = 32
+    parityDelay = 0.25
+
+    fastOpen = False
+
+    keepAliveInterval = 60.0
+    keepAliveProbes = 4
+    idleTimeout = None
+
+    pacingGain = 2.0
+    maximumPacingRate = None
+    pacingHorizon = 0.002
+
+    # A dispatcher port may hold a great many connections, so the state every
+    # connection has lives in slots.  The instance dictionary is only there
+    # for the settings above, when they are overridden for one connection.
+    __slots__ = (
+        '__dict__',
+        'hostPseudoPort', 'peerPseudoPort', 'ptcp', 'factory',
+        'peerAddressTuple', 'protocol', 'machine', 'congestion',
+        'wasEverListen', 'disconnecting', 'disconnected',
+        'producer', 'producerPaused', 'streamingProducer',
+
+        'oldestUnackedSendSeqNum', 'nextSendSeqNum', 'hostSendISN',
+        'nextRecvSeqNum', 'peerSendISN', 'setPeerISN', 'sackPermitted',
+        'connectionID', 'migrationKey', '_pathChallenge',
+        'fecPermitted', '_fastOpenRequested',
+        '_sendWindowSeq', '_sendWindowAck', '_advertisedWindowEdge',
+
+        '_outgoingBytes', 'retransmissionQueue', '_duplicateAcks',
+        '_recoveryPoint', '_recoveredTo', '_deliveredSentAt',
+        '_reorderingWindow',
+        'retransmitTimeout', 'smoothedRTT', 'rttVariance',
+        '_mtuProbe', '_mtuCeiling', '_nextMTUProbe',
+
+        '_reassemblyQueue', '_receiveBuffer', '_receiveBufferSize',
+        '_paused', '_pendingFin',
+
+        '_nagle', '_retransmitter', '_windowProbe', '_windowProbes',
+        '_ackTimer',
+        '_timeWaitCall', '_closeWaitLoseConnection',
+
+        '_keepAliveTimer', '_lastReceived', '_lastData', '_keepAliveProbes',
+        '_pacedUntil',
+
+        'lossRate', 'segmentsRecovered', '_paritySegments', '_parityTimer',
+        '_heldSegments',
+        '_heldSegmentOrder',
+
+        '_reactor',
+
+        'segmentsSent', 'octetsSent', 'segmentsReceived', 'octetsReceived',
+        'segmentsRetransmitted', 'duplicateAcksReceived',
+        '_state', '_stateEntered', '_stateTimes',
+        )
 
     def __init__(self,
                  hostPseudoPort, peerPseudoPort,
-                 ptcp, factory, peerAddressTuple):
+                 ptcp, factory, peerAddressTuple, reactor=None):
+        if reactor is None:
+            reactor = _defaultReactor()
+        self._reactor = reactor
         self.hostPseudoPort = hostPseudoPort
         self.peerPseudoPort = peerPseudoPort
         self.ptcp = ptcp
         self.factory = factory
         self._receiveBuffer = []
+        self._receiveBufferSize = 0
+        self._paused = False
+        self._pendingFin = False
+        self._outgoingBytes = _SendBuffer()
+        self._reassemblyQueue = []
         self.retransmissionQueue = []
         self.peerAddressTuple = peerAddressTuple
+        self.protocol = None
+        self.wasEverListen = False
+
+        # This is *TWISTED* level state-machine stuff, not TCP-level.
+        self.disconnecting = False
+        self.disconnected = False
+        self.producer = None
+        self.producerPaused = False
+        self.streamingProducer = False
 
         self.oldestUnackedSendSeqNum = 0
         self.nextSendSeqNum = 0
@@ -362,9 +1149,129 @@ class PTCPConnection(object):
         self.nextRecvSeqNum = 0
         self.peerSendISN = 0
         self.setPeerISN = False
+        self.sackPermitted = False
+        self.connectionID = None
+        self.migrationKey = None
+        self._pathChallenge = None
+        self.fecPermitted = False
+        self._fastOpenRequested = False
+        self._sendWindowSeq = -1
+        self._sendWindowAck = -1
+        self._advertisedWindowEdge = 0
+        self._duplicateAcks = 0
+        self._recoveryPoint = None
+        self._recoveredTo = 0
+        self._deliveredSentAt = None
+        self._reorderingWindow = 0.0
+        self.smoothedRTT = None
+        self.rttVariance = None
+
+        self._nagle = None
+        self._retransmitter = None
+        self._windowProbe = None
+        self._windowProbes = 0
+        self._ackTimer = None
+        self._timeWaitCall = None
+        self._closeWaitLoseConnection = None
+
+        self._keepAliveTimer = None
+        self._lastReceived = self._lastData = None
+        self._keepAliveProbes = 0
+        self._pacedUntil = float('-inf')
+
+        self.lossRate = 0.0
+        self.segmentsRecovered = 0
+        self._paritySegments = None
+        self._parityTimer = None
+        self._heldSegments = None
+        self._heldSegmentOrder = None
+
+        self.segmentsSent = self.octetsSent = 0
+        self.segmentsReceived = self.octetsReceived = 0
+        self.segmentsRetransmitted = 0
+        self.duplicateAcksReceived = 0
+        self._state = 'closed'
+        self._stateEntered = self._reactor.seconds()
+        self._stateTimes = {}
+
+        self._mtuProbe = None
+        self._mtuCeiling = None
+        self._nextMTUProbe = 0
+        knownMTU = ptcp.getPathMTU(peerAddressTuple[0])
+        if knownMTU is not None:
+            self.mtu = knownMTU
+            self._nextMTUProbe = (
+                self._reactor.seconds() + self.mtuProbeInterval)
+        self.congestion = self.congestionControlFactory(self.mtu)
+        self.retransmitTimeout = self._retransmitTimeout
         self.machine = TCP(self)
 
-    peerSendISN = None
+    def sendWindowRemaining():
+        def get(self):
+            inFlight = self.nextSendSeqNum - self.oldestUnackedSendSeqNum
+            window = min(self.congestion.congestionWindow, self.sendWindow)
+            return max(0, window - inFlight)
+        return get,
+    sendWindowRemaining = property(*sendWindowRemaining())
+
+    def pacingRate():
+        def get(self):
+            rate = self.maximumPacingRate
+            if self.pacingGain is not None and self.smoothedRTT is not None:
+                estimate = (self.pacingGain * self.congestion.congestionWindow
+                            / max(self.smoothedRTT, self.clockGranularity))
+                if rate is None or estimate < rate:
+                    rate = estimate
+            return rate
+        return get,
+    pacingRate = property(*pacingRate())
+
+    def parityGroupSize():
+        def get(self):
+            if not self.fecPermitted or self.lossRate < self.minimumLossRate:
+                return None
+            size = int(self.parityGroupLosses / self.lossRate)
+            return max(self.minimumParityGroup,
+                       min(self.maximumParityGroup, size))
+        return get,
+    parityGroupSize = property(*parityGroupSize())
+
+    def getStatistics(self):
+        """
+        Take a snapshot of how this connection has fared so far.
+
+        @return: A C{dict} of our counters (C{segmentsSent}, C{octetsSent},
+            C{segmentsReceived}, C{octetsReceived}, C{segmentsRetransmitted},
+            C{duplicateAcksReceived}, C{segmentsRecovered}); of our estimates
+            of the path (C{smoothedRTT}, C{rttVariance},
+            C{retransmitTimeout}, C{lossRate}, C{mtu}); of our windows
+            (C{congestionWindow}, C{sendWindow}, and C{recvWindow}, as we would
+            advertise it now); of C{state}, the name of the state we
+            are in; and of C{stateTimes}, a C{dict} mapping the names of the
+            states we have been in to the number of seconds spent in each.
+        """
+        now = self._reactor.seconds()
+        stateTimes = dict(self._stateTimes)
+        stateTimes[self._state] = (stateTimes.get(self._state, 0.0)
+                                   + now - self._stateEntered)
+        return dict(
+            segmentsSent=self.segmentsSent,
+            octetsSent=self.octetsSent,
+            segmentsReceived=self.segmentsReceived,
+            octetsReceived=self.octetsReceived,
+            segmentsRetransmitted=self.segmentsRetransmitted,
+            duplicateAcksReceived=self.duplicateAcksReceived,
+            segmentsRecovered=self.segmentsRecovered,
+            smoothedRTT=self.smoothedRTT,
+            rttVariance=self.rttVariance,
+            retransmitTimeout=self.retransmitTimeout,
+            lossRate=self.lossRate,
+            mtu=self.mtu,
+            congestionWindow=self.congestion.congestionWindow,
+            sendWindow=self.sendWindow,
+            recvWindow=self.currentRecvWindow(),
+            state=self._state,
+            stateTimes=stateTimes)
 
     def packetReceived(self, packet):
         # XXX TODO: probably have to do something to the packet here to
@@ -372,28 +1279,41 @@ class PTCPConnection(object):
 
         # print 'received', self, packet
 
+        self.segmentsReceived += 1
+        self.octetsReceived += packet.dlen
+        self._lastReceived = self._reactor.seconds()
+        self._keepAliveProbes = 0
+
         if packet.stb:
-            # Shrink the MTU
-            [self.mtu] = struct.unpack('!H', packet.data)
-            rq = []
-            for pkt in self.retransmissionQueue:
-                rq.extend(pkt.fragment(self.mtu))
-            self.retransmissionQueue = rq
+            if packet.mig:
+                if not packet.ack:
+                    # Our peer wants to know that we are where it thinks we
+                    # are.
+                    self._sendPathPacket(packet.data, self.peerAddressTuple,
+                                         True)
+                return
+            self._segmentTruncated(packet)
             return
 
-        if self._paused:
+        if packet.fec and not packet.syn:
+            if self.fecPermitted:
+                self._parityReceived(packet)
             return
 
-        if packet.syn and packet.dlen:
-            # Whoops, what?  SYNs probably can contain data, I think, but I
-            # certainly don't see anything in the spec about how to deal with
-            # this or in ethereal for how linux deals with it -glyph
+        if packet.syn and packet.dlen and packet.ack:
+            # Data only goes with a SYN when it is fast-opening a connection,
+            # and is only taken by the end listening for it.
             raise BadPacketError(
-                "currently no data allowed in SYN packets: %r"
+                "no data allowed in SYN-ACK packets: %r"
                 % (packet,))
 
+        if not (packet.syn or self.setPeerISN):
+            # Until our peer's SYN arrives, there is no making sense of its
+            # sequence numbers; data sent straight after a SYN-ACK may
+            # overtake it.
+            return
+
         if packet.syn:
-            assert packet.segmentLength() == 1
             if self.peerAddressTuple is None:
                 # we're a server
                 assert self.wasEverListen, "Clients must specify a connect address."
@@ -410,34 +1330,113 @@ class PTCPConnection(object):
                 return
             self.setPeerISN = True
             self.peerSendISN = packet.seqNum
-            # syn, fin, and data are mutually exclusive, so this relative
+            if packet.ack:
+                self.sackPermitted = self.selectiveAcknowledgement and packet.sak
+                if (self.connectionMigration and packet.mig and
+                    packet.migrationKey is not None and
+                    len(packet.migrationKey) == _migrationKeySize):
+                    self.migrationKey = packet.migrationKey
+                    self.ptcp.connectionIdentified(self, packet.connectionID)
+                self._permitFEC(self.forwardErrorCorrection and packet.fec)
+                if self.fastOpen and packet.fastOpenCookie is not None:
+                    self.ptcp.setFastOpenCookie(self.peerAddressTuple,
+                                                packet.fastOpenCookie)
+            else:
+                self.sackPermitted = self.selectiveAcknowledgement and bool(
+                    packet.ackNum & _SYN_SACK_PERMITTED)
+                if (self.connectionMigration and
+                    packet.ackNum & _SYN_MIGRATION_PERMITTED):
+                    self.migrationKey = os.urandom(_migrationKeySize)
+                    self.ptcp.connectionIdentified(
+                        self, self.ptcp.newConnectionID())
+                self._permitFEC(self.forwardErrorCorrection and bool(
+                    packet.ackNum & _SYN_FEC_PERMITTED))
+                self._fastOpenRequested = self.fastOpen and bool(
+                    packet.ackNum & _SYN_FAST_OPEN)
+            # syn, fin, and data are mutually exclusive, except for the data
+            # of a fast open, which is dealt with separately; so this relative
             # sequence-number increment is done both here, and below in the
             # data/fin processing block.
-            self.nextRecvSeqNum += packet.segmentLength()
+            self.nextRecvSeqNum += 1
             if not packet.ack:
+                # There's no acknowledgement to check, below, before taking
+                # our peer's window.
+                self.sendWindow = packet.window
+                if packet.dlen:
+                    self._fastOpenReceived(packet)
+                    return
                 # Since "syn" and "synAck" are separate inputs, we produce
                 # 'synAck' below once we've ensured the ack is acceptable.
                 self.machine.syn()
 
+        packet.relativeTo(self.peerSendISN, self.hostSendISN)
+
+        if (packet.syn and packet.ack and self.retransmissionQueue
+            and self.retransmissionQueue[0].syn
+            and self.retransmissionQueue[0].dlen
+            and packet.relativeAck() == 1):
+            self._fastOpenRefused()
+
+        if packet.ack and packet.sackBlocks and self.sackPermitted:
+            self._selectivelyAcknowledged(packet.relativeSackBlocks())
+
+        windowChanged = packet.ack and self._updateSendWindow(packet)
+
         if packet.ack and ackAcceptable(self.oldestUnackedSendSeqNum,
                                         packet.relativeAck(),
                                         self.nextSendSeqNum):
             rq = self.retransmissionQueue
+            sentAt = earliest = None
             while rq and ((rq[0].relativeSeq() + rq[0].segmentLength())
                           <= packet.relativeAck()):
-                # fully acknowledged, as per RFC!
-                self.sendWindowRemaining += rq.pop(0).segmentLength()
-                # print 'inc send window', self, self.sendWindowRemaining
+                # fully acknowledged, as per RFC!  Only the newest segment
+                # this acknowledges measures the round trip, and not if it
+                # was retransmitted, or selectively acknowledged before.
+                acknowledged = rq.pop(0)
+                sentAt = acknowledged.sentAt
+                if earliest is None:
+                    earliest = sentAt
+                if acknowledged is self._mtuProbe:
+                    self._mtuProbeSucceeded()
+            if earliest is not None:
+                self._segmentsDelivered(earliest, sentAt)
+            if self.oldestUnackedSendSeqNum:
+                # (The acknowledgement of our SYN says nothing about how much
+                # data the path can take.)
+                self.congestion.acknowledged(
+                    packet.relativeAck() - self.oldestUnackedSendSeqNum)
             self.oldestUnackedSendSeqNum = packet.relativeAck()
+            self._duplicateAcks = 0
+            if self._recoveryPoint is not None:
+                if packet.relativeAck() >= self._recoveryPoint:
+                    self._recoveryPoint = None
+                elif not self._recoverLosses():
+                    return
+
+            # What's left may be due for retransmission later than what was
+            # just acknowledged.
+            self._rescheduleRetransmit()
 
             self.machine.maybeReceiveAck(packet)
 
             if not rq:
                 # write buffer is empty; alert the application layer.
                 self._writeBufferEmpty()
-
-
-        # XXX TODO: examine 'window' field and adjust sendWindowRemaining
+            elif self._outgoingBytes and self.sendWindowRemaining:
+                # The acknowledgement made room for more data.
+                self._writeLater()
+
+        elif (packet.ack and not packet.segmentLength()
+              and not windowChanged
+              and self.retransmissionQueue
+              and packet.relativeAck() == self.oldestUnackedSendSeqNum):
+            # The peer is telling us, again, where the gap in what it has
+            # received starts.
+            self._duplicateAcknowledgement()
+
+        elif windowChanged and self._outgoingBytes and self.sendWindowRemaining:
+            # A window update made room for more data.
+            self._writeLater()
         # is it 'occupying a portion of valid receive sequence space'?  I think
         # this means 'packet which might acceptably contain useful data'
         if not packet.segmentLength():
@@ -445,46 +1444,416 @@ class PTCPConnection(object):
             return
 
         if not segmentAcceptable(self.nextRecvSeqNum,
-                                 self.recvWindow,
+                                 self.currentRecvWindow(),
                                  packet.relativeSeq(),
                                  packet.segmentLength()):
             self.ackSoon()
             return
 
+        if self.fecPermitted and packet.dlen:
+            self._holdSegment(packet)
+
         if packet.relativeSeq() > self.nextRecvSeqNum:
-            # XXX: Here's what's going on.  Data can be 'in the window', but
-            # still in the future.  For example, if I have a window of length 3
-            # and I send segments DATA1(len 1) DATA2(len 1) FIN and you receive
-            # them in the order FIN DATA1 DATA2, you don't actually want to
-            # process the FIN until you've processed the data.
-
-            # For the moment we are just dropping anything that isn't exactly
-            # the next thing we want to process.  This is perfectly valid;
-            # these packets might have been dropped, so the other end will have
-            # to retransmit them anyway.
+            # Data can be 'in the window', but still in the future.  For
+            # example, if I have a window of length 3 and I send segments
+            # DATA1(len 1) DATA2(len 1) FIN and you receive them in the order
+            # FIN DATA1 DATA2, you don't actually want to process the FIN
+            # until you've processed the data.  Hold on to it until the gap
+            # is filled, and tell the peer right away where the gap starts.
+            self._enqueueOutOfOrder(packet)
+            self.originate(ack=True)
             return
 
         # OK!  It's acceptable!  Let's process the various bits of data.
+        self._processSegment(packet)
+
+        # That may have filled a gap in front of segments we already have.
+        rq = self._reassemblyQueue
+        while rq and not packet.fin and rq[0][0] <= self.nextRecvSeqNum:
+            seq, queued = rq.pop(0)
+            if seq + queued.segmentLength() > self.nextRecvSeqNum:
+                packet = queued
+                self._processSegment(packet)
+
+        if packet.fin:
+            del rq[:]
+            if self._receiveBuffer:
+                # Don't tell the application about the end of the stream
+                # until it has had everything before it.
+                self._pendingFin = True
+                self.ackSoon()
+            else:
+                self.machine.fin()
+        elif packet.segmentLength() > 0:
+            self.ackSoon()
+
+
+    def _fastOpenReceived(self, packet):
+        """
+        Our peer's SYN carried data: if it also carried the fast-open cookie
+        we would issue it, take the data, and tell the application about the
+        connection now, rather than a round trip later; otherwise, answer it
+        like any other SYN, and leave our peer to send the data again.
+        """
+        if not (self._fastOpenRequested and
+                self.ptcp.fastOpenCookieValid(self.peerAddressTuple[0],
+                                              packet.fastOpenCookie)):
+            self.machine.syn()
+            return
+        self.nextRecvSeqNum += packet.dlen
+        self.machine.fastOpen()
+        self._lastData = self._lastReceived
+        self._deliver(packet.data)
+
+
+    def _fastOpenRefused(self):
+        """
+        Our peer acknowledged our SYN, but not the data we sent with it; send
+        the data again, after the SYN.
+        """
+        syn = self.retransmissionQueue.pop(0)
+        self._outgoingBytes.prepend(syn.data)
+        self.nextSendSeqNum = 1
+
+
+    def cookieAcknowledged(self, packet, hostSendISN, sackPermitted):
+        """
+        Take up a listening connection whose SYN-ACK was sent by L{PTCP}
+        without keeping any state for it, now that C{packet} has acknowledged
+        it: carry on from where we would have been had we sent it ourselves.
+
+        @param packet: The acknowledgement, carrying a valid SYN cookie.
+
+        @param hostSendISN: The initial sequence number of the SYN-ACK; the
+            cookie itself.
+
+        @param sackPermitted: Whether the SYN-ACK agreed to use selective
+            acknowledgements.
+        """
+        self.setPeerISN = True
+        self.peerSendISN = (packet.seqNum - 1) % (2**32)
+        self.nextRecvSeqNum = 1
+        self.hostSendISN = hostSendISN
+        self.nextSendSeqNum = 1
+        self.sackPermitted = sackPermitted
+        self.machine.cookieAck()
+        self.packetReceived(packet)
+
+
+    def migrationAcceptable(self, packet):
+        """
+        Decide whether a packet carrying our connection ID, but from an
+        address we don't know, may be taken as coming from our peer: only if
+        it carries the right MAC, so that nobody else can have made it up,
+        and, unless it answers a path challenge, which L{pathValidated}
+        checks, is no older than what we have already received from our peer
+        and acknowledges nothing we haven't sent, as a packet replayed by
+        someone else is unlikely to be.
+        """
+        if self.migrationKey is None or not packet.verifyMAC(
+            self.migrationKey):
+            return False
+        if packet.stb:
+            return packet.ack
+        packet.relativeTo(self.peerSendISN, self.hostSendISN)
+        if not segmentAcceptable(self.nextRecvSeqNum,
+                                 self.currentRecvWindow(),
+                                 packet.relativeSeq(),
+                                 packet.segmentLength()):
+            return False
+        return not packet.ack or (self.oldestUnackedSendSeqNum
+                                  <= packet.relativeAck()
+                                  <= self.nextSendSeqNum)
+
+
+    def pathValidated(self, packet):
+        """
+        Find out whether a packet from a new address, which
+        L{migrationAcceptable} accepted, answers a path challenge we sent
+        there, so that our peer has shown it is really there.  If it
+        doesn't, challenge the new address, unless we already are; until our
+        peer answers, we carry on sending to it where it was.
+        """
+        address = packet.peerAddressTuple
+        if packet.stb:
+            return (self._pathChallenge is not None and
+                    self._pathChallenge[:2] == (address, packet.data))
+        if self._pathChallenge is None or self._pathChallenge[0] != address:
+            self._stopChallenging()
+            self._challengePath(address, os.urandom(_pathChallengeSize),
+                                self.pathChallenges)
+        return False
+
+
+    def _challengePath(self, address, challenge, remaining):
+        """
+        Send a path challenge to C{address}, and arrange to send it again if
+        it isn't answered, C{remaining} times in all.
+        """
+        if not remaining:
+            self._pathChallenge = None
+            return
+        self._sendPathPacket(challenge, address, False)
+        self._pathChallenge = (address, challenge, self.ptcp.callLater(
+                self.retransmitTimeout, self._challengePath, address,
+                challenge, remaining - 1))
+
+
+    def _stopChallenging(self):
+        if self._pathChallenge is not None:
+            self._pathChallenge[2].cancel()
+            self._pathChallenge = None
+
+
+    def _sendPathPacket(self, challenge, destination, answer):
+        """
+        Send a path challenge, or the answer to one.
+        """
+        self._sendPacket(PTCPPacket.create(
+                self.hostPseudoPort, self.peerPseudoPort,
+                (self.nextSendSeqNum + self.hostSendISN) % (2**32),
+                self.currentAckNum(), challenge,
+                window=self.currentRecvWindow(), ack=answer, stb=True,
+                destination=destination, connectionID=self.connectionID,
+                migrationKey=self.migrationKey))
+
+
+    def peerMigrated(self, peerAddressTuple):
+        """
+        Our peer has turned up at a new address; send everything there from
+        now on.  If it's a new host, rather than just a new port on the same
+        host, the path there is a new one too, so we have to find out how
+        much it can take and how long it takes all over again.
+        """
+        if peerAddressTuple[0] != self.peerAddressTuple[0]:
+            self.congestion = self.congestionControlFactory(self.mtu)
+            self.smoothedRTT = self.rttVariance = None
+            self.retransmitTimeout = self._retransmitTimeout
+        self.peerAddressTuple = peerAddressTuple
+        self._stopChallenging()
+        for p in self.retransmissionQueue:
+            p.destination = peerAddressTuple
+
+
+    def _enqueueOutOfOrder(self, packet):
+        """
+        Hold on to an acceptable segment which arrived ahead of
+        C{nextRecvSeqNum}, unless it is a duplicate of one we are already
+        holding or the reassembly queue is full.
+        """
+        rq = self._reassemblyQueue
+        seq = packet.relativeSeq()
+        i = bisect.bisect_left(rq, (seq,))
+        if i < len(rq) and rq[i][0] == seq:
+            return
+        if len(rq) >= self.reassemblyLimit:
+            return
+        rq.insert(i, (seq, packet))
+
+
+    def _updateSendWindow(self, packet):
+        """
+        Take our peer's window from an acknowledgement, unless it is older than
+        the one we last took it from (TCP RFC: SND.WL1 and SND.WL2, page 72).
+
+        @return: whether C{sendWindow} changed.
+        """
+        seq = packet.relativeSeq()
+        ack = packet.relativeAck()
+        if not (self.oldestUnackedSendSeqNum <= ack <= self.nextSendSeqNum):
+            return False
+        if (seq, ack) < (self._sendWindowSeq, self._sendWindowAck):
+            return False
+        self._sendWindowSeq = seq
+        self._sendWindowAck = ack
+        if packet.window == self.sendWindow:
+            return False
+        self.sendWindow = packet.window
+        if self.sendWindow:
+            self._windowProbes = 0
+            if self._windowProbe is not None:
+                self._windowProbe.cancel()
+                self._windowProbe = None
+        return True
+
+
+    def currentRecvWindow(self):
+        """
+        The window we currently allow our peer, to be advertised in the packets
+        we send: C{recvWindow}, less whatever is waiting in C{_receiveBuffer}.
+        """
+        return max(0, self.recvWindow - self._receiveBufferSize)
+
+
+    def _maybeUpdateWindow(self):
+        """
+        If our receive window has opened up by a useful amount since we last
+        told our peer where its right edge is, tell it now, rather than
+        leaving it to find out with a window probe (RFC 1122 4.2.3.3).
+        """
+        edge = self.nextRecvSeqNum + self.currentRecvWindow()
+        opened = edge - self._advertisedWindowEdge
+        if self.setPeerISN and opened >= min(self.mtu, self.recvWindow // 2):
+            self.originate(ack=True)
+
+
+    def _selectivelyAcknowledged(self, blocks):
+        """
+        Our peer has told us which ranges of sequence space beyond its
+        cumulative acknowledgement it is holding; mark the segments in
+        C{retransmissionQueue} which lie entirely within one of them.
+
+        The newest segment they cover for the first time has only just
+        arrived, so it measures the round trip.  The cumulative
+        acknowledgement which eventually covers any of them says nothing
+        about the round trip, however: they may have waited at our peer for
+        the gap before them to be filled for a long time since.
+        """
+        sentAt = earliest = None
+        for packet in self.retransmissionQueue:
+            if packet.sacked:
+                continue
+            start = packet.relativeSeq()
+            end = start + packet.segmentLength()
+            for (left, right) in blocks:
+                if left <= start and end <= right:
+                    packet.sacked = True
+                    if packet.sentAt is not None:
+                        sentAt = packet.sentAt
+                        if earliest is None:
+                            earliest = sentAt
+                        packet.sentAt = None
+                    break
+        if earliest is not None:
+            self._segmentsDelivered(earliest, sentAt)
+
+
+    def _sackBlocks(self):
+        """
+        Describe the contiguous ranges of sequence space held in
+        C{_reassemblyQueue}, lowest first, as wire sequence numbers for the
+        selective acknowledgement blocks of an outgoing packet.
+        """
+        blocks = []
+        for (seq, packet) in self._reassemblyQueue:
+            end = seq + packet.segmentLength()
+            if blocks and seq <= blocks[-1][1]:
+                blocks[-1][1] = max(blocks[-1][1], end)
+            elif len(blocks) < self.maximumSackBlocks:
+                blocks.append([seq, end])
+            else:
+                break
+        return [((left + self.peerSendISN) % (2**32),
+                 (right + self.peerSendISN) % (2**32))
+                for (left, right) in blocks]
+
+
+    def _permitFEC(self, permitted):
+        """
+        Settle, during the handshake, whether we use parity segments.
+        """
+        self.fecPermitted = permitted
+        if permitted:
+            self._paritySegments = []
+            self._heldSegments = {}
+            self._heldSegmentOrder = deque()
+
+
+    def _holdSegment(self, packet):
+        """
+        Keep the data of an acceptable segment for a while, in case a parity
+        segment covering it turns up to rebuild one of its neighbours with.
+        Parity comes straight after the group it covers, so only the last
+        two groups' worth of segments are kept.
+        """
+        seq = packet.relativeSeq()
+        held = self._heldSegments
+        order = self._heldSegmentOrder
+        if seq not in held:
+            order.append(seq)
+            if len(order) > 2 * self.maximumParityGroup:
+                held.pop(order.popleft(), None)
+        held[seq] = packet.data
+
+
+    def _parityReceived(self, packet):
+        """
+        Our peer has sent us the parity of a group of its segments.  If just
+        one of them is missing, rebuild it and take it as though it had
+        arrived.
+        """
+        packet.relativeTo(self.peerSendISN, self.hostSendISN)
+        held = self._heldSegments
+        first = packet.relativeSeq()
+        end = first + packet.window
+        seq = first
+        group = []
+        while seq < end and seq in held:
+            group.append(seq)
+            seq += len(held[seq])
+        if seq >= end:
+            # We have them all.
+            return
+        missing = seq
+        later = [s for s in held if missing < s < end]
+        if later:
+            resume = min(later)
+        else:
+            resume = end
+        seq = resume
+        while seq < end and seq in held:
+            group.append(seq)
+            seq += len(held[seq])
+        length = resume - missing
+        if (seq != end or len(group) != packet.ackNum - 1
+            or length > packet.dlen):
+            # More than one of them is missing.
+            return
+        data = _xor([packet.data] + [held.pop(s) for s in group],
+                    packet.dlen)[:length]
+        if missing + length <= self.nextRecvSeqNum:
+            # It was retransmitted after all.
+            return
+        self.segmentsRecovered += 1
+        self.packetReceived(PTCPPacket(
+                packet.sourcePseudoPort, packet.destPseudoPort,
+                (missing + self.peerSendISN) % (2**32), 0, 0, 0, 0,
+                length, data, packet.peerAddressTuple))
+
+
+    def _processSegment(self, packet):
+        """
+        Deliver the data of an in-order segment (one which starts at or before
+        C{nextRecvSeqNum} and ends after it) to the application, and advance
+        C{nextRecvSeqNum} past it.  FIN processing is left to the caller.
+        """
         # Where is the useful data in the packet?
         if packet.dlen:
             usefulData = packet.data[self.nextRecvSeqNum - packet.relativeSeq():]
             # DONT check/slice the window size here, the acceptability code
             # checked it, we can over-ack if the other side is buggy (???)
 
-            self.machine.segmentReceived()
-            if self.protocol is not None:
-                try:
-                    self.protocol.dataReceived(usefulData)
-                except:
-                    log.err()
-                    self.loseConnection()
+            self.machine.receiveSegment()
+            self._lastData = self._lastReceived
+            if self._paused or self._receiveBuffer:
+                self._receiveBuffer.append(usefulData)
+                self._receiveBufferSize += len(usefulData)
+            else:
+                self._deliver(usefulData)
 
-        self.nextRecvSeqNum += packet.segmentLength()
+        self.nextRecvSeqNum = packet.relativeSeq() + packet.segmentLength()
 
-        if packet.fin:
-            self.machine.fin()
-        elif packet.segmentLength() > 0:
-            self.ackSoon()
+
+    def _deliver(self, data):
+        """
+        Give some received data to the application.
+        """
+        if self.protocol is not None:
+            try:
+                self.protocol.dataReceived(data)
+            except:
+                log.err()
+                self.loseConnection()
 
 
     def getHost(self):
@@ -496,46 +1865,350 @@ class PTCPConnection(object):
         return PTCPAddress(self.peerAddressTuple,
                            self.pseudoPortPair)
 
-    _outgoingBytes = ''
-    _nagle = None
 
     def write(self, bytes):
         assert not self.disconnected, 'Writing to a transport that was already disconnected.'
-        self._outgoingBytes += bytes
+        self._outgoingBytes.append(bytes)
         self._writeLater()
 
 
     def writeSequence(self, seq):
-        self.write(''.join(seq))
+        assert not self.disconnected, 'Writing to a transport that was already disconnected.'
+        for bytes in seq:
+            self._outgoingBytes.append(bytes)
+        self._writeLater()
 
 
     def _writeLater(self):
         if self._nagle is None:
-            self._nagle = reactor.callLater(SEND_DELAY, self._reallyWrite)
+            self._nagle = self.ptcp.callLater(SEND_DELAY, self._reallyWrite)
 
-    def _originateOneData(self):
-        amount = min(self.sendWindowRemaining, self.mtu)
-        sendOut = self._outgoingBytes[:amount]
+    def _originateOneData(self, amount):
+        sendOut = self._outgoingBytes.take(amount)
         # print 'originating data packet', len(sendOut)
-        self._outgoingBytes = self._outgoingBytes[amount:]
-        self.sendWindowRemaining -= len(sendOut)
-        self.originate(ack=True, data=sendOut)
+        rate = self.pacingRate
+        if rate is not None:
+            self._pacedUntil = (
+                max(self._pacedUntil,
+                    self._reactor.seconds() - self.pacingHorizon)
+                + (_fixedSize + len(sendOut)) / float(rate))
+        return self.originate(ack=True, data=sendOut)
+
+    def _protectSegment(self, packet):
+        """
+        Count a segment of new data we just sent into our next parity segment,
+        and send that if its group is complete.
+        """
+        self.lossRate -= self.lossRate * self.lossRateGain
+        size = self.parityGroupSize
+        if size is None:
+            return
+        self._paritySegments.append(packet)
+        if len(self._paritySegments) >= size:
+            self._sendParity()
+
+    def _sendParity(self):
+        """
+        Send the parity of the segments we have sent since we last did.
+        """
+        self._stopParityTimer()
+        group, self._paritySegments = self._paritySegments, []
+        size = max([p.dlen for p in group])
+        self._sendPacket(PTCPPacket.create(
+                self.hostPseudoPort, self.peerPseudoPort,
+                group[0].seqNum, len(group),
+                _xor([p.data for p in group], size),
+                window=sum([p.dlen for p in group]), fec=True,
+                destination=self.peerAddressTuple,
+                connectionID=self.connectionID,
+                migrationKey=self.migrationKey))
+
+    def _sendParityLater(self):
+        """
+        Hold the group of C{_paritySegments} open for more segments, but only
+        for C{parityDelay} of a round trip.
+        """
+        if self._parityTimer is None:
+            rtt = self.smoothedRTT
+            if rtt is None:
+                rtt = self.retransmitTimeout
+            self._parityTimer = self.ptcp.callLater(
+                rtt * self.parityDelay, self._parityTimedOut)
+
+    def _parityTimedOut(self):
+        self._parityTimer = None
+        if self._paritySegments:
+            self._sendParity()
+
+    def _stopParityTimer(self):
+        if self._parityTimer is not None:
+            self._parityTimer.cancel()
+            self._parityTimer = None
+
+    def _lossObserved(self, segments=1):
+        """
+        Some of our segments have evidently gone missing; count them towards
+        C{lossRate}.
+        """
+        if self.fecPermitted:
+            self.lossRate = min(
+                1.0, self.lossRate + segments * self.lossRateGain)
+
+    def _paceLater(self):
+        """
+        If C{pacingRate} doesn't allow us to send any more new data yet,
+        arrange to carry on writing when it does.
+
+        @return: whether we must wait.
+        """
+        delay = self._pacedUntil - self._reactor.seconds()
+        if delay <= 0:
+            return False
+        if self._nagle is None:
+            self._nagle = self.ptcp.callLater(delay, self._reallyWrite)
+        return True
 
     def _reallyWrite(self):
         # print self, 'really writing', self._paused
         self._nagle = None
+        if not self.setPeerISN:
+            # Anything written once our SYN has gone has to wait for our
+            # peer's, to be acknowledged in.
+            return
         if self._outgoingBytes:
             # print 'window and bytes', self.sendWindowRemaining, len(self._outgoingBytes)
+            probeSize = self._mtuProbeSize()
+            if (probeSize is not None
+                and len(self._outgoingBytes) >= probeSize
+                and self.sendWindowRemaining >= probeSize):
+                self._mtuProbe = self._originateOneData(probeSize)
             while self.sendWindowRemaining and self._outgoingBytes:
-                self._originateOneData()
+                if self._paceLater():
+                    break
+                packet = self._originateOneData(
+                    min(self.sendWindowRemaining, self.mtu))
+                if self.fecPermitted:
+                    self._protectSegment(packet)
+            if self._paritySegments:
+                # Don't leave the end of what we have sent unprotected for
+                # long, but don't make the group any smaller than it must be.
+                if self._outgoingBytes:
+                    self._sendParityLater()
+                else:
+                    self._sendParity()
+            if (self._outgoingBytes and not self.sendWindow
+                and not self.retransmissionQueue):
+                self._probeWindowLater()
+
+
+    def _mtuProbeSize(self):
+        """
+        Decide how big a segment to send to find out whether our path can take
+        larger segments than C{mtu}.
+
+        @return: the size of the probe to send, or C{None} if we shouldn't
+            send one now.
+        """
+        if (self._mtuProbe is not None or self.mtu >= self.maximumMTU
+            or self._reactor.seconds() < self._nextMTUProbe):
+            return None
+        if self._mtuCeiling is None:
+            # Optimistically, try for the lot first.
+            return self.maximumMTU
+        size = (self.mtu + self._mtuCeiling) // 2
+        if size - self.mtu < self.mtuProbeGranularity:
+            # That's as close as we need to get; look again later, in case
+            # the path has changed.
+            self._mtuCeiling = None
+            self._nextMTUProbe = (
+                self._reactor.seconds() + self.mtuProbeInterval)
+            return None
+        return size
+
+    def _mtuProbeSucceeded(self):
+        """
+        Our probe segment was acknowledged, so segments of its size get
+        through.
+        """
+        probe, self._mtuProbe = self._mtuProbe, None
+        self._setMTU(probe.dlen)
+        self.ptcp.setPathMTU(self.peerAddressTuple[0], probe.dlen)
+
+    def _mtuProbeFailed(self):
+        """
+        Our probe segment went missing, which we take to mean that it was too
+        big rather than that the network is congested.  Send its data again in
+        segments of our usual size.
+        """
+        probe, self._mtuProbe = self._mtuProbe, None
+        self._mtuCeiling = probe.dlen
+        fragments = probe.fragment(self.mtu)
+        rq = self.retransmissionQueue
+        i = rq.index(probe)
+        rq[i:i + 1] = fragments
+        for fragment in fragments:
+            self._resend(fragment)
+
+    def _segmentTruncated(self, packet):
+        """
+        Our peer says one of our segments was truncated on its way, to the
+        size C{packet} carries.  Believe it only of a segment we have in
+        flight, which it names by sequence number in the acknowledgement
+        number field, and only as far as making our segments smaller, but no
+        smaller than C{minimumMTU}.
+        """
+        if len(packet.data) != 2:
+            return
+        [mtu] = struct.unpack('!H', packet.data)
+        truncated = [p for p in self.retransmissionQueue
+                     if p.seqNum == packet.ackNum and p.dlen > mtu]
+        if not truncated:
+            return
+        if truncated[0] is self._mtuProbe and mtu >= self.mtu:
+            self._mtuProbeFailed()
+        elif mtu < self.mtu:
+            self._limitMTU(max(mtu, self.minimumMTU))
+
+    def _limitMTU(self, mtu):
+        """
+        Our segments don't get through at their current size, but do at
+        C{mtu}; use that size until it's time to probe for a larger one.
+        """
+        self._setMTU(mtu)
+        self._mtuCeiling = None
+        self._nextMTUProbe = self._reactor.seconds() + self.mtuProbeInterval
+
+    def _setMTU(self, mtu):
+        """
+        Change the size of the segments we send, and split up any waiting to
+        be retransmitted which are now too big.
+        """
+        self.mtu = mtu
+        self.congestion.maximumSegmentSize = mtu
+        if self._mtuProbe is not None and self._mtuProbe.dlen > mtu:
+            self._mtuProbe = None
+        rq = []
+        for pkt in self.retransmissionQueue:
+            for fragment in pkt.fragment(mtu):
+                fragment.transmittedAt = pkt.transmittedAt
+                fragment.firstSentAt = pkt.firstSentAt
+                rq.append(fragment)
+        self.retransmissionQueue = rq
+
+
+    def _probeWindowLater(self):
+        """
+        Our peer's window is closed and we have nothing in flight, so there is
+        nothing to prompt it to tell us when it opens again; arrange to find
+        out for ourselves (TCP RFC: the persist timer).
+        """
+        if self._windowProbe is None:
+            delay = min(self.retransmitTimeout * 2 ** min(self._windowProbes,
+                                                          16),
+                        self.maximumRetransmitTimeout)
+            self._windowProbe = self.ptcp.callLater(delay, self._probeWindow)
+
+    def _probeWindow(self):
+        """
+        Prompt our peer to tell us its window, with the same probe as a
+        keep-alive, and keep doing so, backing off, for as long as the window
+        stays closed.  The probe is not queued for retransmission: our peer
+        may keep its window closed indefinitely (RFC 1122 4.2.2.17), and
+        every answer it sends shows it is still there, so an unopened window
+        is neither a loss nor a reason to give up on the connection.
+        """
+        self._windowProbe = None
+        if (self._outgoingBytes and not self.sendWindow
+            and not self.retransmissionQueue):
+            self._windowProbes += 1
+            self._sendKeepAlive()
+            self._probeWindowLater()
 
-    _retransmitter = None
     _retransmitTimeout = 0.5
+    duplicateAckThreshold = 3
+    reorderingTolerance = 0.25
+    minimumRetransmitTimeout = 0.2
+    maximumRetransmitTimeout = 60.0
+    maximumRetransmitTime = 100.0
+    clockGranularity = 0.001
+
+
+    def _segmentsDelivered(self, earliest, latest):
+        """
+        Our peer has just acknowledged, cumulatively or selectively, segments
+        we sent only once, the oldest of them at C{earliest}.
+
+        @param latest: when the newest segment acknowledged was sent, which
+            measures the round trip; or C{None} if we sent that one more than
+            once.
+        """
+        delivered = self._deliveredSentAt
+        if delivered is not None and earliest < delivered:
+            # Something sent after it got there first.
+            self._reorderingWindow = max(self._reorderingWindow,
+                                         delivered - earliest)
+        newest = earliest
+        if latest is not None:
+            newest = latest
+            self._roundTripMeasured(self._reactor.seconds() - latest)
+        if delivered is None or newest > delivered:
+            self._deliveredSentAt = newest
+
+    def _roundTripMeasured(self, rtt):
+        """
+        Update our round-trip time estimates with a new measurement, and derive
+        a new retransmission timeout from them, as per RFC 6298.
+        """
+        if self.smoothedRTT is None:
+            self.smoothedRTT = rtt
+            self.rttVariance = rtt / 2.0
+        else:
+            self.rttVariance = (0.75 * self.rttVariance +
+                                0.25 * abs(self.smoothedRTT - rtt))
+            self.smoothedRTT = 0.875 * self.smoothedRTT + 0.125 * rtt
+        rto = self.smoothedRTT + max(self.clockGranularity,
+                                     4 * self.rttVariance)
+        self.retransmitTimeout = min(self.maximumRetransmitTimeout,
+                                     max(self.minimumRetransmitTimeout, rto))
 
     def _retransmitLater(self):
-        if self._retransmitter is None:
-            self._retransmitter = reactor.callLater(self._retransmitTimeout,
-                                                    self._reallyRetransmit)
+        """
+        Make sure the retransmission timer will go off when the first of the
+        segments in C{retransmissionQueue} is due to be retransmitted, or when
+        the connection is due to time out, if that is sooner.
+        """
+        if self._retransmitter is None and self.retransmissionQueue:
+            due = min(p.transmittedAt for p in self._unsackedSegments())
+            due += self.retransmitTimeout
+            giveUp = self._giveUpAt()
+            if giveUp is not None:
+                due = min(due, giveUp)
+            delay = max(0, due - self._reactor.seconds())
+            self._retransmitter = self.ptcp.callLater(delay,
+                                                      self._reallyRetransmit)
+
+    def _rescheduleRetransmit(self):
+        """
+        The segments in C{retransmissionQueue} have changed; set the
+        retransmission timer for whichever of them is now due first.
+        """
+        if self._retransmitter is not None:
+            self._retransmitter.cancel()
+            self._retransmitter = None
+        self._retransmitLater()
+
+    def _giveUpAt(self):
+        """
+        Find out when the oldest segment in C{retransmissionQueue} will have
+        gone unacknowledged for C{maximumRetransmitTime}, at which point the
+        connection times out, however few retransmissions it has had.
+
+        @return: that time, or C{None} if the queue is empty.
+        """
+        rq = self.retransmissionQueue
+        if not rq or rq[0].firstSentAt is None:
+            return None
+        return rq[0].firstSentAt + self.maximumRetransmitTime
 
     def _stopRetransmitting(self):
         # used both as a quick-and-dirty test shutdown hack and a way to shut
@@ -543,30 +2216,242 @@ class PTCPConnection(object):
         if self._retransmitter is not None:
             self._retransmitter.cancel()
             self._retransmitter = None
+        if self._windowProbe is not None:
+            self._windowProbe.cancel()
+            self._windowProbe = None
         if self._nagle is not None:
             self._nagle.cancel()
             self._nagle = None
         if self._closeWaitLoseConnection is not None:
             self._closeWaitLoseConnection.cancel()
             self._closeWaitLoseConnection = None
+        if self._keepAliveTimer is not None:
+            self._keepAliveTimer.cancel()
+            self._keepAliveTimer = None
 
     def _reallyRetransmit(self):
         # XXX TODO: packet fragmentation & coalescing.
-        # print 'Wee a retransmit!  What I got?', self.retransmissionQueue
         self._retransmitter = None
-        if self.retransmissionQueue:
-            for packet in self.retransmissionQueue:
-                packet.retransmitCount -= 1
-                if packet.retransmitCount:
-                    packet.ackNum = self.currentAckNum()
-                    self.ptcp.sendPacket(packet)
-                else:
-                    self.machine.timeout()
+        giveUp = self._giveUpAt()
+        if (giveUp is not None
+            and self._reactor.seconds() + self.clockGranularity >= giveUp):
+            self.machine.timeout()
+            return
+        # Anything which would be due within the resolution of the clock is
+        # due now; otherwise we'd only reschedule ourselves for no time at all.
+        deadline = (self._reactor.seconds() - self.retransmitTimeout
+                    + self.clockGranularity)
+        probe = self._mtuProbe
+        if probe is not None and probe.transmittedAt <= deadline:
+            self._mtuProbeFailed()
+        rq = self.retransmissionQueue
+        if (rq and rq[0].transmittedAt <= deadline
+            and rq[0].retransmissions >= self.blackHoleRetransmits
+            and self.mtu > self.minimumMTU and rq[0].dlen > self.minimumMTU):
+            # Perhaps segments our size are being silently dropped somewhere
+            # along the way; see if smaller ones fare any better.
+            self._limitMTU(self.minimumMTU)
+        expired = [p for p in self._unsackedSegments()
+                   if p.transmittedAt <= deadline]
+        if expired:
+            self.congestion.timedOut(
+                self.nextSendSeqNum - self.oldestUnackedSendSeqNum)
+            self._lossObserved(len(expired))
+            for packet in expired:
+                if not self._retransmit(packet):
                     return
-            self._retransmitLater()
+            # Whatever else was in flight may have been lost with them.
+            self._recoveryPoint = self.nextSendSeqNum
+            self._recoveredTo = max(
+                self._recoveredTo,
+                packet.relativeSeq() + packet.segmentLength())
+            self.retransmitTimeout = min(self.retransmitTimeout * 2,
+                                         self.maximumRetransmitTimeout)
+        self._retransmitLater()
+
+    def _unsackedSegments(self):
+        """
+        The segments in C{retransmissionQueue} which may need to be
+        retransmitted: all but those our peer has told us it is holding.  The
+        first is never skipped, since if our peer still had it, it would have
+        acknowledged it.
+        """
+        rq = self.retransmissionQueue
+        return rq[:1] + [p for p in rq[1:] if not p.sacked]
+
+    def _retransmit(self, packet):
+        """
+        Send a segment from C{retransmissionQueue} again, unless it has run out
+        of retransmission attempts, in which case the connection times out.
+
+        @return: C{True} if the segment was sent, C{False} if the connection
+            timed out instead.
+        """
+        if packet.retransmitCount <= 1:
+            self.machine.timeout()
+            return False
+        packet.retransmissions += 1
+        self._resend(packet)
+        return True
+
+    def _resend(self, packet):
+        """
+        Send a segment from C{retransmissionQueue} again, with up-to-date
+        acknowledgement information.
+        """
+        if packet.ack:
+            packet.ackNum = self.currentAckNum()
+        # Karn's algorithm: there's no telling which transmission an
+        # acknowledgement of this packet will be for.
+        packet.sentAt = None
+        packet.transmittedAt = self._reactor.seconds()
+        self.segmentsRetransmitted += 1
+        self._sendPacket(packet)
+
+    def _keepAliveLater(self):
+        """
+        Arrange to send the next keep-alive probe, or to time out, whichever
+        comes first, if either is called for.
+        """
+        due = []
+        if self.keepAliveInterval is not None:
+            due.append(self._lastReceived +
+                       self.keepAliveInterval * (self._keepAliveProbes + 1))
+        if self.idleTimeout is not None:
+            due.append(self._lastData + self.idleTimeout)
+        if due:
+            self._keepAliveTimer = self.ptcp.callLater(
+                max(0, min(due) - self._reactor.seconds()), self._keepAlive)
+
+    def _keepAlive(self):
+        """
+        Our keep-alive timer went off; it may be time to send another probe,
+        or to give up on our peer.  Either way, set it again.
+        """
+        self._keepAliveTimer = None
+        now = self._reactor.seconds()
+        if (self.idleTimeout is not None
+            and now >= self._lastData + self.idleTimeout):
+            self._reap()
+            return
+        if (self.keepAliveInterval is not None
+            and now >= self._lastReceived +
+            self.keepAliveInterval * (self._keepAliveProbes + 1)):
+            if self._keepAliveProbes >= self.keepAliveProbes:
+                self._reap()
+                return
+            self._keepAliveProbes += 1
+            self._sendKeepAlive()
+        self._keepAliveLater()
 
-    disconnecting = False       # This is *TWISTED* level state-machine stuff,
-                                # not TCP-level.
+    def _sendKeepAlive(self):
+        """
+        Send our peer a garbage octet from just before its receive window,
+        which it will refuse, and answer with an acknowledgement of what it
+        has really received.  The probe is not queued for retransmission.
+        """
+        self._sendPacket(PTCPPacket.create(
+                self.hostPseudoPort, self.peerPseudoPort,
+                (self.nextSendSeqNum - 1 + self.hostSendISN) % (2**32),
+                self.currentAckNum(), '\x00',
+                window=self.currentRecvWindow(), ack=True,
+                destination=self.peerAddressTuple,
+                connectionID=self.connectionID,
+                migrationKey=self.migrationKey))
+
+    def _reap(self):
+        """
+        Give up on an idle connection, or on a peer which no longer answers.
+        """
+        self.ptcp.connectionReaped(self)
+        self.machine.timeout()
+
+    def _duplicateAcknowledgement(self):
+        """
+        Our peer acknowledged nothing new while we have segments in flight,
+        which it does when segments arrive after a gap.  Enough of these in a
+        row mean the segment at the start of the gap was lost, and it is
+        retransmitted without waiting for its timer (RFC 5681 fast
+        retransmit); unless we are sending parity, in which case our peer may
+        be able to rebuild it once the rest of its group arrives.
+        """
+        self._duplicateAcks += 1
+        self.duplicateAcksReceived += 1
+        if self._duplicateAcks == 1:
+            self._lossObserved()
+        threshold = self.duplicateAckThreshold + (self.parityGroupSize or 0)
+        if (self._duplicateAcks == threshold
+            and self.retransmissionQueue[0] is self._mtuProbe):
+            self._mtuProbeFailed()
+            self._rescheduleRetransmit()
+        elif (self._recoveryPoint is not None
+              or self._duplicateAcks >= threshold):
+            self._recoverLosses()
+
+    def _lostSegments(self):
+        """
+        Find the segments in C{retransmissionQueue} which are evidently lost.
+
+        This is called once there have been C{duplicateAckThreshold}
+        duplicate acknowledgements, or during a recovery.  Without selective
+        acknowledgements, only ever the oldest segment is lost.  With them,
+        it is any which was sent more than C{_reorderingWindow} before the
+        newest segment our peer has since received was first sent; anything
+        sent that much earlier which has not arrived is not merely overtaken
+        on the way (RFC 8985).  The duplicate acknowledgements alone are
+        enough for the oldest only if we have never seen our segments
+        overtake one another.  Once a recovery has begun, the oldest is lost
+        if it was sent before then, since our peer would have acknowledged it
+        long since otherwise.
+
+        @return: a list of those not yet retransmitted during the current
+            recovery, oldest first.
+        """
+        rq = self.retransmissionQueue
+        if not rq:
+            return []
+        first = rq[0]
+        if self._recoveryPoint is None:
+            recoveredTo = self.oldestUnackedSendSeqNum
+            firstLost = not (self.sackPermitted and self._reorderingWindow)
+        else:
+            recoveredTo = self._recoveredTo
+            firstLost = first.relativeSeq() < self._recoveryPoint
+        deadline = None
+        if self.sackPermitted and self._deliveredSentAt is not None:
+            deadline = self._deliveredSentAt - min(
+                self._reorderingWindow,
+                self.reorderingTolerance * self.smoothedRTT)
+        lost = []
+        for p in rq:
+            if p.sacked or p.relativeSeq() < recoveredTo:
+                continue
+            if ((p is first and firstLost)
+                or (deadline is not None and p.transmittedAt <= deadline)):
+                lost.append(p)
+        return lost
+
+    def _recoverLosses(self):
+        """
+        Retransmit whichever segments L{_lostSegments} finds, without waiting
+        for their timers, starting a recovery if there isn't one already.
+
+        @return: C{False} if the connection timed out instead, C{True}
+            otherwise.
+        """
+        lost = self._lostSegments()
+        if not lost:
+            return True
+        if self._recoveryPoint is None:
+            self.congestion.lost(
+                self.nextSendSeqNum - self.oldestUnackedSendSeqNum)
+            self._recoveryPoint = self.nextSendSeqNum
+        for packet in lost:
+            self._recoveredTo = packet.relativeSeq() + packet.segmentLength()
+            if not self._retransmit(packet):
+                return False
+        self._rescheduleRetransmit()
+        return True
 
     def loseConnection(self):
         if not self.disconnecting:
@@ -600,11 +2485,6 @@ class PTCPConnection(object):
             pass
 
 
-    disconnected = False
-    producer = None
-    producerPaused = False
-    streamingProducer = False
-
     def registerProducer(self, producer, streaming):
         if self.producer is not None:
             raise RuntimeError(
@@ -624,17 +2504,35 @@ class PTCPConnection(object):
         if not self._outgoingBytes:
             self._writeBufferEmpty()
 
-    _paused = False
     def pauseProducing(self):
+        """
+        Stop delivering data to the application.  Data which arrives in the
+        meantime is held in C{_receiveBuffer}, which shrinks the window we
+        advertise until our peer has to stop sending.
+        """
         self._paused = True
 
     def resumeProducing(self):
+        """
+        Deliver whatever arrived while we were paused, and tell our peer that
+        our window has opened again.
+        """
         self._paused = False
+        while self._receiveBuffer and not self._paused:
+            data = self._receiveBuffer.pop(0)
+            self._receiveBufferSize -= len(data)
+            self._deliver(data)
+        if self._paused or self.disconnected:
+            return
+        if self._pendingFin:
+            self._pendingFin = False
+            self.machine.fin()
+        else:
+            self._maybeUpdateWindow()
 
     def currentAckNum(self):
         return (self.nextRecvSeqNum + self.peerSendISN) % (2**32)
 
-    _ackTimer = None
     def ackSoon(self):
         """
         Emit an acknowledgement packet soon.
@@ -643,7 +2541,7 @@ class PTCPConnection(object):
             def originateAck():
                 self._ackTimer = None
                 self.originate(ack=True)
-            self._ackTimer = reactor.callLater(0.1, originateAck)
+            self._ackTimer = self.ptcp.callLater(0.1, originateAck)
         else:
             self._ackTimer.reset(ACK_DELAY)
 
@@ -661,15 +2559,53 @@ class PTCPConnection(object):
             assert self.nextSendSeqNum == 0, (
                 "NSSN = " + repr(self.nextSendSeqNum))
             assert self.hostSendISN == 0
+        ackNum = self.currentAckNum()
+        sak = fec = False
+        sackBlocks = ()
+        fastOpenCookie = None
+        if syn and not ack:
+            ackNum = _SYN_ANY_ISN
+            if self.selectiveAcknowledgement:
+                ackNum |= _SYN_SACK_PERMITTED
+            if self.connectionMigration:
+                ackNum |= _SYN_MIGRATION_PERMITTED
+            if self.forwardErrorCorrection:
+                ackNum |= _SYN_FEC_PERMITTED
+            if self.fastOpen:
+                ackNum |= _SYN_FAST_OPEN
+                if self._outgoingBytes:
+                    fastOpenCookie = self.ptcp.getFastOpenCookie(
+                        self.peerAddressTuple)
+                if fastOpenCookie is not None:
+                    data = self._outgoingBytes.take(
+                        self.mtu - _fastOpenCookieSize)
+        elif syn:
+            sak = self.sackPermitted
+            fec = self.fecPermitted
+            if self._fastOpenRequested:
+                fastOpenCookie = self.ptcp.issueFastOpenCookie(
+                    self.peerAddressTuple[0])
+        elif (ack and self.sackPermitted and self._reassemblyQueue
+              and not (data or fin or rst)):
+            sackBlocks = self._sackBlocks()
+        window = self.currentRecvWindow()
+        self._advertisedWindowEdge = self.nextRecvSeqNum + window
         p = PTCPPacket.create(self.hostPseudoPort,
                               self.peerPseudoPort,
                               seqNum=(self.nextSendSeqNum +
                                       self.hostSendISN) % (2**32),
-                              ackNum=self.currentAckNum(),
+                              ackNum=ackNum,
                               data=data,
-                              window=self.recvWindow,
-                              syn=syn, ack=ack, fin=fin, rst=rst,
-                              destination=self.peerAddressTuple)
+                              window=window,
+                              syn=syn, ack=ack, fin=fin, rst=rst, sak=sak,
+                              fec=fec, destination=self.peerAddressTuple,
+                              sackBlocks=sackBlocks,
+                              connectionID=self.connectionID,
+                              migrationKey=self.migrationKey,
+                              fastOpenCookie=fastOpenCookie)
+        p.relativeTo(self.hostSendISN, self.peerSendISN)
+        if data:
+            self._lastData = self._reactor.seconds()
         # do we want to enqueue this packet for retransmission?
         sl = p.segmentLength()
         self.nextSendSeqNum += sl
@@ -680,6 +2616,8 @@ class PTCPConnection(object):
                 if self.retransmissionQueue[-1].fin:
                     raise AssertionError("Sending %r after FIN??!" % (p,))
             # print 'putting it on the queue'
+            p.sentAt = p.transmittedAt = p.firstSentAt = (
+                self._reactor.seconds())
             self.retransmissionQueue.append(p)
             # print 'and sending it later'
             self._retransmitLater()
@@ -691,21 +2629,37 @@ class PTCPConnection(object):
             else:
                 # print 'my queue is still small enough', len(self.retransmissionQueue), self, self.sendWindowRemaining
                 pass
-        self.ptcp.sendPacket(p)
+        self._sendPacket(p)
         return p
 
+    def _sendPacket(self, packet):
+        """
+        Hand a packet to C{ptcp} to send, counting it.
+        """
+        self.segmentsSent += 1
+        self.octetsSent += len(packet.data)
+        self.ptcp.sendPacket(packet)
+
 
     # State machine transition definitions, hooray.
     def outgoingConnectionFailed(self):
         """
         The connection never got anywhere.  Goodbye.
         """
+        if self.protocol is not None:
+            # The application was told about it early, to send data with our
+            # SYN.
+            self.disconnected = True
+            protocol, self.protocol = self.protocol, None
+            try:
+                protocol.connectionLost(Failure(error.TimeoutError()))
+            except:
+                log.err()
+            return
         # XXX CONNECTOR API OMFG
         self.factory.clientConnectionFailed(None, error.TimeoutError())
 
 
-    wasEverListen = False
-
     def nowListeningSocket(self):
         # Spec says this is necessary for RST handling; we need it for making
         # sure it's OK to bind port numbers.
@@ -714,6 +2668,8 @@ class PTCPConnection(object):
     def releaseConnectionResources(self):
         self.ptcp.connectionClosed(self)
         self._stopRetransmitting()
+        self._stopChallenging()
+        self._stopParityTimer()
         if self._timeWaitCall is not None:
             self._timeWaitCall.cancel()
             self._timeWaitCall = None
@@ -721,20 +2677,17 @@ class PTCPConnection(object):
             self._ackTimer.cancel()
             self._ackTimer = None
 
-    _timeWaitCall = None
     _timeWaitTimeout = 0.01     # REALLY fast timeout, right now this is for
                                 # the tests...
 
     def scheduleTimeWaitTimeout(self):
         self._stopRetransmitting()
-        self._timeWaitCall = reactor.callLater(self._timeWaitTimeout, self._do2mslTimeout)
+        self._timeWaitCall = self.ptcp.callLater(self._timeWaitTimeout, self._do2mslTimeout)
 
     def _do2mslTimeout(self):
         self._timeWaitCall = None
         self.machine.timeout()
 
-    peerAddressTuple = None
-
     def pseudoPortPair():
         def get(self):
             return (self.hostPseudoPort,
@@ -742,11 +2695,44 @@ class PTCPConnection(object):
         return get,
     pseudoPortPair = property(*pseudoPortPair())
 
+    def stateChanged(self, state):
+        """
+        Our state machine has moved into a new state; account for the time
+        spent in the one it left.
+        """
+        now = self._reactor.seconds()
+        self._stateTimes[self._state] = (
+            self._stateTimes.get(self._state, 0.0) + now - self._stateEntered)
+        self._state = state
+        self._stateEntered = now
+
     def connectionJustEstablished(self):
         """
         We sent out SYN, they acknowledged it.  Congratulations, you
         have a new baby connection.
         """
+        self._lastData = self._lastReceived = self._reactor.seconds()
+        self._keepAliveLater()
+        if self.protocol is None:
+            # (Unless it was introduced to the application already, to send
+            # data with our SYN.)
+            self._makeProtocol()
+
+    def activeOpen(self):
+        """
+        Connect to our peer.  If we have a fast-open cookie from it, the
+        application is told about the connection now, so that whatever it
+        writes straight away can go with our SYN.
+        """
+        if (self.fastOpen and
+            self.ptcp.getFastOpenCookie(self.peerAddressTuple) is not None):
+            self._makeProtocol()
+        self.machine.appActiveOpen()
+
+    def _makeProtocol(self):
+        """
+        Build the application's protocol, and connect it to us.
+        """
         assert not self.disconnecting
         assert not self.disconnected
         try:
@@ -760,11 +2746,11 @@ class PTCPConnection(object):
         else:
             self.protocol = p
 
-    def connectionJustEnded(self):
+    def connectionJustEnded(self, reason=CONNECTION_DONE):
         assert not self.disconnected
         self.disconnected = True
         try:
-            self.protocol.connectionLost(Failure(CONNECTION_DONE))
+            self.protocol.connectionLost(Failure(reason))
         except:
             log.err()
         self.protocol = None
@@ -777,14 +2763,33 @@ class PTCPConnection(object):
             self.producer = None
 
 
-    _closeWaitLoseConnection = None
+    def connectionTimedOut(self):
+        """
+        We gave up on our peer, however far the stream got; the application
+        must not take that for a clean close.
+        """
+        self.connectionJustEnded(error.TimeoutError())
+
+
+    def connectionBroken(self, reason):
+        """
+        Something went wrong with the connection which it can't recover
+        from: tell the application, and let go of everything it holds.
+
+        @param reason: The exception to give the application as the reason
+            its connection was lost.
+        """
+        if self.protocol is not None and not self.disconnected:
+            self.connectionJustEnded(reason)
+        self.releaseConnectionResources()
+
 
     def nowHalfClosed(self):
         # TODO: look for IHalfCloseableProtocol, call the appropriate methods
         def appCloseNow():
             self._closeWaitLoseConnection = None
             self.loseConnection()
-        self._closeWaitLoseConnection = reactor.callLater(0.01, appCloseNow)
+        self._closeWaitLoseConnection = self.ptcp.callLater(0.01, appCloseNow)
 
 
 
@@ -833,6 +2838,13 @@ class _PendingEvent(object):
 
 
 
+# The counters of PTCPConnection which PTCP.getStatistics totals.
+_connectionCounters = ('segmentsSent', 'segmentsReceived',
+                       'segmentsRetransmitted', 'duplicateAcksReceived',
+                       'segmentsRecovered')
+
+
+
 class PTCP(protocol.DatagramProtocol):
     """
     L{PTCP} implements a strongly TCP-like protocol on top of UDP.  It
@@ -860,12 +2872,225 @@ class PTCP(protocol.DatagramProtocol):
         instances.
     @type _connections: C{dict}
 
+    @ivar _reactor: The L{IReactorTime} provider all our connections tell
+        the time by and arm their timers with; C{reactor} by default, but
+        anything else which keeps time, like a L{twisted.internet.task.Clock}
+        or a L{vertex.netsim.Network}, will do.
+
+    @ivar _timers: The L{TimerWheel} our connections arm their timers on.
+
+    @ivar bandwidthLimit: The most octets per second all our connections
+        together may send, or C{None}, for no limit; see L{setBandwidthLimit}.
+
+    @ivar _egress: The L{EgressScheduler} which decides when, and in what
+        order, the packets our connections send are written to our
+        transport: each connection's in turn, and all of them no faster than
+        C{bandwidthLimit}.  Whatever may be written is written once the
+        reactor has finished with whatever it is doing now; if our transport
+        has a C{writeBatch} method, like L{vertex.batchudp.BatchedUDPPort},
+        all in one call to it.
+
+    @ivar batching: Whether packets which may be sent right away wait for the
+        reactor to write them in a batch; if not, and there is no
+        C{bandwidthLimit}, each is written to our transport as it is sent.
+
+    @ivar synCookieThreshold: The number of half-open connections (ones whose
+        SYN we have answered, but whose handshake has not completed) beyond
+        which we answer SYNs with SYN cookies rather than setting up a
+        connection for them; or C{None}, never to do so.  A SYN cookie is a
+        SYN-ACK whose initial sequence number authenticates the SYN it answers,
+        so that the connection can be set up when, and only if, the
+        acknowledgement of it arrives, and nothing need be kept for it until
+        then.  Peers whose SYN doesn't say they take any initial sequence
+        number always get a connection set up for them.
+
+    @ivar synCookieInterval: The number of seconds a SYN cookie is good for;
+        an acknowledgement of one must arrive within between one and two of
+        these intervals of its being sent.
+
+    @ivar cookiesIssued: The number of SYN cookies we have sent.
+
+    @ivar cookiesAccepted: The number of connections we have set up for
+        acknowledgements carrying a valid SYN cookie.
+
+    @ivar halfOpenConnections: The number of connections whose handshake is
+        still in progress.
+
+    @ivar connectionsReaped: The number of connections which have timed out
+        for having been idle too long, or because their peer stopped
+        answering keep-alive probes.
+
+    @ivar connectionsMigrated: The number of times a connection has moved to
+        a new peer address; see L{PTCPConnection.connectionID}.
+
+    @ivar datagramsReceived: The number of datagrams which have arrived on
+        our transport; C{octetsReceived} is the number of octets in them.
+
+    @ivar datagramsSent: The number of datagrams we have written to our
+        transport; C{octetsSent} is the number of octets in them.
+
+    @ivar dropped: A C{dict} mapping the reasons we throw datagrams away to
+        the number thrown away for each: C{'short'}, for those too short to
+        hold a header; C{'truncated'}, for those which have lost the end of
+        their data; C{'garbage'}, for those with more data than their header
+        says; C{'checksum'}, for those whose checksum is wrong;
+        C{'unexpected'}, for those which are not for any of our connections
+        and can't start one; and C{'malformed'}, for those which our
+        connections find to make no sense.
+
+    @ivar fastOpenCookieLifetime: The most seconds after a PTCP port sends
+        us a fast-open cookie that we use it to fast-open connections to it;
+        see L{PTCPConnection.fastOpen}.
+
+    @ivar _fastOpenCookies: A C{dict} mapping the C{(host, port)} addresses
+        of the PTCP ports which have sent us fast-open cookies to two-tuples
+        of the latest cookie and when it arrived.
+
+    @ivar dropLogInterval: The fewest seconds between the messages we log
+        about throwing datagrams away, so that a flood of bad ones costs no
+        more than counting them; or C{None}, never to log any.
+
+    @ivar _halfOpen: The C{set} of the keys in C{_connections} of the
+        connections whose handshake is still in progress.
+
+    @ivar _identified: A C{dict} mapping connection IDs to the connections
+        which use them.  A SYN cookie has no room for a connection ID, so
+        connections set up by one don't have one.
+
+    @ivar _cookieSecret: The key our SYN cookies are computed with.
     """
+    synCookieThreshold = 128
+    synCookieInterval = 64.0
+    dropLogInterval = 60.0
+    fastOpenCookieLifetime = 3600.0
+
     # External API
 
-    def __init__(self, factory):
+    def __init__(self, factory, bandwidthLimit=None, reactor=None,
+                 batching=True):
+        if reactor is None:
+            reactor = _defaultReactor()
         self.factory = factory
+        self._reactor = reactor
+        self.batching = batching
         self._allConnectionsClosed = _PendingEvent()
+        self._pathMTUs = {}
+        self._timers = TimerWheel(reactor)
+        self._egress = EgressScheduler(reactor, self._writeDatagrams,
+                                       bandwidthLimit)
+        self._cookieSecret = os.urandom(16)
+        self.cookiesIssued = 0
+        self.cookiesAccepted = 0
+        self.connectionsReaped = 0
+        self.connectionsMigrated = 0
+        self.datagramsReceived = self.octetsReceived = 0
+        self.datagramsSent = self.octetsSent = 0
+        self.dropped = {}
+        self._dropLoggedAt = None
+        self._fastOpenCookies = {}
+
+
+    def bandwidthLimit():
+        def get(self):
+            return self._egress.bandwidthLimit
+        return get,
+    bandwidthLimit = property(*bandwidthLimit())
+
+
+    def setBandwidthLimit(self, bandwidthLimit):
+        """
+        Change the most octets per second all our connections together may
+        send.
+
+        @param bandwidthLimit: The new limit, or C{None}, for no limit.
+        """
+        self._egress.bandwidthLimit = bandwidthLimit
+
+
+    def halfOpenConnections():
+        def get(self):
+            return len(self._halfOpen)
+        return get,
+    halfOpenConnections = property(*halfOpenConnections())
+
+
+    def getPathMTU(self, host):
+        """
+        Find out what our connections have discovered about the size of the
+        segments they can send to a host.
+
+        @param host: The IP address of the host.
+        @type host: C{str}
+
+        @return: The largest number of octets of data a segment to C{host}
+            was last found to be able to carry, or C{None} if we don't know.
+        """
+        return self._pathMTUs.get(host)
+
+
+    def setPathMTU(self, host, mtu):
+        """
+        Remember the largest number of octets of data a segment to C{host}
+        has been found to be able to carry, for future connections.
+        """
+        self._pathMTUs[host] = mtu
+
+
+    def getFastOpenCookie(self, address):
+        """
+        Find the fast-open cookie the PTCP port at an address sent us, if it
+        did so no more than C{fastOpenCookieLifetime} seconds ago.
+
+        @param address: The C{(host, port)} address of the port.
+
+        @return: The cookie, or C{None}.
+        """
+        cookie, issued = self._fastOpenCookies.get(address, (None, None))
+        if (cookie is None or
+            self._reactor.seconds() - issued > self.fastOpenCookieLifetime):
+            return None
+        return cookie
+
+
+    def setFastOpenCookie(self, address, cookie):
+        """
+        Remember the fast-open cookie the PTCP port at an address has just
+        sent us, for fast-opening connections to it in future.
+        """
+        self._fastOpenCookies[address] = (cookie, self._reactor.seconds())
+
+
+    def issueFastOpenCookie(self, host):
+        """
+        Compute the fast-open cookie we issue to a host: a MAC of its address,
+        so that we need remember nothing about it to check it later.
+
+        @param host: The IP address of the host.
+        @type host: C{str}
+        """
+        return hmac.new(self._cookieSecret, 'fast open ' + host,
+                        hashlib.sha256).digest()[:_fastOpenCookieSize]
+
+
+    def fastOpenCookieValid(self, host, cookie):
+        """
+        Check a fast-open cookie sent to us by a host.
+
+        @return: Whether we would issue that host that cookie.
+        """
+        return cookie is not None and hmac.compare_digest(
+            cookie, self.issueFastOpenCookie(host))
+
+
+    def callLater(self, delay, f, *args, **kw):
+        """
+        Arm a timer for one of our connections.  All of their timers share a
+        single L{TimerWheel}, and so a single delayed call in the reactor,
+        however many connections there are.
+
+        @return: An L{IDelayedCall} provider for the timer.
+        """
+        return self._timers.callLater(delay, f, *args, **kw)
 
 
     def connect(self, factory, host, port, pseudoPort=1):
@@ -896,14 +3121,42 @@ class PTCP(protocol.DatagramProtocol):
         sourcePseudoPort = genConnID() % MAX_PSEUDO_PORT
         conn = self._connections[(pseudoPort, sourcePseudoPort, (host, port))
                                  ] = PTCPConnection(
-            sourcePseudoPort, pseudoPort, self, factory, (host, port))
-        conn.machine.appActiveOpen()
+            sourcePseudoPort, pseudoPort, self, factory, (host, port),
+            self._reactor)
+        conn.activeOpen()
         return conn
 
     def sendPacket(self, packet):
+        """
+        Send a packet, as soon as its connection's turn comes round and our
+        bandwidth limit allows.
+        """
+        if self.transportGoneAway:
+            return
+        if (not self.batching and self._egress.bandwidthLimit is None
+            and not self._egress.pending()):
+            self._writeDatagrams([(packet.encode(), packet.destination)])
+            return
+        key = (packet.destPseudoPort, packet.sourcePseudoPort,
+               packet.destination)
+        self._egress.enqueue(key, packet.encode(), packet.destination)
+
+
+    def _writeDatagrams(self, datagrams):
+        """
+        Write some datagrams to our transport, all at once if it can take a
+        batch of them.
+        """
         if self.transportGoneAway:
             return
-        self.transport.write(packet.encode(), packet.destination)
+        self.datagramsSent += len(datagrams)
+        self.octetsSent += sum([len(datagram) for datagram, addr in datagrams])
+        writeBatch = getattr(self.transport, 'writeBatch', None)
+        if writeBatch is not None:
+            writeBatch(datagrams)
+        else:
+            for datagram, addr in datagrams:
+                self.transport.write(datagram, addr)
 
 
     # Internal stuff
@@ -911,6 +3164,8 @@ class PTCP(protocol.DatagramProtocol):
         self.transportGoneAway = False
         self._lastConnID = 10 # random.randrange(2 ** 32)
         self._connections = {}
+        self._halfOpen = set()
+        self._identified = {}
 
     def _finalCleanup(self):
         """
@@ -931,6 +3186,7 @@ class PTCP(protocol.DatagramProtocol):
         opriate application-level messages.
         """
         self.transportGoneAway = True
+        self._egress.discard()
         self._finalCleanup()
 
     def cleanupAndClose(self):
@@ -948,37 +3204,95 @@ class PTCP(protocol.DatagramProtocol):
         return self._stop()
 
     def datagramReceived(self, bytes, addr):
+        self.datagramsReceived += 1
+        self.octetsReceived += len(bytes)
         if len(bytes) < _fixedSize:
             # It can't be any good.
+            self._drop('short', addr)
             return
 
         pkt = PTCPPacket.decode(bytes, addr)
         try:
             pkt.verifyChecksum()
         except TruncatedDataError:
-#             print '(ptcp packet truncated: %r)' % (pkt,)
+            self._drop('truncated', addr)
             self.sendPacket(
                 PTCPPacket.create(
                     pkt.destPseudoPort,
                     pkt.sourcePseudoPort,
                     0,
-                    0,
+                    # Say which segment it was, so that its sender can tell
+                    # we really saw it.
+                    pkt.seqNum,
                     struct.pack('!H', len(pkt.data)),
                     stb=True,
                     destination=addr))
         except GarbageDataError:
-            print("garbage data!", pkt)
-        except ChecksumMismatchError, cme:
-            print("bad checksum", pkt, cme)
-            print(repr(pkt.data))
-            print(hex(pkt.checksum), hex(pkt.computeChecksum()))
+            self._drop('garbage', addr)
+        except ChecksumMismatchError:
+            self._drop('checksum', addr)
         else:
             self.packetReceived(pkt)
 
+
+    def _drop(self, reason, addr):
+        """
+        Count a datagram we are throwing away, and say so in the log, unless
+        we did less than C{dropLogInterval} seconds ago.
+
+        @param reason: The key in C{dropped} to count it under.
+
+        @param addr: The address it came from.
+        """
+        self.dropped[reason] = self.dropped.get(reason, 0) + 1
+        if self.dropLogInterval is None:
+            return
+        now = self._reactor.seconds()
+        if (self._dropLoggedAt is not None
+            and now < self._dropLoggedAt + self.dropLogInterval):
+            return
+        self._dropLoggedAt = now
+        log.msg("PTCP dropped a datagram from %r (%s); %d dropped so far" % (
+                addr, reason, sum(self.dropped.values())))
+
+
+    def getStatistics(self):
+        """
+        Take a snapshot of how this port and its connections have fared so
+        far.
+
+        @return: A C{dict} of our counters (C{datagramsReceived},
+            C{octetsReceived}, C{datagramsSent}, C{octetsSent},
+            C{cookiesIssued}, C{cookiesAccepted}, C{connectionsReaped},
+            C{connectionsMigrated}); of C{dropped}, a copy of ours; of the
+            numbers of C{connections} and C{halfOpenConnections} we have now;
+            and of the totals of those counters of L{PTCPConnection} which
+            count segments, over the connections we have now.
+        """
+        stats = dict(
+            datagramsReceived=self.datagramsReceived,
+            octetsReceived=self.octetsReceived,
+            datagramsSent=self.datagramsSent,
+            octetsSent=self.octetsSent,
+            cookiesIssued=self.cookiesIssued,
+            cookiesAccepted=self.cookiesAccepted,
+            connectionsReaped=self.connectionsReaped,
+            connectionsMigrated=self.connectionsMigrated,
+            dropped=dict(self.dropped),
+            connections=len(self._connections),
+            halfOpenConnections=self.halfOpenConnections)
+        for name in _connectionCounters:
+            stats[name] = 0
+        for conn in self._connections.itervalues():
+            for name in _connectionCounters:
+                stats[name] += getattr(conn, name)
+        return stats
+
     stopped = False
     def _stop(self, result=None):
         if not self.stopped:
             self.stopped = True
+            self._egress.flush()
             return self.transport.stopListening()
         else:
             return defer.succeed(None)
@@ -992,10 +3306,30 @@ class PTCP(protocol.DatagramProtocol):
             return self._stop()
         return self._allConnectionsClosed.deferred().addBoth(self._stop)
 
+    def _connectionFailed(self, conn, packey):
+        """
+        A connection blew up on a packet: break it off, unless it already
+        let go of its resources.
+        """
+        if self._connections.get(packey) is not conn:
+            return
+        try:
+            conn.connectionBroken(error.ConnectionLost(
+                    "PTCP connection failed on a packet from its peer"))
+        except:
+            log.err()
+            if self._connections.get(packey) is conn:
+                del self._connections[packey]
+                self._halfOpen.discard(packey)
+
+
     def connectionClosed(self, ptcpConn):
         packey = (ptcpConn.peerPseudoPort, ptcpConn.hostPseudoPort,
                   ptcpConn.peerAddressTuple)
         del self._connections[packey]
+        self._halfOpen.discard(packey)
+        if self._identified.get(ptcpConn.connectionID) is ptcpConn:
+            del self._identified[ptcpConn.connectionID]
         if ((not self.transportGoneAway) and
             (not self._connections) and
             self.factory is None):
@@ -1003,21 +3337,181 @@ class PTCP(protocol.DatagramProtocol):
         if not self._connections:
             self._allConnectionsClosed.callback(None)
 
+    def connectionReaped(self, ptcpConn):
+        """
+        One of our connections is about to time out, having been idle too long
+        or lost touch with its peer.
+        """
+        self.connectionsReaped += 1
+
+    def newConnectionID(self):
+        """
+        Pick an ID for a new connection, which none of our others is using.
+        """
+        while True:
+            [connectionID] = _connectionID.unpack(os.urandom(_connectionIDSize))
+            if connectionID not in self._identified:
+                return connectionID
+
+    def connectionIdentified(self, ptcpConn, connectionID):
+        """
+        One of our connections and its peer have agreed on an ID for it.
+        Should another of our connections already be using the same one (which
+        can only happen if its peer picked it), the connection will not be
+        found by it, but will still carry it for its peer's sake.
+        """
+        ptcpConn.connectionID = connectionID
+        self._identified.setdefault(connectionID, ptcpConn)
+
     def packetReceived(self, packet):
         packey = (packet.sourcePseudoPort, packet.destPseudoPort, packet.peerAddressTuple)
-        if packey not in self._connections:
+        cookie = None
+        conn = self._connections.get(packey)
+        if conn is None:
             if packet.flags == _SYN and packet.destPseudoPort == 1: # SYN and _ONLY_ SYN set.
-                conn = PTCPConnection(packet.destPseudoPort,
-                                      packet.sourcePseudoPort, self,
-                                      self.factory, packet.peerAddressTuple)
-                conn.machine.appPassiveOpen()
-                self._connections[packey] = conn
+                if (self.synCookieThreshold is not None and
+                    len(self._halfOpen) >= self.synCookieThreshold and
+                    packet.ackNum & _SYN_ANY_ISN):
+                    self._sendSynCookie(packet)
+                    return
+                conn = self._passiveOpen(packey)
+                self._halfOpen.add(packey)
+            elif packet.mig:
+                conn = self._migrate(packet, packey)
+                if conn is None:
+                    self._drop('unexpected', packet.peerAddressTuple)
+                    return
+                packey = (conn.peerPseudoPort, conn.hostPseudoPort,
+                          conn.peerAddressTuple)
             else:
-                log.msg("corrupted packet? %r %r %r" % (packet,packey, self._connections))
-                return
+                if packet.destPseudoPort == 1 and not (
+                    packet.flags & ~(_ACK | _SAK)) and packet.ack:
+                    cookie = self._checkSynCookie(packet)
+                if cookie is None:
+                    self._drop('unexpected', packet.peerAddressTuple)
+                    return
+                conn = self._passiveOpen(packey)
+                self.cookiesAccepted += 1
         try:
-            self._connections[packey].packetReceived(packet)
+            if cookie is None:
+                conn.packetReceived(packet)
+            else:
+                conn.cookieAcknowledged(packet, *cookie)
+        except BadPacketError:
+            self._drop('malformed', packet.peerAddressTuple)
+            self._connectionFailed(conn, packey)
         except:
             log.msg("PTCPConnection error on %r:" % (packet,))
             log.err()
-            del self._connections[packey]
+            self._connectionFailed(conn, packey)
+        else:
+            if packey in self._halfOpen and (conn.machine.isEstablished() or
+                                             conn.disconnected):
+                self._halfOpen.discard(packey)
+
+
+    def _migrate(self, packet, packey):
+        """
+        A packet has arrived from an address we don't know, carrying a
+        connection ID; if the connection using it is established, and the
+        packet is really from its peer, move the connection there, once its
+        peer has answered a challenge sent there.
+
+        @return: The connection, moved or not yet, or C{None} if the packet
+            isn't for any.
+        """
+        conn = self._identified.get(packet.connectionID)
+        if (conn is None or not conn.machine.isEstablished()
+            or conn.peerPseudoPort != packet.sourcePseudoPort
+            or conn.hostPseudoPort != packet.destPseudoPort
+            or not conn.migrationAcceptable(packet)):
+            return None
+        if not conn.pathValidated(packet):
+            return conn
+        log.msg("PTCP connection %r moving from %r to %r" % (
+                packet.connectionID, conn.peerAddressTuple,
+                packet.peerAddressTuple))
+        del self._connections[(conn.peerPseudoPort, conn.hostPseudoPort,
+                               conn.peerAddressTuple)]
+        conn.peerMigrated(packet.peerAddressTuple)
+        self._connections[packey] = conn
+        self.connectionsMigrated += 1
+        return conn
+
+
+    def _passiveOpen(self, packey):
+        """
+        Set up a connection to answer a peer connecting to us.
+        """
+        peerPseudoPort, hostPseudoPort, peerAddressTuple = packey
+        conn = PTCPConnection(hostPseudoPort, peerPseudoPort, self,
+                              self.factory, peerAddressTuple, self._reactor)
+        conn.machine.appPassiveOpen()
+        self._connections[packey] = conn
+        return conn
+
+
+    def _synCookie(self, peerAddressTuple, peerPseudoPort, peerSendISN,
+                   counter, sackPermitted):
+        """
+        Compute a SYN cookie: a MAC of the SYN it answers and of the interval
+        it is sent in, with the bottom three bits given over to the last two
+        bits of C{counter} and to whether we agreed to selective
+        acknowledgements.
+
+        @param counter: The number of C{synCookieInterval}s since the epoch.
+
+        @return: The cookie, as an initial sequence number.
+        """
+        host, port = peerAddressTuple
+        message = struct.pack('!QHHL?', counter, port, peerPseudoPort,
+                              peerSendISN, sackPermitted) + host
+        [mac] = struct.unpack(
+            '!L', hmac.new(self._cookieSecret, message,
+                           hashlib.sha256).digest()[:4])
+        return (mac & ~7 & 0xffffffff) | ((counter & 3) << 1) | sackPermitted
+
+
+    def _cookieCounter(self):
+        return int(self._reactor.seconds() // self.synCookieInterval)
+
+
+    def _sendSynCookie(self, packet):
+        """
+        Answer a SYN with a SYN-ACK whose initial sequence number is a SYN
+        cookie, without setting up a connection for it.
+        """
+        sackPermitted = (PTCPConnection.selectiveAcknowledgement and
+                         bool(packet.ackNum & _SYN_SACK_PERMITTED))
+        cookie = self._synCookie(packet.peerAddressTuple,
+                                 packet.sourcePseudoPort, packet.seqNum,
+                                 self._cookieCounter(), sackPermitted)
+        self.cookiesIssued += 1
+        self.sendPacket(PTCPPacket.create(
+                packet.destPseudoPort, packet.sourcePseudoPort,
+                cookie, (packet.seqNum + 1) % (2**32), '',
+                window=PTCPConnection.recvWindow,
+                syn=True, ack=True, sak=sackPermitted,
+                destination=packet.peerAddressTuple))
+
+
+    def _checkSynCookie(self, packet):
+        """
+        Find out whether an acknowledgement for no connection we know of is
+        the acknowledgement of a SYN cookie we sent in this interval or the
+        one before.
+
+        @return: C{None} if it isn't, otherwise a two-tuple of the cookie and
+            whether it agreed to selective acknowledgements.
+        """
+        cookie = (packet.ackNum - 1) % (2**32)
+        peerSendISN = (packet.seqNum - 1) % (2**32)
+        sackPermitted = bool(cookie & 1)
+        now = self._cookieCounter()
+        for counter in (now, now - 1):
+            if ((counter & 3) == (cookie >> 1) & 3 and
+                self._synCookie(packet.peerAddressTuple,
+                                packet.sourcePseudoPort, peerSendISN,
+                                counter, sackPermitted) == cookie):
+                return cookie, sackPermitted
+        return None
@@ -0,0 +1,499 @@
+# -*- test-case-name: vertex.test.test_ptcpshard -*-
+# Copyright 2005 Divmod, Inc.  See LICENSE file for details
+
+"""
+Sharing the PTCP traffic of one UDP port among several processes.
+
+A single L{ptcp.PTCP} can only ever use one core.  L{ShardedPTCPService}
+starts several worker processes instead, each with its own L{ptcp.PTCP} bound
+to the same UDP port with C{SO_REUSEPORT}, and lets the kernel divide the
+datagrams arriving on it among them.
+
+Every datagram a PTCP connection receives has to reach the worker holding its
+state, so the division must depend on nothing but where the datagram came
+from, and must not change while the workers are running.  Where the kernel
+allows it (Linux 4.5 and later), the workers install a small BPF program which
+picks the worker given by L{shardFor}; the parent can then also tell which
+worker a peer's connections belong to.  Elsewhere, the kernel's own hash of
+the datagram's addresses is used.  It is just as stable while the set of
+workers stays the same, but there is no telling which worker it picks.
+Either way, every pseudo-port of a peer address lands on the same worker,
+because the kernel cannot see the pseudo-ports at all.
+
+Each worker reports its statistics to the parent every
+C{statisticsInterval} seconds, over an AMP connection on its standard input
+and output.
+"""
+
+import os
+import sys
+import socket
+import struct
+
+from twisted.application import service
+from twisted.internet import defer, endpoints, protocol, task
+from twisted.protocols.amp import (
+    AMP, BinaryBoxProtocol, Command, Integer, Boolean)
+from twisted.python import log, reflect
+from twisted.python.failure import Failure
+
+from vertex import ptcp, batchudp
+
+try:
+    import ctypes
+except ImportError:
+    ctypes = None
+
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT',
+                       sys.platform.startswith('linux') and 15 or None)
+
+_SO_ATTACH_REUSEPORT_CBPF = 51
+_SKF_NET_OFF = -0x100000
+
+# Knuth's multiplicative hash, to spread out addresses which differ only a
+# little.
+_MULTIPLIER = 2654435761
+
+
+
+def shardFor(address, shards):
+    """
+    Decide which of C{shards} workers datagrams from an address go to.
+
+    @param address: A C{(host, port)} two-tuple, with C{host} a dotted-quad
+        IPv4 address.
+
+    @return: The number of the worker, counting from 0.
+    """
+    host, port = address
+    key = struct.unpack('!I', socket.inet_aton(host))[0] ^ port
+    return (((key * _MULTIPLIER) & 0xffffffff) >> 16) % shards
+
+
+
+def _steeringProgram(shards):
+    """
+    Assemble a classic BPF program which computes L{shardFor} from the IPv4
+    and UDP headers of a datagram, for C{SO_ATTACH_REUSEPORT_CBPF}.  It
+    assumes the IPv4 header has no options.
+
+    @return: The program, as a C{str}.
+    """
+    def instruction(code, k):
+        return struct.pack('=HBBI', code, 0, 0, k & 0xffffffff)
+    return ''.join([
+        instruction(0x28, _SKF_NET_OFF + 20),   # ldh [source port]
+        instruction(0x07, 0),                   # tax
+        instruction(0x20, _SKF_NET_OFF + 12),   # ld [source address]
+        instruction(0xac, 0),                   # xor x
+        instruction(0x24, _MULTIPLIER),         # mul #multiplier
+        instruction(0x74, 16),                  # rsh #16
+        instruction(0x94, shards),              # mod #shards
+        instruction(0x16, 0),                   # ret a
+        ])
+
+
+
+def steer(skt, shards):
+    """
+    Have the kernel hand datagrams arriving on a C{SO_REUSEPORT} group of
+    sockets to the one L{shardFor} picks, the sockets being numbered in the
+    order they were bound.
+
+    @param skt: Any socket in the group.
+
+    @return: Whether the kernel agreed to; if it didn't, it carries on
+        picking sockets by its own hash.
+    """
+    if ctypes is None or not sys.platform.startswith('linux'):
+        return False
+    program = _steeringProgram(shards)
+    buf = ctypes.create_string_buffer(program, len(program))
+    fprog = struct.pack('HL', len(program) // 8, ctypes.addressof(buf))
+    try:
+        skt.setsockopt(socket.SOL_SOCKET, _SO_ATTACH_REUSEPORT_CBPF, fprog)
+    except socket.error:
+        return False
+    return True
+
+
+
+class ReusePortUDPPort(batchudp.BatchedUDPPort):
+    """
+    A L{batchudp.BatchedUDPPort} which shares its UDP port with any other
+    socket bound to it with C{SO_REUSEPORT}.
+    """
+
+    def createInternetSocket(self):
+        skt = batchudp.BatchedUDPPort.createInternetSocket(self)
+        skt.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        return skt
+
+
+
+def listenShardedUDP(port, protocol, shards, interface='',
+                     maxPacketSize=8192, reactor=None):
+    """
+    Like L{batchudp.listenUDP}, but sharing the port among C{shards} sockets,
+    steered as L{steer} describes.
+
+    @return: A two-tuple of the L{ReusePortUDPPort}, and whether datagrams
+        are steered by L{shardFor}.
+    """
+    if SO_REUSEPORT is None:
+        raise NotImplementedError("SO_REUSEPORT is not available here.")
+    if reactor is None:
+        from twisted.internet import reactor
+    p = ReusePortUDPPort(port, protocol, interface, maxPacketSize, reactor)
+    p.startListening()
+    return p, steer(p.socket, shards)
+
+
+
+class ShardListening(Command):
+    """
+    A worker has bound its socket.
+    """
+    commandName = 'shard-listening'
+
+    arguments = [('shard', Integer()),
+                 ('port', Integer()),
+                 ('steered', Boolean())]
+
+
+
+class ShardStatistics(Command):
+    """
+    A worker's latest statistics.
+    """
+    commandName = 'shard-statistics'
+
+    arguments = [('shard', Integer()),
+                 ('connections', Integer()),
+                 ('halfOpenConnections', Integer()),
+                 ('cookiesIssued', Integer()),
+                 ('cookiesAccepted', Integer()),
+                 ('connectionsReaped', Integer()),
+                 ('datagramsPending', Integer()),
+                 ('datagramsDropped', Integer())]
+
+    requiresAnswer = False
+
+
+
+def statistics(proto):
+    """
+    Gather the statistics a worker reports about its L{ptcp.PTCP}.
+
+    @return: A C{dict} of the L{ShardStatistics} arguments, other than
+        C{shard}.
+    """
+    return dict(connections=len(proto._connections),
+                halfOpenConnections=proto.halfOpenConnections,
+                cookiesIssued=proto.cookiesIssued,
+                cookiesAccepted=proto.cookiesAccepted,
+                connectionsReaped=proto.connectionsReaped,
+                datagramsPending=proto._egress.pending(),
+                datagramsDropped=proto._egress.dropped)
+
+
+
+class _ShardMonitor(AMP):
+    """
+    The parent's end of its connection to a worker.
+
+    @ivar shard: The number of the worker.
+
+    @ivar ended: A L{Deferred} which fires when the worker has exited.
+    """
+
+    def __init__(self, service, shard):
+        AMP.__init__(self)
+        self.service = service
+        self.shard = shard
+        self.ended = defer.Deferred()
+
+
+    def makeConnection(self, transport):
+        # A process has no addresses for AMP to remember.
+        self._transportPeer = self._transportHost = None
+        return BinaryBoxProtocol.makeConnection(self, transport)
+
+
+    @ShardListening.responder
+    def shardListening(self, shard, port, steered):
+        self.service._shardListening(self, port, steered)
+        return {}
+
+
+    @ShardStatistics.responder
+    def shardStatistics(self, shard, **stats):
+        self.service.statistics[self.shard] = stats
+        return {}
+
+
+    def connectionLost(self, reason):
+        AMP.connectionLost(self, reason)
+        self.service._shardEnded(self, reason)
+        self.ended.callback(None)
+
+
+
+class ShardedPTCPService(service.Service):
+    """
+    Serve PTCP connections on one UDP port from C{shards} worker processes.
+
+    The workers are started one at a time, each only once the one before it
+    has bound the port, so that the kernel numbers their sockets in the same
+    order as L{shardFor} numbers the workers.
+
+    Should a worker exit while the service is running, the kernel renumbers
+    the sockets left, and datagrams would go to workers which know nothing of
+    their connections; so the service stops every other worker, and stops
+    itself.
+
+    @ivar factoryName: The fully-qualified name of a callable, importable in
+        the workers, which takes no arguments and returns the
+        L{protocol.ServerFactory} for each worker's connections.
+
+    @ivar portNum: The UDP port to serve; if C{0}, the port the first worker
+        happens to bind, once it has.
+
+    @ivar shards: The number of workers.
+
+    @ivar interface: The interface to bind.
+
+    @ivar statisticsInterval: How often, in seconds, each worker reports its
+        statistics.
+
+    @ivar steered: Whether datagrams are handed to the worker L{shardFor}
+        picks, rather than one picked by the kernel's own hash; C{None} until
+        the first worker is listening.
+
+    @ivar statistics: A C{dict} mapping the number of each worker to a C{dict}
+        of the statistics it last reported, as described by
+        L{ShardStatistics}.
+
+    @ivar _workers: A C{list} of the L{_ShardMonitor}s of the workers started
+        so far.
+
+    @ivar _starting: The L{_ShardMonitor} of the worker being started, if
+        there is one.
+
+    @ivar _failure: C{None}, or a L{Failure} saying why the workers could not
+        all be started, or why the service stopped of its own accord.
+    """
+    statisticsInterval = 5.0
+
+    steered = None
+    _failure = None
+
+    def __init__(self, factoryName, portNum, shards, interface='',
+                 reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.factoryName = factoryName
+        self.portNum = portNum
+        self.shards = shards
+        self.interface = interface
+        self._reactor = reactor
+        self.statistics = {}
+        self._workers = []
+        self._listening = ptcp._PendingEvent()
+        self._starting = None
+
+
+    def whenListening(self):
+        """
+        @return: A L{Deferred} which fires with the port number once every
+            worker is listening, or fails if any of them could not be
+            started.
+        """
+        if self._failure is not None:
+            return defer.fail(self._failure)
+        if self.running and self._starting is None:
+            return defer.succeed(self.portNum)
+        return self._listening.deferred()
+
+
+    def shardFor(self, address):
+        """
+        @return: The number of the worker whose connections datagrams from
+            C{address} belong to, or C{None} if there is no telling.
+        """
+        if not self.steered:
+            return None
+        return shardFor(address, self.shards)
+
+
+    def totalStatistics(self):
+        """
+        @return: A C{dict} of the statistics last reported by every worker,
+            added up.
+        """
+        total = {}
+        for stats in self.statistics.values():
+            for name, value in stats.items():
+                total[name] = total.get(name, 0) + value
+        return total
+
+
+    def startService(self):
+        service.Service.startService(self)
+        self._failure = None
+        self._startWorker()
+
+
+    def _startWorker(self):
+        shard = len(self._workers)
+        args = [sys.executable, '-m', 'vertex.ptcpshard', self.factoryName,
+                str(self.portNum), str(shard), str(self.shards),
+                self.interface, repr(self.statisticsInterval)]
+        # The worker has to be able to import whatever we can, whatever
+        # directory it starts in.
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+                [os.path.abspath(entry) for entry in sys.path]))
+        endpoint = endpoints.ProcessEndpoint(
+            self._reactor, sys.executable, args, env=env,
+            errFlag=endpoints.StandardErrorBehavior.LOG)
+        monitor = _ShardMonitor(self, shard)
+        self._workers.append(monitor)
+        self._starting = monitor
+        d = endpoint.connect(protocol.Factory.forProtocol(lambda: monitor))
+        d.addErrback(self._spawnFailed, monitor)
+
+
+    def _spawnFailed(self, reason, monitor):
+        self._workers.remove(monitor)
+        self._startFailed(reason)
+
+
+    def _shardListening(self, monitor, port, steered):
+        if monitor is not self._starting:
+            return
+        log.msg("PTCP shard %d listening on UDP %d" % (monitor.shard, port))
+        if monitor.shard == 0:
+            self.portNum = port
+            self.steered = steered
+        else:
+            self.steered = self.steered and steered
+        if len(self._workers) < self.shards:
+            self._startWorker()
+        else:
+            self._starting = None
+            self._listening.callback(self.portNum)
+
+
+    def _shardEnded(self, monitor, reason):
+        self.statistics.pop(monitor.shard, None)
+        if monitor is self._starting:
+            self._startFailed(RuntimeError(
+                "PTCP shard %d exited before listening" % (monitor.shard,)))
+        elif monitor in self._workers:
+            # stopService forgets the workers before they exit, so this one
+            # went of its own accord.
+            log.err(reason, "PTCP shard %d exited; stopping the service" % (
+                    monitor.shard,))
+            self._workers.remove(monitor)
+            self._failure = Failure(RuntimeError(
+                    "PTCP shard %d exited" % (monitor.shard,)))
+            self.stopService()
+
+
+    def _startFailed(self, reason):
+        if not isinstance(reason, Failure):
+            reason = Failure(reason)
+        self._starting = None
+        self._failure = reason
+        self._listening.errback(reason)
+
+
+    def stopService(self):
+        """
+        Stop every worker, closing their connections.
+
+        @return: A L{Deferred} which fires when they have all exited.
+        """
+        service.Service.stopService(self)
+        workers, self._workers = self._workers, []
+        for monitor in workers:
+            if monitor.transport is not None:
+                monitor.transport.loseConnection()
+        return defer.DeferredList([monitor.ended for monitor in workers])
+
+
+
+class _ShardWorker(AMP):
+    """
+    A worker's end of its connection to its parent.
+
+    @ivar proto: The worker's L{ptcp.PTCP}.
+
+    @ivar shard: The number of the worker.
+    """
+
+    def __init__(self, reactor, proto, shard, statisticsInterval):
+        AMP.__init__(self)
+        self.reactor = reactor
+        self.proto = proto
+        self.shard = shard
+        self._reporter = task.LoopingCall(self.reportStatistics)
+        self._reporter.clock = reactor
+        self._statisticsInterval = statisticsInterval
+
+
+    def listening(self, port, steered):
+        """
+        Tell the parent the worker is listening, and start reporting its
+        statistics.
+        """
+        self.callRemote(ShardListening, shard=self.shard, port=port,
+                        steered=steered)
+        self._reporter.start(self._statisticsInterval)
+
+
+    def reportStatistics(self):
+        self.callRemote(ShardStatistics, shard=self.shard,
+                        **statistics(self.proto))
+
+
+    def connectionLost(self, reason):
+        """
+        The parent has gone, or wants the worker to stop; close every
+        connection and exit.
+        """
+        AMP.connectionLost(self, reason)
+        if self._reporter.running:
+            self._reporter.stop()
+        d = defer.maybeDeferred(self.proto.cleanupAndClose)
+        d.addErrback(log.err)
+        d.addBoth(lambda ign: self.reactor.stop())
+
+
+
+def main(argv=None, reactor=None):
+    """
+    Run a worker for L{ShardedPTCPService}:
+
+        python -m vertex.ptcpshard FACTORY PORT SHARD SHARDS INTERFACE INTERVAL
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+    if reactor is None:
+        from twisted.internet import reactor
+    from twisted.internet import stdio
+    factoryName, portNum, shard, shards, interface, interval = argv
+    shard, shards = int(shard), int(shards)
+    log.startLogging(sys.stderr)
+    proto = ptcp.PTCP(reflect.namedAny(factoryName)())
+    port, steered = listenShardedUDP(int(portNum), proto, shards, interface,
+                                     reactor=reactor)
+    worker = _ShardWorker(reactor, proto, shard, float(interval))
+    stdio.StandardIO(worker, reactor=reactor)
+    worker.listening(port.getHost().port, steered)
+    reactor.run()
+
+
+
+if __name__ == '__main__':
+    main()
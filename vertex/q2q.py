@@ -7,6 +7,8 @@ I{Quotient to Quotient} protocol implementation.
 """
 
 # Stdlib
+import os
+import hmac
 import itertools
 from hashlib import md5
 import struct
@@ -19,7 +21,7 @@ from pprint import pformat
 from zope.interface import implements, implementer
 
 # Twisted
-from twisted.internet import reactor, defer, interfaces, protocol, error
+from twisted.internet import defer, interfaces, protocol, error
 from twisted.internet.main import CONNECTION_DONE
 from twisted.internet.ssl import (
     Certificate, PrivateCertificate, KeyPair, DistinguishedName)
@@ -39,7 +41,7 @@ from twisted.protocols.amp import (
 )
 
 # Vertex
-from vertex import subproducer, ptcp
+from vertex import subproducer, ptcp, batchudp
 from vertex import endpoint, ivertex
 from vertex.address import (
     Q2QTransportAddress, VirtualTransportAddress, Q2QAddress
@@ -52,6 +54,7 @@ from vertex.command import (
     Write, Close, Choke, Unchoke, WhoAmI
     )
 from vertex.conncache import ConnectionCache
+from vertex.multipath import MultipathTransport, SubflowFactory
 
 # Extra
 import attr
@@ -222,12 +225,15 @@ class AbstractConnectionAttempt(protocol.ClientFactory):
 
     cancelled = False
 
+    # The token to join a multipath stream with, if the listener gave one.
+    joinToken = None
+
     def buildProtocol(self, addr):
         if self.cancelled:
             return ImmediatelyLoseConnection()
         assert self.q2qb is None
         self.q2qb = Q2QBootstrap(
-            self.connectionID, self.clientProtocolFactory)
+            self.connectionID, self.clientProtocolFactory, self.joinToken)
         return self.q2qb
 
 
@@ -264,7 +270,8 @@ class TCPConnectionAttempt(AbstractConnectionAttempt):
     def startAttempt(self):
         assert not self.attempted
         self.attempted = True
-        reactor.connectTCP(self.method.host, self.method.port, self)
+        self.q2qproto.service._reactor.connectTCP(
+            self.method.host, self.method.port, self)
         return self.deferred
 
 
@@ -275,6 +282,7 @@ class TCPMethod:
         self.port = int(port)
 
     attemptFactory = TCPConnectionAttempt
+    attempts = 1
     relayable = True
     ptype = 'tcp'
 
@@ -318,6 +326,7 @@ class VirtualMethod:
     def __init__(self, virt=None):
         pass
 
+    attempts = 1
     relayable = False
 
 
@@ -378,6 +387,7 @@ class PTCPMethod(TCPMethod):
     Pseudo-TCP method.
     """
     ptype = 'ptcp'
+    attempts = 2
 
     def attempt(self, *a):
         return [_PTCPConnectionAttempt1NoPress(self, *a),
@@ -565,20 +575,31 @@ class Inbound(Command):
     The response is a list of "listeners" - a small (unicode) textual
     description of a host, plus a list of methods describing how to connect to
     it.
+
+    The "Multipath" header asks for every connection attempt which succeeds to
+    carry part of one stream, rather than only the first; see
+    L{vertex.multipath}.  Listeners which can, and whose service has
+    C{multipath} set, say so with a "Multipath" header of their own, and a
+    "Token" which every connection joining the stream has to give to
+    L{RetrieveConnection}; they leave their id mapped until as many
+    connections have joined as their methods can make, or until it expires.
     """
 
     commandName = 'inbound'
     arguments = [('From', Q2QAddressArgument()),
                  ('to', Q2QAddressArgument()),
                  ('protocol', String()),
-                 ('udp_source', HostPort(optional=True))]
+                 ('udp_source', HostPort(optional=True)),
+                 ('multipath', Boolean(optional=True))]
 
     response = [('listeners', AmpList(
                 [('id', String()),
                  ('certificate', Cert(optional=True)),
                  ('methods', ListOf(Method())),
                  ('expires', AmpTime()),
-                 ('description', Unicode())]))]
+                 ('description', Unicode()),
+                 ('multipath', Boolean(optional=True)),
+                 ('token', String(optional=True))]))]
 
     errors = {KeyError: "NotFound"}
     fatalErrors = {VerifyError: "VerifyError"}
@@ -928,7 +949,7 @@ class Q2Q(AMP, subproducer.SuperProducer):
 
 
     @Inbound.responder
-    def _inbound(self, From, to, protocol, udp_source=None):
+    def _inbound(self, From, to, protocol, udp_source=None, multipath=None):
         """
         Implementation of L{Inbound}.
         """
@@ -940,11 +961,13 @@ class Q2Q(AMP, subproducer.SuperProducer):
                                                      From,
                                                      to,
                                                      protocol,
-                                                     udp_source).addErrback(
+                                                     udp_source,
+                                                     multipath).addErrback(
             lambda f: f.trap(KeyError) and dict(listeners=[]))
 
 
-    def _inboundimpl(self, ign, From, to, protocol, udp_source):
+    def _inboundimpl(self, ign, From, to, protocol, udp_source,
+                     multipath=None):
 
         # 2-tuples of factory, description
         srvfacts = self.service.getLocalFactories(From, to, protocol)
@@ -1022,13 +1045,21 @@ class Q2Q(AMP, subproducer.SuperProducer):
                 (localMethods,)
             )
 
+            joinable = bool(multipath and self.service.multipath)
+            joins = sum([meth.attempts for meth in localMethods])
             for serverFactory, description in srvfacts:
                 expiryTime, listenID = self.service.mapListener(
-                    to, From, protocol, serverFactory)
-                result.append(dict(id=listenID,
-                                   expires=expiryTime,
-                                   methods=localMethods,
-                                   description=description))
+                    to, From, protocol, serverFactory,
+                    multipath=joinable, joins=joins)
+                listener = dict(id=listenID,
+                                expires=expiryTime,
+                                methods=localMethods,
+                                description=description)
+                if joinable:
+                    cwait, call = self.service.inboundConnections[listenID]
+                    listener['multipath'] = True
+                    listener['token'] = cwait.token
+                result.append(listener)
 
             # We've looked for our local factory.  Let's see if we have any
             # listening protocols elsewhere.
@@ -1037,7 +1068,8 @@ class Q2Q(AMP, subproducer.SuperProducer):
             args = dict(From=From,
                         to=to,
                         protocol=protocol,
-                        udp_source=udp_source)
+                        udp_source=udp_source,
+                        multipath=multipath)
             DL = []
             lclients = self.service.listeningClients[key]
             log.msg("listeners found for %s:%r" % (to, protocol))
@@ -1305,7 +1337,7 @@ class Q2Q(AMP, subproducer.SuperProducer):
         host = str(From.domainAddress())
         p = AMP()
         p.wrapper = self.wrapper
-        f = protocol.ClientCreator(reactor, lambda: p)
+        f = protocol.ClientCreator(self.service._reactor, lambda: p)
         connD = f.connectTCP(host, port)
 
         def connected(proto):
@@ -1378,11 +1410,37 @@ class Q2Q(AMP, subproducer.SuperProducer):
 
 
     def attemptConnectionMethods(self, methods, connectionID, From, to,
-                                 protocolName, protocolFactory):
+                                 protocolName, protocolFactory,
+                                 multipath=False, joinToken=None):
+        """
+        Try every way of connecting to a listener at once.
+
+        @param multipath: If true, rather than keeping only the first attempt
+            to succeed, stripe one stream across every one which does, with a
+            L{MultipathTransport}; the listener must have agreed to this.
+
+        @param joinToken: The token the listener gave for joining its stream,
+            if C{multipath}.
+
+        @return: a Deferred which fires with the protocol built by
+            C{protocolFactory}, once the first attempt succeeds, or fails
+            with L{AttemptsFailed} if they all fail.
+        """
+        stream = None
+        if multipath:
+            reactor = None
+            if self.service is not None:
+                reactor = self.service._reactor
+            stream = MultipathTransport(protocolFactory, to, reactor)
+            protocolFactory = SubflowFactory(stream)
+
         attemptObjects = []
         for meth in methods:
             atts = meth.attempt(self, connectionID, From, to,
                                 protocolName, protocolFactory)
+            if joinToken is not None:
+                for att in atts:
+                    att.joinToken = joinToken
             attemptObjects.extend(atts)
 
         attemptDeferreds = [att.startAttempt() for att in attemptObjects]
@@ -1393,6 +1451,16 @@ class Q2Q(AMP, subproducer.SuperProducer):
         def dontLogThat(e):
             e.trap(error.ConnectionLost, error.ConnectionDone)
 
+        if stream is not None:
+            # Attempts still going when the first succeeds join the stream if
+            # they succeed too, so only those which fail are cancelled, as
+            # they do.
+            def cancelFailed(reason, attempt):
+                attempt.cancel()
+                return reason
+            for att, attDef in zip(attemptObjects, attemptDeferreds):
+                attDef.addErrback(cancelFailed, att)
+
         for attDef in attemptDeferreds:
             attDef.addErrback(dontLogThat)
 
@@ -1408,6 +1476,10 @@ class Q2Q(AMP, subproducer.SuperProducer):
             theResult = None
             anyResult = False
             for index, (success, result) in enumerate(results):
+                if stream is not None:
+                    if success:
+                        return stream.protocol
+                    continue
                 if success:
                     # Woohoo!  home free.
                     # XXX Cancel outstanding attempts, maybe. Will fail anyway,
@@ -1467,6 +1539,9 @@ class Q2Q(AMP, subproducer.SuperProducer):
             # Don't tell them because we don't know
             log.msg("dispatcher unavailable when connecting")
 
+        if self.service.multipath:
+            A['multipath'] = True
+
         D = self.callRemote(Inbound, **A)
 
         def _connected(answer):
@@ -1479,6 +1554,8 @@ class Q2Q(AMP, subproducer.SuperProducer):
                         listener['id'],
                         From, to,
                         protocolName, clientFactory,
+                        multipath=bool(listener.get('multipath')),
+                        joinToken=listener.get('token'),
                         )
                     allConnectionAttempts.append(d)
                 return defer.DeferredList(allConnectionAttempts)
@@ -1549,6 +1626,19 @@ class SeparateConnectionTransport(object):
         return self.q2qpeer
 
 
+    def getStatistics(self):
+        """
+        Find out what the connection underneath has counted, if anything; see
+        L{ptcp.PTCPConnection.getStatistics}.
+
+        @rtype: C{dict}
+        """
+        getStatistics = getattr(self.transport, 'getStatistics', None)
+        if getStatistics is None:
+            return {}
+        return getStatistics()
+
+
     def makeConnection(self, tpt):
         self.transport = tpt
         self.service.subConnections.append(self)
@@ -1606,6 +1696,7 @@ class RetrieveConnection(ProtocolSwitchCommand):
 
     arguments = [
         ('identifier', String()),
+        ('token', String(optional=True)),
         ]
 
     fatalErrors = {KeyError: "NoSuchConnection"}
@@ -1613,11 +1704,12 @@ class RetrieveConnection(ProtocolSwitchCommand):
 
 
 class Q2QBootstrap(AMP):
-    def __init__(self, connIdentifier=None, protoFactory=None):
+    def __init__(self, connIdentifier=None, protoFactory=None, joinToken=None):
         AMP.__init__(self)
         assert connIdentifier is None or isinstance(connIdentifier, (str))
         self.connIdentifier = connIdentifier
         self.protoFactory = protoFactory
+        self.joinToken = joinToken
 
 
     def connectionMade(self):
@@ -1626,7 +1718,8 @@ class Q2QBootstrap(AMP):
                 err.trap(error.ConnectionDone, KeyError)
             self.retrieveConnection(
                 self.connIdentifier,
-                self.protoFactory
+                self.protoFactory,
+                self.joinToken
             ).addErrback(swallowKnown)
 
 
@@ -1648,28 +1741,35 @@ class Q2QBootstrap(AMP):
             }
 
 
-    def retrieveConnection(self, identifier, factory):
+    def retrieveConnection(self, identifier, factory, token=None):
+        kw = dict(identifier=identifier)
+        if token is not None:
+            kw['token'] = token
         return self.callRemote(
             RetrieveConnection,
             factory,
-            identifier=identifier
+            **kw
         )
 
 
-    def _retrieveConnection(self, identifier):
-        listenerInfo = self.service.lookupListener(identifier)
+    def _retrieveConnection(self, identifier, token=None):
+        listenerInfo = self.service.lookupListener(identifier, token)
         if listenerInfo is None:
             raise KeyError(identifier)
+        elif listenerInfo.multipath is not None:
+            proto = SubflowFactory(listenerInfo.multipath).buildProtocol(
+                listenerInfo.From
+            )
         else:
             proto = listenerInfo.protocolFactory.buildProtocol(
                 listenerInfo.From
             )
-            return SeparateConnectionTransport(
-                    self.service,
-                    proto,
-                    listenerInfo.to,
-                    listenerInfo.From,
-                    listenerInfo.protocolName)
+        return SeparateConnectionTransport(
+                self.service,
+                proto,
+                listenerInfo.to,
+                listenerInfo.From,
+                listenerInfo.protocolName)
 
     RetrieveConnection.responder(_retrieveConnection)
 
@@ -2076,8 +2176,9 @@ class MessageSender(AMP):
 theMessageFactory = protocol.ClientFactory()
 theMessageFactory.protocol = MessageSender
 
-_ConnectionWaiter = namedtuple('_ConnectionWaiter',
-                               'From to protocolName protocolFactory isClient')
+_ConnectionWaiter = namedtuple(
+    '_ConnectionWaiter',
+    'From to protocolName protocolFactory isClient multipath token joins')
 
 
 
@@ -2136,8 +2237,24 @@ def _noResults(*x):
 
 
 class PTCPConnectionDispatcher(object):
-    def __init__(self, factory):
+    """
+    Bind PTCP ports, and make connections through them, for a
+    L{Q2QService}.
+
+    @ivar _reactor: The L{IReactorUDP} and L{IReactorTime} provider our
+        ports are bound with and keep time by.
+
+    @ivar batching: Whether our ports hand datagrams to the kernel in
+        batches, with L{vertex.batchudp}, and write what their connections
+        send once the reactor gets round to it; if not, they are plain UDP
+        ports, written to as soon as anything is sent.
+    """
+    def __init__(self, factory, reactor=None, batching=True):
+        if reactor is None:
+            from twisted.internet import reactor
         self.factory = factory
+        self._reactor = reactor
+        self.batching = batching
         self._ports = {}
 
 
@@ -2162,8 +2279,13 @@ class PTCPConnectionDispatcher(object):
 
     def bindNewPort(self, portNum=0, iface=''):
         iPortNum = portNum
-        proto = ptcp.PTCP(self.factory)
-        p = reactor.listenUDP(portNum, proto, interface=iface)
+        proto = ptcp.PTCP(self.factory, reactor=self._reactor,
+                          batching=self.batching)
+        if self.batching:
+            p = batchudp.listenUDP(portNum, proto, interface=iface,
+                                   reactor=self._reactor)
+        else:
+            p = self._reactor.listenUDP(portNum, proto, interface=iface)
         portNum = p.getHost().port
         log.msg("Binding PTCP/UDP %d=%d" % (iPortNum, portNum))
         self._ports[portNum] = (p, proto)
@@ -2190,6 +2312,26 @@ class PTCPConnectionDispatcher(object):
                     pass
 
 
+    def getStatistics(self):
+        """
+        Total up the statistics of all our PTCP ports.
+
+        @return: A C{dict} like L{ptcp.PTCP.getStatistics} returns, with
+            each count the sum of those of our ports, and C{ports}, the
+            number of them.
+        """
+        stats = {'ports': len(self._ports), 'dropped': {}}
+        for p, proto in self._ports.itervalues():
+            for name, value in proto.getStatistics().iteritems():
+                if name == 'dropped':
+                    for reason, count in value.iteritems():
+                        stats['dropped'][reason] = (
+                            stats['dropped'].get(reason, 0) + count)
+                else:
+                    stats[name] = stats.get(name, 0) + value
+        return stats
+
+
     def killAllConnections(self):
         dl = []
         for p, proto in self._ports.itervalues():
@@ -2217,6 +2359,9 @@ class Q2QService(service.MultiService, protocol.ServerFactory):
         <https://en.wikipedia.org/wiki/Network_address_translation
         #Methods_of_translation>}.
     @type sharedUDPPortnum: L{int}
+
+    @ivar _reactor: The reactor the service listens, resolves names and keeps
+        time with.
     """
     # Server factory stuff
     publicIP = None
@@ -2258,7 +2403,8 @@ class Q2QService(service.MultiService, protocol.ServerFactory):
                  publicIP=None,
                  udpEnabled=None,
                  portal=None,
-                 verifyHook=None):
+                 verifyHook=None,
+                 reactor=None):
         """
 
         @param protocolFactoryFactory: A callable of three arguments
@@ -2268,7 +2414,14 @@ class Q2QService(service.MultiService, protocol.ServerFactory):
 
         @param certificateStorage: an implementor of ICertificateStore, or None
         for the default implementation.
+
+        @param reactor: a provider of L{IReactorTime}, L{IReactorUDP},
+        L{IReactorTCP} and L{IReactorPluggableResolver}, or None for the global
+        reactor.
         """
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
 
         if udpEnabled is not None:
             self.udpEnabled = udpEnabled
@@ -2450,18 +2603,31 @@ class Q2QService(service.MultiService, protocol.ServerFactory):
 
 
     def mapListener(self, to, From, protocolName, protocolFactory,
-        isClient=False):
+        isClient=False, multipath=False, joins=1):
         """
         Returns 2-tuple of (expiryTime, listenerID)
+
+        @param multipath: If true, every connection retrieved by the
+            listenerID until it expires carries part of one stream, to a
+            protocol built by C{protocolFactory} when the first is.  Each of
+            them has to give the waiter's random C{token}.
+
+        @param joins: How many connections may join a multipath stream before
+            the listenerID is unmapped.
         """
         listenerID = self._nextConnectionID(From, to)
-        call = reactor.callLater(120,
-                                 self.unmapListener,
-                                 listenerID)
+        call = self._reactor.callLater(120,
+                                       self.unmapListener,
+                                       listenerID)
         expires = datetime.datetime(*time.localtime(call.getTime())[:7])
+        stream = token = None
+        if multipath:
+            stream = MultipathTransport(protocolFactory, From, self._reactor)
+            token = os.urandom(16)
         self.inboundConnections[listenerID] = (
             _ConnectionWaiter(
-                From, to, protocolName, protocolFactory, isClient
+                From, to, protocolName, protocolFactory, isClient, stream,
+                token, joins
             ),
             call
         )
@@ -2472,16 +2638,30 @@ class Q2QService(service.MultiService, protocol.ServerFactory):
         del self.inboundConnections[listenID]
 
 
-    def lookupListener(self, listenID):
+    def lookupListener(self, listenID, token=None):
         """
         (internal)
 
         Retrieve a waiting connection by its connection identifier, passing in
         the transport to be used to connect the waiting protocol factory to.
+
+        @param token: The token given with the identifier, which has to match
+            a multipath waiter's.
         """
         if listenID in self.inboundConnections:
+            cwait, call = self.inboundConnections[listenID]
+            if cwait.multipath is not None:
+                if token is None or not hmac.compare_digest(token,
+                                                            cwait.token):
+                    return None
+                if cwait.joins > 1:
+                    # Later connections may join the stream, until as many
+                    # have as the listener's methods could make.
+                    self.inboundConnections[listenID] = (
+                        cwait._replace(joins=cwait.joins - 1), call)
+                    return cwait
             # Make the connection?
-            cwait, call = self.inboundConnections.pop(listenID)
+            del self.inboundConnections[listenID]
             # _ConnectionWaiter instance
             call.cancel()
             return cwait
@@ -2519,13 +2699,22 @@ class Q2QService(service.MultiService, protocol.ServerFactory):
 
     virtualEnabled = True
 
+    multipath = False          # Ask peers to stripe each connection across
+                               # every path on which it can be made; see
+                               # vertex.multipath
+
+    batching = True            # Batch the datagrams our PTCP ports send and
+                               # receive; see PTCPConnectionDispatcher
+
     def startService(self):
         self._bootstrapFactory = Q2QBootstrapFactory(self)
         if self.udpEnabled:
-            self.dispatcher = PTCPConnectionDispatcher(self._bootstrapFactory)
+            self.dispatcher = PTCPConnectionDispatcher(self._bootstrapFactory,
+                                                       self._reactor,
+                                                       self.batching)
 
         if self.q2qPortnum is not None:
-            self.q2qPort = reactor.listenTCP(self.q2qPortnum, self)
+            self.q2qPort = self._reactor.listenTCP(self.q2qPortnum, self)
             self.q2qPortnum = self.q2qPort.getHost().port
             if self.dispatcher is not None:
                 self.sharedUDPPortnum = self.dispatcher.bindNewPort(
@@ -2534,7 +2723,7 @@ class Q2QService(service.MultiService, protocol.ServerFactory):
                 )
 
         if self.inboundTCPPortnum is not None:
-            self.inboundTCPPort = reactor.listenTCP(
+            self.inboundTCPPort = self._reactor.listenTCP(
                 self.inboundTCPPortnum,
                 self._bootstrapFactory)
 
@@ -2704,7 +2893,7 @@ class Q2QService(service.MultiService, protocol.ServerFactory):
         # capable of connecting to other domains (supernodes)
 
         toDomain = toAddress.domainAddress()
-        resolveme = reactor.resolve(str(toDomain))
+        resolveme = self._reactor.resolve(str(toDomain))
         def cb(toIPAddress, authorize=authorize):
             GPS = self.certificateStorage.getPrivateCertificate
             if usePrivateCertificate:
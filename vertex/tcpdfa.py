@@ -4,13 +4,31 @@
 from automat import MethodicalMachine
 
 
+
+def _noAckExpected(packet):
+    """
+    The L{TCP.ackPredicate} for when we aren't waiting for any particular
+    acknowledgement.
+    """
+    return False
+
+
+
 class TCP(object):
     """
     A L{TCP} represents a single connection's TCP-over-UDP state machine.
+
+    @ivar fastPath: Whether to take the shortcuts, in the L{established}
+        state, which L{receiveSegment} and L{maybeReceiveAck} take around the
+        state machine.
+
+    @ivar _established: Whether the machine is in the L{established} state.
     """
 
     _machine = MethodicalMachine()
 
+    fastPath = True
+
     def __init__(self, impl):
         """
         Initialize a L{TCP}.
@@ -19,7 +37,35 @@ class TCP(object):
         @type impl: L{vertex.ptcp.PTCPConnection}
         """
         self._impl = impl
-        self.ackPredicate = lambda packet: False
+        self.ackPredicate = _noAckExpected
+        self._established = False
+
+
+    def _entered(self, state):
+        """
+        Keep track of whether we are L{established}, and tell our
+        implementation which state we are in now.
+
+        @param state: The name of the state the machine has just entered from
+            another.
+        """
+        self._established = (state == 'established')
+        self._impl.stateChanged(state)
+
+
+    def _entering(state):
+        """
+        Make the method of an output which records that the machine has
+        entered C{state}, for every transition into it from another state to
+        produce first.
+
+        @param state: The name of the state.
+        """
+        def entering(self):
+            self._entered(state)
+        entering.__name__ = 'enter' + state[0].upper() + state[1:]
+        entering.__doc__ = "Record that we are in L{%s} now." % (state,)
+        return entering
 
     @_machine.state(initial=True)
     def closed(self):
@@ -95,6 +141,20 @@ class TCP(object):
         
         """
 
+    enterClosed = _machine.output()(_entering('closed'))
+    enterSynSent = _machine.output()(_entering('synSent'))
+    enterSynRcvd = _machine.output()(_entering('synRcvd'))
+    enterListen = _machine.output()(_entering('listen'))
+    enterEstablished = _machine.output()(_entering('established'))
+    enterCloseWait = _machine.output()(_entering('closeWait'))
+    enterLastAck = _machine.output()(_entering('lastAck'))
+    enterFinWait1 = _machine.output()(_entering('finWait1'))
+    enterFinWait2 = _machine.output()(_entering('finWait2'))
+    enterClosing = _machine.output()(_entering('closing'))
+    enterTimeWait = _machine.output()(_entering('timeWait'))
+    del _entering
+
+
     @_machine.input()
     def appPassiveOpen(self):
         """
@@ -159,6 +219,25 @@ class TCP(object):
         """
 
 
+    @_machine.input()
+    def cookieAck(self):
+        """
+        While listening, an acknowledgement arrived of a SYN-ACK sent on our
+        behalf without any state being kept for it, carrying a valid SYN
+        cookie; the handshake is complete.
+        """
+
+
+    @_machine.input()
+    def fastOpen(self):
+        """
+        While listening, a SYN arrived carrying data and a fast-open cookie we
+        issued to its sender earlier; the data is taken, and the connection is
+        established at once, without waiting for the SYN-ACK to be
+        acknowledged.
+        """
+
+
     @_machine.input()
     def segmentReceived(self):
         """
@@ -180,6 +259,28 @@ class TCP(object):
         )
 
 
+    def isEstablished(self):
+        """
+        @return: Whether the machine is in the L{established} state.
+        """
+        return self._established
+
+
+    def receiveSegment(self):
+        """
+        Produce a L{segmentReceived} input.
+
+        Almost every segment arrives in L{established}, where the input leaves
+        the state as it is, so there the outputs the transition table gives
+        for it are produced directly, without going through the machine.
+        """
+        if self._established and self.fastPath:
+            for output in self._establishedSegmentOutputs:
+                output(self)
+        else:
+            self.segmentReceived()
+
+
     def originate(self, **kw):
         """
         Originate a packet.
@@ -198,9 +299,11 @@ class TCP(object):
     @_machine.output()
     def sendFin(self):
         """
-        
+        Send a FIN packet.  We only ever do this after having received our
+        peer's SYN, so it carries an acknowledgement too; that way a lost
+        final ACK doesn't leave our peer retransmitting its own FIN.
         """
-        self.originate(fin=True)
+        self.originate(fin=True, ack=True)
 
 
     @_machine.output()
@@ -220,7 +323,6 @@ class TCP(object):
         self._impl.originate(ack=True)
 
 
-    @_machine.output()
     def sendAckSoon(self):
         """
         Send an ACK-only packet, but, give it a second; some more data might be
@@ -228,6 +330,12 @@ class TCP(object):
         """
         self._impl.ackSoon()
 
+    # The outputs of a segment received in established, which leaves the
+    # machine there; receiveSegment produces them directly.  The transition
+    # below has to give the same ones.
+    _establishedSegmentOutputs = (sendAckSoon,)
+    sendAckSoon = _machine.output()(sendAckSoon)
+
 
     @_machine.output()
     def sendRst(self):
@@ -242,13 +350,19 @@ class TCP(object):
         """
         Receive an L{ack} or L{synAck} input from the given packet.
         """
-        ackPredicate = self.ackPredicate
-        self.ackPredicate = lambda packet: False
         if ackPacket.syn:
             # New SYN packets are always news.
+            self.ackPredicate = _noAckExpected
             self.synAck()
             return
-        if ackPredicate(ackPacket):
+        if self._established and self.fastPath:
+            if self.ackPredicate is _noAckExpected:
+                # Nothing we send in established waits on an acknowledgement.
+                return
+        # Only stop expecting an acknowledgement once we've got it; a partial
+        # acknowledgement of the data in front of it is not enough.
+        if self.ackPredicate(ackPacket):
+            self.ackPredicate = _noAckExpected
             self.ack()
 
 
@@ -271,6 +385,14 @@ class TCP(object):
         self._impl.connectionJustEnded()
 
 
+    @_machine.output()
+    def appNotifyTimedOut(self):
+        """
+        Tell the application we gave up on our peer.
+        """
+        self._impl.connectionTimedOut()
+
+
     @_machine.output()
     def releaseResources(self):
         """
@@ -310,74 +432,101 @@ class TCP(object):
 
 
     # invariant: if a state has .upon(ack) in it, all enter=that-state edges
-    # here must produce the "expectAck" output.
-    closed.upon(appPassiveOpen, enter=listen, outputs=[appNotifyListen])
-    closed.upon(appActiveOpen, enter=synSent, outputs=[sendSyn,
-                                                       expectAck])
+    # here must produce the "expectAck" output.  Every edge into a state from
+    # another produces that state's "enter" output first.
+    closed.upon(appPassiveOpen, enter=listen,
+                outputs=[enterListen, appNotifyListen])
+    closed.upon(appActiveOpen, enter=synSent,
+                outputs=[enterSynSent, sendSyn, expectAck])
 
     synSent.upon(timeout, enter=closed,
-                 outputs=[appNotifyAttemptFailed, releaseResources])
+                 outputs=[enterClosed, appNotifyAttemptFailed,
+                          releaseResources])
     synSent.upon(appClose, enter=closed,
-                 outputs=[appNotifyAttemptFailed, releaseResources])
+                 outputs=[enterClosed, appNotifyAttemptFailed,
+                          releaseResources])
     synSent.upon(synAck, enter=established,
-                 outputs=[sendAck, appNotifyConnected])
+                 outputs=[enterEstablished, sendAck, appNotifyConnected])
 
     synRcvd.upon(ack, enter=established,
-                 outputs=[appNotifyConnected])
+                 outputs=[enterEstablished, appNotifyConnected])
     synRcvd.upon(appClose, enter=finWait1,
-                 outputs=[sendFin, expectAck])
+                 outputs=[enterFinWait1, sendFin, expectAck])
     synRcvd.upon(timeout, enter=closed,
-                 outputs=[sendRst, releaseResources])
+                 outputs=[enterClosed, sendRst, releaseResources])
     synRcvd.upon(rst, enter=broken,
-                 outputs=[releaseResources])
+                 outputs=[enterClosed, releaseResources])
 
     listen.upon(appSendData, enter=synSent,
-                outputs=[sendSyn, expectAck])
+                outputs=[enterSynSent, sendSyn, expectAck])
     listen.upon(syn, enter=synRcvd,
-                outputs=[sendSynAck, expectAck])
+                outputs=[enterSynRcvd, sendSynAck, expectAck])
+    listen.upon(cookieAck, enter=established,
+                outputs=[enterEstablished, appNotifyConnected])
+    listen.upon(fastOpen, enter=established,
+                outputs=[enterEstablished, sendSynAck, expectAck,
+                         appNotifyConnected])
 
     established.upon(appClose, enter=finWait1,
-                     outputs=[appNotifyDisconnected,
+                     outputs=[enterFinWait1,
+                              appNotifyDisconnected,
                               sendFin,
                               expectAck])
     established.upon(fin, enter=closeWait,
-                     outputs=[appNotifyHalfClose,
+                     outputs=[enterCloseWait,
+                              appNotifyHalfClose,
                               sendAck])
-    established.upon(timeout, enter=broken, outputs=[appNotifyDisconnected,
-                                                     releaseResources])
+    established.upon(timeout, enter=broken,
+                     outputs=[enterClosed,
+                              appNotifyTimedOut,
+                              releaseResources])
 
     established.upon(segmentReceived, enter=established,
                      outputs=[sendAckSoon])
+    # The acknowledgement of the SYN-ACK sent on a fast open; no other way
+    # into established leaves an acknowledgement expected.
+    established.upon(ack, enter=established, outputs=[])
 
 
     closeWait.upon(appClose, enter=lastAck,
-                   outputs=[sendFin,
+                   outputs=[enterLastAck,
+                            sendFin,
                             expectAck,
                             appNotifyDisconnected])
     closeWait.upon(timeout, enter=broken,
-                   outputs=[appNotifyDisconnected,
+                   outputs=[enterClosed,
+                            appNotifyTimedOut,
                             releaseResources])
 
-    lastAck.upon(ack, enter=closed, outputs=[releaseResources])
-    lastAck.upon(timeout, enter=broken, outputs=[releaseResources])
+    lastAck.upon(ack, enter=closed, outputs=[enterClosed, releaseResources])
+    lastAck.upon(timeout, enter=broken,
+                 outputs=[enterClosed, releaseResources])
 
     # TODO: is this actually just "ack" or is it ack _of_ something in
     # particular?  ack of the fin we sent upon transitioning to this state?
-    finWait1.upon(ack, enter=finWait2, outputs=[])
-    finWait1.upon(fin, enter=closing, outputs=[sendAck])
-    finWait1.upon(timeout, enter=broken, outputs=[releaseResources])
+    finWait1.upon(ack, enter=finWait2, outputs=[enterFinWait2])
+    finWait1.upon(fin, enter=closing, outputs=[enterClosing, sendAck])
+    finWait1.upon(timeout, enter=broken,
+                  outputs=[enterClosed, releaseResources])
 
-    finWait2.upon(timeout, enter=broken, outputs=[releaseResources])
-    finWait2.upon(fin, enter=timeWait, outputs=[sendAck, startTimeWaiting])
+    finWait2.upon(timeout, enter=broken,
+                  outputs=[enterClosed, releaseResources])
+    finWait2.upon(fin, enter=timeWait,
+                  outputs=[enterTimeWait, sendAck, startTimeWaiting])
 
-    closing.upon(timeout, enter=broken, outputs=[releaseResources])
-    closing.upon(ack, enter=timeWait, outputs=[startTimeWaiting])
+    closing.upon(timeout, enter=broken,
+                 outputs=[enterClosed, releaseResources])
+    closing.upon(ack, enter=timeWait,
+                 outputs=[enterTimeWait, startTimeWaiting])
 
-    timeWait.upon(timeout, enter=closed, outputs=[releaseResources])
+    timeWait.upon(timeout, enter=closed,
+                  outputs=[enterClosed, releaseResources])
 
     for noDataState in [finWait1, finWait2, closing]:
         noDataState.upon(segmentReceived, enter=noDataState, outputs=[])
 
+
+
 if __name__ == '__main__':
     for line in TCP._machine.graphviz():
         print(line)
@@ -0,0 +1,143 @@
+# Copyright 2005 Divmod, Inc.  See LICENSE file for details
+
+"""
+Tests for L{vertex.batchudp}.
+"""
+
+import socket
+from errno import ENOSYS
+
+from twisted.trial import unittest
+from twisted.internet import protocol
+
+from vertex import batchudp
+
+
+
+class Recorder(protocol.DatagramProtocol):
+    """
+    A datagram protocol which remembers every datagram it receives.
+    """
+    def __init__(self):
+        self.received = []
+
+
+    def datagramReceived(self, data, addr):
+        self.received.append((data, addr))
+
+
+
+def failWith(errnum):
+    """
+    Make a stand-in for C{sendmmsg} or C{recvmmsg} which fails with the given
+    error.
+    """
+    def fail(*args):
+        batchudp.ctypes.set_errno(errnum)
+        return -1
+    return fail
+
+
+
+class BatchedUDPPortTests(unittest.TestCase):
+    """
+    Tests for L{batchudp.BatchedUDPPort}.
+    """
+    if not batchudp.batchingSupported:
+        skip = "sendmmsg and recvmmsg are not available on this platform."
+
+    def setUp(self):
+        self.proto = Recorder()
+        self.port = batchudp.listenUDP(0, self.proto, interface='127.0.0.1')
+        self.addCleanup(self.port.stopListening)
+        self.address = ('127.0.0.1', self.port.getHost().port)
+        self.peer = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(self.peer.close)
+        self.peer.bind(('127.0.0.1', 0))
+        self.peer.settimeout(5)
+
+
+    def test_listen(self):
+        """
+        L{batchudp.listenUDP} makes a L{batchudp.BatchedUDPPort} where batching
+        is supported.
+        """
+        self.assertIsInstance(self.port, batchudp.BatchedUDPPort)
+
+
+    def test_writeBatch(self):
+        """
+        L{batchudp.BatchedUDPPort.writeBatch} sends each datagram to its
+        address, in order.
+        """
+        datagrams = [('datagram %d' % (i,), self.peer.getsockname())
+                     for i in range(100)]
+        self.port.writeBatch(datagrams)
+        for datagram, addr in datagrams:
+            self.assertEqual(self.peer.recvfrom(1024),
+                             (datagram, self.address))
+
+
+    def test_writeBatchUnsupported(self):
+        """
+        If the kernel doesn't implement C{sendmmsg}, datagrams are written
+        one at a time instead, from then on.
+        """
+        self.port._batchSend = failWith(ENOSYS)
+        self.port.writeBatch([('one', self.peer.getsockname()),
+                              ('two', self.peer.getsockname())])
+        self.assertIdentical(self.port._batchSend, None)
+        self.assertEqual(self.peer.recvfrom(1024), ('one', self.address))
+        self.assertEqual(self.peer.recvfrom(1024), ('two', self.address))
+
+
+    def test_readBatch(self):
+        """
+        When its socket becomes readable, a L{batchudp.BatchedUDPPort} delivers
+        every datagram waiting to be read to its protocol, more than
+        C{batchSize} of them if need be.
+        """
+        self.port.batchSize = 8
+        datagrams = ['datagram %d' % (i,) for i in range(20)]
+        for datagram in datagrams:
+            self.peer.sendto(datagram, self.address)
+        self.port.doRead()
+        self.assertEqual(
+            self.proto.received,
+            [(datagram, self.peer.getsockname()) for datagram in datagrams])
+
+
+    def test_readBatchUnsupported(self):
+        """
+        If the kernel doesn't implement C{recvmmsg}, datagrams are read one at
+        a time instead, from then on.
+        """
+        self.port._batchReceive = failWith(ENOSYS)
+        self.peer.sendto('datagram', self.address)
+        self.port.doRead()
+        self.assertIdentical(self.port._batchReceive, None)
+        self.assertEqual(self.proto.received,
+                         [('datagram', self.peer.getsockname())])
+
+
+
+class ListenUDPTests(unittest.TestCase):
+    """
+    Tests for L{batchudp.listenUDP}.
+    """
+
+    def test_otherReactors(self):
+        """
+        Reactors which don't deal in file descriptors listen however they
+        usually would.
+        """
+        listened = []
+        class NotAnFDReactor(object):
+            def listenUDP(self, *args):
+                listened.append(args)
+                return 'port'
+        proto = Recorder()
+        self.assertEqual(
+            batchudp.listenUDP(1234, proto, 'iface', 100, NotAnFDReactor()),
+            'port')
+        self.assertEqual(listened, [(1234, proto, 'iface', 100)])
@@ -0,0 +1,153 @@
+# Copyright 2005 Divmod, Inc.  See LICENSE file for details
+
+"""
+Tests for L{vertex.egress}.
+"""
+
+from twisted.internet import task
+from twisted.trial import unittest
+
+from vertex.egress import EgressScheduler
+
+ADDR = ('10.0.0.2', 4321)
+
+
+
+class EgressSchedulerTests(unittest.TestCase):
+    """
+    Tests for L{EgressScheduler}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.clock.advance(1000)
+        self.batches = []
+        self.egress = EgressScheduler(self.clock, self.batches.append)
+
+
+    def written(self):
+        """
+        @return: The datagrams written so far, in the order they were written.
+        """
+        return [datagram for batch in self.batches
+                for (datagram, addr) in batch]
+
+
+    def test_batched(self):
+        """
+        Datagrams are written together once the reactor gets round to it,
+        not as they are queued.
+        """
+        self.egress.enqueue(1, 'a', ADDR)
+        self.egress.enqueue(1, 'b', ADDR)
+        self.assertEqual(self.batches, [])
+        self.assertEqual(self.egress.pending(), 2)
+        self.clock.advance(0)
+        self.assertEqual(self.batches, [[('a', ADDR), ('b', ADDR)]])
+        self.assertEqual(self.egress.pending(), 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_roundRobin(self):
+        """
+        Flows take turns, each sending up to C{quantum} octets on its turn, so
+        one with a lot queued doesn't hold up the others.
+        """
+        self.egress.quantum = 2
+        for datagram in ['a1', 'a2', 'a3']:
+            self.egress.enqueue('a', datagram, ADDR)
+        for datagram in ['b1', 'b2']:
+            self.egress.enqueue('b', datagram, ADDR)
+        self.egress.enqueue('c', 'c1', ADDR)
+        self.clock.advance(0)
+        self.assertEqual(self.written(),
+                         ['a1', 'b1', 'c1', 'a2', 'b2', 'a3'])
+
+
+    def test_deficit(self):
+        """
+        A datagram bigger than C{quantum} waits until its flow has had enough
+        turns to make up the difference.
+        """
+        self.egress.quantum = 2
+        self.egress.enqueue('a', 'aaaa', ADDR)
+        self.egress.enqueue('b', 'b1', ADDR)
+        self.egress.enqueue('b', 'b2', ADDR)
+        self.clock.advance(0)
+        self.assertEqual(self.written(), ['b1', 'aaaa', 'b2'])
+
+
+    def test_bandwidthLimit(self):
+        """
+        With a C{bandwidthLimit}, datagrams are spread out so that the port
+        sends no faster than the limit.
+        """
+        self.egress.bandwidthLimit = 1000
+        self.egress.horizon = 0
+        for i in range(3):
+            self.egress.enqueue('a', 'x' * 100, ADDR)
+        self.clock.advance(0)
+        self.assertEqual(len(self.written()), 1)
+        self.clock.advance(0.09)
+        self.assertEqual(len(self.written()), 1)
+        self.clock.advance(0.01)
+        self.assertEqual(len(self.written()), 2)
+        self.clock.advance(0.1)
+        self.assertEqual(len(self.written()), 3)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_bandwidthLimitShared(self):
+        """
+        The C{bandwidthLimit} applies to all flows together, which still take
+        turns.
+        """
+        self.egress.bandwidthLimit = 1000
+        self.egress.horizon = 0
+        for flow in 'ab':
+            for i in range(2):
+                self.egress.enqueue(flow, flow * 100, ADDR)
+        self.clock.pump([0] + [0.1] * 3)
+        self.assertEqual([len(batch) for batch in self.batches], [1] * 4)
+        self.assertEqual([datagram[0] for datagram in self.written()],
+                         ['a', 'b', 'a', 'b'])
+
+
+    def test_flowLimit(self):
+        """
+        Datagrams beyond C{flowLimit} waiting in a flow are dropped, and
+        counted in C{dropped}; other flows are unaffected.
+        """
+        self.egress.flowLimit = 2
+        for datagram in ['a1', 'a2', 'a3']:
+            self.egress.enqueue('a', datagram, ADDR)
+        self.egress.enqueue('b', 'b1', ADDR)
+        self.assertEqual(self.egress.dropped, 1)
+        self.clock.advance(0)
+        self.assertEqual(sorted(self.written()), ['a1', 'a2', 'b1'])
+
+
+    def test_flush(self):
+        """
+        L{EgressScheduler.flush} writes everything waiting right away,
+        whatever the C{bandwidthLimit}.
+        """
+        self.egress.bandwidthLimit = 1000
+        for i in range(3):
+            self.egress.enqueue('a', 'x' * 100, ADDR)
+        self.egress.flush()
+        self.assertEqual(len(self.written()), 3)
+        self.assertEqual(self.egress.pending(), 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_discard(self):
+        """
+        L{EgressScheduler.discard} throws away everything waiting.
+        """
+        self.egress.enqueue('a', 'a1', ADDR)
+        self.egress.discard()
+        self.clock.advance(1)
+        self.assertEqual(self.batches, [])
+        self.assertEqual(self.egress.pending(), 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
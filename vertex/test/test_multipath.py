@@ -0,0 +1,416 @@
+# Copyright 2005 Divmod, Inc.  See LICENSE file for details
+
+"""
+Tests for L{vertex.multipath}.
+"""
+
+from twisted.internet import error, protocol
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.test.iosim import FakeTransport, connect
+from twisted.trial import unittest
+
+from vertex import ptcp
+from vertex.multipath import MultipathTransport, Subflow, SubflowFactory
+from vertex.netsim import Network
+
+SERVER = '10.0.0.1'
+CLIENT_ADDRESSES = ['10.0.0.2', '10.0.0.3']
+
+
+
+class Collector(protocol.Protocol):
+    """
+    Remember what arrives, and why the connection was lost.
+    """
+    reason = None
+
+    def __init__(self):
+        self.buffer = []
+
+
+    def dataReceived(self, data):
+        self.buffer.append(data)
+
+
+    def connectionLost(self, reason):
+        self.reason = reason
+
+
+    def received(self):
+        return ''.join(self.buffer)
+
+
+
+def streamFactory(proto):
+    factory = protocol.Factory()
+    factory.protocol = lambda: proto
+    return factory
+
+
+
+class MultipathTransportTests(unittest.TestCase):
+    """
+    Tests for L{MultipathTransport} over subflows connected in memory.
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        self.clientProto = Collector()
+        self.serverProto = Collector()
+        self.client = MultipathTransport(streamFactory(self.clientProto),
+                                         'server', self.clock)
+        self.server = MultipathTransport(streamFactory(self.serverProto),
+                                         'client', self.clock)
+        self.pumps = []
+
+
+    def addSubflow(self):
+        """
+        Connect another subflow between the client and the server.
+
+        @return: The L{IOPump} between the two ends of the subflow.
+        """
+        clientSubflow = SubflowFactory(self.client).buildProtocol(None)
+        serverSubflow = Subflow(self.server)
+        pump = connect(serverSubflow, FakeTransport(serverSubflow, True),
+                       clientSubflow, FakeTransport(clientSubflow, False),
+                       greet=False)
+        self.pumps.append(pump)
+        return pump
+
+
+    def flush(self):
+        while [pump for pump in self.pumps if pump.pump()]:
+            pass
+
+
+    def data(self, size):
+        return ''.join([chr(i % 251) for i in range(size)])
+
+
+    def test_connected(self):
+        """
+        The protocol is connected to the stream when the first subflow is, and
+        the stream's addresses are those of the first subflow.
+        """
+        self.assertIdentical(self.clientProto.transport, None)
+        first = self.addSubflow()
+        self.addSubflow()
+        self.assertIdentical(self.clientProto.transport, self.client)
+        self.assertIdentical(self.serverProto.transport, self.server)
+        self.assertEqual(self.client.getPeer(), first.clientIO.getPeer())
+        self.assertEqual(len(self.client.subflows), 2)
+
+
+    def test_striped(self):
+        """
+        What is written is cut into chunks, which are shared out among the
+        subflows, and put back in order at the other end, even when one
+        subflow delivers all of its chunks before the other.
+        """
+        self.patch(MultipathTransport, 'defaultWindow', 4096)
+        first, second = self.addSubflow(), self.addSubflow()
+        data = self.data(64 * 1024)
+        self.client.write(data)
+        # The second subflow's chunks arrive first, so nothing can be
+        # delivered yet.
+        second.pump()
+        self.assertEqual(self.serverProto.buffer, [])
+        self.flush()
+        self.assertEqual(self.serverProto.received(), data)
+        self.assertEqual(first.clientIO.protocol.inflight, 0)
+        self.assertEqual(self.client._unacked, {})
+
+
+    def test_window(self):
+        """
+        A subflow is only given as much of the stream as its window has room
+        for, until some of it is acknowledged.
+        """
+        self.patch(MultipathTransport, 'defaultWindow', 4096)
+        self.patch(MultipathTransport, 'chunkSize', 1024)
+        self.addSubflow()
+        self.client.write(self.data(10000))
+        [subflow] = self.client.subflows
+        self.assertEqual(subflow.inflight, 4096)
+        self.assertEqual(len(self.client._pending), 10000 - 4096)
+
+
+    def test_subflowLost(self):
+        """
+        What was in flight on a subflow which is lost is sent again on those
+        left.
+        """
+        first, second = self.addSubflow(), self.addSubflow()
+        data = self.data(200000)
+        self.client.write(data)
+        lost = second.clientIO.protocol
+        self.assertTrue(lost.inflight)
+        second.clientIO.getOutBuffer()
+        lost.connectionLost(Failure(error.ConnectionLost()))
+        self.pumps.remove(second)
+        self.flush()
+        self.assertEqual(self.serverProto.received(), data)
+        self.assertEqual(self.client.subflows, [first.clientIO.protocol])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_overdue(self):
+        """
+        A chunk which goes unacknowledged for C{defaultChunkTimeout} on a
+        subflow whose transport doesn't measure its round trips is sent again
+        on another, and the subflow it was late on is given nothing more.
+        """
+        self.patch(MultipathTransport, 'defaultWindow', 4096)
+        self.patch(MultipathTransport, 'chunkSize', 4096)
+        first, second = self.addSubflow(), self.addSubflow()
+        late = second.clientIO.protocol
+        data = self.data(4096 * 2)
+        self.client.write(data)
+        second.clientIO.getOutBuffer()
+        while first.pump():
+            pass
+        self.clock.advance(MultipathTransport.defaultChunkTimeout)
+        self.assertTrue(late.overdue)
+        self.assertEqual(late.inflight, 0)
+        self.pumps.remove(second)
+        self.flush()
+        self.assertEqual(self.serverProto.received(), data)
+        more = self.data(4096 * 4)
+        self.client.write(more)
+        self.assertEqual(late.inflight, 0)
+        self.flush()
+        self.assertEqual(self.serverProto.received(), data + more)
+        self.assertEqual(self.client._unacked, {})
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_overdueCatchesUp(self):
+        """
+        A subflow which was overdue is given more of the stream again once it
+        acknowledges something.
+        """
+        self.patch(MultipathTransport, 'defaultWindow', 4096)
+        self.patch(MultipathTransport, 'chunkSize', 4096)
+        first, second = self.addSubflow(), self.addSubflow()
+        late = second.clientIO.protocol
+        self.client.write(self.data(4096 * 2))
+        while first.pump():
+            pass
+        self.clock.advance(MultipathTransport.defaultChunkTimeout)
+        self.assertTrue(late.overdue)
+        self.flush()
+        self.assertFalse(late.overdue)
+        self.client.write(self.data(4096 * 2))
+        self.assertEqual(late.inflight, 4096)
+
+
+    def test_overdueOnlySubflow(self):
+        """
+        A chunk which is overdue on the only subflow stays on it, to be
+        acknowledged when it can be.
+        """
+        pump = self.addSubflow()
+        [subflow] = self.client.subflows
+        data = self.data(1000)
+        self.client.write(data)
+        self.clock.advance(MultipathTransport.defaultChunkTimeout)
+        self.assertTrue(subflow.overdue)
+        self.assertEqual(subflow.inflight, 1000)
+        self.assertEqual(self.client._resend, [])
+        self.flush()
+        self.assertEqual(self.serverProto.received(), data)
+        self.assertFalse(subflow.overdue)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_chunkTimeout(self):
+        """
+        L{Subflow.chunkTimeout} is C{rttMultiple} times the round trip time
+        and four times its variance its transport measures, but no less than
+        C{minimumChunkTimeout}; or C{defaultChunkTimeout} before the round
+        trip time is measured.
+        """
+        class Transport(object):
+            def getStatistics(self):
+                return self.stats
+        subflow = Subflow(self.client)
+        subflow.transport = Transport()
+        subflow.transport.stats = dict(smoothedRTT=0.1, rttVariance=0.02)
+        self.assertAlmostEqual(subflow.chunkTimeout(),
+                               MultipathTransport.rttMultiple * 0.18)
+        subflow.transport.stats = dict(smoothedRTT=0.001, rttVariance=0.0)
+        self.assertEqual(subflow.chunkTimeout(),
+                         MultipathTransport.minimumChunkTimeout)
+        subflow.transport.stats = dict(smoothedRTT=None, rttVariance=None)
+        self.assertEqual(subflow.chunkTimeout(),
+                         MultipathTransport.defaultChunkTimeout)
+
+
+    def test_lastSubflowLost(self):
+        """
+        When its last subflow is lost before the stream is done, the
+        protocol's connection is lost.
+        """
+        pump = self.addSubflow()
+        pump.clientIO.protocol.connectionLost(
+            Failure(error.ConnectionDone()))
+        self.clientProto.reason.trap(error.ConnectionLost)
+        self.assertTrue(self.client.disconnected)
+
+
+    def test_loseConnection(self):
+        """
+        Once all that was written has been acknowledged, losing the connection
+        tells the peer where the stream ends, and the peer loses its
+        connection in turn; every subflow is closed once both ends have, and
+        both protocols' connections are then done.
+        """
+        self.addSubflow()
+        self.addSubflow()
+        data = self.data(100000)
+        self.client.write(data)
+        self.client.loseConnection()
+        self.assertFalse(self.client._finSent)
+        self.flush()
+        self.assertEqual(self.serverProto.received(), data)
+        self.clientProto.reason.trap(error.ConnectionDone)
+        self.serverProto.reason.trap(error.ConnectionDone)
+        for pump in self.pumps:
+            self.assertTrue(pump.clientIO.disconnected)
+
+
+    def test_finishedWhileSending(self):
+        """
+        When the peer's stream ends while some of ours is yet to be
+        acknowledged, the subflows are kept until it is.
+        """
+        self.patch(MultipathTransport, 'streamWindow', 50000)
+        self.addSubflow()
+        data = self.data(200000)
+        self.client.write(data)
+        self.server.loseConnection()
+        self.flush()
+        self.assertEqual(self.serverProto.received(), data)
+        self.assertEqual(self.client._unacked, {})
+        self.clientProto.reason.trap(error.ConnectionDone)
+        self.serverProto.reason.trap(error.ConnectionDone)
+
+
+    def test_abandonedWhileSending(self):
+        """
+        When the peer closes the subflows once its stream has ended, while
+        some of ours is yet to be acknowledged, the connection is lost rather
+        than done, at both ends.
+        """
+        self.patch(MultipathTransport, 'streamWindow', 50000)
+        pump = self.addSubflow()
+        self.client.write(self.data(200000))
+        self.server.loseConnection()
+        pump.serverIO.protocol.close()
+        self.flush()
+        self.assertTrue(self.client._pending)
+        self.clientProto.reason.trap(error.ConnectionLost)
+        self.serverProto.reason.trap(error.ConnectionLost)
+
+
+    def test_joinAfterLost(self):
+        """
+        A subflow connecting to a stream which has been lost is closed.
+        """
+        pump = self.addSubflow()
+        pump.clientIO.protocol.connectionLost(
+            Failure(error.ConnectionDone()))
+        pump = self.addSubflow()
+        self.assertTrue(pump.clientIO.disconnecting)
+        self.assertEqual(self.client.subflows, [])
+
+
+    def test_paused(self):
+        """
+        While the protocol is paused, nothing is delivered to it, and the
+        peer sends no more than C{streamWindow} octets; what is held back is
+        delivered on resuming.
+        """
+        self.patch(MultipathTransport, 'streamWindow', 50000)
+        self.addSubflow()
+        self.addSubflow()
+        self.server.pauseProducing()
+        data = self.data(200000)
+        self.client.write(data)
+        self.flush()
+        self.assertEqual(self.serverProto.buffer, [])
+        self.assertEqual(self.client._nextOffset, 50000)
+        self.server.resumeProducing()
+        self.flush()
+        self.assertEqual(self.serverProto.received(), data)
+
+
+    def test_producer(self):
+        """
+        A streaming producer is paused while more than C{bufferSize} octets
+        are waiting to be sent, and resumed once they are not.
+        """
+        class Producer(object):
+            paused = False
+            def pauseProducing(self):
+                self.paused = True
+            def resumeProducing(self):
+                self.paused = False
+        self.patch(MultipathTransport, 'bufferSize', 1000)
+        producer = Producer()
+        self.addSubflow()
+        self.client.registerProducer(producer, True)
+        self.client.write(self.data(self.client.defaultWindow + 1000))
+        self.assertTrue(producer.paused)
+        self.flush()
+        self.assertFalse(producer.paused)
+
+
+
+class SimulatedMultipathTests(unittest.TestCase):
+    """
+    Tests for L{MultipathTransport} striping across PTCP connections over a
+    simulated network.
+    """
+
+    def transfer(self, paths, size=500000):
+        """
+        Send C{size} octets from a client to a server across C{paths} PTCP
+        connections, each from a different client address over a link of its
+        own, which carries 100000 octets a second.
+
+        @return: How long the transfer took.
+        """
+        network = Network(delay=0.02, bandwidth=100000, queueLimit=32)
+        serverProto = Collector()
+        server = MultipathTransport(streamFactory(serverProto), 'client',
+                                    network)
+        network.listenUDP(5000, ptcp.PTCP(SubflowFactory(server),
+                                          reactor=network), SERVER)
+        clientProto = Collector()
+        client = MultipathTransport(streamFactory(clientProto), 'server',
+                                    network)
+        for address in CLIENT_ADDRESSES[:paths]:
+            port = ptcp.PTCP(None, reactor=network)
+            network.listenUDP(0, port, address)
+            port.connect(SubflowFactory(client), SERVER, 5000)
+        self.assertTrue(network.runUntil(
+                lambda: len(client.subflows) == paths, 10))
+        data = ''.join([chr(i % 251) for i in range(size)])
+        client.write(data)
+        self.assertTrue(network.runUntil(
+                lambda: len(serverProto.received()) >= size, 120))
+        self.assertEqual(serverProto.received(), data)
+        return network.seconds()
+
+
+    def test_aggregate(self):
+        """
+        A stream striped across two paths gets through substantially faster
+        than one carried on only one of them.
+        """
+        one = self.transfer(1)
+        two = self.transfer(2)
+        self.assertTrue(two < one * 0.7, (one, two))
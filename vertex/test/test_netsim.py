@@ -0,0 +1,370 @@
+# Copyright 2005 Divmod, Inc.  See LICENSE file for details
+
+"""
+Tests for L{vertex.netsim}.
+"""
+
+from zope.interface.verify import verifyObject
+
+from twisted.internet import protocol
+from twisted.internet.interfaces import IReactorTime, IReactorUDP
+from twisted.trial import unittest
+
+from vertex import ptcp
+from vertex.netsim import Network
+from vertex.test.test_ptcp import TestProtocol, Requester
+
+A = '10.0.0.1'
+B = '10.0.0.2'
+
+
+
+class Recorder(protocol.DatagramProtocol):
+    """
+    Remember every datagram received, with when it arrived.
+    """
+    def __init__(self, clock):
+        self.clock = clock
+        self.received = []
+
+
+    def datagramReceived(self, datagram, addr):
+        self.received.append((self.clock.seconds(), datagram, addr))
+
+
+
+class Echo(protocol.Protocol):
+    """
+    Write back whatever arrives.
+    """
+    def dataReceived(self, data):
+        self.transport.write(data)
+
+
+
+class NetworkTests(unittest.TestCase):
+    """
+    Tests for L{Network} and the conditions of its links.
+    """
+
+    def test_interfaces(self):
+        """
+        L{Network} provides L{IReactorTime} and L{IReactorUDP}, telling the
+        time by its C{clock}.
+        """
+        network = Network()
+        verifyObject(IReactorTime, network)
+        verifyObject(IReactorUDP, network)
+        call = network.callLater(5, lambda: None)
+        self.assertEqual(network.clock.getDelayedCalls(), [call])
+        self.assertEqual(network.getDelayedCalls(), [call])
+        network.clock.advance(2)
+        self.assertEqual(network.seconds(), 2)
+
+    def setUp(self):
+        self.network = Network(seed=1)
+        self.clock = self.network.clock
+        self.sender = self.network.listenUDP(0, Recorder(self.clock), A)
+        self.receiver = Recorder(self.clock)
+        self.port = self.network.listenUDP(5000, self.receiver, B)
+        self.link = self.network.link(A, B)
+
+
+    def send(self, *datagrams):
+        for datagram in datagrams:
+            self.sender.write(datagram, (B, 5000))
+
+
+    def arrived(self):
+        return [datagram for (when, datagram, addr) in self.receiver.received]
+
+
+    def test_delivery(self):
+        """
+        A datagram arrives at the port it was sent to, from the port which
+        sent it, C{delay} seconds later.
+        """
+        self.link.delay = 0.05
+        self.send('hello')
+        self.network.advance(0.049)
+        self.assertEqual(self.receiver.received, [])
+        self.network.advance(0.001)
+        self.assertEqual(self.receiver.received,
+                         [(0.05, 'hello', self.sender.address)])
+        self.assertEqual((self.link.sent, self.link.delivered), (1, 1))
+
+
+    def test_directions(self):
+        """
+        Each direction between two hosts has a link of its own, which starts
+        out with the network's defaults.
+        """
+        network = Network(delay=0.1)
+        forward = network.link(A, B)
+        self.assertIdentical(network.link(A, B), forward)
+        self.assertNotIdentical(network.link(B, A), forward)
+        self.assertEqual(network.link(B, A).delay, 0.1)
+
+
+    def test_unknownCondition(self):
+        """
+        Conditions links don't have are rejected.
+        """
+        self.assertRaises(TypeError, Network, lossRate=0.1)
+        self.assertRaises(TypeError, self.link.configure, lossRate=0.1)
+
+
+    def test_loss(self):
+        """
+        Datagrams are lost with probability C{loss}.
+        """
+        self.link.loss = 0.25
+        self.send(*['x'] * 1000)
+        self.network.advance(0)
+        self.assertEqual(len(self.arrived()), 1000 - self.link.lost)
+        self.assertApproximates(self.link.lost, 250, 50)
+
+
+    def test_deterministic(self):
+        """
+        The same seed makes the same choices.
+        """
+        def run():
+            network = Network(seed=7, loss=0.5)
+            receiver = Recorder(network.clock)
+            network.listenUDP(5000, receiver, B)
+            sender = network.listenUDP(0, Recorder(network.clock), A)
+            for i in range(100):
+                sender.write(str(i), (B, 5000))
+            network.advance(0)
+            return receiver.received
+        self.assertEqual(run(), run())
+
+
+    def test_duplication(self):
+        """
+        Datagrams are delivered twice with probability C{duplication}.
+        """
+        self.link.duplication = 1.0
+        self.send('hello')
+        self.network.advance(0)
+        self.assertEqual(self.arrived(), ['hello', 'hello'])
+        self.assertEqual(self.link.duplicated, 1)
+
+
+    def test_reordering(self):
+        """
+        Reordered datagrams are overtaken by those sent after them.
+        """
+        self.link.reordering = 1.0
+        self.send('first')
+        self.link.reordering = 0.0
+        self.send('second')
+        self.network.advance(self.link.reorderDelay)
+        self.assertEqual(self.arrived(), ['second', 'first'])
+
+
+    def test_jitter(self):
+        """
+        Datagrams are delayed by up to C{jitter} seconds more than C{delay}.
+        """
+        self.link.configure(delay=0.1, jitter=0.05)
+        self.send(*['x'] * 100)
+        self.network.advance(0.15)
+        times = [when for (when, datagram, addr) in self.receiver.received]
+        self.assertEqual(len(times), 100)
+        self.assertTrue(min(times) >= 0.1)
+        self.assertTrue(max(times) <= 0.15)
+        self.assertTrue(max(times) - min(times) > 0.04)
+
+
+    def test_bandwidth(self):
+        """
+        A link with limited bandwidth sends datagrams one after another, at
+        its rate.
+        """
+        self.link.bandwidth = 1000
+        self.send(*['x' * 100] * 3)
+        self.network.advance(0.31)
+        self.assertEqual(
+            [round(when, 6) for (when, datagram, addr)
+             in self.receiver.received],
+            [0.1, 0.2, 0.3])
+
+
+    def test_queueLimit(self):
+        """
+        Datagrams which find the queue for a link's bandwidth full are
+        dropped.
+        """
+        self.link.configure(bandwidth=1000, queueLimit=2)
+        self.send(*['x' * 100] * 3)
+        self.network.advance(0.1)
+        self.send('y' * 100)
+        self.network.advance(1)
+        self.assertEqual(self.arrived(), ['x' * 100] * 2 + ['y' * 100])
+        self.assertEqual(self.link.dropped, 1)
+
+
+    def test_mtu(self):
+        """
+        Datagrams larger than a link's C{mtu} have their ends cut off.
+        """
+        self.link.mtu = 4
+        self.send('hello', 'hi')
+        self.network.advance(0)
+        self.assertEqual(self.arrived(), ['hell', 'hi'])
+        self.assertEqual(self.link.truncated, 1)
+
+
+    def test_stopListening(self):
+        """
+        Once a port stops listening, nothing more is delivered to it, and its
+        address is free again.
+        """
+        self.send('hello')
+        self.port.stopListening()
+        self.network.advance(0)
+        self.assertEqual(self.arrived(), [])
+        self.network.listenUDP(5000, Recorder(self.clock), B)
+
+
+    def test_runUntil(self):
+        """
+        L{Network.runUntil} runs the network only until its condition holds,
+        or until it has waited as long as it was told to.
+        """
+        self.link.delay = 1.0
+        self.send('hello')
+        self.assertTrue(self.network.runUntil(self.arrived, 10))
+        self.assertEqual(self.clock.seconds(), 1.0)
+        self.assertFalse(self.network.runUntil(lambda: False, 10))
+        self.assertEqual(self.clock.seconds(), 1.0)
+        self.clock.callLater(100, lambda: None)
+        self.assertFalse(self.network.runUntil(lambda: False, 10))
+        self.assertEqual(self.clock.seconds(), 11.0)
+
+
+
+class SimulatedPTCPTests(unittest.TestCase):
+    """
+    Tests for L{ptcp.PTCP} connections over a simulated network.
+    """
+
+    def transfer(self, seed, size=100000, **conditions):
+        """
+        Send C{size} octets from a client to a server over a network with the
+        given conditions.
+
+        @return: The data the server received, and how long it took.
+        """
+        network = Network(seed=seed, **conditions)
+        serverProto = TestProtocol()
+        factory = protocol.ServerFactory()
+        factory.protocol = lambda: serverProto
+        network.listenUDP(5000, ptcp.PTCP(factory, reactor=network), B)
+        client = ptcp.PTCP(None, reactor=network)
+        network.listenUDP(0, client, A)
+
+        clientProto = TestProtocol()
+        factory = protocol.ClientFactory()
+        factory.protocol = lambda: clientProto
+        client.connect(factory, B, 5000)
+        self.assertTrue(network.runUntil(
+                lambda: clientProto.transport is not None, 60))
+        data = ''.join([chr(i % 256) for i in range(size)])
+        clientProto.transport.write(data)
+        received = lambda: sum(map(len, serverProto.buffer)) >= size
+        self.assertTrue(network.runUntil(received, 600))
+        return ''.join(serverProto.buffer), network.clock.seconds()
+
+
+    def test_adverse(self):
+        """
+        Everything sent arrives intact, in order, over a link which loses,
+        duplicates and reorders datagrams, and cuts short large ones.
+        """
+        data, elapsed = self.transfer(
+            seed=3, loss=0.05, duplication=0.02, reordering=0.05,
+            delay=0.02, jitter=0.005, bandwidth=1000000, mtu=1000)
+        self.assertEqual(data, ''.join([chr(i % 256)
+                                        for i in range(100000)]))
+
+
+    def test_reorderedRoundTrips(self):
+        """
+        Over a link which loses and reorders many datagrams, segments which
+        wait at the receiver for a gap before them to be filled don't
+        inflate the measured round-trip time, and the transfer completes.
+        """
+        samples = []
+        measured = ptcp.PTCPConnection._roundTripMeasured
+        def record(connection, rtt):
+            samples.append(rtt)
+            measured(connection, rtt)
+        self.patch(ptcp.PTCPConnection, '_roundTripMeasured', record)
+        data, elapsed = self.transfer(
+            seed=1, size=300000, loss=0.15, reordering=0.1, delay=0.02,
+            jitter=0.01)
+        self.assertEqual(data, ''.join([chr(i % 256)
+                                        for i in range(300000)]))
+        self.assertTrue(max(samples) < 1.0, max(samples))
+
+
+    def test_longFatPipe(self):
+        """
+        Over a path with a large bandwidth-delay product, a transfer is not
+        held back to one small receive window per round trip.
+        """
+        data, elapsed = self.transfer(
+            seed=0, size=1000000, delay=0.1, bandwidth=12500000,
+            queueLimit=256)
+        self.assertEqual(len(data), 1000000)
+        self.assertTrue(elapsed < 3.0, elapsed)
+
+
+    def test_repeatable(self):
+        """
+        A transfer over the same network with the same seed takes the same
+        time.
+        """
+        conditions = dict(seed=5, loss=0.05, delay=0.01, jitter=0.002)
+        self.assertEqual(self.transfer(**conditions)[1],
+                         self.transfer(**conditions)[1])
+
+
+    def exchange(self, fastOpen):
+        """
+        Have a client make two connections to an echo server, one after the
+        other, across a path with a round-trip time of 0.1 seconds, writing
+        a request as soon as each is connected.
+
+        @return: How long the second took, from connecting to the reply
+            arriving.
+        """
+        self.patch(ptcp.PTCPConnection, 'fastOpen', fastOpen)
+        network = Network(delay=0.05)
+        factory = protocol.ServerFactory()
+        factory.protocol = Echo
+        network.listenUDP(5000, ptcp.PTCP(factory, reactor=network), B)
+        client = ptcp.PTCP(None, reactor=network)
+        network.listenUDP(0, client, A)
+        for i in range(2):
+            clientProto = Requester('hello')
+            factory = protocol.ClientFactory()
+            factory.protocol = lambda: clientProto
+            started = network.seconds()
+            client.connect(factory, B, 5000)
+            self.assertTrue(network.runUntil(
+                    lambda: clientProto.buffer == ['hello'], 10))
+        return network.seconds() - started
+
+
+    def test_fastOpen(self):
+        """
+        With fast open, a request written as soon as a connection to a server
+        connected to before is made is answered a round trip sooner.
+        """
+        self.assertApproximates(self.exchange(False), 0.2, 0.01)
+        self.assertApproximates(self.exchange(True), 0.1, 0.01)
+
@@ -3,12 +3,19 @@
 # -*- test-case-name: vertex.test.test_ptcp -*-
 from __future__ import print_function
 
-import random, os
+import random, os, struct
 
-from twisted.internet import reactor, protocol, defer, error
+from binascii import crc32
+
+from twisted.internet import reactor, protocol, defer, error, task
+from twisted.python import log
+from twisted.python.monkey import MonkeyPatcher
 from twisted.trial import unittest
 
-from vertex import ptcp
+from zope.interface.verify import verifyObject
+
+from vertex import ptcp, tcpdfa
+from vertex.ivertex import ICongestionControl
 
 def reallyLossy(method):
     r = random.Random()
@@ -29,6 +36,7 @@ def insufficientTransmitter(method,  mtu):
 
 class TestProtocol(protocol.Protocol):
     buffer = None
+    reason = None
     def __init__(self):
         self.onConnect = defer.Deferred()
         self.onDisconn = defer.Deferred()
@@ -41,6 +49,7 @@ class TestProtocol(protocol.Protocol):
 
 
     def connectionLost(self, reason):
+        self.reason = reason
         self.onDisconn.callback(None)
 
 
@@ -84,6 +93,19 @@ class Django(protocol.ClientFactory):
 
 class ConnectedPTCPMixin:
     serverPort = None
+    patcher = None
+
+    def patchUntilClosed(self, obj, attribute, value):
+        """
+        Like L{unittest.TestCase.patch}, but leave the patch in place until
+        every connection has closed in L{tearDown}; trial undoes its own patches
+        before the close handshake has even started.
+        """
+        if self.patcher is None:
+            self.patcher = MonkeyPatcher()
+        self.patcher.addPatch(obj, attribute, value)
+        self.patcher.patch()
+
 
     def setUpForATest(self,
                       ServerProtocol=TestProtocol, ClientProtocol=TestProtocol):
@@ -125,6 +147,11 @@ class ConnectedPTCPMixin:
         for ptcpTransport in (self.serverTransport, self.clientTransport):
             td.append(ptcpTransport.waitForAllConnectionsToClose())
         d = defer.DeferredList(td)
+        if self.patcher is not None:
+            def restore(result):
+                self.patcher.restore()
+                return result
+            d.addBoth(restore)
         return d
 
 
@@ -174,9 +201,15 @@ class PTCPTransportTests(ConnectedPTCPMixin, unittest.TestCase):
         self.patch(
             ptcp.PTCPConnection, '_retransmitTimeout',
             ptcp.PTCPConnection._retransmitTimeout / 10)
+        self.patchUntilClosed(
+            ptcp.PTCPConnection, 'minimumRetransmitTimeout',
+            ptcp.PTCPConnection.minimumRetransmitTimeout / 10)
+        self.patchUntilClosed(
+            ptcp.PTCPConnection, 'maximumRetransmitTimeout',
+            ptcp.PTCPConnection._retransmitTimeout)
         self.patch(
-            ptcp.PTCPPacket, 'retransmitCount',
-            ptcp.PTCPPacket.retransmitCount * 10)
+            ptcp.PTCPPacket, 'maximumRetransmits',
+            ptcp.PTCPPacket.maximumRetransmits * 10)
 
 
     def xtestWhoAmI(self):
@@ -309,7 +342,7 @@ class PTCPTransportTests(ConnectedPTCPMixin, unittest.TestCase):
             # The server must write enough to completely fill the outgoing buffer,
             # since our peer isn't ACKing /anything/ and our server waits for
             # writes to be acked before proceeding.
-            serverProto.WRITE_SIZE = serverProto.transport.sendWindow * 5
+            serverProto.WRITE_SIZE = serverProto.transport.mtu * 5
 
             # print 'Connected'
             # print 'PAUSING CLIENT PROTO', clientProto, clientTransport, clientPort
@@ -333,10 +366,16 @@ class LossyTransportTestCase(PTCPTransportTests):
 
 
 class SmallMTUTransportTestCase(PTCPTransportTests):
+    # The least an IPv4 path carries in a UDP datagram; PTCP won't send
+    # segments smaller than that to suit a path which says it can't.
+    mtu = 576 - 28
+
     def setUpForATest(self, *a, **kw):
         results = PTCPTransportTests.setUpForATest(self, *a, **kw)
-        results[-2].write = insufficientTransmitter(results[-2].write, 128)
-        results[-1].write = insufficientTransmitter(results[-1].write, 128)
+        results[-2].write = insufficientTransmitter(results[-2].write,
+                                                    self.mtu)
+        results[-1].write = insufficientTransmitter(results[-1].write,
+                                                    self.mtu)
         return results
 
 
@@ -349,6 +388,12 @@ class TimeoutTests(ConnectedPTCPMixin, unittest.TestCase):
         self.patch(
             ptcp.PTCPConnection, '_retransmitTimeout',
             ptcp.PTCPConnection._retransmitTimeout / 10)
+        self.patchUntilClosed(
+            ptcp.PTCPConnection, 'minimumRetransmitTimeout',
+            ptcp.PTCPConnection.minimumRetransmitTimeout / 10)
+        self.patchUntilClosed(
+            ptcp.PTCPConnection, 'maximumRetransmitTimeout',
+            ptcp.PTCPConnection._retransmitTimeout)
 
 
     def test_ConnectTimeout(self):
@@ -383,3 +428,3254 @@ class TimeoutTests(ConnectedPTCPMixin, unittest.TestCase):
         d = defer.DeferredList([serverProto.onConnect, clientProto.onConnect])
         d.addCallback(cbConnected)
         return d
+
+
+
+class FakePTCP(object):
+    """
+    A stand-in for L{ptcp.PTCP} which records the packets its connections send
+    rather than writing them to a UDP transport.
+    """
+    def __init__(self):
+        self.sent = []
+        self.closed = []
+        self.reaped = []
+        self.pathMTUs = {}
+
+
+    def sendPacket(self, packet):
+        self.sent.append(packet)
+
+
+    def callLater(self, delay, f, *args, **kw):
+        # Straight to the reactor rather than to a timer wheel, so that timers
+        # go off exactly when they are due.
+        return ptcp.reactor.callLater(delay, f, *args, **kw)
+
+
+    def getPathMTU(self, host):
+        return self.pathMTUs.get(host)
+
+
+    def setPathMTU(self, host, mtu):
+        self.pathMTUs[host] = mtu
+
+
+    def connectionClosed(self, conn):
+        self.closed.append(conn)
+
+
+    def connectionReaped(self, conn):
+        self.reaped.append(conn)
+
+
+    def newConnectionID(self):
+        return 0x1d
+
+
+    def connectionIdentified(self, conn, connectionID):
+        conn.connectionID = connectionID
+
+
+
+PEER_ADDRESS = ('10.0.0.2', 4321)
+
+def peerPacket(seqNum, ackNum=1, data='', **flags):
+    """
+    Create a packet from our peer's pseudo-port 2 to our pseudo-port 1, the way
+    it would arrive off the wire.
+    """
+    flags.setdefault('ack', True)
+    pkt = ptcp.PTCPPacket.create(2, 1, seqNum, ackNum, data, **flags)
+    return ptcp.PTCPPacket.decode(pkt.encode(), PEER_ADDRESS)
+
+
+
+class EstablishedConnectionMixin:
+    """
+    Set up a server-side L{ptcp.PTCPConnection} which has completed its
+    handshake, attached to a L{FakePTCP} and running on a L{task.Clock}.
+
+    @ivar peerOptions: the options in the acknowledgement number of the
+        peer's SYN; by default, none, as an old peer would send.
+    """
+
+    peerOptions = 0
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(ptcp, 'reactor', self.clock)
+        self.ptcp = FakePTCP()
+        self.proto = TestProtocol()
+        factory = protocol.ServerFactory()
+        factory.protocol = lambda: self.proto
+        self.conn = ptcp.PTCPConnection(1, 2, self.ptcp, factory,
+                                        PEER_ADDRESS)
+        self.conn.machine.appPassiveOpen()
+        self.conn.packetReceived(
+            peerPacket(0, self.peerOptions, syn=True, ack=False))
+        self.conn.packetReceived(peerPacket(1))
+        self.assertIdentical(self.proto.transport, self.conn)
+        del self.ptcp.sent[:]
+
+
+
+class ReassemblyTests(EstablishedConnectionMixin, unittest.TestCase):
+    """
+    Tests for the holding and in-order delivery of segments which arrive
+    ahead of the next expected sequence number.
+    """
+
+    def test_outOfOrderDataHeld(self):
+        """
+        A segment which arrives ahead of the next expected one is not
+        delivered, but is immediately acknowledged with the sequence number
+        of the gap.
+        """
+        self.conn.packetReceived(peerPacket(6, data='world'))
+        self.assertEqual(self.proto.buffer, [])
+        self.assertEqual([p.ackNum for p in self.ptcp.sent], [1])
+        self.assertEqual(len(self.conn._reassemblyQueue), 1)
+
+
+    def test_gapFilled(self):
+        """
+        Once the gap in front of held segments is filled, they are all
+        delivered in sequence order.
+        """
+        self.conn.packetReceived(peerPacket(11, data='!!!'))
+        self.conn.packetReceived(peerPacket(6, data='world'))
+        self.conn.packetReceived(peerPacket(1, data='hello'))
+        self.assertEqual(self.proto.buffer, ['hello', 'world', '!!!'])
+        self.assertEqual(self.conn.nextRecvSeqNum, 14)
+        self.assertEqual(self.conn._reassemblyQueue, [])
+
+
+    def test_overlappingSegment(self):
+        """
+        A held segment which overlaps data that has already been delivered
+        only contributes its new bytes.
+        """
+        self.conn.packetReceived(peerPacket(4, data='lo world'))
+        self.conn.packetReceived(peerPacket(1, data='hello'))
+        self.assertEqual(''.join(self.proto.buffer), 'hello world')
+        self.assertEqual(self.conn.nextRecvSeqNum, 12)
+
+
+    def test_pendingFin(self):
+        """
+        A FIN which arrives before the data preceding it is only processed
+        after that data has been delivered.
+        """
+        self.conn.packetReceived(peerPacket(6, fin=True))
+        self.assertIdentical(self.conn._closeWaitLoseConnection, None)
+        self.conn.packetReceived(peerPacket(1, data='hello'))
+        self.assertEqual(self.proto.buffer, ['hello'])
+        self.assertEqual(self.conn.nextRecvSeqNum, 7)
+        self.assertNotIdentical(self.conn._closeWaitLoseConnection, None)
+
+
+    def test_duplicateIgnored(self):
+        """
+        Receiving the same out-of-order segment twice holds it only once.
+        """
+        self.conn.packetReceived(peerPacket(6, data='world'))
+        self.conn.packetReceived(peerPacket(6, data='world'))
+        self.assertEqual(len(self.conn._reassemblyQueue), 1)
+
+
+    def test_bounded(self):
+        """
+        No more than C{reassemblyLimit} segments are held; the rest are
+        dropped, to be retransmitted by the peer.
+        """
+        self.conn.reassemblyLimit = 2
+        for seq in (6, 11, 16):
+            self.conn.packetReceived(peerPacket(seq, data='xxxxx'))
+        self.assertEqual([seq for (seq, pkt) in self.conn._reassemblyQueue],
+                         [6, 11])
+
+
+    def test_outsideWindowDropped(self):
+        """
+        Segments beyond the receive window are not held.
+        """
+        self.conn.packetReceived(
+            peerPacket(1 + self.conn.recvWindow, data='late'))
+        self.assertEqual(self.conn._reassemblyQueue, [])
+
+
+
+class ClosingTests(EstablishedConnectionMixin, unittest.TestCase):
+    """
+    Tests for the exchange of FINs at the end of a connection.
+    """
+
+    def test_partialAckAfterFin(self):
+        """
+        An acknowledgement of only some of the data sent before our FIN does
+        not stop us from noticing the acknowledgement of the FIN itself.
+        """
+        self.conn.write('hello')
+        self.clock.advance(ptcp.SEND_DELAY)
+        self.conn.loseConnection()
+        [data, fin] = self.ptcp.sent
+        self.assertTrue(fin.fin)
+        self.assertTrue(fin.ack)
+
+        self.conn.packetReceived(peerPacket(1, 4))
+        self.conn.packetReceived(peerPacket(1, 7, fin=True))
+        self.assertNotIdentical(self.conn._timeWaitCall, None)
+
+
+
+class KeepAliveTests(EstablishedConnectionMixin, unittest.TestCase):
+    """
+    Tests for the keep-alive probes which find out whether an established
+    connection's peer is still there.
+    """
+
+    def setUp(self):
+        EstablishedConnectionMixin.setUp(self)
+        # Get the acknowledgement of the handshake out of the way.
+        self.clock.advance(0.5)
+        del self.ptcp.sent[:]
+
+
+    def test_probe(self):
+        """
+        Once nothing has been heard from our peer for C{keepAliveInterval}
+        seconds, it is sent a garbage octet from before its receive window,
+        which is not queued for retransmission.
+        """
+        self.clock.advance(self.conn.keepAliveInterval - 1)
+        self.assertEqual(self.ptcp.sent, [])
+        self.clock.advance(1)
+        [probe] = self.ptcp.sent
+        self.assertEqual(probe.seqNum, self.conn.nextSendSeqNum - 1)
+        self.assertEqual(probe.ackNum, 1)
+        self.assertEqual(probe.dlen, 1)
+        self.assertEqual(self.conn.retransmissionQueue, [])
+
+
+    def test_answered(self):
+        """
+        As long as our peer answers, the connection stays up, and probes are
+        only sent when it has been quiet for C{keepAliveInterval} seconds.
+        """
+        interval = self.conn.keepAliveInterval
+        for i in range(self.conn.keepAliveProbes * 2):
+            self.clock.advance(interval)
+            self.conn.packetReceived(peerPacket(1))
+        self.assertEqual(len(self.ptcp.sent), self.conn.keepAliveProbes * 2)
+        self.assertEqual(self.ptcp.closed, [])
+        self.clock.advance(interval / 2)
+        self.conn.packetReceived(peerPacket(1))
+        self.clock.advance(interval / 2)
+        self.assertEqual(len(self.ptcp.sent), self.conn.keepAliveProbes * 2)
+
+
+    def test_deadPeer(self):
+        """
+        If our peer answers none of C{keepAliveProbes} probes, the connection
+        times out and is reaped.
+        """
+        interval = self.conn.keepAliveInterval
+        self.clock.advance(interval * self.conn.keepAliveProbes)
+        self.assertEqual(len(self.ptcp.sent), self.conn.keepAliveProbes)
+        self.assertEqual(self.ptcp.closed, [])
+        self.clock.advance(interval)
+        self.assertEqual(self.ptcp.closed, [self.conn])
+        self.assertEqual(self.ptcp.reaped, [self.conn])
+        self.assertTrue(self.conn.disconnected)
+        self.proto.reason.trap(error.TimeoutError)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_probeAnswered(self):
+        """
+        A keep-alive probe is answered with an acknowledgement of what has
+        really been received.
+        """
+        self.conn.packetReceived(peerPacket(1, data='hello'))
+        self.clock.advance(1)
+        del self.ptcp.sent[:]
+        self.conn.packetReceived(peerPacket(5, data='\x00'))
+        self.assertEqual(self.proto.buffer, ['hello'])
+        self.clock.advance(1)
+        [ack] = self.ptcp.sent
+        self.assertEqual(ack.ackNum, 6)
+
+
+    def test_disabled(self):
+        """
+        With C{keepAliveInterval} set to C{None}, no probes are sent.
+        """
+        self.conn.keepAliveInterval = None
+        self.clock.advance(ptcp.PTCPConnection.keepAliveInterval * 100)
+        self.assertEqual(self.ptcp.sent, [])
+        self.assertEqual(self.ptcp.closed, [])
+
+
+
+class IdleTimeoutTests(EstablishedConnectionMixin, unittest.TestCase):
+    """
+    Tests for the timing out of connections on which no data has been sent or
+    received for too long.
+    """
+
+    def setUp(self):
+        self.patch(ptcp.PTCPConnection, 'idleTimeout', 10.0)
+        EstablishedConnectionMixin.setUp(self)
+
+
+    def test_idle(self):
+        """
+        A connection with no data for C{idleTimeout} seconds is reaped, however
+        responsive its peer.
+        """
+        for i in range(9):
+            self.clock.advance(1)
+            self.conn.packetReceived(peerPacket(1))
+        self.assertEqual(self.ptcp.closed, [])
+        self.clock.advance(1)
+        self.assertEqual(self.ptcp.closed, [self.conn])
+        self.assertEqual(self.ptcp.reaped, [self.conn])
+        self.proto.reason.trap(error.TimeoutError)
+
+
+    def test_dataKeepsAlive(self):
+        """
+        Data sent or received puts off the idle timeout.
+        """
+        self.clock.advance(6)
+        self.conn.packetReceived(peerPacket(1, data='hello'))
+        self.clock.advance(6)
+        self.conn.write('world')
+        self.clock.advance(ptcp.SEND_DELAY)
+        self.clock.advance(9)
+        self.assertEqual(self.ptcp.closed, [])
+        self.clock.advance(1)
+        self.assertEqual(self.ptcp.reaped, [self.conn])
+
+
+
+class ConnectionReapingTests(unittest.TestCase):
+    """
+    Tests for L{ptcp.PTCP} counting the connections which are reaped.
+    """
+
+    def test_counted(self):
+        """
+        L{ptcp.PTCP.connectionReaped} adds to C{connectionsReaped}.
+        """
+        proto = ptcp.PTCP(None)
+        self.assertEqual(proto.connectionsReaped, 0)
+        proto.connectionReaped(None)
+        proto.connectionReaped(None)
+        self.assertEqual(proto.connectionsReaped, 2)
+
+
+
+class EstablishedFastPathTests(EstablishedConnectionMixin, unittest.TestCase):
+    """
+    Tests for the shortcuts an established connection's state machine takes
+    for the segments and acknowledgements which leave it established.
+    """
+
+    inputs = ['appPassiveOpen', 'appActiveOpen', 'timeout', 'appClose',
+              'synAck', 'ack', 'rst', 'appSendData', 'syn', 'fin',
+              'cookieAck', 'fastOpen', 'segmentReceived']
+
+    def setUp(self):
+        EstablishedConnectionMixin.setUp(self)
+        self.transitions = []
+        machine = self.conn.machine
+        for name in self.inputs:
+            setattr(machine, name, self.recordInput(name,
+                                                    getattr(machine, name)))
+
+
+    def recordInput(self, name, input):
+        """
+        Wrap an input to the machine, to record its name in C{transitions}
+        when it is given.
+        """
+        def recorded(*a, **kw):
+            self.transitions.append(name)
+            return input(*a, **kw)
+        return recorded
+
+
+    def test_established(self):
+        """
+        The machine knows when it is in the established state, and when it has
+        left it.
+        """
+        self.assertTrue(self.conn.machine.isEstablished())
+        self.conn.loseConnection()
+        self.assertEqual(self.transitions, ['appClose'])
+        self.assertFalse(self.conn.machine.isEstablished())
+
+
+    def test_outputsFromTable(self):
+        """
+        The outputs produced directly for a segment received in the
+        established state are those of the transition the machine makes for
+        it.
+        """
+        self.assertEqual(
+            [output.__name__ for output in
+             tcpdfa.TCP._establishedSegmentOutputs],
+            ['sendAckSoon'])
+
+
+    def test_stateChanged(self):
+        """
+        The machine tells its implementation the name of every state it
+        enters from another, but not of one it stays in.
+        """
+        impl = RecordingConnection()
+        machine = tcpdfa.TCP(impl)
+        machine.appPassiveOpen()
+        machine.cookieAck()
+        machine.segmentReceived()
+        machine.appClose()
+        self.assertEqual([args for (name, args) in impl.arguments
+                          if name == 'stateChanged'],
+                         [('listen',), ('established',), ('finWait1',)])
+
+
+    def test_fastPath(self):
+        """
+        Data and acknowledgements received in the established state don't go
+        through the state machine, but are delivered and acknowledged just
+        the same.
+        """
+        self.conn.write('hello')
+        self.clock.advance(ptcp.SEND_DELAY)
+        self.conn.packetReceived(peerPacket(1, 6, data='world'))
+        self.clock.advance(ptcp.ACK_DELAY)
+        self.assertEqual(self.transitions, [])
+        self.assertEqual(self.proto.buffer, ['world'])
+        self.assertEqual(self.conn.retransmissionQueue, [])
+        self.assertEqual(self.ptcp.sent[-1].ackNum, 6)
+        self.assertEqual(self.ptcp.sent[-1].dlen, 0)
+
+
+    def test_slowPath(self):
+        """
+        With the fast path turned off, segments go through the state machine,
+        to the same effect.
+        """
+        self.conn.machine.fastPath = False
+        self.conn.packetReceived(peerPacket(1, data='world'))
+        self.clock.advance(ptcp.ACK_DELAY)
+        self.assertEqual(self.transitions, ['segmentReceived'])
+        self.assertEqual(self.proto.buffer, ['world'])
+        self.assertEqual(self.ptcp.sent[-1].ackNum, 6)
+
+
+    def test_sameOutputs(self):
+        """
+        A segment received in the established state has the same outputs,
+        and leaves the machine in the same state, whether it takes the fast
+        path or goes through the C{segmentReceived} input.
+        """
+        def receive(fastPath):
+            impl = RecordingConnection()
+            machine = tcpdfa.TCP(impl)
+            machine.fastPath = fastPath
+            machine.appPassiveOpen()
+            machine.cookieAck()
+            del impl.calls[:]
+            machine.receiveSegment()
+            machine.receiveSegment()
+            received = impl.calls[:]
+            machine.appClose()
+            return received, impl.calls[len(received):]
+        fast, slow = receive(True), receive(False)
+        self.assertEqual(fast, slow)
+        self.assertEqual(fast[0], ['ackSoon', 'ackSoon'])
+
+
+
+class RecordingConnection(object):
+    """
+    Stand in for a L{ptcp.PTCPConnection} driven by a L{tcpdfa.TCP}, and
+    record the names of the methods it calls.
+    """
+    def __init__(self):
+        self.calls = []
+        self.arguments = []
+
+
+    def __getattr__(self, name):
+        def call(*a, **kw):
+            self.calls.append(name)
+            self.arguments.append((name, a))
+        return call
+
+
+
+class RenoCongestionControlTests(unittest.TestCase):
+    """
+    Tests for L{ptcp.RenoCongestionControl}.
+    """
+
+    def test_interface(self):
+        """
+        L{ptcp.RenoCongestionControl} provides L{ICongestionControl}.
+        """
+        self.assertTrue(
+            verifyObject(ICongestionControl, ptcp.RenoCongestionControl(500)))
+
+
+    def test_initialWindow(self):
+        """
+        The initial window is as large as possible while staying at or below
+        4380 octets, but at least two segments.
+        """
+        for (mss, window) in [(500, 2000), (1200, 3600), (2200, 4400)]:
+            self.assertEqual(
+                ptcp.RenoCongestionControl(mss).congestionWindow, window)
+
+
+    def test_slowStart(self):
+        """
+        Below the slow start threshold, each acknowledgement grows the window
+        by the amount acknowledged, up to one segment.
+        """
+        cc = ptcp.RenoCongestionControl(500)
+        cc.acknowledged(300)
+        self.assertEqual(cc.congestionWindow, 2300)
+        cc.acknowledged(5000)
+        self.assertEqual(cc.congestionWindow, 2800)
+
+
+    def test_congestionAvoidance(self):
+        """
+        Above the slow start threshold, each acknowledgement grows the window
+        by a fraction of a segment, so that it grows by about one segment per
+        window's worth of acknowledgements.
+        """
+        cc = ptcp.RenoCongestionControl(500)
+        cc.slowStartThreshold = 2000
+        cc.acknowledged(500)
+        self.assertEqual(cc.congestionWindow, 2125)
+
+
+    def test_timedOut(self):
+        """
+        A retransmission timeout halves the slow start threshold (but not below
+        two segments) and collapses the window to a single segment.
+        """
+        cc = ptcp.RenoCongestionControl(500)
+        cc.timedOut(6000)
+        self.assertEqual(cc.slowStartThreshold, 3000)
+        self.assertEqual(cc.congestionWindow, 500)
+        cc.timedOut(600)
+        self.assertEqual(cc.slowStartThreshold, 1000)
+
+
+    def test_lost(self):
+        """
+        A segment lost while others are still getting through halves the slow
+        start threshold (but not below two segments), and the window shrinks
+        to match it.
+        """
+        cc = ptcp.RenoCongestionControl(500)
+        cc.lost(6000)
+        self.assertEqual(cc.slowStartThreshold, 3000)
+        self.assertEqual(cc.congestionWindow, 3000)
+        cc.lost(600)
+        self.assertEqual(cc.congestionWindow, 1000)
+
+
+
+class FixedCongestionWindowTests(unittest.TestCase):
+    """
+    Tests for L{ptcp.FixedCongestionWindow}.
+    """
+
+    def test_interface(self):
+        """
+        L{ptcp.FixedCongestionWindow} provides L{ICongestionControl}.
+        """
+        self.assertTrue(
+            verifyObject(ICongestionControl, ptcp.FixedCongestionWindow(500)))
+
+
+    def test_fixed(self):
+        """
+        The window is always the same number of segments.
+        """
+        cc = ptcp.FixedCongestionWindow(500)
+        cc.acknowledged(500)
+        cc.timedOut(1000)
+        cc.lost(1000)
+        self.assertEqual(cc.congestionWindow, 1000)
+        cc.maximumSegmentSize = 100
+        self.assertEqual(cc.congestionWindow, 200)
+
+
+
+class CongestionWindowTests(EstablishedConnectionMixin, unittest.TestCase):
+    """
+    Tests for the way L{ptcp.PTCPConnection} limits what it sends according
+    to its congestion controller.
+    """
+
+    def setUp(self):
+        """
+        Use segments small enough that the initial window is four of them.
+        """
+        self.patch(ptcp.PTCPConnection, 'mtu', ptcp.PTCPConnection.minimumMTU)
+        self.patch(ptcp.PTCPConnection, 'maximumMTU',
+                   ptcp.PTCPConnection.minimumMTU)
+        EstablishedConnectionMixin.setUp(self)
+
+
+    def sendLots(self):
+        self.conn.write('x' * (self.conn.mtu * 20))
+        self.clock.advance(ptcp.SEND_DELAY)
+
+
+    def test_initialWindow(self):
+        """
+        No more than the initial congestion window is sent before anything is
+        acknowledged.
+        """
+        self.sendLots()
+        self.assertEqual(len(self.ptcp.sent), 4)
+        self.assertEqual(self.conn.sendWindowRemaining, 0)
+
+
+    def test_acknowledgementOpensWindow(self):
+        """
+        An acknowledgement both makes room in the window and grows it, and more
+        data is sent to fill it.
+        """
+        self.sendLots()
+        self.conn.packetReceived(peerPacket(1, 1 + self.conn.mtu * 2))
+        self.clock.advance(ptcp.SEND_DELAY)
+        self.assertEqual(self.conn.congestion.congestionWindow,
+                         self.conn.mtu * 5)
+        self.assertEqual(len(self.ptcp.sent), 7)
+
+
+    def test_timeoutCollapsesWindow(self):
+        """
+        When the retransmission timer expires, the congestion controller is
+        told how much was in flight.
+        """
+        self.sendLots()
+        self.clock.advance(self.conn._retransmitTimeout)
+        self.assertEqual(self.conn.congestion.congestionWindow, self.conn.mtu)
+        self.assertEqual(self.conn.congestion.slowStartThreshold,
+                         self.conn.mtu * 2)
+
+
+    def test_pluggable(self):
+        """
+        The congestion controller is created by C{congestionControlFactory}.
+        """
+        self.patch(ptcp.PTCPConnection, 'congestionControlFactory',
+                   ptcp.FixedCongestionWindow)
+        conn = ptcp.PTCPConnection(1, 3, self.ptcp, None, PEER_ADDRESS)
+        self.assertIsInstance(conn.congestion, ptcp.FixedCongestionWindow)
+        self.assertEqual(conn.congestion.maximumSegmentSize, conn.mtu)
+
+
+
+class PacingTests(EstablishedConnectionMixin, unittest.TestCase):
+    """
+    Tests for the way L{ptcp.PTCPConnection} spreads out the segments of new
+    data it sends according to its pacing rate.
+    """
+
+    def setUp(self):
+        EstablishedConnectionMixin.setUp(self)
+        self.conn.sendWindow = self.conn.congestion.congestionWindow = 1 << 20
+        self.conn.smoothedRTT = 0.5
+
+
+    def test_estimatedRate(self):
+        """
+        The pacing rate is C{pacingGain} congestion windows per smoothed round
+        trip time, or C{maximumPacingRate} if that is lower.
+        """
+        self.assertEqual(self.conn.pacingRate,
+                         self.conn.pacingGain * (1 << 20) / 0.5)
+        self.conn.maximumPacingRate = 1000
+        self.assertEqual(self.conn.pacingRate, 1000)
+        self.conn.pacingGain = None
+        self.conn.maximumPacingRate = None
+        self.assertIdentical(self.conn.pacingRate, None)
+
+
+    def test_spread(self):
+        """
+        Segments which the windows would allow to be sent all at once go out
+        no faster than the pacing rate.
+        """
+        size = self.conn.mtu + ptcp._fixedSize
+        self.conn.pacingGain = None
+        self.conn.maximumPacingRate = size * 10
+        self.conn.pacingHorizon = 0
+        self.conn.write('x' * (self.conn.mtu * 3))
+        self.clock.advance(ptcp.SEND_DELAY)
+        self.assertEqual(len(self.ptcp.sent), 1)
+        self.clock.advance(0.099)
+        self.assertEqual(len(self.ptcp.sent), 1)
+        self.clock.advance(0.002)
+        self.assertEqual(len(self.ptcp.sent), 2)
+        self.clock.advance(0.1)
+        self.assertEqual(len(self.ptcp.sent), 3)
+        self.assertEqual(''.join([p.data for p in self.ptcp.sent]),
+                         'x' * (self.conn.mtu * 3))
+
+
+    def test_unpaced(self):
+        """
+        Without a pacing rate, everything the windows allow is sent at once.
+        """
+        self.conn.pacingGain = None
+        self.conn.write('x' * (self.conn.mtu * 3))
+        self.clock.advance(ptcp.SEND_DELAY)
+        self.assertEqual(len(self.ptcp.sent), 3)
+
+
+
+class RetransmitTimeoutTests(EstablishedConnectionMixin, unittest.TestCase):
+    """
+    Tests for the measurement of round-trip times and the retransmission
+    timeout derived from them.
+    """
+
+    def sendAndAcknowledge(self, rtt):
+        """
+        Send a segment, and receive its acknowledgement C{rtt} seconds later.
+        """
+        self.conn.write('hello')
+        self.clock.advance(ptcp.SEND_DELAY)
+        self.clock.advance(rtt)
+        self.conn.packetReceived(peerPacket(1, self.conn.nextSendSeqNum))
+
+
+    def test_handshakeMeasured(self):
+        """
+        The acknowledgement of our SYN provides the first round-trip time
+        measurement.
+        """
+        self.assertEqual(self.conn.smoothedRTT, 0)
+        self.assertEqual(self.conn.rttVariance, 0)
+        self.assertEqual(self.conn.retransmitTimeout,
+                         self.conn.minimumRetransmitTimeout)
+
+
+    def test_firstMeasurement(self):
+        """
+        The first measurement sets the smoothed round-trip time, and half of
+        it the variance.
+        """
+        conn = ptcp.PTCPConnection(1, 3, self.ptcp, None, PEER_ADDRESS)
+        self.assertEqual(conn.retransmitTimeout, conn._retransmitTimeout)
+        conn._roundTripMeasured(0.3)
+        self.assertEqual(conn.smoothedRTT, 0.3)
+        self.assertEqual(conn.rttVariance, 0.15)
+        self.assertAlmostEqual(conn.retransmitTimeout, 0.9)
+
+
+    def test_laterMeasurement(self):
+        """
+        Later measurements are folded into the estimates with the RFC 6298
+        gains, and the timeout is the smoothed round-trip time plus four times
+        the variance.
+        """
+        self.conn.retransmitTimeout = 1.0
+        self.sendAndAcknowledge(0.4)
+        self.assertAlmostEqual(self.conn.smoothedRTT, 0.05)
+        self.assertAlmostEqual(self.conn.rttVariance, 0.1)
+        self.assertAlmostEqual(self.conn.retransmitTimeout, 0.45)
+
+
+    def test_timerUsesTimeout(self):
+        """
+        The retransmission timer waits for the current retransmission
+        timeout.
+        """
+        self.conn.retransmitTimeout = 3
+        self.conn.write('hello')
+        self.clock.advance(ptcp.SEND_DELAY)
+        del self.ptcp.sent[:]
+        self.clock.advance(2.9)
+        self.assertEqual(self.ptcp.sent, [])
+        self.clock.advance(0.1)
+        self.assertEqual(len(self.ptcp.sent), 1)
+
+
+    def test_backoff(self):
+        """
+        Each time the retransmission timer expires, the timeout doubles, up to
+        C{maximumRetransmitTimeout}.
+        """
+        self.conn.maximumRetransmitTimeout = 1.0
+        self.conn.write('hello')
+        self.clock.advance(ptcp.SEND_DELAY)
+        timeouts = []
+        for i in range(4):
+            self.clock.advance(self.conn.retransmitTimeout)
+            timeouts.append(self.conn.retransmitTimeout)
+        self.assertEqual(timeouts, [0.4, 0.8, 1.0, 1.0])
+
+
+    def test_giveUp(self):
+        """
+        A segment which has gone unacknowledged for C{maximumRetransmitTime}
+        times the connection out, however few of its C{maximumRetransmits}
+        it has used up while the timeout backed off.
+        """
+        lost = []
+        self.proto.onDisconn.addCallback(lost.append)
+        self.conn.write('hello')
+        self.clock.advance(ptcp.SEND_DELAY)
+        self.clock.pump([1] * int(self.conn.maximumRetransmitTime - 1))
+        self.assertEqual(lost, [])
+        self.assertTrue(self.conn.retransmissionQueue[0].retransmitCount > 1)
+        self.clock.advance(1)
+        self.assertEqual(lost, [None])
+
+
+    def test_retransmittedNotMeasured(self):
+        """
+        The acknowledgement of a retransmitted segment is not used as a
+        measurement, and the timeout stays backed off.
+        """
+        self.conn.write('hello')
+        self.clock.advance(ptcp.SEND_DELAY)
+        self.clock.advance(self.conn.retransmitTimeout)
+        self.conn.packetReceived(peerPacket(1, self.conn.nextSendSeqNum))
+        self.assertEqual(self.conn.smoothedRTT, 0)
+        self.assertEqual(self.conn.retransmitTimeout,
+                         self.conn.minimumRetransmitTimeout * 2)
+
+
+    def test_minimum(self):
+        """
+        The timeout is never less than C{minimumRetransmitTimeout}.
+        """
+        self.sendAndAcknowledge(0.001)
+        self.assertEqual(self.conn.retransmitTimeout,
+                         self.conn.minimumRetransmitTimeout)
+
+
+
+class RetransmissionTests(EstablishedConnectionMixin, unittest.TestCase):
+    """
+    Tests for the retransmission of individual segments, when their own timer
+    expires or when duplicate acknowledgements show they were lost.
+    """
+
+    def send(self, data):
+        self.conn.write(data)
+        self.clock.advance(ptcp.SEND_DELAY)
+
+
+    def test_onlyExpiredRetransmitted(self):
+        """
+        When the retransmission timer goes off, only the segments which were
+        last sent a full retransmission timeout ago are sent again.
+        """
+        timeout = self.conn.retransmitTimeout
+        self.send('hello')
+        self.clock.advance(timeout / 2)
+        self.send('world')
+        del self.ptcp.sent[:]
+        self.clock.advance(timeout / 2)
+        self.assertEqual([p.data for p in self.ptcp.sent], ['hello'])
+        self.assertEqual([p.retransmitCount
+                          for p in self.conn.retransmissionQueue],
+                         [ptcp.PTCPPacket.maximumRetransmits - 1,
+                          ptcp.PTCPPacket.maximumRetransmits])
+
+
+    def test_laterSegmentRetransmittedOnItsOwnTimer(self):
+        """
+        A segment sent after one which has been retransmitted is retransmitted
+        when its own timer expires.
+        """
+        timeout = self.conn.retransmitTimeout
+        self.send('hello')
+        self.clock.advance(timeout / 2)
+        self.send('world')
+        self.clock.advance(timeout / 2)
+        del self.ptcp.sent[:]
+        self.clock.advance(self.conn.retransmitTimeout - timeout / 2)
+        self.assertEqual([p.data for p in self.ptcp.sent], ['world'])
+
+
+    def test_acknowledgementReschedules(self):
+        """
+        Once the segments which were due first are acknowledged, the timer is
+        set for the next segment to fall due.
+        """
+        timeout = self.conn.retransmitTimeout
+        self.send('hello')
+        self.clock.advance(timeout / 2)
+        self.send('world')
+        self.conn.packetReceived(peerPacket(1, 6))
+        del self.ptcp.sent[:]
+        self.clock.advance(timeout / 2)
+        self.assertEqual(self.ptcp.sent, [])
+        self.clock.advance(timeout / 2)
+        self.assertEqual([p.data for p in self.ptcp.sent], ['world'])
+
+
+    def test_fastRetransmit(self):
+        """
+        The third acknowledgement in a row which acknowledges nothing new
+        causes the oldest unacknowledged segment to be retransmitted at once,
+        and the congestion controller to be told about the loss.
+        """
+        for data in ['one', 'two', 'three']:
+            self.send(data)
+        del self.ptcp.sent[:]
+        self.conn.packetReceived(peerPacket(1, 1))
+        self.conn.packetReceived(peerPacket(1, 1))
+        self.assertEqual(self.ptcp.sent, [])
+        self.conn.packetReceived(peerPacket(1, 1))
+        self.assertEqual([p.data for p in self.ptcp.sent], ['one'])
+        self.assertEqual(self.conn.congestion.congestionWindow,
+                         2 * self.conn.mtu)
+        self.conn.packetReceived(peerPacket(1, 1))
+        self.assertEqual(len(self.ptcp.sent), 1)
+
+
+    def test_partialAcknowledgement(self):
+        """
+        After a fast retransmission, an acknowledgement of only some of what
+        was in flight shows that the segment after it was lost too, and it is
+        retransmitted at once; the congestion window is not reduced again.
+        """
+        for data in ['one', 'two', 'three']:
+            self.send(data)
+        for i in range(self.conn.duplicateAckThreshold):
+            self.conn.packetReceived(peerPacket(1, 1))
+        window = self.conn.congestion.congestionWindow
+        del self.ptcp.sent[:]
+        self.conn.packetReceived(peerPacket(1, 4))
+        self.assertEqual([p.data for p in self.ptcp.sent], ['two'])
+        self.assertTrue(self.conn.congestion.congestionWindow >= window)
+        self.conn.packetReceived(peerPacket(1, 12))
+        self.assertIdentical(self.conn._recoveryPoint, None)
+
+
+    def test_noFastRetransmitAfterTimeout(self):
+        """
+        Duplicate acknowledgements of segments already retransmitted when
+        their timer went off don't cause them to be retransmitted again.
+        """
+        for data in ['one', 'two', 'three']:
+            self.send(data)
+        self.clock.advance(self.conn.retransmitTimeout)
+        del self.ptcp.sent[:]
+        for i in range(self.conn.duplicateAckThreshold):
+            self.conn.packetReceived(peerPacket(1, 1))
+        self.assertEqual(self.ptcp.sent, [])
+
+
+    def test_newAcknowledgementResetsDuplicates(self):
+        """
+        Duplicate acknowledgements are only counted since the last
+        acknowledgement of something new.
+        """
+        for data in ['one', 'two', 'three']:
+            self.send(data)
+        self.conn.packetReceived(peerPacket(1, 1))
+        self.conn.packetReceived(peerPacket(1, 1))
+        self.conn.packetReceived(peerPacket(1, 4))
+        del self.ptcp.sent[:]
+        self.conn.packetReceived(peerPacket(1, 4))
+        self.conn.packetReceived(peerPacket(1, 4))
+        self.assertEqual(self.ptcp.sent, [])
+        self.conn.packetReceived(peerPacket(1, 4))
+        self.assertEqual([p.data for p in self.ptcp.sent], ['two'])
+
+
+    def test_dataIsNotDuplicate(self):
+        """
+        A segment carrying data is not a duplicate acknowledgement, even if it
+        acknowledges nothing new.
+        """
+        self.send('hello')
+        del self.ptcp.sent[:]
+        for seq in [1, 2, 3]:
+            self.conn.packetReceived(peerPacket(seq, 1, data='x'))
+        self.assertNotIn('hello', [p.data for p in self.ptcp.sent])
+
+
+
+class PacketCodecTests(unittest.TestCase):
+    """
+    Tests for the encoding and decoding of L{ptcp.PTCPPacket}s.
+    """
+
+    def test_roundTrip(self):
+        """
+        Every field of a packet survives encoding and decoding.
+        """
+        pkt = ptcp.PTCPPacket.create(1, 2, 2 ** 32 - 1, 20, 'data',
+                                     window=1234, syn=True, ack=True, fin=True)
+        bytes = pkt.encode()
+        self.assertEqual(len(bytes), ptcp._fixedSize + 4)
+        decoded = ptcp.PTCPPacket.decode(bytes, PEER_ADDRESS)
+        decoded.verifyChecksum()
+        self.assertEqual(
+            (decoded.sourcePseudoPort, decoded.destPseudoPort, decoded.seqNum,
+             decoded.ackNum, decoded.window, decoded.flags, decoded.checksum,
+             decoded.dlen, decoded.data, decoded.peerAddressTuple),
+            (1, 2, 2 ** 32 - 1, 20, 1234, ptcp._SYN | ptcp._ACK | ptcp._FIN,
+             crc32('data'), 4, 'data', PEER_ADDRESS))
+
+
+    def test_defaultWindow(self):
+        """
+        A packet created without a window advertises
+        L{ptcp.PTCPConnection.recvWindow}.
+        """
+        self.patch(ptcp.PTCPConnection, 'recvWindow', 12345)
+        pkt = ptcp.PTCPPacket.create(1, 2, 10, 20, 'data', ack=True)
+        self.assertEqual(pkt.window, 12345)
+
+
+    def test_checksumOnce(self):
+        """
+        The checksum of a packet is computed when it is created, and not again
+        however many times it is encoded; it covers nothing which changes when
+        a packet is retransmitted.
+        """
+        checksums = []
+        def countingCRC32(*args):
+            checksums.append(args)
+            return crc32(*args)
+        self.patch(ptcp, 'crc32', countingCRC32)
+        pkt = ptcp.PTCPPacket.create(1, 2, 10, 20, 'data', ack=True)
+        first = pkt.encode()
+        pkt.ackNum = 30
+        second = pkt.encode()
+        self.assertEqual(len(checksums), 1)
+        decoded = ptcp.PTCPPacket.decode(second, PEER_ADDRESS)
+        decoded.verifyChecksum()
+        self.assertEqual(decoded.ackNum, 30)
+        self.assertEqual(first[ptcp._fixedSize:], second[ptcp._fixedSize:])
+
+
+    def test_fastOpenCookie(self):
+        """
+        A SYN or a SYN-ACK may carry a fast-open cookie after its other
+        options, which is covered by its checksum and takes up no sequence
+        space.
+        """
+        cookie = '\x00cookie\xff'
+        for pkt in [
+            ptcp.PTCPPacket.create(1, 2, 10, ptcp._SYN_FAST_OPEN, 'data',
+                                   syn=True, fastOpenCookie=cookie),
+            ptcp.PTCPPacket.create(1, 2, 10, 20, '', syn=True, ack=True,
+                                   sak=True, connectionID=0x1d,
+                                   migrationKey='k' * 16,
+                                   fastOpenCookie=cookie)]:
+            decoded = ptcp.PTCPPacket.decode(pkt.encode(), PEER_ADDRESS)
+            decoded.verifyChecksum()
+            self.assertEqual(decoded.fastOpenCookie, cookie)
+            self.assertEqual(decoded.data, pkt.data)
+            self.assertEqual(decoded.connectionID, pkt.connectionID)
+            self.assertEqual(decoded.migrationKey, pkt.migrationKey)
+            self.assertEqual(decoded.segmentLength(), 1 + len(pkt.data))
+        bytes = pkt.encode()
+        bytes = bytes[:-1] + 'x'
+        self.assertRaises(ptcp.ChecksumMismatchError,
+                          ptcp.PTCPPacket.decode(bytes, None).verifyChecksum)
+
+
+
+class CompactRepresentationTests(unittest.TestCase):
+    """
+    Tests for the memory-saving representations of packets and connections.
+    """
+
+    def test_packet(self):
+        """
+        Packets have no instance dictionary.
+        """
+        pkt = ptcp.PTCPPacket.create(1, 2, 10, 20, 'data', ack=True)
+        self.assertFalse(hasattr(pkt, '__dict__'))
+        self.assertRaises(AttributeError, setattr, pkt, 'surprise', 1)
+
+
+    def test_connection(self):
+        """
+        A new connection keeps none of its state in its instance dictionary,
+        which only holds settings overridden for that connection.
+        """
+        fake = FakePTCP()
+        conn = ptcp.PTCPConnection(1, 2, fake, None, PEER_ADDRESS)
+        self.assertEqual(conn.__dict__, {})
+        fake.pathMTUs[PEER_ADDRESS[0]] = 700
+        conn = ptcp.PTCPConnection(1, 2, fake, None, PEER_ADDRESS)
+        self.assertEqual(conn.__dict__, {'mtu': 700})
+
+
+    def test_repr(self):
+        """
+        Packets still describe themselves in detail.
+        """
+        pkt = ptcp.PTCPPacket.create(1, 2, 10, 20, 'data', ack=True)
+        self.assertEqual(
+            repr(pkt),
+            "<PTCPPacket sourcePseudoPort=1 destPseudoPort=2 data='data' "
+            "flags=.A...... dlen=4 seq=10 ack=20 checksum=%x "
+            "peerAddress=None retransmitCount=50 sack=() connectionID=None>"
+            % (crc32('data'),))
+
+
+
+class SelectiveAcknowledgementPacketTests(unittest.TestCase):
+    """
+    Tests for the encoding of selective acknowledgement blocks.
+    """
+
+    def test_roundTrip(self):
+        """
+        Selective acknowledgement blocks survive encoding and decoding, along
+        with the data, and are covered by the checksum.
+        """
+        pkt = ptcp.PTCPPacket.create(1, 2, 10, 20, 'data', ack=True,
+                                     sackBlocks=[(30, 40), (50, 60)])
+        self.assertTrue(pkt.sak)
+        decoded = ptcp.PTCPPacket.decode(pkt.encode(), PEER_ADDRESS)
+        decoded.verifyChecksum()
+        self.assertTrue(decoded.sak)
+        self.assertEqual(decoded.sackBlocks, [(30, 40), (50, 60)])
+        self.assertEqual(decoded.data, 'data')
+
+
+    def test_corruptBlocks(self):
+        """
+        A packet whose selective acknowledgement blocks were damaged in transit
+        fails its checksum.
+        """
+        pkt = ptcp.PTCPPacket.create(1, 2, 10, 20, '', ack=True,
+                                     sackBlocks=[(30, 40)])
+        bytes = pkt.encode()
+        bytes = bytes[:-1] + chr(ord(bytes[-1]) ^ 1)
+        decoded = ptcp.PTCPPacket.decode(bytes, PEER_ADDRESS)
+        self.assertRaises(ptcp.ChecksumMismatchError, decoded.verifyChecksum)
+
+
+    def test_withoutBlocks(self):
+        """
+        A packet without selective acknowledgement blocks is encoded exactly
+        as it always was, so that peers which don't know about them can read
+        it.
+        """
+        pkt = ptcp.PTCPPacket.create(1, 2, 10, 20, 'data', ack=True)
+        self.assertFalse(pkt.sak)
+        self.assertEqual(len(pkt.encode()), ptcp._fixedSize + 4)
+        self.assertEqual(pkt.checksum, crc32('data'))
+
+
+
+class SelectiveAcknowledgementNegotiationTests(unittest.TestCase):
+    """
+    Tests for the agreement, during the handshake, to use selective
+    acknowledgements.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(ptcp, 'reactor', self.clock)
+        # Keep the acknowledgement number of our SYNs down to the one option.
+        self.patch(ptcp.PTCPConnection, 'connectionMigration', False)
+        self.ptcp = FakePTCP()
+
+
+    def connect(self):
+        factory = protocol.ClientFactory()
+        factory.protocol = TestProtocol
+        conn = ptcp.PTCPConnection(1, 2, self.ptcp, factory, PEER_ADDRESS)
+        conn.machine.appActiveOpen()
+        return conn
+
+
+    def accept(self, options):
+        conn = ptcp.PTCPConnection(1, 2, self.ptcp, protocol.ServerFactory(),
+                                   PEER_ADDRESS)
+        conn.machine.appPassiveOpen()
+        conn.packetReceived(peerPacket(0, options, syn=True, ack=False))
+        return conn
+
+
+    def test_offered(self):
+        """
+        Our SYN offers selective acknowledgements in its acknowledgement
+        number, and no flags besides SYN, which older peers insist upon.
+        """
+        self.connect()
+        [syn] = self.ptcp.sent
+        self.assertEqual(syn.flags, ptcp._SYN)
+        self.assertEqual(syn.ackNum,
+                         ptcp._SYN_SACK_PERMITTED | ptcp._SYN_ANY_ISN)
+
+
+    def test_offeredOnRetransmission(self):
+        """
+        A retransmitted SYN still offers selective acknowledgements.
+        """
+        conn = self.connect()
+        self.clock.advance(conn.retransmitTimeout)
+        self.assertEqual([p.ackNum for p in self.ptcp.sent],
+                         [ptcp._SYN_SACK_PERMITTED | ptcp._SYN_ANY_ISN] * 2)
+
+
+    def test_notOffered(self):
+        """
+        If C{selectiveAcknowledgement} is false, our SYN doesn't offer them.
+        """
+        self.patch(ptcp.PTCPConnection, 'selectiveAcknowledgement', False)
+        self.connect()
+        [syn] = self.ptcp.sent
+        self.assertEqual(syn.ackNum, ptcp._SYN_ANY_ISN)
+
+
+    def test_accepted(self):
+        """
+        A peer which accepts our offer sets the SAK flag on its SYN+ACK.
+        """
+        conn = self.connect()
+        conn.packetReceived(peerPacket(0, 1, syn=True, sak=True))
+        self.assertTrue(conn.sackPermitted)
+
+
+    def test_declined(self):
+        """
+        A peer which does not know about selective acknowledgements doesn't
+        set the SAK flag on its SYN+ACK.
+        """
+        conn = self.connect()
+        conn.packetReceived(peerPacket(0, 1, syn=True))
+        self.assertFalse(conn.sackPermitted)
+
+
+    def test_accept(self):
+        """
+        We accept a peer's offer of selective acknowledgements by setting the
+        SAK flag on our SYN+ACK.
+        """
+        conn = self.accept(ptcp._SYN_SACK_PERMITTED)
+        [synAck] = self.ptcp.sent
+        self.assertTrue(synAck.syn and synAck.ack and synAck.sak)
+        self.assertEqual(synAck.sackBlocks, ())
+        self.assertTrue(conn.sackPermitted)
+
+
+    def test_oldPeer(self):
+        """
+        A peer which doesn't offer selective acknowledgements gets a SYN+ACK
+        it can understand.
+        """
+        conn = self.accept(0)
+        [synAck] = self.ptcp.sent
+        self.assertEqual(synAck.flags, ptcp._SYN | ptcp._ACK)
+        self.assertFalse(conn.sackPermitted)
+
+
+    def test_decline(self):
+        """
+        If C{selectiveAcknowledgement} is false, we decline a peer's offer.
+        """
+        self.patch(ptcp.PTCPConnection, 'selectiveAcknowledgement', False)
+        conn = self.accept(ptcp._SYN_SACK_PERMITTED)
+        [synAck] = self.ptcp.sent
+        self.assertFalse(synAck.sak)
+        self.assertFalse(conn.sackPermitted)
+
+
+
+class SelectiveAcknowledgementTests(EstablishedConnectionMixin,
+                                    unittest.TestCase):
+    """
+    Tests for the sending and use of selective acknowledgements on a
+    connection which negotiated them.
+    """
+
+    peerOptions = ptcp._SYN_SACK_PERMITTED
+
+    def test_blocksReported(self):
+        """
+        Our acknowledgements report the contiguous ranges of segments held
+        for reassembly.
+        """
+        self.conn.packetReceived(peerPacket(6, data='world'))
+        self.conn.packetReceived(peerPacket(11, data='!!!'))
+        self.conn.packetReceived(peerPacket(20, data='x'))
+        self.assertEqual([p.sackBlocks for p in self.ptcp.sent],
+                         [[(6, 11)], [(6, 14)], [(6, 14), (20, 21)]])
+
+
+    def test_blocksLimited(self):
+        """
+        No more than C{maximumSackBlocks} ranges are reported.
+        """
+        self.conn.maximumSackBlocks = 2
+        for seq in [6, 11, 16]:
+            self.conn.packetReceived(peerPacket(seq, data='x'))
+        self.assertEqual(self.ptcp.sent[-1].sackBlocks, [(6, 7), (11, 12)])
+
+
+    def test_noBlocksWhenInOrder(self):
+        """
+        Acknowledgements sent when nothing is held for reassembly have no
+        blocks.
+        """
+        self.conn.packetReceived(peerPacket(1, data='hello'))
+        self.clock.advance(1)
+        [ack] = self.ptcp.sent
+        self.assertFalse(ack.sak)
+
+
+    def test_notReportedWithoutAgreement(self):
+        """
+        If our peer didn't agree to selective acknowledgements, we don't send
+        any.
+        """
+        self.conn.sackPermitted = False
+        self.conn.packetReceived(peerPacket(6, data='world'))
+        [ack] = self.ptcp.sent
+        self.assertFalse(ack.sak)
+
+
+    def test_sackedNotRetransmitted(self):
+        """
+        Segments our peer has told us it is holding are not retransmitted when
+        their timers expire.
+        """
+        for data in ['one', 'two', 'three']:
+            self.conn.write(data)
+            self.clock.advance(ptcp.SEND_DELAY)
+        self.conn.packetReceived(peerPacket(1, 1, sackBlocks=[(4, 7)]))
+        del self.ptcp.sent[:]
+        self.clock.advance(self.conn.retransmitTimeout)
+        self.assertEqual([p.data for p in self.ptcp.sent], ['one', 'three'])
+
+
+    def test_firstAlwaysRetransmitted(self):
+        """
+        The oldest unacknowledged segment is retransmitted even if our peer
+        once said it was holding it, since it evidently isn't any more.
+        """
+        self.conn.write('one')
+        self.clock.advance(ptcp.SEND_DELAY)
+        self.conn.packetReceived(peerPacket(1, 1, sackBlocks=[(1, 4)]))
+        del self.ptcp.sent[:]
+        self.clock.advance(self.conn.retransmitTimeout)
+        self.assertEqual([p.data for p in self.ptcp.sent], ['one'])
+
+
+
+    def sendApart(self, *pieces):
+        """
+        Write each of C{pieces} 20ms after the one before.
+        """
+        for data in pieces:
+            self.conn.write(data)
+            self.clock.advance(0.02)
+
+
+    def test_sackedPastRetransmitted(self):
+        """
+        Once duplicate acknowledgements show a loss, every segment which our
+        peer has selectively acknowledged a later one past is retransmitted
+        at once.
+        """
+        self.sendApart('one', 'two', 'three', 'four')
+        del self.ptcp.sent[:]
+        for i in range(self.conn.duplicateAckThreshold):
+            self.conn.packetReceived(
+                peerPacket(1, 1, sackBlocks=[(4, 7), (12, 16)]))
+        self.assertEqual([p.data for p in self.ptcp.sent], ['one', 'three'])
+
+
+    def test_reorderingTolerated(self):
+        """
+        Once a segment has been seen to arrive after one sent some time after
+        it, segments sent less than that long before one which has arrived
+        are given the chance to arrive as well before they are retransmitted.
+        """
+        self.conn.smoothedRTT = 1.0
+        self.sendApart('one', 'two')
+        self.conn.packetReceived(peerPacket(1, 1, sackBlocks=[(4, 7)]))
+        self.conn.packetReceived(peerPacket(1, 7))
+        self.assertApproximates(self.conn._reorderingWindow, 0.02, 1e-6)
+
+        for data in ['three', 'four']:
+            self.conn.write(data)
+            self.clock.advance(0.01)
+        del self.ptcp.sent[:]
+        for i in range(self.conn.duplicateAckThreshold):
+            self.conn.packetReceived(
+                peerPacket(1, 7, sackBlocks=[(12, 16)]))
+        self.assertEqual(self.ptcp.sent, [])
+
+        self.clock.advance(0.01)
+        self.sendApart('five')
+        del self.ptcp.sent[:]
+        self.conn.packetReceived(peerPacket(1, 7, sackBlocks=[(12, 20)]))
+        self.assertEqual([p.data for p in self.ptcp.sent], ['three'])
+
+
+
+class FlowControlTests(EstablishedConnectionMixin, unittest.TestCase):
+    """
+    Tests for honouring the window our peer advertises, and advertising our
+    own.
+    """
+
+    def send(self, data):
+        self.conn.write(data)
+        self.clock.advance(ptcp.SEND_DELAY)
+
+
+    def sentData(self):
+        return [p.data for p in self.ptcp.sent if p.dlen]
+
+
+    def test_windowFromSyn(self):
+        """
+        Our peer's window is first taken from its SYN.
+        """
+        conn = ptcp.PTCPConnection(1, 3, self.ptcp, protocol.ServerFactory(),
+                                   PEER_ADDRESS)
+        conn.machine.appPassiveOpen()
+        conn.packetReceived(peerPacket(0, 0, syn=True, ack=False, window=1234))
+        self.assertEqual(conn.sendWindow, 1234)
+
+
+    def test_sendLimitedByWindow(self):
+        """
+        No more than our peer's window is sent before it is acknowledged, even
+        if the congestion window would allow more.
+        """
+        self.conn.packetReceived(peerPacket(1, 1, window=100))
+        self.send('x' * 1000)
+        self.assertEqual(map(len, self.sentData()), [100])
+        self.assertEqual(self.conn.sendWindowRemaining, 0)
+
+
+    def test_windowUpdate(self):
+        """
+        An acknowledgement which acknowledges nothing new but opens the window
+        lets more data be sent, and isn't a duplicate acknowledgement.
+        """
+        self.conn.packetReceived(peerPacket(1, 1, window=100))
+        self.send('x' * 1000)
+        for window in [150, 200, 250]:
+            self.conn.packetReceived(peerPacket(1, 1, window=window))
+            self.clock.advance(ptcp.SEND_DELAY)
+        self.assertEqual(map(len, self.sentData()), [100, 50, 50, 50])
+
+
+    def test_staleWindowIgnored(self):
+        """
+        A window from a segment older than the one we last took the window
+        from is ignored.
+        """
+        self.conn.packetReceived(peerPacket(6, 1, data='hello', window=500))
+        self.conn.packetReceived(peerPacket(1, 1, window=100))
+        self.assertEqual(self.conn.sendWindow, 500)
+
+
+    def test_zeroWindowProbe(self):
+        """
+        If our peer's window is closed and nothing is in flight, a probe like
+        a keep-alive's, which it will answer with its window, is sent after a
+        retransmission timeout, and again after twice as long, and so on,
+        until the window opens.  The probes are not queued for
+        retransmission.
+        """
+        self.conn.packetReceived(peerPacket(1, 1, window=0))
+        self.send('hello')
+        self.assertEqual(self.sentData(), [])
+        timeout = self.conn.retransmitTimeout
+        self.clock.advance(timeout)
+        [probe] = [p for p in self.ptcp.sent if p.dlen]
+        self.assertEqual((probe.seqNum, probe.data),
+                         (self.conn.nextSendSeqNum - 1, '\x00'))
+        self.assertEqual(self.conn.retransmissionQueue, [])
+        self.clock.advance(timeout * 2 - 0.01)
+        self.assertEqual(self.sentData(), ['\x00'])
+        self.clock.advance(0.01)
+        self.assertEqual(self.sentData(), ['\x00', '\x00'])
+        self.conn.packetReceived(peerPacket(1, 1, window=100))
+        self.clock.advance(ptcp.SEND_DELAY)
+        self.assertEqual(self.sentData()[-1], 'hello')
+
+
+    def test_zeroWindowIndefinitely(self):
+        """
+        A peer may keep its window closed for as long as it likes: as long as
+        it answers our probes, the connection stays up, and its congestion
+        window and loss rate are left alone.
+        """
+        self.conn.packetReceived(peerPacket(1, 1, window=0))
+        self.send('hello')
+        congestionWindow = self.conn.congestion.congestionWindow
+        for i in range(200):
+            self.clock.advance(self.conn.maximumRetransmitTimeout)
+            self.conn.packetReceived(peerPacket(1, 1, window=0))
+        self.assertTrue(len(self.ptcp.sent) >= 190)
+        self.assertEqual(self.proto.onDisconn.called, False)
+        self.assertEqual(self.conn.congestion.congestionWindow,
+                         congestionWindow)
+        self.assertEqual(self.conn.lossRate, 0)
+        self.conn.packetReceived(peerPacket(1, 1, window=100))
+        self.clock.advance(ptcp.SEND_DELAY)
+        self.assertEqual(self.sentData()[-1], 'hello')
+
+
+    def test_windowOpensBeforeProbe(self):
+        """
+        If our peer's window opens before we probe it, no probe is sent.
+        """
+        self.conn.packetReceived(peerPacket(1, 1, window=0))
+        self.send('hello')
+        self.conn.packetReceived(peerPacket(1, 1, window=100))
+        self.clock.advance(self.conn.retransmitTimeout)
+        self.assertEqual(self.sentData(), ['hello'])
+
+
+    def test_largeWindowAdvertised(self):
+        """
+        Our receive window is advertised in full, however far beyond 32KB it
+        is.
+        """
+        self.conn.recvWindow = 1 << 24
+        self.conn.originate(ack=True)
+        [ack] = self.ptcp.sent
+        decoded = ptcp.PTCPPacket.decode(ack.encode(), PEER_ADDRESS)
+        self.assertEqual(decoded.window, 1 << 24)
+
+
+    def test_windowUpdateSent(self):
+        """
+        When our receive window opens by at least a segment, we tell our peer
+        at once; smaller changes wait for the next packet we send anyway.
+        """
+        self.conn.recvWindow += 1
+        self.conn._maybeUpdateWindow()
+        self.assertEqual(self.ptcp.sent, [])
+        self.conn.recvWindow += self.conn.mtu
+        self.conn._maybeUpdateWindow()
+        [update] = self.ptcp.sent
+        self.assertEqual(update.window, self.conn.recvWindow)
+
+
+
+class ReceivePausingTests(EstablishedConnectionMixin, unittest.TestCase):
+    """
+    Tests for pausing the delivery of received data to the application.
+    """
+
+    def test_dataHeld(self):
+        """
+        Data which arrives while paused is acknowledged but not delivered, and
+        the window we advertise shrinks by its size.
+        """
+        self.conn.pauseProducing()
+        self.conn.packetReceived(peerPacket(1, data='hello'))
+        self.clock.advance(1)
+        self.assertEqual(self.proto.buffer, [])
+        [ack] = self.ptcp.sent
+        self.assertEqual(ack.ackNum, 6)
+        self.assertEqual(ack.window, self.conn.recvWindow - 5)
+
+
+    def test_acknowledgementsProcessed(self):
+        """
+        Acknowledgements of data we sent are processed while paused.
+        """
+        self.conn.write('hello')
+        self.clock.advance(ptcp.SEND_DELAY)
+        self.conn.pauseProducing()
+        self.conn.packetReceived(peerPacket(1, 6))
+        self.assertEqual(self.conn.retransmissionQueue, [])
+
+
+    def test_windowCloses(self):
+        """
+        Once the held data fills the receive window, more is refused.
+        """
+        self.conn.recvWindow = 10
+        self.conn.pauseProducing()
+        self.conn.packetReceived(peerPacket(1, data='hello'))
+        self.conn.packetReceived(peerPacket(6, data='world'))
+        self.conn.packetReceived(peerPacket(11, data='!'))
+        self.assertEqual(self.conn.currentRecvWindow(), 0)
+        self.assertEqual(self.conn.nextRecvSeqNum, 11)
+
+
+    def test_resume(self):
+        """
+        Resuming delivers the held data, in order, and tells our peer that the
+        window has opened again.
+        """
+        self.conn.pauseProducing()
+        self.conn.packetReceived(peerPacket(1, data='hello' * 300))
+        self.conn.packetReceived(peerPacket(1501, data='world'))
+        self.clock.advance(1)
+        del self.ptcp.sent[:]
+        self.conn.resumeProducing()
+        self.assertEqual(self.proto.buffer, ['hello' * 300, 'world'])
+        [update] = self.ptcp.sent
+        self.assertEqual(update.window, self.conn.recvWindow)
+
+
+    def test_resumeWithNothingHeld(self):
+        """
+        Resuming when nothing arrived in the meantime sends nothing.
+        """
+        self.conn.pauseProducing()
+        self.conn.resumeProducing()
+        self.assertEqual(self.ptcp.sent, [])
+
+
+    def test_pausedDuringResume(self):
+        """
+        If the application pauses again while held data is being delivered,
+        the rest stays held.
+        """
+        self.conn.pauseProducing()
+        self.conn.packetReceived(peerPacket(1, data='hello'))
+        self.conn.packetReceived(peerPacket(6, data='world'))
+        self.proto.dataReceived = lambda data: self.conn.pauseProducing()
+        self.conn.resumeProducing()
+        self.assertEqual(self.conn._receiveBuffer, ['world'])
+
+
+    def test_finHeld(self):
+        """
+        A FIN which arrives while data is held is only processed once that
+        data has been delivered.
+        """
+        self.conn.pauseProducing()
+        self.conn.packetReceived(peerPacket(1, data='hello'))
+        self.conn.packetReceived(peerPacket(6, fin=True))
+        self.assertIdentical(self.conn._closeWaitLoseConnection, None)
+        self.conn.resumeProducing()
+        self.assertEqual(self.proto.buffer, ['hello'])
+        self.assertNotIdentical(self.conn._closeWaitLoseConnection, None)
+
+
+
+class SendBufferTests(unittest.TestCase):
+    """
+    Tests for L{ptcp._SendBuffer}.
+    """
+
+    def test_empty(self):
+        """
+        A new buffer is empty, and taking from it gives nothing.
+        """
+        buf = ptcp._SendBuffer()
+        self.assertEqual(len(buf), 0)
+        self.assertFalse(buf)
+        self.assertEqual(buf.take(10), '')
+
+
+    def test_drained(self):
+        """
+        Once everything has been taken from a buffer, it lets go of its
+        storage.
+        """
+        buf = ptcp._SendBuffer()
+        buf.append('hello')
+        buf.append('world')
+        self.assertEqual(buf.take(10), 'helloworld')
+        self.assertIdentical(buf._chunks, None)
+        buf.append('again')
+        self.assertEqual(buf.take(10), 'again')
+
+
+    def test_take(self):
+        """
+        Octets are taken from the front of the buffer, in the order they were
+        appended, across the boundaries between appended strings.
+        """
+        buf = ptcp._SendBuffer()
+        for data in ['hello', '', ' ', 'world']:
+            buf.append(data)
+        self.assertEqual(len(buf), 11)
+        self.assertEqual(buf.take(3), 'hel')
+        self.assertEqual(buf.take(4), 'lo w')
+        self.assertEqual(len(buf), 4)
+        self.assertEqual(buf.take(100), 'orld')
+        self.assertEqual(len(buf), 0)
+
+
+    def test_wholeStringNotCopied(self):
+        """
+        Taking exactly a string which was appended gives that string back.
+        """
+        data = 'x' * 1000
+        buf = ptcp._SendBuffer()
+        buf.append(data)
+        self.assertIdentical(buf.take(1000), data)
+
+
+    def test_prepend(self):
+        """
+        Octets put back at the front of the buffer are taken next, before what
+        was left of the rest.
+        """
+        buf = ptcp._SendBuffer()
+        buf.prepend('world')
+        buf.append('wide')
+        self.assertEqual(buf.take(2), 'wo')
+        buf.prepend('hello ')
+        self.assertEqual(len(buf), 13)
+        self.assertEqual(buf.take(100), 'hello rldwide')
+
+
+
+class LargeWriteTests(EstablishedConnectionMixin, unittest.TestCase):
+    """
+    Tests for writing more data than fits in a single segment.
+    """
+
+    def test_segmented(self):
+        """
+        Data written in pieces of any size is sent in segments of the MTU, and
+        arrives intact.
+        """
+        self.conn.sendWindow = self.conn.congestion.congestionWindow = 1 << 20
+        data = ''.join([chr(i % 256) * i for i in range(100)])
+        self.conn.writeSequence([data[:10], data[10:3000]])
+        self.conn.write(data[3000:])
+        self.clock.advance(ptcp.SEND_DELAY)
+        sent = [p.data for p in self.ptcp.sent]
+        self.assertEqual(''.join(sent), data)
+        self.assertEqual(set(map(len, sent[:-1])), set([self.conn.mtu]))
+
+
+
+class PathMTUTests(EstablishedConnectionMixin, unittest.TestCase):
+    """
+    Tests for the discovery of the largest segments a path can carry.
+    """
+
+    def setUp(self):
+        EstablishedConnectionMixin.setUp(self)
+        # Our peer stays quiet for longer than keep-alives would put up with
+        # while we wait to probe again.
+        self.conn.keepAliveInterval = None
+
+
+    def send(self, data):
+        self.conn.write(data)
+        self.clock.advance(ptcp.SEND_DELAY)
+
+
+    def sentSizes(self):
+        sizes = [p.dlen for p in self.ptcp.sent if p.dlen]
+        del self.ptcp.sent[:]
+        return sizes
+
+
+    def test_ethernetDefault(self):
+        """
+        Segments start out as large as an Ethernet frame can carry in a UDP
+        datagram.
+        """
+        self.assertEqual(ptcp.PTCPConnection.mtu + ptcp._fixedSize, 1472)
+        self.assertEqual(self.conn.congestion.maximumSegmentSize,
+                         self.conn.mtu)
+
+
+    def test_truncated(self):
+        """
+        When our peer tells us a segment we sent was truncated, we send
+        segments no larger than what got through, including those waiting to
+        be retransmitted, but don't remember that for later connections to
+        the same host, since nothing has shown it to be true.
+        """
+        self.send('x' * 1000)
+        [segment] = self.conn.retransmissionQueue
+        self.conn.packetReceived(peerPacket(
+                0, segment.seqNum, data=struct.pack('!H', 600), stb=True,
+                ack=False))
+        self.assertEqual(self.conn.mtu, 600)
+        self.assertEqual([p.dlen for p in self.conn.retransmissionQueue],
+                         [600, 400])
+        self.assertEqual(self.ptcp.pathMTUs, {})
+
+
+    def test_truncatedClamped(self):
+        """
+        However small our peer says our segments are being truncated to, we
+        send segments of at least C{minimumMTU} octets.
+        """
+        self.send('x' * 1000)
+        [segment] = self.conn.retransmissionQueue
+        self.conn.packetReceived(peerPacket(
+                0, segment.seqNum, data=struct.pack('!H', 0), stb=True,
+                ack=False))
+        self.assertEqual(self.conn.mtu, self.conn.minimumMTU)
+        self.assertEqual([p.dlen for p in self.conn.retransmissionQueue],
+                         [489, 489, 22])
+
+
+    def test_truncatedUnknown(self):
+        """
+        A report of the truncation of a segment we don't have in flight, or
+        which was no larger than what got through, is ignored.
+        """
+        self.send('x' * 1000)
+        [segment] = self.conn.retransmissionQueue
+        mtu = self.conn.mtu
+        self.conn.packetReceived(peerPacket(
+                0, segment.seqNum + 1, data=struct.pack('!H', 600),
+                stb=True, ack=False))
+        self.conn.packetReceived(peerPacket(
+                0, segment.seqNum, data=struct.pack('!H', 1200), stb=True,
+                ack=False))
+        self.assertEqual(self.conn.mtu, mtu)
+        self.assertEqual([p.dlen for p in self.conn.retransmissionQueue],
+                         [1000])
+
+
+    def test_remembered(self):
+        """
+        A new connection to a host starts out with the segment size an earlier
+        one discovered.
+        """
+        self.ptcp.pathMTUs[PEER_ADDRESS[0]] = 700
+        conn = ptcp.PTCPConnection(1, 3, self.ptcp, None, PEER_ADDRESS)
+        self.assertEqual(conn.mtu, 700)
+        self.assertEqual(conn.congestion.maximumSegmentSize, 700)
+
+
+    def test_probe(self):
+        """
+        Some time after our segment size was limited, a segment as large as
+        C{maximumMTU} is sent to probe the path, and if it is acknowledged,
+        that becomes our segment size.
+        """
+        self.conn._limitMTU(self.conn.minimumMTU)
+        self.send('x' * 2000)
+        self.assertEqual(self.sentSizes(), [489, 489, 489, 489, 44])
+        self.conn.packetReceived(peerPacket(1, 2001))
+        self.clock.advance(self.conn.mtuProbeInterval)
+        self.send('x' * 2000)
+        self.assertEqual(self.sentSizes(), [self.conn.maximumMTU, 489, 62])
+        self.conn.packetReceived(peerPacket(1, 2001 + self.conn.maximumMTU))
+        self.assertEqual(self.conn.mtu, self.conn.maximumMTU)
+        self.assertEqual(self.ptcp.pathMTUs,
+                         {PEER_ADDRESS[0]: self.conn.maximumMTU})
+
+
+    def test_probeLost(self):
+        """
+        A probe which goes unacknowledged has its data sent again in segments
+        of the usual size, without being taken as a sign of congestion, and the
+        next probe is smaller.
+        """
+        self.conn._limitMTU(self.conn.minimumMTU)
+        self.clock.advance(self.conn.mtuProbeInterval)
+        self.send('x' * self.conn.maximumMTU)
+        self.assertEqual(self.sentSizes(), [self.conn.maximumMTU])
+        window = self.conn.congestion.congestionWindow
+        timeout = self.conn.retransmitTimeout
+        self.clock.advance(timeout)
+        self.assertEqual(self.sentSizes(), [489, 489, 471])
+        self.assertEqual(self.conn.congestion.congestionWindow, window)
+        self.assertEqual(self.conn.retransmitTimeout, timeout)
+        self.assertEqual(self.conn.mtu, self.conn.minimumMTU)
+        self.assertEqual(self.conn._mtuProbeSize(), (489 + 1449) // 2)
+
+
+    def test_probeSearchEnds(self):
+        """
+        Once successive probes have narrowed down the segment size to within
+        C{mtuProbeGranularity}, no more are sent until C{mtuProbeInterval}
+        has passed.
+        """
+        self.conn._limitMTU(self.conn.minimumMTU)
+        self.clock.advance(self.conn.mtuProbeInterval)
+        self.conn._mtuCeiling = self.conn.mtu + self.conn.mtuProbeGranularity
+        self.assertIdentical(self.conn._mtuProbeSize(), None)
+        self.clock.advance(self.conn.mtuProbeInterval)
+        self.assertEqual(self.conn._mtuProbeSize(), self.conn.maximumMTU)
+
+
+    def test_blackHole(self):
+        """
+        If the oldest unacknowledged segment has been retransmitted
+        C{blackHoleRetransmits} times, segments are assumed to be too large to
+        get through, and the minimum segment size is used instead.
+        """
+        self.send('x' * 1000)
+        for i in range(self.conn.blackHoleRetransmits):
+            self.clock.advance(self.conn.retransmitTimeout)
+        self.assertEqual(self.sentSizes(), [1000] * 4)
+        self.clock.advance(self.conn.retransmitTimeout)
+        self.assertEqual(self.conn.mtu, self.conn.minimumMTU)
+        self.assertEqual(self.sentSizes(), [489, 489, 22])
+
+
+
+class BatchingTransport(object):
+    """
+    A UDP transport which records the batches of datagrams written to it.
+    """
+    def __init__(self):
+        self.batches = []
+
+
+    def writeBatch(self, datagrams):
+        self.batches.append(list(datagrams))
+
+
+
+class DatagramBatchingTests(unittest.TestCase):
+    """
+    Tests for L{ptcp.PTCP} writing the packets its connections send to its
+    transport in batches.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(ptcp, 'reactor', self.clock)
+        self.transport = BatchingTransport()
+        self.ptcp = ptcp.PTCP(None)
+        self.ptcp.makeConnection(self.transport)
+
+
+    def packet(self, data, sourcePseudoPort=1):
+        return ptcp.PTCPPacket.create(sourcePseudoPort, 2, 1, 1, data,
+                                      ack=True, destination=PEER_ADDRESS)
+
+
+    def test_batched(self):
+        """
+        Packets sent before control returns to the reactor are written to the
+        transport in one batch, in the order they were sent.
+        """
+        packets = [self.packet('one'), self.packet('two')]
+        for packet in packets:
+            self.ptcp.sendPacket(packet)
+        self.assertEqual(self.transport.batches, [])
+        self.clock.advance(0)
+        self.assertEqual(
+            self.transport.batches,
+            [[(packet.encode(), PEER_ADDRESS) for packet in packets]])
+        self.ptcp.sendPacket(self.packet('three'))
+        self.clock.advance(0)
+        self.assertEqual(len(self.transport.batches), 2)
+
+
+    def test_unbatched(self):
+        """
+        With C{batching} off, each packet is written to the transport as it is
+        sent, without waiting for the reactor.
+        """
+        self.ptcp = ptcp.PTCP(None, batching=False)
+        self.ptcp.makeConnection(self.transport)
+        packets = [self.packet('one'), self.packet('two')]
+        for packet in packets:
+            self.ptcp.sendPacket(packet)
+        self.assertEqual(
+            self.transport.batches,
+            [[(packet.encode(), PEER_ADDRESS)] for packet in packets])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_fairQueueing(self):
+        """
+        The packets of different connections are written in turn, so that one
+        connection sending a great deal doesn't hold the others up.
+        """
+        for data in ['a1', 'a2', 'a3']:
+            self.ptcp.sendPacket(self.packet(data * 500, 1))
+        self.ptcp.sendPacket(self.packet('b1' * 500, 3))
+        self.clock.advance(0)
+        [batch] = self.transport.batches
+        self.assertEqual(
+            [ptcp.PTCPPacket.decode(datagram, addr).data[:2]
+             for (datagram, addr) in batch],
+            ['a1', 'b1', 'a2', 'a3'])
+
+
+    def test_bandwidthLimit(self):
+        """
+        With a C{bandwidthLimit}, packets are written no faster than it
+        allows, however many connections send them.
+        """
+        size = len(self.packet('x' * 100).encode())
+        self.ptcp.setBandwidthLimit(size * 10)
+        self.assertEqual(self.ptcp.bandwidthLimit, size * 10)
+        self.ptcp._egress.horizon = 0
+        self.ptcp.sendPacket(self.packet('x' * 100, 1))
+        self.ptcp.sendPacket(self.packet('x' * 100, 3))
+        self.clock.advance(0)
+        self.assertEqual(len(self.transport.batches), 1)
+        self.clock.advance(0.099)
+        self.assertEqual(len(self.transport.batches), 1)
+        self.clock.advance(0.002)
+        self.assertEqual(len(self.transport.batches), 2)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_flushedOnStop(self):
+        """
+        Packets which have not been written yet when the port is stopped are
+        written before it stops listening.
+        """
+        stopped = []
+        self.transport.stopListening = lambda: stopped.append(
+            list(self.transport.batches))
+        self.ptcp.sendPacket(self.packet('fin'))
+        self.ptcp._stop()
+        self.assertEqual(stopped, [[[(self.packet('fin').encode(),
+                                      PEER_ADDRESS)]]])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_droppedWhenTransportGone(self):
+        """
+        Once the transport has gone away, unwritten packets are discarded.
+        """
+        self.ptcp.sendPacket(self.packet('lost'))
+        self.ptcp.stopProtocol()
+        self.assertEqual(self.transport.batches, [])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+
+class ConnectionTimerTests(unittest.TestCase):
+    """
+    Tests for the timers L{ptcp.PTCP} keeps for its connections.
+    """
+
+    def test_sharedWheel(self):
+        """
+        However many timers a L{ptcp.PTCP}'s connections arm, the reactor only
+        has to keep track of one.
+        """
+        clock = task.Clock()
+        self.patch(ptcp, 'reactor', clock)
+        proto = ptcp.PTCP(None)
+        called = []
+        for i in range(100):
+            proto.callLater(i / 10.0, called.append, i)
+        self.assertEqual(len(clock.getDelayedCalls()), 1)
+        clock.pump([0.1] * 100)
+        self.assertEqual(called, range(100))
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+
+    def test_givenReactor(self):
+        """
+        A L{ptcp.PTCP} given a reactor arms its connections' timers with it,
+        and its connections tell the time by it, rather than by the global
+        reactor.
+        """
+        clock = task.Clock()
+        clock.advance(1000)
+        proto = ptcp.PTCP(None, reactor=clock)
+        proto.makeConnection(BatchingTransport())
+        conn = proto.connect(protocol.ClientFactory(), '10.0.0.2', 5000)
+        self.assertIdentical(conn._reactor, clock)
+        [syn] = conn.retransmissionQueue
+        self.assertEqual(syn.transmittedAt, 1000)
+        clock.advance(0)
+        self.assertEqual(len(proto.transport.batches), 1)
+        clock.advance(conn.retransmitTimeout)
+        self.assertEqual(len(proto.transport.batches), 2)
+        conn._stopRetransmitting()
+
+
+
+class Wire(object):
+    """
+    A UDP transport which delivers the datagrams written to it straight to
+    another L{ptcp.PTCP}, unless told to drop them.
+
+    @ivar datagrams: Every datagram written, decoded.
+    """
+    def __init__(self, address, peer):
+        self.address = address
+        self.peer = peer
+        self.datagrams = []
+        self.connected = True
+
+
+    def writeBatch(self, datagrams):
+        for datagram, addr in datagrams:
+            self.datagrams.append(ptcp.PTCPPacket.decode(datagram, addr))
+            if self.connected and self.peer is not None:
+                self.peer.datagramReceived(datagram, self.address)
+
+
+    def stopListening(self):
+        self.connected = False
+
+
+
+class SynCookieTests(unittest.TestCase):
+    """
+    Tests for L{ptcp.PTCP} answering SYNs with SYN cookies once it has too
+    many half-open connections.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(ptcp, 'reactor', self.clock)
+        self.proto = TestProtocol()
+        factory = protocol.ServerFactory()
+        factory.protocol = lambda: self.proto
+        self.server = ptcp.PTCP(factory)
+        self.server.synCookieThreshold = 0
+        self.wire = Wire(None, None)
+        self.server.makeConnection(self.wire)
+
+
+    def receive(self, pkt, address=PEER_ADDRESS):
+        """
+        Have the server receive a packet from our peer, and return the packets
+        it sends straight back.
+        """
+        self.server.datagramReceived(pkt.encode(), address)
+        self.clock.advance(0)
+        sent, self.wire.datagrams[:] = self.wire.datagrams[:], []
+        return sent
+
+
+    def handshake(self, sourcePseudoPort=2,
+                  options=ptcp._SYN_SACK_PERMITTED | ptcp._SYN_ANY_ISN):
+        """
+        Send a SYN, offering selective acknowledgements and taking any initial
+        sequence number, and return the SYN-ACK sent back.
+        """
+        [synAck] = self.receive(ptcp.PTCPPacket.create(
+                sourcePseudoPort, 1, 0, options, '', syn=True))
+        return synAck
+
+
+    def ack(self, seqNum, ackNum, data='', sourcePseudoPort=2):
+        """
+        Make an acknowledgement from our peer.
+        """
+        return ptcp.PTCPPacket.create(sourcePseudoPort, 1, seqNum,
+                                      ackNum % (2**32), data, ack=True)
+
+
+    def test_cookieIssued(self):
+        """
+        Above the threshold, a SYN is answered with a SYN-ACK, but no
+        connection is set up for it.
+        """
+        synAck = self.handshake()
+        self.assertTrue(synAck.syn)
+        self.assertTrue(synAck.ack)
+        self.assertTrue(synAck.sak)
+        self.assertEqual(synAck.ackNum, 1)
+        self.assertEqual(self.server._connections, {})
+        self.assertEqual(self.server.cookiesIssued, 1)
+        self.assertEqual(self.server.halfOpenConnections, 0)
+
+
+    def test_cookieWindow(self):
+        """
+        The SYN-ACK carrying a SYN cookie advertises the receive window a
+        connection would have.
+        """
+        self.patch(ptcp.PTCPConnection, 'recvWindow', 12345)
+        self.assertEqual(self.handshake().window, 12345)
+
+
+    def test_cookieAcknowledged(self):
+        """
+        The acknowledgement of a SYN cookie sets up the connection, as though
+        the server had kept it since the SYN.
+        """
+        cookie = self.handshake().seqNum
+        self.receive(self.ack(1, cookie + 1))
+        self.assertEqual(self.server.cookiesAccepted, 1)
+        [conn] = self.server._connections.values()
+        self.assertIdentical(self.proto.transport, conn)
+        self.assertTrue(conn.sackPermitted)
+
+        self.receive(self.ack(1, cookie + 1, 'hello'))
+        self.assertEqual(self.proto.buffer, ['hello'])
+        self.clock.advance(0.1)
+        [ack] = self.wire.datagrams
+        self.assertEqual(ack.ackNum, 6)
+        del self.wire.datagrams[:]
+
+        conn.write('world')
+        self.clock.pump([0.01, 0])
+        [data] = self.wire.datagrams
+        self.assertEqual(data.seqNum, (cookie + 1) % (2**32))
+        self.assertEqual(data.data, 'world')
+        self.receive(self.ack(6, cookie + 6))
+        self.assertEqual(conn.retransmissionQueue, [])
+
+
+    def test_oldPeer(self):
+        """
+        A SYN which doesn't say its sender takes any initial sequence number
+        gets a connection set up for it, and an initial sequence number of 0,
+        however many connections are half-open.
+        """
+        synAck = self.handshake(options=ptcp._SYN_SACK_PERMITTED)
+        self.assertEqual(synAck.seqNum, 0)
+        self.assertEqual(self.server.cookiesIssued, 0)
+        self.assertEqual(self.server.halfOpenConnections, 1)
+        self.receive(self.ack(1, 1))
+        self.assertEqual(self.server.halfOpenConnections, 0)
+        self.assertNotIdentical(self.proto.transport, None)
+
+
+    def test_sequenceWraps(self):
+        """
+        Sequence numbers counted from a SYN cookie wrap around 2**32.
+        """
+        cookie = 2**32 - 7
+        self.server._synCookie = lambda *args: cookie
+        self.assertEqual(self.handshake().seqNum, cookie)
+        self.receive(self.ack(1, cookie + 1))
+        [conn] = self.server._connections.values()
+        conn.write('hello world')
+        self.clock.pump([0.01, 0])
+        [data] = self.wire.datagrams
+        self.assertEqual(data.seqNum, cookie + 1)
+        self.receive(self.ack(1, cookie + 12))
+        self.assertEqual(conn.retransmissionQueue, [])
+        self.assertEqual(conn.oldestUnackedSendSeqNum, 12)
+
+
+    def test_forgedCookie(self):
+        """
+        An acknowledgement of a SYN cookie the server never sent is ignored.
+        """
+        cookie = self.handshake().seqNum
+        self.receive(self.ack(1, cookie + 9))
+        self.receive(self.ack(2, cookie + 1))
+        self.receive(self.ack(1, cookie + 1, sourcePseudoPort=3))
+        self.receive(self.ack(1, cookie + 1), ('10.0.0.3', 4321))
+        self.assertEqual(self.server._connections, {})
+        self.assertEqual(self.server.cookiesAccepted, 0)
+
+
+    def test_expiredCookie(self):
+        """
+        A SYN cookie is only good for between one and two
+        C{synCookieInterval}s.
+        """
+        cookie = self.handshake().seqNum
+        self.clock.advance(self.server.synCookieInterval * 2)
+        self.receive(self.ack(1, cookie + 1))
+        self.assertEqual(self.server._connections, {})
+
+
+    def test_threshold(self):
+        """
+        Connections are set up for SYNs as usual until there are
+        C{synCookieThreshold} half-open ones.
+        """
+        self.server.synCookieThreshold = 1
+        first = self.handshake(2)
+        self.assertEqual(self.server.halfOpenConnections, 1)
+        self.assertEqual(self.server.cookiesIssued, 0)
+        self.handshake(3)
+        self.assertEqual(self.server.cookiesIssued, 1)
+        self.assertEqual(len(self.server._connections), 1)
+
+        self.receive(self.ack(1, first.seqNum + 1))
+        self.assertEqual(self.server.halfOpenConnections, 0)
+        self.handshake(4)
+        self.assertEqual(self.server.halfOpenConnections, 1)
+
+
+    def test_client(self):
+        """
+        A L{ptcp.PTCP} client connects to a server which answers it with a SYN
+        cookie, and the two can talk.
+        """
+        serverAddress = ('10.0.0.1', 1234)
+        client = ptcp.PTCP(None)
+        client.makeConnection(Wire(PEER_ADDRESS, self.server))
+        self.wire.address, self.wire.peer = serverAddress, client
+        clientProto = TestProtocol()
+        factory = protocol.ClientFactory()
+        factory.protocol = lambda: clientProto
+        conn = client.connect(factory, *serverAddress)
+
+        self.clock.pump([0.01] * 10)
+        self.assertEqual(self.server.cookiesIssued, 1)
+        self.assertEqual(self.server.cookiesAccepted, 1)
+        self.assertNotIdentical(self.proto.transport, None)
+        self.assertIdentical(clientProto.transport, conn)
+
+        clientProto.transport.write('hello')
+        self.proto.transport.write('world')
+        self.clock.pump([0.01] * 10)
+        self.assertEqual(self.proto.buffer, ['hello'])
+        self.assertEqual(clientProto.buffer, ['world'])
+
+
+
+class ConnectionMigrationTests(unittest.TestCase):
+    """
+    Tests for L{ptcp.PTCP} connections surviving their peer turning up at a
+    new address, as it does when a NAT rebinds it.
+    """
+    serverAddress = ('10.0.0.1', 1234)
+    rebound = ('10.0.0.2', 5678)
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(ptcp, 'reactor', self.clock)
+        self.serverProto = TestProtocol()
+        factory = protocol.ServerFactory()
+        factory.protocol = lambda: self.serverProto
+        self.server = ptcp.PTCP(factory)
+        self.client = ptcp.PTCP(None)
+        self.clientWire = Wire(PEER_ADDRESS, self.server)
+        self.serverWire = Wire(self.serverAddress, self.client)
+        self.client.makeConnection(self.clientWire)
+        self.server.makeConnection(self.serverWire)
+
+
+    def connect(self):
+        """
+        Connect the client to the server, and return the server's end of the
+        connection and the client's protocol.
+        """
+        clientProto = TestProtocol()
+        factory = protocol.ClientFactory()
+        factory.protocol = lambda: clientProto
+        self.client.connect(factory, *self.serverAddress)
+        self.clock.pump([0.01] * 10)
+        self.assertIdentical(self.serverProto.transport.__class__,
+                             ptcp.PTCPConnection)
+        return self.serverProto.transport, clientProto
+
+
+    def test_negotiated(self):
+        """
+        Both ends of a new connection agree on an ID for it, which every packet
+        either sends carries.
+        """
+        serverConn, clientProto = self.connect()
+        clientConn = clientProto.transport
+        self.assertNotIdentical(serverConn.connectionID, None)
+        self.assertEqual(clientConn.connectionID, serverConn.connectionID)
+        self.assertEqual(len(serverConn.migrationKey), 16)
+        self.assertEqual(clientConn.migrationKey, serverConn.migrationKey)
+        self.assertIdentical(
+            self.server._identified[serverConn.connectionID], serverConn)
+        [syn] = [p for p in self.clientWire.datagrams if p.syn]
+        self.assertEqual(syn.connectionID, None)
+        self.assertTrue(syn.ackNum & ptcp._SYN_MIGRATION_PERMITTED)
+        for p in self.serverWire.datagrams:
+            self.assertEqual(p.connectionID, serverConn.connectionID)
+
+
+    def test_rebinding(self):
+        """
+        When the client's packets start coming from a new address, the
+        connection moves there, and carries on where it left off.
+        """
+        serverConn, clientProto = self.connect()
+        self.clientWire.address = self.rebound
+        clientProto.transport.write('hello')
+        self.clock.pump([0.01] * 10)
+        self.assertEqual(self.serverProto.buffer, ['hello'])
+        self.assertEqual(self.server.connectionsMigrated, 1)
+        self.assertEqual(serverConn.peerAddressTuple, self.rebound)
+        self.assertEqual(
+            self.server._connections.keys(),
+            [(clientProto.transport.hostPseudoPort, 1, self.rebound)])
+
+        del self.serverWire.datagrams[:]
+        serverConn.write('world')
+        self.clock.pump([0.01] * 10)
+        self.assertEqual(clientProto.buffer, ['world'])
+        for p in self.serverWire.datagrams:
+            self.assertEqual(p.peerAddressTuple, self.rebound)
+
+
+    def test_challenged(self):
+        """
+        Until the client answers a challenge sent to its new address, the
+        server carries on sending to it at the old one, challenging the new
+        one every retransmission timeout, C{pathChallenges} times.
+        """
+        serverConn, clientProto = self.connect()
+        self.serverWire.connected = False
+        del self.serverWire.datagrams[:]
+        self.clientWire.address = self.rebound
+        clientProto.transport.write('hello')
+        self.clock.pump([0.01, 0])
+        self.assertEqual(self.serverProto.buffer, ['hello'])
+        self.assertEqual(serverConn.peerAddressTuple, PEER_ADDRESS)
+        [challenge] = [p for p in self.serverWire.datagrams if p.stb]
+        self.assertTrue(challenge.mig)
+        self.assertFalse(challenge.ack)
+        self.assertEqual(challenge.peerAddressTuple, self.rebound)
+        self.clock.pump([0.01] * 10)
+        for p in self.serverWire.datagrams:
+            if not p.stb:
+                self.assertEqual(p.peerAddressTuple, PEER_ADDRESS)
+        self.clock.pump([serverConn.retransmitTimeout] * 5)
+        challenges = [p for p in self.serverWire.datagrams if p.stb]
+        self.assertEqual([p.data for p in challenges],
+                         [challenge.data] * serverConn.pathChallenges)
+        self.assertIdentical(serverConn._pathChallenge, None)
+        self.assertEqual(self.server.connectionsMigrated, 0)
+
+
+    def test_answerElsewhere(self):
+        """
+        The answer to a path challenge only moves the connection to the
+        address it comes from if that is where the challenge went.
+        """
+        serverConn, clientProto = self.connect()
+        self.serverWire.connected = False
+        self.clientWire.address = self.rebound
+        clientProto.transport.write('hello')
+        self.clock.pump([0.01, 0])
+        [challenge] = [p for p in self.serverWire.datagrams if p.stb]
+        self.clientWire.address = ('10.0.0.3', 5678)
+        self.client.datagramReceived(challenge.encode(), self.serverAddress)
+        self.clock.pump([0.01, 0])
+        [answer] = [p for p in self.clientWire.datagrams if p.stb]
+        self.assertTrue(answer.ack)
+        self.assertEqual(answer.data, challenge.data)
+        self.assertEqual(self.server.connectionsMigrated, 0)
+        self.assertEqual(serverConn.peerAddressTuple, PEER_ADDRESS)
+        self.server.datagramReceived(answer.encode(), self.rebound)
+        self.assertEqual(self.server.connectionsMigrated, 1)
+        self.assertEqual(serverConn.peerAddressTuple, self.rebound)
+
+
+    def test_forged(self):
+        """
+        A packet from a new address carrying the connection's ID, but not the
+        right MAC, is dropped, and nothing is sent there.
+        """
+        serverConn, clientProto = self.connect()
+        clientProto.transport.migrationKey = 'x' * 16
+        del self.serverWire.datagrams[:]
+        self.clientWire.address = self.rebound
+        clientProto.transport.write('hello')
+        self.clock.pump([0.01] * 10)
+        self.assertEqual(self.serverProto.buffer, [])
+        self.assertTrue(self.server.dropped['unexpected'])
+        self.assertEqual(
+            [p for p in self.serverWire.datagrams
+             if p.peerAddressTuple == self.rebound], [])
+
+
+    def test_replayIgnored(self):
+        """
+        A packet the server has already received, replayed from another
+        address, doesn't move the connection there.
+        """
+        serverConn, clientProto = self.connect()
+        clientProto.transport.write('hello')
+        self.clock.pump([0.01] * 10)
+        [data] = [p for p in self.clientWire.datagrams if p.data == 'hello']
+        self.server.datagramReceived(data.encode(), self.rebound)
+        self.assertEqual(self.server.connectionsMigrated, 0)
+        self.assertEqual(serverConn.peerAddressTuple, PEER_ADDRESS)
+        self.assertEqual(self.serverProto.buffer, ['hello'])
+
+
+    def test_unknownID(self):
+        """
+        A packet carrying an ID no connection uses is dropped.
+        """
+        serverConn, clientProto = self.connect()
+        clientProto.transport.connectionID ^= 1
+        self.clientWire.address = self.rebound
+        clientProto.transport.write('hello')
+        self.clock.pump([0.01] * 10)
+        self.assertEqual(self.serverProto.buffer, [])
+        self.assertEqual(serverConn.peerAddressTuple, PEER_ADDRESS)
+
+
+    def test_notNegotiated(self):
+        """
+        If C{connectionMigration} is false, connections have no ID, and
+        packets from a new address don't reach them.
+        """
+        self.patch(ptcp.PTCPConnection, 'connectionMigration', False)
+        serverConn, clientProto = self.connect()
+        self.assertIdentical(serverConn.connectionID, None)
+        self.assertIdentical(clientProto.transport.connectionID, None)
+        self.clientWire.address = self.rebound
+        clientProto.transport.write('hello')
+        self.clock.pump([0.01] * 10)
+        self.assertEqual(self.serverProto.buffer, [])
+        self.assertEqual(self.server.connectionsMigrated, 0)
+
+
+    def test_newPath(self):
+        """
+        A connection which moves to a new host starts measuring its path
+        again; one which only moves to a new port on the same host doesn't.
+        """
+        serverConn, clientProto = self.connect()
+        serverConn.peerMigrated(('10.0.0.2', 5678))
+        self.assertNotIdentical(serverConn.smoothedRTT, None)
+        serverConn.peerMigrated(('10.0.0.3', 5678))
+        self.assertIdentical(serverConn.smoothedRTT, None)
+        self.assertEqual(serverConn.retransmitTimeout,
+                         serverConn._retransmitTimeout)
+
+
+    def test_forgotten(self):
+        """
+        A closed connection can no longer be found by its ID.
+        """
+        serverConn, clientProto = self.connect()
+        clientProto.transport.loseConnection()
+        self.clock.pump([0.01] * 1000)
+        self.assertEqual(self.server._identified, {})
+
+
+
+class ForwardErrorCorrectionNegotiationTests(unittest.TestCase):
+    """
+    Tests for the agreement, during the handshake, to use parity segments.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(ptcp, 'reactor', self.clock)
+        self.patch(ptcp.PTCPConnection, 'forwardErrorCorrection', True)
+        self.ptcp = FakePTCP()
+
+
+    def connect(self):
+        factory = protocol.ClientFactory()
+        factory.protocol = TestProtocol
+        conn = ptcp.PTCPConnection(1, 2, self.ptcp, factory, PEER_ADDRESS)
+        conn.machine.appActiveOpen()
+        return conn
+
+
+    def accept(self, options):
+        conn = ptcp.PTCPConnection(1, 2, self.ptcp, protocol.ServerFactory(),
+                                   PEER_ADDRESS)
+        conn.machine.appPassiveOpen()
+        conn.packetReceived(peerPacket(0, options, syn=True, ack=False))
+        return conn
+
+
+    def test_notOfferedByDefault(self):
+        """
+        Parity costs bandwidth, so it is only offered if
+        C{forwardErrorCorrection} is set.
+        """
+        self.patch(ptcp.PTCPConnection, 'forwardErrorCorrection', False)
+        self.connect()
+        [syn] = self.ptcp.sent
+        self.assertFalse(syn.ackNum & ptcp._SYN_FEC_PERMITTED)
+
+
+    def test_offered(self):
+        """
+        Our SYN offers parity in its acknowledgement number.
+        """
+        self.connect()
+        [syn] = self.ptcp.sent
+        self.assertEqual(syn.flags, ptcp._SYN)
+        self.assertTrue(syn.ackNum & ptcp._SYN_FEC_PERMITTED)
+
+
+    def test_accepted(self):
+        """
+        A peer which accepts our offer sets the FEC flag on its SYN+ACK.
+        """
+        conn = self.connect()
+        conn.packetReceived(peerPacket(0, 1, syn=True, fec=True))
+        self.assertTrue(conn.fecPermitted)
+
+
+    def test_declined(self):
+        """
+        A peer which doesn't set the FEC flag on its SYN+ACK won't use parity.
+        """
+        conn = self.connect()
+        conn.packetReceived(peerPacket(0, 1, syn=True))
+        self.assertFalse(conn.fecPermitted)
+
+
+    def test_accept(self):
+        """
+        We accept a peer's offer by setting the FEC flag on our SYN+ACK.
+        """
+        conn = self.accept(ptcp._SYN_FEC_PERMITTED)
+        [synAck] = self.ptcp.sent
+        self.assertTrue(synAck.syn and synAck.ack and synAck.fec)
+        self.assertTrue(conn.fecPermitted)
+
+
+    def test_oldPeer(self):
+        """
+        A peer which doesn't offer parity gets none.
+        """
+        conn = self.accept(0)
+        [synAck] = self.ptcp.sent
+        self.assertFalse(synAck.fec)
+        self.assertFalse(conn.fecPermitted)
+
+
+
+class ParityRecoveryTests(EstablishedConnectionMixin, unittest.TestCase):
+    """
+    Tests for rebuilding a lost segment from a parity segment.
+    """
+
+    peerOptions = ptcp._SYN_FEC_PERMITTED
+
+    def setUp(self):
+        self.patch(ptcp.PTCPConnection, 'forwardErrorCorrection', True)
+        EstablishedConnectionMixin.setUp(self)
+
+
+    def parity(self, seqNum, segments):
+        """
+        Make our peer's parity segment for some segments of data, the first
+        of which begins at C{seqNum}.
+        """
+        return peerPacket(seqNum, len(segments),
+                          ptcp._xor(segments, max(map(len, segments))),
+                          window=sum(map(len, segments)), fec=True, ack=False)
+
+
+    def test_middleRecovered(self):
+        """
+        A segment lost from the middle of a group is rebuilt, and delivered
+        along with the segments held behind it.
+        """
+        self.conn.packetReceived(peerPacket(1, data='abc'))
+        self.conn.packetReceived(peerPacket(8, data='hi'))
+        self.conn.packetReceived(self.parity(1, ['abc', 'defg', 'hi']))
+        self.assertEqual(''.join(self.proto.buffer), 'abcdefghi')
+        self.assertEqual(self.conn.nextRecvSeqNum, 10)
+        self.assertEqual(self.conn.segmentsRecovered, 1)
+
+
+    def test_firstRecovered(self):
+        """
+        The first segment of a group can be rebuilt.
+        """
+        self.conn.packetReceived(peerPacket(4, data='defg'))
+        self.conn.packetReceived(peerPacket(8, data='hi'))
+        self.conn.packetReceived(self.parity(1, ['abc', 'defg', 'hi']))
+        self.assertEqual(''.join(self.proto.buffer), 'abcdefghi')
+
+
+    def test_lastRecovered(self):
+        """
+        The last segment of a group can be rebuilt.
+        """
+        self.conn.packetReceived(peerPacket(1, data='abc'))
+        self.conn.packetReceived(peerPacket(4, data='defg'))
+        self.conn.packetReceived(self.parity(1, ['abc', 'defg', 'hi']))
+        self.assertEqual(''.join(self.proto.buffer), 'abcdefghi')
+
+
+    def test_twoLost(self):
+        """
+        Nothing can be done about a group which has lost two segments.
+        """
+        self.conn.packetReceived(peerPacket(1, data='abc'))
+        self.conn.packetReceived(self.parity(1, ['abc', 'defg', 'hi']))
+        self.assertEqual(self.proto.buffer, ['abc'])
+        self.assertEqual(self.conn.segmentsRecovered, 0)
+
+
+    def test_noneLost(self):
+        """
+        Parity for a group which arrived whole is ignored, and takes up no
+        sequence space.
+        """
+        for seq, data in [(1, 'abc'), (4, 'defg')]:
+            self.conn.packetReceived(peerPacket(seq, data=data))
+        self.conn.packetReceived(self.parity(1, ['abc', 'defg']))
+        self.assertEqual(''.join(self.proto.buffer), 'abcdefg')
+        self.assertEqual(self.conn.nextRecvSeqNum, 8)
+        self.assertEqual(self.conn.segmentsRecovered, 0)
+
+
+    def test_notPermitted(self):
+        """
+        Parity segments are ignored on connections which didn't agree to use
+        them.
+        """
+        self.conn.fecPermitted = False
+        self.conn.packetReceived(peerPacket(1, data='abc'))
+        self.conn.packetReceived(self.parity(1, ['abc', 'defg']))
+        self.assertEqual(self.proto.buffer, ['abc'])
+        self.assertEqual(self.conn.nextRecvSeqNum, 4)
+
+
+    def test_heldSegmentsBounded(self):
+        """
+        Only the most recent segments are kept for rebuilding others with.
+        """
+        limit = 2 * self.conn.maximumParityGroup
+        for seq in range(1, limit + 11):
+            self.conn.packetReceived(peerPacket(seq, data='x'))
+        self.assertEqual(sorted(self.conn._heldSegments),
+                         range(11, limit + 11))
+
+
+
+class ParitySendingTests(EstablishedConnectionMixin, unittest.TestCase):
+    """
+    Tests for the parity segments L{ptcp.PTCPConnection} sends, and how many.
+    """
+
+    peerOptions = ptcp._SYN_FEC_PERMITTED
+
+    def setUp(self):
+        self.patch(ptcp.PTCPConnection, 'forwardErrorCorrection', True)
+        EstablishedConnectionMixin.setUp(self)
+        self.conn.congestion.congestionWindow = 1 << 20
+        self.conn.pacingGain = None
+
+
+    def send(self, data):
+        self.conn.write(data)
+        self.clock.advance(ptcp.SEND_DELAY)
+
+
+    def test_noLoss(self):
+        """
+        Until we have seen some loss, we send no parity.
+        """
+        self.send('x' * (self.conn.mtu * 3))
+        self.assertEqual([p.fec for p in self.ptcp.sent], [False] * 3)
+
+
+    def test_groupSize(self):
+        """
+        The more segments we lose, the fewer each parity segment covers.
+        """
+        conn = self.conn
+        self.assertIdentical(conn.parityGroupSize, None)
+        conn.lossRate = conn.minimumLossRate / 2
+        self.assertIdentical(conn.parityGroupSize, None)
+        conn.lossRate = 0.01
+        self.assertEqual(conn.parityGroupSize, 25)
+        conn.lossRate = 0.2
+        self.assertEqual(conn.parityGroupSize, conn.minimumParityGroup)
+        conn.lossRate = conn.minimumLossRate
+        self.assertEqual(conn.parityGroupSize, conn.maximumParityGroup)
+
+
+    def test_parity(self):
+        """
+        Once we are losing segments, a parity segment follows each group of
+        C{parityGroupSize} segments, and the last, shorter group.
+        """
+        self.conn.lossRate = 0.1
+        self.send('x' * (self.conn.mtu * 2) + 'y' * 10)
+        sent = self.ptcp.sent
+        self.assertEqual([p.fec for p in sent],
+                         [False, False, True, False, True])
+        first, second, parity, third, last = sent
+        self.assertEqual(
+            (parity.seqNum, parity.ackNum, parity.window, parity.data),
+            (first.seqNum, 2, self.conn.mtu * 2,
+             ptcp._xor([first.data, second.data], self.conn.mtu)))
+        self.assertEqual(
+            (last.seqNum, last.ackNum, last.window, last.data),
+            (third.seqNum, 1, 10, 'y' * 10))
+        self.assertFalse(parity.ack)
+        self.assertEqual(len(self.conn.retransmissionQueue), 3)
+
+
+    def test_acrossBursts(self):
+        """
+        When our peer's window stops us sending everything at once, the
+        group is held open across bursts, until it is complete, or we have
+        nothing more to send.
+        """
+        mtu = self.conn.mtu
+        self.conn.lossRate = 0.05
+        self.conn.smoothedRTT = 0.1
+        self.assertEqual(self.conn.parityGroupSize, 5)
+        self.conn.packetReceived(peerPacket(1, 1, window=mtu * 2))
+        self.send('x' * (mtu * 6))
+        self.assertEqual([p.fec for p in self.ptcp.sent], [False] * 2)
+        for ack in [1 + mtu * 2, 1 + mtu * 4]:
+            self.conn.packetReceived(peerPacket(1, ack, window=mtu * 2))
+            self.clock.advance(ptcp.SEND_DELAY)
+        self.assertEqual([p.fec for p in self.ptcp.sent if p.dlen],
+                         [False] * 5 + [True, False, True])
+
+
+    def test_heldBriefly(self):
+        """
+        An incomplete group held open for more segments has its parity sent
+        once C{parityDelay} of a round trip has gone by without them.
+        """
+        mtu = self.conn.mtu
+        self.conn.lossRate = 0.05
+        self.conn.smoothedRTT = 0.1
+        self.conn.packetReceived(peerPacket(1, 1, window=mtu * 2))
+        self.send('x' * (mtu * 3))
+        delay = self.conn.smoothedRTT * self.conn.parityDelay
+        self.clock.advance(delay - ptcp.SEND_DELAY * 2)
+        self.assertEqual([p.fec for p in self.ptcp.sent], [False] * 2)
+        self.clock.advance(ptcp.SEND_DELAY * 2)
+        self.assertEqual([p.fec for p in self.ptcp.sent], [False] * 2 + [True])
+
+
+    def test_lossMeasured(self):
+        """
+        Each run of duplicate acknowledgements and each retransmission
+        timeout counts towards our loss rate, and every segment sent without
+        either counts against it.
+        """
+        gain = self.conn.lossRateGain
+        self.send('one')
+        self.send('two')
+        self.conn.packetReceived(peerPacket(1, 1))
+        self.conn.packetReceived(peerPacket(1, 1))
+        self.assertEqual(self.conn.lossRate, gain)
+        self.clock.advance(self.conn.retransmitTimeout)
+        self.assertEqual(self.conn.lossRate, gain * 3)
+        self.send('three')
+        self.assertEqual(self.conn.lossRate, gain * 3 * (1 - gain))
+
+
+    def test_fastRetransmitDeferred(self):
+        """
+        While we are sending parity, a lost segment is only retransmitted
+        without waiting for its timer once our peer has had the chance to
+        rebuild it from the rest of its group.
+        """
+        self.conn.lossRate = 0.2
+        for data in ['one', 'two', 'three']:
+            self.send(data)
+        del self.ptcp.sent[:]
+        threshold = (self.conn.duplicateAckThreshold +
+                     self.conn.minimumParityGroup)
+        for i in range(threshold - 1):
+            self.conn.packetReceived(peerPacket(1, 1))
+        self.assertEqual(self.ptcp.sent, [])
+        self.conn.packetReceived(peerPacket(1, 1))
+        self.assertEqual([p.data for p in self.ptcp.sent], ['one'])
+
+
+
+class ConnectionStatisticsTests(EstablishedConnectionMixin, unittest.TestCase):
+    """
+    Tests for the counters L{ptcp.PTCPConnection} keeps, and for
+    L{ptcp.PTCPConnection.getStatistics}.
+    """
+
+    def send(self, data):
+        self.conn.write(data)
+        self.clock.advance(ptcp.SEND_DELAY)
+
+
+    def test_segmentsCounted(self):
+        """
+        Every segment sent and received is counted, with the data in it.
+        """
+        stats = self.conn.getStatistics()
+        self.assertEqual((stats['segmentsSent'], stats['segmentsReceived']),
+                         (1, 2))
+        self.send('hello')
+        self.conn.packetReceived(peerPacket(1, 6, 'hi'))
+        stats = self.conn.getStatistics()
+        self.assertEqual((stats['segmentsSent'], stats['octetsSent']), (2, 5))
+        self.assertEqual((stats['segmentsReceived'], stats['octetsReceived']),
+                         (3, 2))
+
+
+    def test_retransmissionsCounted(self):
+        """
+        Segments sent again, when their timer goes off or after duplicate
+        acknowledgements, are counted as retransmitted, and the duplicate
+        acknowledgements as well.
+        """
+        self.send('hello')
+        for i in range(self.conn.duplicateAckThreshold):
+            self.conn.packetReceived(peerPacket(1, 1))
+        self.assertEqual(self.conn.segmentsRetransmitted, 1)
+        self.clock.advance(self.conn.retransmitTimeout)
+        stats = self.conn.getStatistics()
+        self.assertEqual(stats['duplicateAcksReceived'],
+                         self.conn.duplicateAckThreshold)
+        self.assertEqual(stats['segmentsRetransmitted'], 2)
+        self.assertEqual(stats['segmentsSent'], 4)
+
+
+    def test_pathEstimates(self):
+        """
+        The statistics include our estimates of the round-trip time and our
+        windows.
+        """
+        self.send('hello')
+        self.clock.advance(0.25)
+        self.conn.packetReceived(peerPacket(1, 6))
+        stats = self.conn.getStatistics()
+        self.assertNotIdentical(stats['smoothedRTT'], None)
+        self.assertEqual(stats['smoothedRTT'], self.conn.smoothedRTT)
+        self.assertEqual(stats['rttVariance'], self.conn.rttVariance)
+        self.assertEqual(stats['retransmitTimeout'],
+                         self.conn.retransmitTimeout)
+        self.assertEqual(stats['congestionWindow'],
+                         self.conn.congestion.congestionWindow)
+        self.assertEqual(stats['sendWindow'], self.conn.sendWindow)
+        self.assertEqual(stats['recvWindow'], self.conn.recvWindow)
+
+
+    def test_stateTimes(self):
+        """
+        The time spent in each state is accounted for, including the time
+        spent so far in the current one.
+        """
+        self.clock.advance(5)
+        stats = self.conn.getStatistics()
+        self.assertEqual(stats['state'], 'established')
+        self.assertEqual(stats['stateTimes'], {'closed': 0.0, 'listen': 0.0,
+                                               'synRcvd': 0.0,
+                                               'established': 5.0})
+        self.conn.packetReceived(peerPacket(1, fin=True))
+        self.clock.advance(2)
+        stats = self.conn.getStatistics()
+        self.assertNotEqual(stats['state'], 'established')
+        self.assertEqual(stats['stateTimes']['established'], 5.0)
+        self.assertApproximates(sum(stats['stateTimes'].values()), 7.0, 1e-9)
+
+
+
+class PortStatisticsTests(unittest.TestCase):
+    """
+    Tests for the counters L{ptcp.PTCP} keeps, for the datagrams it throws
+    away, and for L{ptcp.PTCP.getStatistics}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.clock.advance(1000)
+        self.proto = TestProtocol()
+        factory = protocol.ServerFactory()
+        factory.protocol = lambda: self.proto
+        self.server = ptcp.PTCP(factory, reactor=self.clock)
+        self.wire = Wire(None, None)
+        self.server.makeConnection(self.wire)
+        self.messages = []
+        log.addObserver(self.messages.append)
+        self.addCleanup(log.removeObserver, self.messages.append)
+
+
+    def receive(self, datagram):
+        self.server.datagramReceived(datagram, PEER_ADDRESS)
+        self.clock.advance(0)
+
+
+    def test_dropsCounted(self):
+        """
+        Datagrams thrown away are counted by the reason they were.
+        """
+        good = ptcp.PTCPPacket.create(2, 1, 0, 0, 'hello', ack=True).encode()
+        self.receive('x')
+        self.receive(good[:-1])
+        self.receive(good + 'x')
+        self.receive(good[:-1] + 'j')
+        self.receive(good)
+        self.assertEqual(self.server.dropped, {
+                'short': 1, 'truncated': 1, 'garbage': 1, 'checksum': 1,
+                'unexpected': 1})
+
+
+    def test_malformedDropped(self):
+        """
+        A datagram which makes no sense to its connection is counted, and
+        the connection is dropped, as any it blows up is.
+        """
+        self.receive(ptcp.PTCPPacket.create(
+                2, 1, 0, 0, '', syn=True).encode())
+        [conn] = self.server._connections.values()
+        self.receive(ptcp.PTCPPacket.create(
+                2, 1, 5, 0, '', syn=True).encode())
+        self.assertEqual(self.server.dropped, {'malformed': 1})
+        self.assertEqual(self.server._connections, {})
+        self.assertIdentical(conn._retransmitter, None)
+        self.assertIdentical(conn._keepAliveTimer, None)
+        self.clock.advance(ptcp.PTCPConnection.maximumRetransmitTime * 2)
+
+
+    def test_failedEstablished(self):
+        """
+        When an established connection blows up on a packet, its application
+        is told the connection was lost, and it lets go of its timers.
+        """
+        self.receive(ptcp.PTCPPacket.create(
+                2, 1, 0, 0, '', syn=True).encode())
+        [conn] = self.server._connections.values()
+        self.receive(ptcp.PTCPPacket.create(
+                2, 1, 1, conn.hostSendISN + 1, '', ack=True).encode())
+        self.assertIdentical(self.proto.transport, conn)
+        def explode(connection, packet):
+            raise RuntimeError("boom")
+        self.patch(ptcp.PTCPConnection, 'packetReceived', explode)
+        self.receive(ptcp.PTCPPacket.create(
+                2, 1, 1, conn.hostSendISN + 1, 'x', ack=True).encode())
+        self.assertEqual(len(self.flushLoggedErrors(RuntimeError)), 1)
+        self.assertEqual(self.server._connections, {})
+        self.proto.reason.trap(error.ConnectionLost)
+        self.assertIdentical(conn._keepAliveTimer, None)
+        self.clock.advance(ptcp.PTCPConnection.keepAliveInterval * 100)
+
+
+    def test_dropLoggingLimited(self):
+        """
+        Only one message about datagrams thrown away is logged every
+        C{dropLogInterval} seconds, however many are.
+        """
+        def logged():
+            return [m for m in self.messages
+                    if 'PTCP dropped' in log.textFromEventDict(m)]
+        for i in range(10):
+            self.receive('x')
+        self.assertEqual(len(logged()), 1)
+        self.clock.advance(self.server.dropLogInterval)
+        self.receive('x')
+        self.assertEqual(len(logged()), 2)
+        self.server.dropLogInterval = None
+        self.clock.advance(3600)
+        self.receive('x')
+        self.assertEqual(len(logged()), 2)
+        self.assertEqual(self.server.dropped, {'short': 12})
+
+
+    def test_getStatistics(self):
+        """
+        L{ptcp.PTCP.getStatistics} reports the datagrams and octets the port
+        has sent and received, and totals the counters of its connections.
+        """
+        syn = ptcp.PTCPPacket.create(2, 1, 0, 0, '', syn=True).encode()
+        self.receive(syn)
+        self.receive('x')
+        stats = self.server.getStatistics()
+        self.assertEqual(stats['datagramsReceived'], 2)
+        self.assertEqual(stats['octetsReceived'], len(syn) + 1)
+        self.assertEqual(stats['datagramsSent'], 1)
+        self.assertEqual(stats['octetsSent'],
+                         len(self.wire.datagrams[0].encode()))
+        self.assertEqual(stats['dropped'], {'short': 1})
+        self.assertEqual((stats['connections'], stats['halfOpenConnections']),
+                         (1, 1))
+        self.assertEqual((stats['segmentsReceived'], stats['segmentsSent']),
+                         (1, 1))
+
+
+
+class Requester(TestProtocol):
+    """
+    A protocol which writes a request as soon as it is connected.
+    """
+    def __init__(self, request):
+        TestProtocol.__init__(self)
+        self.request = request
+
+
+    def connectionMade(self):
+        TestProtocol.connectionMade(self)
+        self.transport.write(self.request)
+
+
+
+class FastOpenTests(unittest.TestCase):
+    """
+    Tests for L{ptcp.PTCPConnection.fastOpen}, sending data with the SYN of a
+    connection to a peer we have connected to before.
+    """
+    serverAddress = ('10.0.0.1', 1234)
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.clock.advance(1000)
+        self.patch(ptcp.PTCPConnection, 'fastOpen', True)
+        self.serverProtos = []
+        factory = protocol.ServerFactory()
+        def buildProtocol():
+            self.serverProtos.append(TestProtocol())
+            return self.serverProtos[-1]
+        factory.protocol = buildProtocol
+        self.server = ptcp.PTCP(factory, reactor=self.clock)
+        self.client = ptcp.PTCP(None, reactor=self.clock)
+        self.clientWire = Wire(PEER_ADDRESS, self.server)
+        self.serverWire = Wire(self.serverAddress, self.client)
+        self.client.makeConnection(self.clientWire)
+        self.server.makeConnection(self.serverWire)
+
+
+    def connect(self, request='hello'):
+        """
+        Connect the client to the server, with a protocol which writes
+        C{request} as soon as it is connected.
+
+        @return: The client's protocol.
+        """
+        clientProto = Requester(request)
+        self.failures = []
+        factory = protocol.ClientFactory()
+        factory.protocol = lambda: clientProto
+        factory.clientConnectionFailed = lambda *a: self.failures.append(a)
+        self.client.connect(factory, *self.serverAddress)
+        return clientProto
+
+
+    def syns(self):
+        """
+        Take the SYNs the client has sent so far.
+        """
+        syns = [p for p in self.clientWire.datagrams if p.syn]
+        del self.clientWire.datagrams[:]
+        return syns
+
+
+    def test_cookieIssued(self):
+        """
+        A SYN asks for a fast-open cookie, which the SYN-ACK answering it
+        carries, and which the client remembers for the server's address.
+        The SYN carries no data, since the client had no cookie yet.
+        """
+        self.connect()
+        self.clock.pump([0.01] * 10)
+        [syn] = self.syns()
+        self.assertTrue(syn.ackNum & ptcp._SYN_FAST_OPEN)
+        self.assertEqual((syn.fastOpenCookie, syn.data), (None, ''))
+        [synAck] = [p for p in self.serverWire.datagrams if p.syn]
+        cookie = self.server.issueFastOpenCookie(PEER_ADDRESS[0])
+        self.assertEqual(synAck.fastOpenCookie, cookie)
+        self.assertEqual(self.client.getFastOpenCookie(self.serverAddress),
+                         cookie)
+        self.assertEqual(self.serverProtos[0].buffer, ['hello'])
+
+
+    def test_dataWithSyn(self):
+        """
+        Once the client has a cookie, what its protocol writes when it is
+        connected goes with the SYN, and the server takes it, and tells its
+        protocol about it, without waiting for anything more from the client.
+        """
+        self.connect()
+        self.clock.pump([0.01] * 10)
+        self.syns()
+        self.serverWire.connected = False
+        clientProto = self.connect('again')
+        self.assertEqual(clientProto.transport.machine.isEstablished(), False)
+        self.clock.advance(0)
+        [syn] = self.syns()
+        self.assertEqual(syn.data, 'again')
+        self.assertEqual(syn.fastOpenCookie,
+                         self.server.issueFastOpenCookie(PEER_ADDRESS[0]))
+        self.assertEqual(self.serverProtos[1].buffer, ['again'])
+        serverConn = self.serverProtos[1].transport
+        self.assertTrue(serverConn.machine.isEstablished())
+
+        self.serverWire.connected = True
+        serverConn.write('reply')
+        self.clock.pump([0.01] * 10 + [serverConn.retransmitTimeout] * 2)
+        self.assertTrue(clientProto.transport.machine.isEstablished())
+        self.assertEqual(''.join(clientProto.buffer), 'reply')
+        self.assertEqual(self.serverProtos[1].buffer, ['again'])
+        self.assertEqual(len(self.serverProtos), 2)
+
+
+    def test_badCookie(self):
+        """
+        A SYN with data and a cookie the server didn't issue is answered like
+        any other; the client sends the data again, once, after the
+        handshake.
+        """
+        self.client.setFastOpenCookie(self.serverAddress, 'x' * 8)
+        self.connect()
+        self.clock.advance(0)
+        [syn] = self.syns()
+        self.assertEqual(syn.data, 'hello')
+        self.clock.pump([0.01] * 10)
+        self.assertEqual(self.serverProtos[0].buffer, ['hello'])
+        self.assertEqual([p.data for p in self.syns()], [])
+        self.assertEqual(self.client.getFastOpenCookie(self.serverAddress),
+                         self.server.issueFastOpenCookie(PEER_ADDRESS[0]))
+
+
+    def test_notListening(self):
+        """
+        A server which doesn't use fast open takes none of the data sent with
+        a SYN, and issues no cookie.
+        """
+        self.client.setFastOpenCookie(
+            self.serverAddress,
+            self.server.issueFastOpenCookie(PEER_ADDRESS[0]))
+        self.patch(ptcp.PTCPConnection, 'fastOpen',
+                   property(lambda conn: conn.ptcp is self.client))
+        self.connect()
+        self.clock.advance(0)
+        [syn] = self.syns()
+        self.assertEqual(syn.data, 'hello')
+        self.clock.pump([0.01] * 10)
+        self.assertEqual(self.serverProtos[0].buffer, ['hello'])
+        [synAck] = [p for p in self.serverWire.datagrams if p.syn]
+        self.assertIdentical(synAck.fastOpenCookie, None)
+
+
+    def test_cookieExpires(self):
+        """
+        A cookie older than C{fastOpenCookieLifetime} isn't used.
+        """
+        self.connect()
+        self.clock.pump([0.01] * 10)
+        self.syns()
+        self.clock.advance(self.client.fastOpenCookieLifetime + 1)
+        self.assertIdentical(
+            self.client.getFastOpenCookie(self.serverAddress), None)
+        self.connect()
+        self.clock.advance(0)
+        [syn] = self.syns()
+        self.assertEqual((syn.fastOpenCookie, syn.data), (None, ''))
+
+
+    def test_unanswered(self):
+        """
+        If a fast open's SYN is never answered, the protocol it was opened to
+        early loses its connection.
+        """
+        self.connect()
+        self.clock.pump([0.01] * 10)
+        self.patch(ptcp.PTCPPacket, 'maximumRetransmits', 2)
+        self.clientWire.connected = False
+        clientProto = self.connect()
+        self.assertNotIdentical(clientProto.transport, None)
+        lost = []
+        clientProto.onDisconn.addCallback(lost.append)
+        self.clock.pump([1] * 30)
+        self.assertEqual(lost, [None])
+        self.assertIdentical(clientProto.transport.protocol, None)
+        self.assertEqual(self.failures, [])
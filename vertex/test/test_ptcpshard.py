@@ -0,0 +1,282 @@
+# Copyright 2005 Divmod, Inc.  See LICENSE file for details
+
+"""
+Tests for L{vertex.ptcpshard}.
+"""
+
+import os
+import socket
+import sys
+
+from twisted.internet import defer, protocol, task, reactor
+from twisted.internet.error import ProcessTerminated
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial import unittest
+
+from vertex import ptcpshard
+from vertex.test.test_batchudp import Recorder
+
+
+
+def serverFactory():
+    """
+    Make the factory the workers in L{ShardedPTCPServiceProcessTests} serve.
+    """
+    return protocol.Factory.forProtocol(protocol.Protocol)
+
+
+
+class ShardForTests(unittest.TestCase):
+    """
+    Tests for L{ptcpshard.shardFor}.
+    """
+
+    def test_deterministic(self):
+        """
+        The same address always goes to the same shard, and every shard gets
+        some addresses.
+        """
+        addresses = [('10.0.0.%d' % (i,), 4000 + i * 7) for i in range(64)]
+        shards = [ptcpshard.shardFor(address, 4) for address in addresses]
+        self.assertEqual(
+            shards, [ptcpshard.shardFor(address, 4) for address in addresses])
+        self.assertEqual(set(shards), set(range(4)))
+
+
+    def test_steeringProgram(self):
+        """
+        The steering program is made of whole classic BPF instructions.
+        """
+        self.assertEqual(len(ptcpshard._steeringProgram(4)), 8 * 8)
+
+
+
+class SteeringTests(unittest.TestCase):
+    """
+    Tests for the sockets L{ptcpshard.listenShardedUDP} binds.
+    """
+    if ptcpshard.SO_REUSEPORT is None:
+        skip = "SO_REUSEPORT is not available on this platform."
+
+    def setUp(self):
+        self.recorders = []
+        self.ports = []
+        portNum = 0
+        for shard in range(2):
+            recorder = Recorder()
+            port, steered = ptcpshard.listenShardedUDP(
+                portNum, recorder, 2, interface='127.0.0.1')
+            self.addCleanup(port.stopListening)
+            portNum = port.getHost().port
+            self.recorders.append(recorder)
+            self.ports.append(port)
+        if not steered:
+            raise unittest.SkipTest("The kernel won't steer datagrams.")
+        self.address = ('127.0.0.1', portNum)
+
+
+    def test_sharedPort(self):
+        """
+        Each socket is bound to the same port.
+        """
+        self.assertEqual(
+            set([port.getHost().port for port in self.ports]),
+            set([self.address[1]]))
+
+
+    def test_steered(self):
+        """
+        Datagrams are handed to the socket L{ptcpshard.shardFor} picks for
+        their source address.
+        """
+        expected = {}
+        for i in range(8):
+            peer = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.addCleanup(peer.close)
+            peer.bind(('127.0.0.1', 0))
+            source = peer.getsockname()
+            peer.sendto('hello', self.address)
+            expected[source] = ptcpshard.shardFor(source, 2)
+
+        def received():
+            return sum([len(r.received) for r in self.recorders])
+
+        def check(ignored):
+            for shard, recorder in enumerate(self.recorders):
+                for data, addr in recorder.received:
+                    self.assertEqual(expected[addr], shard)
+
+        d = self._waitFor(lambda: received() == len(expected))
+        d.addCallback(check)
+        return d
+
+
+    def _waitFor(self, condition):
+        d = defer.Deferred()
+        def poll():
+            if condition():
+                call.stop()
+                d.callback(None)
+        call = task.LoopingCall(poll)
+        call.start(0.01)
+        return d
+
+
+
+class ShardedPTCPServiceTests(unittest.TestCase):
+    """
+    Tests for the bookkeeping L{ptcpshard.ShardedPTCPService} does, without
+    any worker processes.
+    """
+
+    def setUp(self):
+        self.service = ptcpshard.ShardedPTCPService(
+            'vertex.test.test_ptcpshard.serverFactory', 0, 2,
+            reactor=task.Clock())
+        self.started = []
+        self.service._startWorker = self.startWorker
+        self.service.startService()
+
+
+    def startWorker(self):
+        monitor = ptcpshard._ShardMonitor(self.service,
+                                          len(self.service._workers))
+        self.service._workers.append(monitor)
+        self.service._starting = monitor
+        self.started.append(monitor)
+
+
+    def test_startedInTurn(self):
+        """
+        Each worker is started once the one before it is listening, on the
+        port the first one bound; once all of them are, L{whenListening}
+        fires with it.
+        """
+        listening = []
+        self.service.whenListening().addCallback(listening.append)
+        [first] = self.started
+        first.shardListening(shard=0, port=1234, steered=True)
+        self.assertEqual(self.service.portNum, 1234)
+        self.assertEqual(len(self.started), 2)
+        self.assertEqual(listening, [])
+        self.started[1].shardListening(shard=1, port=1234, steered=True)
+        self.assertEqual(listening, [1234])
+        self.assertEqual(self.service.shardFor(('10.0.0.1', 5)),
+                         ptcpshard.shardFor(('10.0.0.1', 5), 2))
+
+
+    def test_unsteered(self):
+        """
+        If any worker couldn't install the steering program, there's no
+        telling which worker an address goes to.
+        """
+        self.started[0].shardListening(shard=0, port=1234, steered=True)
+        self.started[1].shardListening(shard=1, port=1234, steered=False)
+        self.assertIdentical(self.service.shardFor(('10.0.0.1', 5)), None)
+
+
+    def test_exitedBeforeListening(self):
+        """
+        If a worker exits before it is listening, L{whenListening} fails.
+        """
+        d = self.service.whenListening()
+        self.started[0].makeConnection(StringTransport())
+        self.started[0].connectionLost(Failure(ProcessTerminated(1)))
+        return self.assertFailure(d, RuntimeError)
+
+
+    def test_exitedAfterListening(self):
+        """
+        If a worker exits once they are all listening, the error is logged,
+        every other worker is stopped, and the service stops.
+        """
+        self.started[0].makeConnection(StringTransport())
+        self.started[0].shardListening(shard=0, port=1234, steered=True)
+        self.started[1].makeConnection(StringTransport())
+        self.started[1].shardListening(shard=1, port=1234, steered=True)
+        self.started[0].connectionLost(Failure(ProcessTerminated(1)))
+        self.assertEqual(len(self.flushLoggedErrors(ProcessTerminated)), 1)
+        self.assertFalse(self.service.running)
+        self.assertTrue(self.started[1].transport.disconnecting)
+        self.started[1].connectionLost(Failure(ProcessTerminated(0)))
+        self.assertEqual(self.flushLoggedErrors(ProcessTerminated), [])
+        return self.assertFailure(self.service.whenListening(), RuntimeError)
+
+
+    def test_workerPath(self):
+        """
+        A worker is started with every entry of our C{sys.path}, made
+        absolute, on its C{PYTHONPATH}.
+        """
+        started = []
+        class Endpoint(object):
+            def __init__(self, reactor, executable, args, env, errFlag):
+                started.append(env)
+            def connect(self, factory):
+                return defer.Deferred()
+        self.patch(ptcpshard.endpoints, 'ProcessEndpoint', Endpoint)
+        self.patch(sys, 'path', ['', 'lib'] + sys.path)
+        service = ptcpshard.ShardedPTCPService(
+            'vertex.test.test_ptcpshard.serverFactory', 0, 2,
+            reactor=task.Clock())
+        service.startService()
+        [env] = started
+        path = env['PYTHONPATH'].split(os.pathsep)
+        self.assertEqual(path[:2], [os.getcwd(),
+                                    os.path.join(os.getcwd(), 'lib')])
+        self.assertEqual(path, [os.path.abspath(entry) for entry in path])
+
+
+    def test_statistics(self):
+        """
+        Each worker's latest statistics are kept, and can be totalled up.
+        """
+        stats = dict(connections=3, halfOpenConnections=1, cookiesIssued=0,
+                     cookiesAccepted=0, connectionsReaped=2,
+                     datagramsPending=5, datagramsDropped=0)
+        self.started[0].shardStatistics(shard=0, **stats)
+        self.started[0].shardListening(shard=0, port=1234, steered=True)
+        self.started[1].shardStatistics(shard=1, **stats)
+        self.assertEqual(self.service.statistics, {0: stats, 1: stats})
+        total = self.service.totalStatistics()
+        self.assertEqual(total['connections'], 6)
+        self.assertEqual(total['datagramsPending'], 10)
+
+
+
+class ShardedPTCPServiceProcessTests(unittest.TestCase):
+    """
+    Tests for L{ptcpshard.ShardedPTCPService} with real worker processes.
+    """
+    if ptcpshard.SO_REUSEPORT is None:
+        skip = "SO_REUSEPORT is not available on this platform."
+
+    def test_workers(self):
+        """
+        Every worker listens on the same port and reports its statistics, and
+        they all exit when the service is stopped.
+        """
+        service = ptcpshard.ShardedPTCPService(
+            'vertex.test.test_ptcpshard.serverFactory', 0, 2,
+            interface='127.0.0.1')
+        service.statisticsInterval = 0.1
+        service.startService()
+
+        def listening(portNum):
+            self.assertNotEqual(portNum, 0)
+            return task.deferLater(reactor, 0.5, lambda: None)
+
+        def reported(ignored):
+            self.assertEqual(sorted(service.statistics), [0, 1])
+            self.assertEqual(service.totalStatistics()['connections'], 0)
+            return service.stopService()
+
+        def stopped(ignored):
+            self.assertEqual(service.statistics, {})
+
+        d = service.whenListening()
+        d.addCallback(listening)
+        d.addCallback(reported)
+        d.addCallback(stopped)
+        return d
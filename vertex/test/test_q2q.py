@@ -10,15 +10,18 @@ from pretend import call
 from cStringIO import StringIO
 
 from twisted.trial import unittest
+from twisted.test.iosim import FakeTransport
+from twisted.test.proto_helpers import MemoryReactorClock
 from twisted.application import service
 from twisted.cred.error import UnauthorizedLogin
 from twisted.internet import reactor, protocol, defer
-from twisted.internet.task import deferLater
+from twisted.internet.task import Clock, deferLater
 from twisted.internet.ssl import DistinguishedName, PrivateCertificate, KeyPair
 from twisted.protocols import basic
 from twisted.python import log
 from twisted.python import failure
 from twisted.internet.error import ConnectionDone
+from twisted.internet.address import IPv4Address
 
 from zope.interface import implements
 from zope.interface.verify import verifyObject
@@ -34,6 +37,8 @@ from ._fakes import (_makeStubTxscrypt,
 
 from vertex import q2q
 from vertex import ivertex
+from vertex.multipath import MultipathTransport
+from vertex.netsim import Network
 
 
 def noResources(*a):
@@ -110,6 +115,270 @@ class UtilityTests(unittest.TestCase):
         self.failUnless(cert.getPublicKey().matches(cert.privateKey))
 
 
+    def test_listenerExpiresOnGivenReactor(self):
+        """
+        A listener mapped by a L{q2q.Q2QService} given a reactor expires two
+        minutes later by that reactor's clock.
+        """
+        clock = Clock()
+        svc = q2q.Q2QService(noResources, reactor=clock)
+        expires, listenerID = svc.mapListener(
+            q2q.Q2QAddress("test.domain", "alice"),
+            q2q.Q2QAddress("test.domain", "bob"),
+            "chat", protocol.ServerFactory())
+        clock.advance(119)
+        self.assertIn(listenerID, svc.inboundConnections)
+        clock.advance(1)
+        self.assertNotIn(listenerID, svc.inboundConnections)
+
+
+    def test_multipathListener(self):
+        """
+        A listener mapped for a multipath stream stays mapped when its
+        connections are retrieved, until as many have been as it was mapped
+        for, and each of them is a subflow of the same stream.
+        """
+        clock = Clock()
+        svc = q2q.Q2QService(noResources, reactor=clock)
+        expires, listenerID = svc.mapListener(
+            q2q.Q2QAddress("test.domain", "alice"),
+            q2q.Q2QAddress("test.domain", "bob"),
+            "chat", protocol.ServerFactory(), multipath=True, joins=2)
+        token = svc.inboundConnections[listenerID][0].token
+        self.assertEqual(len(token), 16)
+        bootstrap = q2q.Q2QBootstrap()
+        bootstrap.service = svc
+        stream = svc.inboundConnections[listenerID][0].multipath
+        first = bootstrap._retrieveConnection(listenerID, token)
+        second = bootstrap._retrieveConnection(listenerID, token)
+        self.assertIsInstance(stream, MultipathTransport)
+        self.assertIdentical(first.subProtocol.multipath, stream)
+        self.assertIdentical(second.subProtocol.multipath, stream)
+        self.assertNotIn(listenerID, svc.inboundConnections)
+        self.assertEqual(clock.getDelayedCalls(), [])
+        self.assertRaises(KeyError, bootstrap._retrieveConnection,
+                          listenerID, token)
+
+
+    def test_multipathListenerExpires(self):
+        """
+        A listener mapped for a multipath stream is unmapped when it expires,
+        even if fewer connections than it was mapped for have been retrieved.
+        """
+        clock = Clock()
+        svc = q2q.Q2QService(noResources, reactor=clock)
+        expires, listenerID = svc.mapListener(
+            q2q.Q2QAddress("test.domain", "alice"),
+            q2q.Q2QAddress("test.domain", "bob"),
+            "chat", protocol.ServerFactory(), multipath=True, joins=3)
+        token = svc.inboundConnections[listenerID][0].token
+        bootstrap = q2q.Q2QBootstrap()
+        bootstrap.service = svc
+        bootstrap._retrieveConnection(listenerID, token)
+        clock.advance(120)
+        self.assertRaises(KeyError, bootstrap._retrieveConnection,
+                          listenerID, token)
+
+
+    def test_multipathListenerToken(self):
+        """
+        A connection to a listener mapped for a multipath stream is only
+        retrieved with the listener's token; without it, the listener is left
+        as it was.
+        """
+        clock = Clock()
+        svc = q2q.Q2QService(noResources, reactor=clock)
+        expires, listenerID = svc.mapListener(
+            q2q.Q2QAddress("test.domain", "alice"),
+            q2q.Q2QAddress("test.domain", "bob"),
+            "chat", protocol.ServerFactory(), multipath=True)
+        waiter = svc.inboundConnections[listenerID]
+        bootstrap = q2q.Q2QBootstrap()
+        bootstrap.service = svc
+        self.assertRaises(KeyError, bootstrap._retrieveConnection, listenerID)
+        self.assertRaises(KeyError, bootstrap._retrieveConnection,
+                          listenerID, '\0' * 16)
+        self.assertEqual(svc.inboundConnections[listenerID], waiter)
+        bootstrap._retrieveConnection(listenerID, waiter[0].token)
+        self.assertNotIn(listenerID, svc.inboundConnections)
+
+
+    def inboundListener(self, multipath):
+        """
+        Answer an inbound request for multipath from a L{q2q.Q2Q} whose
+        service has C{multipath} as given, and which offers only the virtual
+        method.
+
+        @return: The service, and the one listener in the answer.
+        """
+        svc = q2q.Q2QService(noResources, reactor=Clock())
+        svc.multipath = multipath
+        alice = q2q.Q2QAddress("test.domain", "alice")
+        bob = q2q.Q2QAddress("test.domain", "bob")
+        svc.localFactoriesMapping[(bob, "chat")] = [
+            (protocol.ServerFactory(), "chat")]
+        proto = q2q.Q2Q()
+        proto.service = svc
+        proto.makeConnection(FakeTransport(
+                proto, False, hostAddress=IPv4Address('TCP', '10.0.0.1', 8788)))
+        [listener] = proto._inboundimpl(
+            None, alice, bob, "chat", None, True)['listeners']
+        return svc, listener
+
+
+    def test_inboundMultipath(self):
+        """
+        A L{q2q.Q2Q} whose service has C{multipath} set agrees to an inbound
+        request for multipath, giving the listener's token, and maps the
+        listener for as many connections as its methods can make.
+        """
+        svc, listener = self.inboundListener(True)
+        self.assertTrue(listener['multipath'])
+        cwait = svc.inboundConnections[listener['id']][0]
+        self.assertEqual(listener['token'], cwait.token)
+        self.assertEqual(cwait.joins, 1)
+
+
+    def test_inboundMultipathRefused(self):
+        """
+        A L{q2q.Q2Q} whose service doesn't have C{multipath} set answers an
+        inbound request for multipath with an ordinary listener.
+        """
+        svc, listener = self.inboundListener(False)
+        self.assertNotIn('multipath', listener)
+        self.assertNotIn('token', listener)
+        cwait = svc.inboundConnections[listener['id']][0]
+        self.assertIdentical(cwait.multipath, None)
+
+
+    def test_multipathAttempts(self):
+        """
+        In multipath mode, L{q2q.Q2Q.attemptConnectionMethods} gives the
+        protocol as soon as one attempt succeeds, and every attempt which
+        succeeds after it joins the same stream; only those which fail are
+        cancelled.
+        """
+        class Attempt(object):
+            cancelled = False
+            def __init__(self, method, q2qproto, connectionID, From, to,
+                         protocolName, protocolFactory):
+                self.protocolFactory = protocolFactory
+                self.deferred = defer.Deferred()
+            def startAttempt(self):
+                return self.deferred
+            def succeed(self):
+                subflow = self.protocolFactory.buildProtocol(None)
+                connection = q2q.SeparateConnectionTransport(
+                    svc, subflow, alice, bob, "chat")
+                connection.makeConnection(FakeTransport(connection, False))
+                self.deferred.callback(connection)
+            def cancel(self):
+                self.cancelled = True
+
+        class Method(object):
+            def attempt(self, *a):
+                self.attempt = Attempt(self, *a)
+                return [self.attempt]
+
+        svc = q2q.Q2QService(noResources)
+        alice = q2q.Q2QAddress("test.domain", "alice")
+        bob = q2q.Q2QAddress("test.domain", "bob")
+        methods = [Method(), Method(), Method()]
+        clientProto = protocol.Protocol()
+        factory = protocol.ClientFactory()
+        factory.protocol = lambda: clientProto
+        connected = q2q.Q2Q().attemptConnectionMethods(
+            methods, "id", alice, bob, "chat", factory, multipath=True)
+        methods[0].attempt.succeed()
+        self.assertIdentical(self.successResultOf(connected), clientProto)
+        methods[1].attempt.succeed()
+        methods[2].attempt.deferred.errback(ConnectionDone())
+        stream = clientProto.transport
+        self.assertIsInstance(stream, MultipathTransport)
+        self.assertEqual(len(stream.subflows), 2)
+        self.assertEqual([method.attempt.cancelled for method in methods],
+                         [False, False, True])
+
+
+    def test_tcpAttemptOnGivenReactor(self):
+        """
+        A L{q2q.TCPMethod}'s connection attempt connects with the reactor of
+        the L{q2q.Q2QService} making it.
+        """
+        clock = MemoryReactorClock()
+        proto = q2q.Q2Q()
+        proto.service = q2q.Q2QService(noResources, reactor=clock)
+        [attempt] = q2q.TCPMethod('10.0.0.2:1234').attempt(
+            proto, "id", q2q.Q2QAddress("test.domain", "alice"),
+            q2q.Q2QAddress("test.domain", "bob"), "chat",
+            protocol.ClientFactory())
+        attempt.startAttempt()
+        [(host, port, factory, timeout, bindAddress)] = clock.tcpClients
+        self.assertEqual((host, port), ('10.0.0.2', 1234))
+        self.assertIdentical(factory, attempt)
+
+
+    def test_certificateRetrievedOnGivenReactor(self):
+        """
+        A foreign domain's certificate is retrieved over a connection made
+        with the reactor of the L{q2q.Q2QService}.
+        """
+        clock = MemoryReactorClock()
+        proto = q2q.Q2Q()
+        proto.service = q2q.Q2QService(noResources, reactor=clock)
+        proto.wrapper = None
+        proto._retrieveRemoteCertificate(
+            q2q.Q2QAddress("other.domain", "alice"), 1234)
+        [(host, port, factory, timeout, bindAddress)] = clock.tcpClients
+        self.assertEqual((host, port), ('other.domain', 1234))
+
+
+    def test_dispatcherOnGivenReactor(self):
+        """
+        L{q2q.PTCPConnectionDispatcher} binds its PTCP ports with the reactor
+        it is given, and their connections keep time by it.
+        """
+        network = Network()
+        dispatcher = q2q.PTCPConnectionDispatcher(None, network)
+        portNum = dispatcher.bindNewPort(iface='10.0.0.1')
+        port, proto = dispatcher._ports[portNum]
+        self.assertIdentical(port.protocol, proto)
+        self.assertEqual(port.getHost().host, '10.0.0.1')
+        self.assertIdentical(proto._reactor, network)
+
+
+    def test_dispatcherUnbatched(self):
+        """
+        The PTCP ports of a L{q2q.PTCPConnectionDispatcher} created with
+        C{batching} off don't batch what they send.
+        """
+        network = Network()
+        dispatcher = q2q.PTCPConnectionDispatcher(None, network, batching=False)
+        portNum = dispatcher.bindNewPort(iface='10.0.0.1')
+        port, proto = dispatcher._ports[portNum]
+        self.assertFalse(proto.batching)
+
+
+    def test_dispatcherStatistics(self):
+        """
+        L{q2q.PTCPConnectionDispatcher.getStatistics} totals the statistics
+        of all of its PTCP ports.
+        """
+        network = Network()
+        dispatcher = q2q.PTCPConnectionDispatcher(None, network)
+        first = dispatcher.bindNewPort(iface='10.0.0.1')
+        second = dispatcher.bindNewPort(iface='10.0.0.1')
+        sender = network.listenUDP(0, protocol.DatagramProtocol(), '10.0.0.2')
+        sender.write('x', ('10.0.0.1', first))
+        sender.write('y', ('10.0.0.1', second))
+        sender.write('z', ('10.0.0.1', second))
+        network.advance(0)
+        stats = dispatcher.getStatistics()
+        self.assertEqual(stats['ports'], 2)
+        self.assertEqual(stats['datagramsReceived'], 3)
+        self.assertEqual(stats['dropped'], {'short': 3})
+
+
 
 class OneTrickPony(AMP):
     def amp_TRICK(self, box):
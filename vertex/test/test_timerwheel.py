@@ -0,0 +1,191 @@
+# Copyright 2005 Divmod, Inc.  See LICENSE file for details
+
+"""
+Tests for L{vertex.timerwheel}.
+"""
+
+from zope.interface.verify import verifyObject
+
+from twisted.internet import task
+from twisted.internet.error import AlreadyCalled, AlreadyCancelled
+from twisted.internet.interfaces import IDelayedCall
+from twisted.trial import unittest
+
+from vertex.timerwheel import TimerWheel
+
+
+
+class TimerWheelTests(unittest.TestCase):
+    """
+    Tests for L{TimerWheel}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.clock.advance(1000)
+        self.wheel = TimerWheel(self.clock, granularity=0.01)
+        self.called = []
+
+
+    def test_interface(self):
+        """
+        L{TimerWheel.callLater} returns an L{IDelayedCall} provider.
+        """
+        timer = self.wheel.callLater(1, self.called.append, 1)
+        self.assertTrue(verifyObject(IDelayedCall, timer))
+        self.assertEqual(timer.getTime(), 1001)
+        self.assertTrue(timer.active())
+
+
+    def test_callLater(self):
+        """
+        A timer goes off on the first tick at least as far away as its delay,
+        with the arguments it was armed with.
+        """
+        timer = self.wheel.callLater(0.105, self.called.append, 'x')
+        self.clock.advance(0.1)
+        self.assertEqual(self.called, [])
+        self.clock.advance(0.01)
+        self.assertEqual(self.called, ['x'])
+        self.assertTrue(timer.called)
+        self.assertFalse(timer.active())
+        self.assertRaises(AlreadyCalled, timer.cancel)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_order(self):
+        """
+        Timers which go off on the same tick do so in the order they were due,
+        and in the order they were armed if they were due at the same time.
+        """
+        self.wheel.callLater(0.008, self.called.append, 'c')
+        self.wheel.callLater(0.005, self.called.append, 'a')
+        self.wheel.callLater(0.005, self.called.append, 'b')
+        self.wheel.callLater(0.02, self.called.append, 'd')
+        self.clock.pump([0.01, 0.01])
+        self.assertEqual(self.called, ['a', 'b', 'c', 'd'])
+
+
+    def test_oneDelayedCall(self):
+        """
+        However many timers are armed, the wheel only needs one delayed call
+        from its reactor, and none once they have all gone off.
+        """
+        for i in range(1000):
+            self.wheel.callLater(i * 0.37, self.called.append, i)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.assertEqual(len(self.wheel.getDelayedCalls()), 1000)
+        self.clock.pump([0.37] * 1000)
+        self.assertEqual(self.called, range(1000))
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_distant(self):
+        """
+        Timers further away than the wheel's top level reaches still go off
+        when they are due, without the wheel being turned on every tick in the
+        meantime.
+        """
+        turns = []
+        turn = self.wheel._turn
+        def countingTurn():
+            turns.append(self.clock.seconds())
+            turn()
+        self.wheel._turn = countingTurn
+        self.wheel.callLater(3 * 24 * 60 * 60, self.called.append, 'late')
+        self.wheel.callLater(90, self.called.append, 'soon')
+        self.clock.advance(89.99)
+        self.assertEqual(self.called, [])
+        self.clock.advance(0.01)
+        self.assertEqual(self.called, ['soon'])
+        while self.clock.getDelayedCalls():
+            self.clock.advance(
+                self.clock.getDelayedCalls()[0].getTime() - self.clock.seconds())
+        self.assertEqual(self.called, ['soon', 'late'])
+        self.assertEqual(self.clock.seconds(), 1000 + 3 * 24 * 60 * 60)
+        self.assertTrue(len(turns) < 100)
+
+
+    def test_cancel(self):
+        """
+        A cancelled timer doesn't go off, and once nothing is left on the
+        wheel, the reactor isn't asked to turn it either.
+        """
+        timer = self.wheel.callLater(1, self.called.append, 'x')
+        timer.cancel()
+        self.assertFalse(timer.active())
+        self.assertRaises(AlreadyCancelled, timer.cancel)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.clock.advance(2)
+        self.assertEqual(self.called, [])
+
+
+    def test_reset(self):
+        """
+        A timer can be reset to go off sooner or later than it would have.
+        """
+        later = self.wheel.callLater(1, self.called.append, 'later')
+        sooner = self.wheel.callLater(1, self.called.append, 'sooner')
+        later.reset(5)
+        sooner.reset(0.5)
+        self.clock.advance(0.5)
+        self.assertEqual(self.called, ['sooner'])
+        self.clock.advance(4)
+        self.assertEqual(self.called, ['sooner'])
+        self.clock.advance(0.5)
+        self.assertEqual(self.called, ['sooner', 'later'])
+
+
+    def test_delay(self):
+        """
+        A timer can be put off.
+        """
+        timer = self.wheel.callLater(1, self.called.append, 'x')
+        timer.delay(2)
+        self.assertEqual(timer.getTime(), 1003)
+        self.clock.advance(2)
+        self.assertEqual(self.called, [])
+        self.clock.advance(1)
+        self.assertEqual(self.called, ['x'])
+
+
+    def test_cancelledByEarlier(self):
+        """
+        A timer which goes off can cancel or reset another which would have
+        gone off on the same tick.
+        """
+        def cancelOthers():
+            cancelled.cancel()
+            reset.reset(1)
+        self.wheel.callLater(0.001, cancelOthers)
+        cancelled = self.wheel.callLater(0.002, self.called.append, 'x')
+        reset = self.wheel.callLater(0.002, self.called.append, 'y')
+        self.clock.advance(0.01)
+        self.assertEqual(self.called, [])
+        self.clock.advance(1)
+        self.assertEqual(self.called, ['y'])
+
+
+    def test_armedWhileTurning(self):
+        """
+        A timer armed by another as it goes off goes off on a later tick.
+        """
+        self.wheel.callLater(
+            0.01, self.wheel.callLater, 0, self.called.append, 'x')
+        self.clock.advance(0.01)
+        self.assertEqual(self.called, [])
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.clock.advance(0.01)
+        self.assertEqual(self.called, ['x'])
+
+
+    def test_error(self):
+        """
+        An exception raised by a timer is logged, and doesn't stop the others
+        due on the same tick from going off.
+        """
+        self.wheel.callLater(0.01, lambda: 1 / 0)
+        self.wheel.callLater(0.01, self.called.append, 'x')
+        self.clock.advance(0.01)
+        self.assertEqual(self.called, ['x'])
+        self.assertEqual(len(self.flushLoggedErrors(ZeroDivisionError)), 1)
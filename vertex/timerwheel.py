@@ -0,0 +1,316 @@
+# -*- test-case-name: vertex.test.test_timerwheel -*-
+# Copyright 2005 Divmod, Inc.  See LICENSE file for details
+
+"""
+A hierarchical timing wheel, for when there are far too many timers to give
+each of them a delayed call of its own.
+
+Timers are kept in buckets according to the tick of the wheel they are due
+on, so that arming, resetting and cancelling them costs the same however many
+there are; the wheel itself needs only one delayed call from the reactor, for
+the next tick on which there is something to do.  The price is precision:
+timers go off on the first tick after they are due, rather than exactly when
+they are due.
+"""
+
+import math
+import itertools
+
+from zope.interface import implementer
+
+from twisted.internet.interfaces import IDelayedCall
+from twisted.internet.error import AlreadyCalled, AlreadyCancelled
+from twisted.python import log
+
+
+
+@implementer(IDelayedCall)
+class _WheelTimer(object):
+    """
+    A timer armed on a L{TimerWheel}; it can be used just like the
+    L{IDelayedCall} the reactor's C{callLater} would have returned.
+
+    @ivar time: The time the timer is due, in seconds since the epoch.
+
+    @ivar _due: The tick of the wheel the timer will go off on.
+
+    @ivar _sequence: The order the timer was armed in, relative to the
+        others on the same wheel; timers due at the same time go off in this
+        order.
+
+    @ivar _slot: The C{set} the timer is in on its wheel, or C{None} if it is
+        about to go off, has gone off, or has been cancelled.
+    """
+    called = False
+    cancelled = False
+    _slot = None
+
+    def __init__(self, wheel, time, f, args, kw):
+        self._wheel = wheel
+        self.time = time
+        self.f = f
+        self.args = args
+        self.kw = kw
+
+
+    def getTime(self):
+        return self.time
+
+
+    def _checkActive(self):
+        if self.cancelled:
+            raise AlreadyCancelled()
+        if self.called:
+            raise AlreadyCalled()
+
+
+    def cancel(self):
+        self._checkActive()
+        self.cancelled = True
+        self._wheel._remove(self)
+
+
+    def reset(self, secondsFromNow):
+        self._checkActive()
+        self.time = self._wheel._reactor.seconds() + secondsFromNow
+        self._wheel._move(self)
+
+
+    def delay(self, secondsLater):
+        self._checkActive()
+        self.time += secondsLater
+        self._wheel._move(self)
+
+
+    def active(self):
+        return not (self.called or self.cancelled)
+
+
+    def __repr__(self):
+        return '<_WheelTimer %r at %s>' % (self.f, self.time)
+
+
+
+class TimerWheel(object):
+    """
+    A hierarchical timing wheel (after Varghese and Lauck), with
+    C{levelCount} levels of C{2 ** slotBits} slots each.
+
+    A slot on the first level holds the timers due on one tick; a slot on
+    each level above holds the timers due in a whole revolution of the level
+    below, and is emptied into that level when the wheel gets round to it.
+    Timers further away than the top level reaches wait in its furthest slot
+    and are put back as the wheel turns.
+
+    @ivar granularity: The length of a tick, in seconds.
+
+    @ivar _reactor: The L{IReactorTime} provider which drives the wheel.
+
+    @ivar _levels: A C{list} of levels, each a C{list} of slots, each a
+        C{set} of L{_WheelTimer}s.
+
+    @ivar _tick: The last tick whose timers have gone off.
+
+    @ivar _count: The number of timers still to go off.
+
+    @ivar _ticker: C{None}, or the L{IDelayedCall} which will turn the wheel
+        to C{_tickerDue}.
+
+    @ivar _running: Whether the wheel is being turned right now, in which case
+        there's no point in arming C{_ticker} until it's done.
+    """
+    slotBits = 6
+    levelCount = 4
+
+    _ticker = None
+    _tickerDue = None
+    _running = False
+
+    def __init__(self, reactor, granularity=0.001):
+        """
+        @param reactor: The L{IReactorTime} provider to turn the wheel with.
+
+        @param granularity: The length of a tick, in seconds.
+        """
+        self._reactor = reactor
+        self.granularity = granularity
+        self._levels = [[set() for slot in range(1 << self.slotBits)]
+                        for level in range(self.levelCount)]
+        self._tick = self._currentTick()
+        self._count = 0
+        self._sequence = itertools.count()
+
+
+    def callLater(self, delay, f, *args, **kw):
+        """
+        Arrange for C{f(*args, **kw)} to be called on the first tick at least
+        C{delay} seconds from now.
+
+        @return: An L{IDelayedCall} provider for the timer.
+        """
+        timer = _WheelTimer(self, self._reactor.seconds() + delay, f, args, kw)
+        if not self._count:
+            # Nothing has been turning the wheel; catch it up with the clock.
+            self._tick = max(self._tick, self._currentTick())
+        self._count += 1
+        self._place(timer)
+        return timer
+
+
+    def getDelayedCalls(self):
+        """
+        @return: A C{list} of all the timers still to go off.
+        """
+        return [timer for level in self._levels for slot in level
+                for timer in slot]
+
+
+    def _currentTick(self):
+        return int(self._reactor.seconds() / self.granularity)
+
+
+    def _place(self, timer):
+        """
+        Put a new or reset timer in the slot it belongs in, and make sure the
+        wheel will be turned in time for it.
+        """
+        timer._due = max(int(math.ceil(timer.time / self.granularity)),
+                         self._tick + 1)
+        timer._sequence = next(self._sequence)
+        self._schedule(self._slot(timer))
+
+
+    def _slot(self, timer):
+        """
+        Put a timer in the slot it belongs in, relative to the current tick.
+
+        @return: The tick the wheel has to be turned to for the timer to go
+            off, or to move down to the first level.
+        """
+        bits = self.slotBits
+        top = self.levelCount - 1
+        due = min(timer._due, self._tick + (1 << (bits * (top + 1))) - 1)
+        delta = due - self._tick
+        level = 0
+        while level < top and delta >> (bits * (level + 1)):
+            level += 1
+        shift = bits * level
+        slot = self._levels[level][(due >> shift) & ((1 << bits) - 1)]
+        slot.add(timer)
+        timer._slot = slot
+        return (due >> shift) << shift
+
+
+    def _move(self, timer):
+        """
+        A timer has been reset; move it to its new slot.
+        """
+        if timer._slot is not None:
+            timer._slot.discard(timer)
+            timer._slot = None
+        self._place(timer)
+
+
+    def _remove(self, timer):
+        """
+        A timer has been cancelled; forget about it.
+        """
+        if timer._slot is not None:
+            timer._slot.discard(timer)
+            timer._slot = None
+        self._count -= 1
+        if not self._count and self._ticker is not None:
+            self._ticker.cancel()
+            self._ticker = None
+
+
+    def _schedule(self, tick):
+        """
+        Make sure the wheel will be turned to C{tick} no later than it is
+        due.
+        """
+        if self._running:
+            return
+        delay = max(0, tick * self.granularity - self._reactor.seconds())
+        if self._ticker is None:
+            self._ticker = self._reactor.callLater(delay, self._turn)
+            self._tickerDue = tick
+        elif tick < self._tickerDue:
+            self._ticker.reset(delay)
+            self._tickerDue = tick
+
+
+    def _nextTick(self):
+        """
+        Find the next tick on which there is something to do: either timers
+        to go off, or timers to move down a level.
+
+        @return: The tick, or C{None} if there are no timers at all.
+        """
+        bits = self.slotBits
+        mask = (1 << bits) - 1
+        nextTick = None
+        for level, slots in enumerate(self._levels):
+            shift = bits * level
+            current = self._tick >> shift
+            for index in range(current + 1, current + mask + 2):
+                if slots[index & mask]:
+                    tick = index << shift
+                    if nextTick is None or tick < nextTick:
+                        nextTick = tick
+                    break
+        return nextTick
+
+
+    def _turn(self):
+        """
+        Turn the wheel up to the current tick, moving timers down levels and
+        calling those which are due as it goes.
+        """
+        self._ticker = None
+        now = max(self._currentTick(), self._tickerDue)
+        self._running = True
+        try:
+            while True:
+                tick = self._nextTick()
+                if tick is None or tick > now:
+                    break
+                self._tick = tick
+                self._cascade()
+                slot = self._levels[0][tick & ((1 << self.slotBits) - 1)]
+                due = sorted(slot, key=lambda t: (t.time, t._sequence))
+                slot.clear()
+                for timer in due:
+                    timer._slot = None
+                for timer in due:
+                    # An earlier timer may have cancelled or reset this one.
+                    if timer.cancelled or timer._slot is not None:
+                        continue
+                    timer.called = True
+                    self._count -= 1
+                    try:
+                        timer.f(*timer.args, **timer.kw)
+                    except:
+                        log.err()
+        finally:
+            self._running = False
+        if self._count:
+            self._schedule(self._nextTick())
+
+
+    def _cascade(self):
+        """
+        The wheel has just been turned to a new tick; move the timers from any
+        higher-level slot which has come round down to the levels below.
+        """
+        bits = self.slotBits
+        for level in range(1, self.levelCount):
+            shift = bits * level
+            if self._tick & ((1 << shift) - 1):
+                break
+            slot = self._levels[level][(self._tick >> shift)
+                                       & ((1 << bits) - 1)]
+            timers = list(slot)
+            slot.clear()
+            for timer in timers:
+                self._slot(timer)